@@ -1,4 +1,6 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, g, session
+from flask import (
+    Flask, Response, render_template, request, jsonify, redirect, url_for, g, session, stream_with_context
+)
 from flask_login import (
     LoginManager, login_user, logout_user, login_required, current_user
 )
@@ -6,26 +8,42 @@ from flask_wtf import CSRFProtect
 from flask_wtf.csrf import CSRFError
 from werkzeug.exceptions import HTTPException
 from werkzeug.middleware.proxy_fix import ProxyFix
+import hmac
 import os
 import secrets
+import threading
 import time
 import numpy as np
 from PIL import Image, UnidentifiedImageError
 from werkzeug.utils import secure_filename
+from markupsafe import escape
 from werkzeug.security import check_password_hash
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from medical_analyzer import MedicalAnalyzer
 from symptom_checker import SymptomChecker
+from conversation import (ConversationService, FollowUpInterrupted, FollowUpUnavailable, CONTEXT_WINDOW_TURNS,
+                          history_from_turns)
+from follow_up_intents import match_intent
+from bulkhead import gemini_bulkhead
+from history_writer import history_writer
+import password_hashing
+from maintenance import periodic_jobs
+import model_router
 from dotenv import load_dotenv
 import database as db
+import ratelimit_storage  # noqa: F401 - registers the sqlite:// rate-limit storage
 from auth import login_manager, User
 from logging_config import get_logger
+import mailer
 from mailer import send_email
+import history_export
 from two_factor import generate_secret, provisioning_uri, verify_code as verify_totp_code, qr_code_data_uri
-from oauth import init_oauth, oauth, is_google_oauth_configured
+from oauth import (init_oauth, oauth, is_google_oauth_configured, refresh_google_metadata,
+                   google_metadata_stats)
 import json
 import re
+from functools import wraps
 
 load_dotenv()
 
@@ -112,26 +130,68 @@ def handle_csrf_error(e):
 # should never be gated behind a login wall.
 login_manager.init_app(app)
 
+# Views marked @db.unit_of_work run all their database calls in a single
+# transaction, committed once the response is ready (see database.py).
+db.init_request_sessions(app)
+
 # Optional Google OAuth/SSO - only registers if GOOGLE_CLIENT_ID/SECRET are
 # set (see oauth.py); templates hide the "Continue with Google" button when
 # it isn't, so this is safe to always call.
 init_oauth(app)
 
+# Periodic housekeeping (see maintenance.py). Used and expired reset /
+# verification tokens are deleted in small batches so user_tokens doesn't
+# grow forever. The scheduler thread is started lazily by the first request
+# each worker serves, so it exists in the worker and not just the
+# pre-fork master.
+TOKEN_COMPACT_INTERVAL_SECONDS = int(os.getenv('TOKEN_COMPACT_INTERVAL_SECONDS', '3600'))
+periodic_jobs.register('compact_tokens', db.compact_tokens, TOKEN_COMPACT_INTERVAL_SECONDS)
+# Account deletion and history clearing only tombstone the data; this
+# deletes it in short batches afterwards (see "Deferred deletion" in
+# database.py).
+DELETION_INTERVAL_SECONDS = int(os.getenv('DELETION_INTERVAL_SECONDS', '30'))
+periodic_jobs.register('purge_deleted', db.purge_deleted, DELETION_INTERVAL_SECONDS)
+# Moves old history into compressed archive blocks (see "History archive"
+# in database.py); off unless HISTORY_ARCHIVE_AFTER_DAYS is set.
+HISTORY_ARCHIVE_INTERVAL_SECONDS = int(os.getenv('HISTORY_ARCHIVE_INTERVAL_SECONDS', '86400'))
+if db.HISTORY_ARCHIVE_AFTER_DAYS > 0:
+    periodic_jobs.register('archive_history', db.archive_history, HISTORY_ARCHIVE_INTERVAL_SECONDS)
+# Account emails are only queued by the request that triggers them; this
+# sends them (see mailer.py), and drops delivered ones after
+# EMAIL_OUTBOX_KEEP_DAYS.
+EMAIL_OUTBOX_INTERVAL_SECONDS = float(os.getenv('EMAIL_OUTBOX_INTERVAL_SECONDS', '2'))
+periodic_jobs.register('deliver_email', mailer.deliver_outbox, EMAIL_OUTBOX_INTERVAL_SECONDS)
+periodic_jobs.register('purge_sent_email', db.purge_sent_emails, 3600)
+# Google's OIDC discovery document and signing keys (see oidc_cache.py):
+# fetched in the background as each worker starts serving rather than on a
+# user's first Google sign-in, then kept fresh.
+OIDC_REFRESH_INTERVAL_SECONDS = float(os.getenv('OIDC_REFRESH_INTERVAL_SECONDS', '60'))
+if is_google_oauth_configured():
+    periodic_jobs.register('refresh_oidc_metadata', refresh_google_metadata, OIDC_REFRESH_INTERVAL_SECONDS,
+                           run_at_start=True)
+
+
+@app.before_request
+def _start_periodic_jobs():
+    periodic_jobs.ensure_started()
+
 # Rate limiting: protects the Gemini-backed endpoints from abuse/quota burn,
 # and login/register from brute-force/enumeration attempts.
-# Storage backend is configurable via RATELIMIT_STORAGE_URI. Defaults to
-# in-memory, which is fine for a single dev process but does NOT share
-# limit state across multiple gunicorn workers/instances - each process
-# gets its own counters, so real limits end up (workers x configured limit).
-# For any multi-worker or multi-instance deployment, point this at Redis:
+# Storage backend is configurable via RATELIMIT_STORAGE_URI. By default the
+# counters live in a SQLite file next to the database
+# (<DATABASE_PATH>.ratelimits, see ratelimit_storage.py), shared by every
+# gunicorn worker on this host, so a limit means the same with -w 2 as with
+# one process. `memory://` gives each process its own counters - real
+# limits end up (workers x configured limit) - and is only fine for a
+# single dev process. Deployments spread over several hosts need Redis:
 #   RATELIMIT_STORAGE_URI=redis://localhost:6379
 # (requires the `redis` package - see requirements.txt)
-_ratelimit_storage_uri = os.getenv('RATELIMIT_STORAGE_URI', 'memory://')
+_ratelimit_storage_uri = os.getenv('RATELIMIT_STORAGE_URI') or 'sqlite:///' + os.path.abspath(db.DB_PATH + '.ratelimits')
 if _ratelimit_storage_uri == 'memory://':
     logger.warning(
         "Rate limiter using in-memory storage - limits are per-process only. "
-        "Set RATELIMIT_STORAGE_URI (e.g. to a Redis URL) before running with "
-        "more than one worker/instance."
+        "Leave RATELIMIT_STORAGE_URI unset (or point it at Redis) before "
+        "running with more than one worker."
     )
 limiter = Limiter(
     key_func=get_remote_address,
@@ -144,6 +204,9 @@ limiter = Limiter(
 MAX_SYMPTOM_LENGTH = 1000
 MIN_SYMPTOM_LENGTH = 3
 
+# Follow-up question constraints
+MAX_FOLLOW_UP_LENGTH = 500
+
 # Account constraints
 USERNAME_RE = re.compile(r'^[A-Za-z0-9_]{3,30}$')
 MIN_PASSWORD_LENGTH = 8
@@ -173,6 +236,7 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # Initialize medical analyzer and symptom checker
 medical_analyzer = MedicalAnalyzer()
 symptom_checker = SymptomChecker()
+conversation_service = ConversationService()
 
 # Initialize database (SQLite file, created on first run)
 db.init_db()
@@ -252,6 +316,23 @@ def _set_security_headers(response):
     return response
 
 
+# Forms that hash a password re-render with an error when hashing is
+# overloaded (see password_hashing.py); anything else gets JSON.
+_HASHING_BUSY_TEMPLATES = {'login': 'login.html', 'register': 'register.html'}
+
+
+@app.errorhandler(password_hashing.PasswordHashingBusy)
+def handle_hashing_busy(e):
+    logger.warning("Password hashing overloaded - turned away %s %s", request.method, request.path)
+    message = 'Too many sign-in requests right now. Please try again in a few seconds.'
+    headers = {'Retry-After': '5'}
+    template = _HASHING_BUSY_TEMPLATES.get(request.endpoint)
+    if template:
+        return render_template(template, error=message,
+                               google_oauth_enabled=is_google_oauth_configured()), 503, headers
+    return jsonify({'error': message}), 503, headers
+
+
 @app.errorhandler(Exception)
 def handle_unexpected_error(e):
     # Let Flask/Werkzeug's own HTTP exceptions (404, 405, our jsonify'd 400s,
@@ -356,6 +437,13 @@ def health():
         'status': 'ok' if db_ok else 'degraded',
         'database': 'ok' if db_ok else 'unreachable',
         'gemini_configured': medical_analyzer.use_gemini,
+        'gemini_bulkhead': gemini_bulkhead.stats(),
+        'gemini_latency': model_router.latency_stats(),
+        'history_writer': history_writer.stats(),
+        'password_hashing': password_hashing.stats(),
+        'periodic_jobs': periodic_jobs.stats(),
+        'email_outbox': db.outbox_stats() if db_ok else None,
+        'google_oidc': google_metadata_stats(),
     }
     return jsonify(status), (200 if db_ok else 503)
 
@@ -387,6 +475,7 @@ def _safe_next_path(next_page):
 
 @app.route('/register', methods=['GET', 'POST'])
 @limiter.limit("5 per minute")
+@db.unit_of_work
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -537,6 +626,7 @@ def forgot_password():
 
 @app.route('/reset-password/<token>', methods=['GET', 'POST'])
 @limiter.limit("10 per minute")
+@db.unit_of_work
 def reset_password(token):
     token_row = db.get_valid_token(token, 'password_reset')
     if not token_row:
@@ -556,27 +646,29 @@ def reset_password(token):
     if password != confirm:
         return render_template('reset_password.html', token=token, error='Passwords do not match.'), 400
 
-    # Re-check validity right before committing (belt-and-suspenders against
-    # a token expiring or being used elsewhere between GET and this POST).
-    token_row = db.get_valid_token(token, 'password_reset')
-    if not token_row:
+    # Hash before the first write: from there on the request holds the
+    # write lock (see "Request-scoped unit of work" in database.py).
+    password_hash = password_hashing.hash_password(password)
+    # Using the token up is the first write, and only succeeds once - so a
+    # token used elsewhere since the lookup above can't set a password.
+    if not db.consume_token(token_row['id']):
         return render_template('reset_password.html', invalid=True), 400
-
-    db.set_password(token_row['user_id'], password)
-    db.consume_token(token_row['id'])
+    db.set_password_hash(token_row['user_id'], password_hash)
     logger.info("Password reset completed for user_id=%s", token_row['user_id'])
     return render_template('reset_password.html', done=True)
 
 
 @app.route('/verify-email/<token>')
 @limiter.limit("20 per minute")
+@db.unit_of_work
 def verify_email(token):
     token_row = db.get_valid_token(token, 'email_verify')
     if not token_row:
         return render_template('verify_email.html', invalid=True), 400
 
+    if not db.consume_token(token_row['id']):
+        return render_template('verify_email.html', invalid=True), 400
     db.set_email_verified(token_row['user_id'])
-    db.consume_token(token_row['id'])
     logger.info("Email verified for user_id=%s", token_row['user_id'])
     return render_template('verify_email.html', done=True)
 
@@ -596,6 +688,7 @@ def login_google():
 
 @app.route('/login/google/callback')
 @limiter.limit("15 per minute")
+@db.unit_of_work
 def login_google_callback():
     if not is_google_oauth_configured():
         return redirect(url_for('login'))
@@ -656,6 +749,7 @@ def account():
 @app.route('/account/profile', methods=['POST'])
 @login_required
 @limiter.limit("10 per minute")
+@db.unit_of_work
 def update_profile():
     user_id = int(current_user.id)
     user_row = db.get_user_by_id(user_id)
@@ -674,16 +768,14 @@ def update_profile():
     if user_row['has_password'] and not db.verify_password(user_row, current_password):
         return _account_error('Current password is incorrect.')
 
-    if username != user_row['username'] and db.username_taken(username, exclude_user_id=user_id):
+    # Checked and changed in one write, so a concurrent signup can't take
+    # the name or address between the check and the update.
+    taken = db.update_profile(user_id, username, email)
+    if taken == 'username':
         return _account_error('That username is already taken.')
-    if email != user_row['email'] and db.email_taken(email, exclude_user_id=user_id):
+    if taken == 'email':
         return _account_error('That email is already in use.')
-
-    if username != user_row['username']:
-        db.update_username(user_id, username)
     email_changed = email != user_row['email']
-    if email_changed:
-        db.update_email(user_id, email)
 
     updated_row = db.get_user_by_id(user_id)
     if email_changed:
@@ -696,6 +788,7 @@ def update_profile():
 @app.route('/account/password', methods=['POST'])
 @login_required
 @limiter.limit("5 per minute")
+@db.unit_of_work
 def update_password():
     user_id = int(current_user.id)
     user_row = db.get_user_by_id(user_id)
@@ -734,6 +827,7 @@ def resend_verification():
 @app.route('/account/delete', methods=['POST'])
 @login_required
 @limiter.limit("5 per minute")
+@db.unit_of_work
 def delete_account():
     user_id = int(current_user.id)
     user_row = db.get_user_by_id(user_id)
@@ -748,6 +842,9 @@ def delete_account():
     username = user_row['username']
     logout_user()
     session.clear()
+    # Before the delete: dropping cached contexts calls Gemini, and after
+    # delete_user() this request holds the database's write lock.
+    conversation_service.forget_cached_contexts(user_id)
     db.delete_user(user_id)
     logger.info("Account deleted: user_id=%s username=%s", user_id, username)
     return redirect(url_for('index'))
@@ -770,6 +867,7 @@ def setup_2fa():
 @app.route('/account/2fa/confirm', methods=['POST'])
 @login_required
 @limiter.limit("10 per minute")
+@db.unit_of_work
 def confirm_2fa():
     secret = session.get('pending_totp_secret')
     code = (request.form.get('code') or '').strip()
@@ -799,6 +897,7 @@ def confirm_2fa():
 @app.route('/account/2fa/disable', methods=['POST'])
 @login_required
 @limiter.limit("5 per minute")
+@db.unit_of_work
 def disable_2fa():
     user_id = int(current_user.id)
     user_row = db.get_user_by_id(user_id)
@@ -853,11 +952,12 @@ def upload_file():
             analysis_result = medical_analyzer.analyze_image(filepath)
             os.remove(filepath)
 
-            db.save_image_analysis(int(current_user.id), filename, analysis_result)
+            analysis_id = history_writer.save_image_analysis(int(current_user.id), filename, analysis_result)
 
             return jsonify({
                 'success': True,
-                'analysis': analysis_result
+                'analysis': analysis_result,
+                'analysis_id': analysis_id,
             })
         except Exception as e:
             if os.path.exists(filepath):
@@ -894,11 +994,12 @@ def analyze_symptoms():
 
         analysis_result = symptom_checker.analyze_symptoms(symptoms)
 
-        db.save_symptom_analysis(int(current_user.id), symptoms, analysis_result)
+        analysis_id = history_writer.save_symptom_analysis(int(current_user.id), symptoms, analysis_result)
 
         return jsonify({
             'success': True,
-            'analysis': analysis_result
+            'analysis': analysis_result,
+            'analysis_id': analysis_id,
         })
     except Exception as e:
         logger.error("Symptom analysis failed for user=%s", current_user.username, exc_info=True)
@@ -908,26 +1009,400 @@ def analyze_symptoms():
 @app.route('/history')
 @login_required
 def history_page():
-    entries = db.get_history(int(current_user.id))
-    return render_template('history.html', entries=entries)
+    history_writer.ensure_written()
+    page = db.get_history_page(int(current_user.id), db.HISTORY_PAGE_SIZE)
+    return render_template('history.html', entries=page['entries'], next_cursor=page['next_cursor'])
 
 
 @app.route('/api/history')
 @login_required
 def history_api():
-    entries = db.get_history(int(current_user.id))
-    return jsonify({'success': True, 'history': entries})
+    """
+    One page of history summaries, newest first. `limit` defaults to
+    db.HISTORY_PAGE_SIZE; pass the returned `next_cursor` as `cursor` to
+    get the next page (it's null on the last one).
+    """
+    limit = request.args.get('limit', db.HISTORY_PAGE_SIZE, type=int)
+    history_writer.ensure_written()
+    try:
+        page = db.get_history_page(int(current_user.id), limit, request.args.get('cursor') or None)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({'success': True, 'history': page['entries'], 'next_cursor': page['next_cursor']})
+
+
+MAX_SEARCH_QUERY_LENGTH = 200
+
+
+def _snippet_html(snippet):
+    """Escape a search snippet and turn its match markers into <mark> tags."""
+    return (str(escape(snippet))
+            .replace(db.SNIPPET_START, '<mark>')
+            .replace(db.SNIPPET_END, '</mark>'))
+
+
+@app.route('/api/history/search')
+@login_required
+@limiter.limit("60 per minute")
+def history_search_api():
+    """
+    Full-text search over the user's own history, best match first.
+    `q` is free text (words are ANDed); `limit` / `offset` page through the
+    results, with `next_offset` null on the last page. Each result is a
+    listing summary plus `snippet_html`: an escaped excerpt with the matched
+    words in <mark>.
+    """
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': 'Please enter something to search for'}), 400
+    if len(query) > MAX_SEARCH_QUERY_LENGTH:
+        return jsonify({'error': f'Search is too long (max {MAX_SEARCH_QUERY_LENGTH} characters)'}), 400
+    limit = request.args.get('limit', db.HISTORY_PAGE_SIZE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    history_writer.ensure_written()
+    page = db.search_history(int(current_user.id), query, limit, offset)
+    results = []
+    for entry in page['results']:
+        entry['snippet_html'] = _snippet_html(entry.pop('snippet'))
+        results.append(entry)
+    return jsonify({'success': True, 'results': results, 'next_offset': page['next_offset']})
+
+
+@app.route('/api/history/<analysis_type>/<int:analysis_id>')
+@login_required
+def history_entry_api(analysis_type, analysis_id):
+    """The full analysis behind one history listing entry, fetched when
+    the entry is expanded."""
+    if analysis_type not in ('image', 'symptom'):
+        return jsonify({'error': 'Unknown analysis type'}), 404
+    entry = db.get_analysis(int(current_user.id), analysis_type, analysis_id)
+    if entry is None and history_writer.ensure_written():
+        entry = db.get_analysis(int(current_user.id), analysis_type, analysis_id)
+    if entry is None:
+        return jsonify({'error': 'Analysis not found'}), 404
+    return jsonify({'success': True, 'entry': entry})
+
+
+@app.route('/api/history/export')
+@login_required
+@limiter.limit("30 per hour")
+def history_export_api():
+    """The user's whole history, streamed - see _history_export_response()."""
+    return _history_export_response(int(current_user.id))
+
+
+def _history_export_response(user_id):
+    """
+    Stream a user's complete history as ?format=ndjson (default) or csv.
+    Every record carries a `cursor`; passing the last one received as
+    ?cursor= resumes an interrupted download after it. Rows are read in
+    chunks while the response is sent, so a long history is never held in
+    memory.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in history_export.FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(history_export.FORMATS)}"}), 400
+    cursor = request.args.get('cursor') or None
+    history_writer.ensure_written()
+    try:
+        entries = db.export_history(user_id, cursor=cursor)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    logger.info("History export (%s%s) for user id=%s", fmt, ', resumed' if cursor else '', user_id)
+    return Response(
+        stream_with_context(history_export.export_lines(fmt, entries, resumed=cursor is not None)),
+        mimetype=history_export.FORMATS[fmt],
+        headers={
+            'Content-Disposition': f'attachment; filename="quickaid-history-{user_id}.{fmt}"',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no',
+        },
+    )
 
 
 @app.route('/api/history/clear', methods=['POST'])
 @login_required
 @limiter.limit("5 per minute")
 def clear_history():
+    history_writer.ensure_written()
     db.delete_history(int(current_user.id))
+    conversation_service.forget_cached_contexts(int(current_user.id))
     logger.info("History cleared for user=%s", current_user.username)
     return jsonify({'success': True})
 
 
+@app.route('/api/follow_up', methods=['POST'])
+@login_required
+@limiter.limit("20 per minute")
+def follow_up():
+    """
+    Ask a follow-up question about one of the user's own analyses. The
+    conversation is stored server-side, so the client only sends the new
+    question; the model sees the analysis, a rolling summary of older turns
+    and the most recent CONTEXT_WINDOW_TURNS turns.
+
+    Common questions ("is this serious?") that the analysis call already
+    answered are served from the stored answer without a model call, and
+    flagged `speculative`. If no answer can be given (Gemini not configured
+    or overloaded, or the call failed) it's a 503 with the reason, and
+    nothing is stored.
+    """
+    parsed, error = _parse_follow_up_request()
+    if error:
+        return error
+    user_id, analysis_type, analysis_id, question, analysis = parsed
+
+    answer = _speculative_answer(user_id, analysis_type, analysis_id, question)
+    speculative = answer is not None
+    if not speculative:
+        context = db.get_follow_up_context(user_id, analysis_type, analysis_id, CONTEXT_WINDOW_TURNS)
+        try:
+            answer = conversation_service.ask_follow_up(
+                analysis_type,
+                _analysis_summary_json(analysis),
+                _context_history(context),
+                question,
+                summary=context['summary'],
+                cache_key=(user_id, analysis_type, analysis_id),
+            )
+        except FollowUpUnavailable as e:
+            return _follow_up_unavailable(e)
+    db.save_follow_up(user_id, analysis_type, analysis_id, question, answer)
+    _queue_summary_fold(user_id, analysis_type, analysis_id)
+
+    return jsonify({
+        'success': True,
+        'answer': answer,
+        'speculative': speculative,
+        'follow_up_history': history_from_turns(db.get_follow_ups(user_id, analysis_type, analysis_id)),
+    })
+
+
+@app.route('/api/follow_up/stream', methods=['POST'])
+@login_required
+@limiter.limit("20 per minute")
+def follow_up_stream():
+    """
+    Streaming variant of /api/follow_up as Server-Sent Events: a `chunk`
+    event ({"text": ...}) per piece of the answer as it's generated, then
+    one `done` event ({"answer": ...}). The turn is only stored once the
+    answer is complete - if the client disconnects mid-stream, the
+    upstream Gemini request is cancelled and nothing is saved. If there's
+    no answer to give, the stream ends with an `error` event ({"message":
+    ..., "retryable": ..., "interrupted": ...}) instead of `done`, and
+    nothing is saved either; `interrupted` is true when chunks had already
+    been sent, which the client should then discard. A pre-answered
+    question arrives as a single chunk.
+    """
+    parsed, error = _parse_follow_up_request()
+    if error:
+        return error
+    user_id, analysis_type, analysis_id, question, analysis = parsed
+
+    speculative_answer = _speculative_answer(user_id, analysis_type, analysis_id, question)
+    if speculative_answer is not None:
+        pieces = (piece for piece in [speculative_answer])
+    else:
+        context = db.get_follow_up_context(user_id, analysis_type, analysis_id, CONTEXT_WINDOW_TURNS)
+        pieces = conversation_service.stream_follow_up(
+            analysis_type,
+            _analysis_summary_json(analysis),
+            _context_history(context),
+            question,
+            summary=context['summary'],
+            cache_key=(user_id, analysis_type, analysis_id),
+        )
+
+    def generate():
+        answer_parts = []
+        try:
+            for piece in pieces:
+                answer_parts.append(piece)
+                yield _sse_event('chunk', {'text': piece})
+        except FollowUpUnavailable as e:
+            yield _sse_event('error', {'message': e.message, 'retryable': e.retryable,
+                                       'interrupted': isinstance(e, FollowUpInterrupted)})
+            return
+        finally:
+            # Runs on normal completion and when the WSGI server closes
+            # this generator because the client went away.
+            pieces.close()
+        answer = ''.join(answer_parts).strip()
+        db.save_follow_up(user_id, analysis_type, analysis_id, question, answer)
+        _queue_summary_fold(user_id, analysis_type, analysis_id)
+        yield _sse_event('done', {'answer': answer, 'speculative': speculative_answer is not None})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Stop nginx from buffering the stream until it completes.
+            'X-Accel-Buffering': 'no',
+        },
+    )
+
+
+def _parse_follow_up_request():
+    """
+    Validate a follow-up request body and look up the analysis it refers
+    to. Returns ((user_id, analysis_type, analysis_id, question, analysis),
+    None) or (None, error_response).
+    """
+    data = request.get_json(silent=True) or {}
+    analysis_type = data.get('analysis_type')
+    analysis_id = data.get('analysis_id')
+    question = data.get('question', '')
+
+    if analysis_type not in ('image', 'symptom'):
+        return None, (jsonify({'error': "analysis_type must be 'image' or 'symptom'"}), 400)
+    if not isinstance(analysis_id, int) or isinstance(analysis_id, bool):
+        return None, (jsonify({'error': 'analysis_id must be an integer'}), 400)
+    if not isinstance(question, str) or not question.strip():
+        return None, (jsonify({'error': 'Please enter a question'}), 400)
+    question = question.strip()
+    if len(question) > MAX_FOLLOW_UP_LENGTH:
+        return None, (jsonify({'error': f'Question is too long (max {MAX_FOLLOW_UP_LENGTH} characters)'}), 400)
+
+    user_id = int(current_user.id)
+    analysis = db.get_analysis(user_id, analysis_type, analysis_id)
+    if analysis is None and history_writer.ensure_written():
+        # It may have been created moments ago and still be queued.
+        analysis = db.get_analysis(user_id, analysis_type, analysis_id)
+    if analysis is None:
+        # 404 rather than 403 for someone else's analysis - don't leak existence.
+        return None, (jsonify({'error': 'Analysis not found'}), 404)
+    if analysis.pop('archived', False):
+        # Follow-ups are stored against the hot row: bring it back first.
+        db.restore_archived_analysis(user_id, analysis_type, analysis_id)
+    return (user_id, analysis_type, analysis_id, question, analysis), None
+
+
+def _speculative_answer(user_id, analysis_type, analysis_id, question):
+    """The answer stored with the analysis for this question's intent, or
+    None if the question doesn't match one or none was generated."""
+    intent = match_intent(question)
+    if intent is None:
+        return None
+    answer = db.get_speculative_answer(user_id, analysis_type, analysis_id, intent)
+    if answer is not None:
+        logger.info("Answered follow-up on %s analysis %s from speculative '%s' answer",
+                    analysis_type, analysis_id, intent)
+    return answer
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def _analysis_summary_json(analysis):
+    """The stored analysis as the JSON the follow-up prompt embeds."""
+    return json.dumps({k: v for k, v in analysis.items() if k not in ('id', 'created_at')})
+
+
+def _context_history(context):
+    """The verbatim turns a follow-up prompt gets: the recent window, plus
+    any older turns the background fold hasn't put in the summary yet -
+    so a question asked straight after another never loses a turn."""
+    return history_from_turns(context['evicted'] + context['recent'])
+
+
+def _follow_up_unavailable(e):
+    headers = {'Retry-After': '5'} if e.retryable else {}
+    return jsonify({'success': False, 'error': e.message, 'retryable': e.retryable}), 503, headers
+
+
+# Conversations whose latest turn may have pushed older ones out of the
+# context window. Folding those into the rolling summary is another model
+# call, so it's left to the periodic-jobs thread instead of holding up the
+# answer; a conversation is listed once however many turns arrive before
+# the next run. If a worker exits with folds still pending, the turns stay
+# unfolded (and are sent verbatim, see _context_history) until the next
+# turn in that conversation lists it again.
+_pending_summary_folds = set()
+_pending_summary_folds_lock = threading.Lock()
+
+
+def _queue_summary_fold(user_id, analysis_type, analysis_id):
+    with _pending_summary_folds_lock:
+        _pending_summary_folds.add((user_id, analysis_type, analysis_id))
+
+
+def fold_pending_follow_up_summaries():
+    """Fold the turns that have slid out of the context window into each
+    listed conversation's rolling summary - only those turns, not the
+    whole conversation. Returns how many conversations were updated."""
+    with _pending_summary_folds_lock:
+        pending = list(_pending_summary_folds)
+        _pending_summary_folds.clear()
+    folded = 0
+    for user_id, analysis_type, analysis_id in pending:
+        try:
+            context = db.get_follow_up_context(user_id, analysis_type, analysis_id, CONTEXT_WINDOW_TURNS)
+            if not context['evicted']:
+                continue
+            summary = conversation_service.fold_into_summary(context['summary'], context['evicted'])
+            db.save_follow_up_summary(user_id, analysis_type, analysis_id, summary, context['evicted'][-1]['id'])
+            folded += 1
+        except Exception:
+            logger.error("Could not fold follow-ups of %s analysis %s into the summary",
+                         analysis_type, analysis_id, exc_info=True)
+    return folded
+
+
+FOLLOW_UP_FOLD_INTERVAL_SECONDS = float(os.getenv('FOLLOW_UP_FOLD_INTERVAL_SECONDS', '2'))
+periodic_jobs.register('fold_follow_up_summaries', fold_pending_follow_up_summaries,
+                       FOLLOW_UP_FOLD_INTERVAL_SECONDS)
+
+
+# ---------------------------------------------------------------------------
+# Admin API
+#
+# For operations tooling rather than people: authenticated with a shared
+# bearer token (ADMIN_API_TOKEN) instead of a login session. With no token
+# configured these endpoints don't exist at all.
+# ---------------------------------------------------------------------------
+
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')
+
+
+def admin_token_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_API_TOKEN:
+            return jsonify({'error': 'Not found'}), 404
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {ADMIN_API_TOKEN}'.encode()):
+            logger.warning("Rejected admin API request to %s from %s", request.path, get_remote_address())
+            return jsonify({'error': 'Unauthorized'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/api/admin/rollups')
+@admin_token_required
+def admin_rollups():
+    """Daily analysis counts by kind and urgency, emergency alerts and top
+    conditions, from the rollup tables - ?days= (default 30) and ?top=
+    (default 10)."""
+    days = request.args.get('days', 30, type=int)
+    top = request.args.get('top', 10, type=int)
+    if days < 1 or not 1 <= top <= 100:
+        return jsonify({'error': 'days must be at least 1 and top between 1 and 100'}), 400
+    return jsonify({'success': True, **db.rollup_report(days=days, top=top)})
+
+
+@app.route('/api/admin/users/<int:user_id>/history/export')
+@admin_token_required
+def admin_history_export(user_id):
+    """Any user's history export, for compliance requests - same formats
+    and cursor as /api/history/export."""
+    if db.get_user_by_id(user_id) is None:
+        return jsonify({'error': 'User not found'}), 404
+    return _history_export_response(user_id)
+
+
 @app.errorhandler(429)
 def rate_limit_exceeded(e):
     logger.info("Rate limit exceeded on %s %s from %s", request.method, request.path, get_remote_address())
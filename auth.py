@@ -45,8 +45,10 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id: str):
+    # Runs on every logged-in request - served from the user cache, so
+    # usually without touching the database (see database.py).
     try:
-        row = db.get_user_by_id(int(user_id))
+        row = db.get_cached_user(int(user_id))
     except (TypeError, ValueError):
         return None
     return User.from_row(row)
@@ -0,0 +1,89 @@
+"""
+Queries per second through database.py with the old connect-per-call
+get_connection() versus the pooled, tuned one.
+
+    python benchmarks/bench_connections.py [--seconds 3] [--threads 4]
+
+Runs against a throwaway database in a temp directory; the workload is the
+one an account page render does - get_user_by_id, repeatedly - plus an
+occasional history write.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@contextmanager
+def fresh_connection():
+    """database.get_connection() as it was before pooling."""
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def run(seconds, threads, user_id):
+    counts = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def worker(slot):
+        n = 0
+        while time.monotonic() < deadline:
+            db.get_user_by_id(user_id)
+            n += 1
+            if n % 20 == 0:
+                db.save_symptom_analysis(user_id, 'headache', {'recommendations': ['Rest']})
+                n += 1
+        counts[slot] = n
+        db.close_connection()
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.monotonic()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return sum(counts) / (time.monotonic() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'bench.db')
+        global db
+        import database as db
+        db.init_db()
+        user_id = db.create_user('bench', 'bench@example.com', 'benchmark-password')['id']
+
+        pooled = db.get_connection
+        db.get_connection = fresh_connection
+        before = run(args.seconds, args.threads, user_id)
+        db.get_connection = pooled
+        after = run(args.seconds, args.threads, user_id)
+
+        print(f"connect per call: {before:10.0f} queries/s")
+        print(f"pooled + tuned:   {after:10.0f} queries/s  ({after / before:.1f}x)")
+        db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
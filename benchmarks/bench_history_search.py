@@ -0,0 +1,79 @@
+"""
+Latency of database.search_history for a user with a long history.
+
+    python benchmarks/bench_history_search.py [--rows 100000] [--repeat 20]
+
+Builds a throwaway database in a temp directory with --rows analyses for
+one user (plus a smaller second user, so per-user scoping is exercised),
+inserted through save_symptom_analysis / save_image_analysis so the FTS
+triggers index them, then times a few typical queries.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ("rash itchy red skin headache migraine fever cough sore throat burn cut bruise swelling pain "
+         "chest back knee ankle sprain nausea dizziness fatigue allergy hives eczema acne blister "
+         "insect bite sunburn").split()
+RECOMMENDATIONS = [
+    "Rest and drink plenty of water", "Apply a cold compress", "See a doctor if it persists",
+    "Keep the area clean and dry", "Take over-the-counter pain relief",
+]
+QUERIES = ['rash', 'itchy rash', 'water', 'rash water itchy red', 'no such word']
+
+
+def populate(user_id, rows):
+    for start in range(0, rows, 1000):
+        with db.get_connection(write=True):
+            for _ in range(min(1000, rows - start)):
+                analysis = {
+                    'detected_symptoms': random.sample(WORDS, 2),
+                    'possible_conditions': random.sample(WORDS, 1),
+                    'detected_conditions': random.sample(WORDS, 2),
+                    'recommendations': random.sample(RECOMMENDATIONS, 2),
+                }
+                if random.random() < 0.5:
+                    db.save_symptom_analysis(user_id, ' '.join(random.sample(WORDS, 4)), analysis)
+                else:
+                    db.save_image_analysis(user_id, 'photo.jpg', analysis)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'bench.db')
+        global db
+        import database as db
+        db.init_db()
+        user_id = db.create_user('bench', 'bench@example.com', 'benchmark-password')['id']
+        other_id = db.create_user('other', 'other@example.com', 'benchmark-password')['id']
+
+        started = time.perf_counter()
+        populate(user_id, args.rows)
+        populate(other_id, args.rows // 5)
+        print(f"indexed {args.rows + args.rows // 5} analyses in {time.perf_counter() - started:.1f} s")
+
+        for query in QUERIES:
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                page = db.search_history(user_id, query)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"{query!r:26} median {statistics.median(timings):6.2f} ms  "
+                  f"max {max(timings):6.2f} ms  ({len(page['results'])} results)")
+        db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
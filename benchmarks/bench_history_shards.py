@@ -0,0 +1,101 @@
+"""
+Concurrent history insert throughput with all history in one database file
+versus spread over HISTORY_SHARDS shard files.
+
+    python benchmarks/bench_history_shards.py [--processes 8] [--records 500] [--shards 4]
+
+Each run builds a throwaway database in a temp directory, then starts
+--processes worker processes (like gunicorn workers) that each save
+--records symptom analyses, one transaction apiece, for users of their own.
+Reports inserts per second across all workers and the slowest single save.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ANALYSIS = {
+    'detected_symptoms': ['headache'], 'possible_conditions': [{'name': 'Tension headache'}],
+    'urgency_level': 'low', 'recommendations': ['Rest', 'Drink water'],
+    'safety_tips': ['Avoid screens'], 'disclaimer': 'Not medical advice.',
+}
+USERS_PER_WORKER = 8
+
+
+def _import_database(db_path, shards):
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ['HISTORY_SHARDS'] = str(shards)
+    import database
+    return database
+
+
+def worker(db_path, shards, user_ids, records, start, results):
+    db = _import_database(db_path, shards)
+    start.wait()
+    slowest = 0.0
+    for i in range(records):
+        started = time.perf_counter()
+        db.save_symptom_analysis(user_ids[i % len(user_ids)], 'headache and tiredness', ANALYSIS)
+        slowest = max(slowest, time.perf_counter() - started)
+    results.put(slowest)
+    db.close_connection()
+
+
+def run(shards, processes, records):
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        setup = ctx.Process(target=_create_users, args=(db_path, shards, processes))
+        setup.start()
+        setup.join()
+
+        start = ctx.Barrier(processes + 1)
+        results = ctx.Queue()
+        workers = []
+        for n in range(processes):
+            user_ids = list(range(n * USERS_PER_WORKER + 1, (n + 1) * USERS_PER_WORKER + 1))
+            workers.append(ctx.Process(target=worker, args=(db_path, shards, user_ids, records, start, results)))
+        for w in workers:
+            w.start()
+        start.wait()
+        started = time.perf_counter()
+        slowest = max(results.get() for _ in workers)
+        elapsed = time.perf_counter() - started
+        for w in workers:
+            w.join()
+    return processes * records / elapsed, slowest * 1000
+
+
+def _create_users(db_path, shards, processes):
+    db = _import_database(db_path, shards)
+    db.init_db()
+    with db.get_connection() as conn:
+        for i in range(processes * USERS_PER_WORKER):
+            conn.execute(
+                "INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, 'x', '2024-01-01')",
+                (f'bench{i}', f'bench{i}@example.com')
+            )
+    db.close_connection()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--records', type=int, default=500)
+    parser.add_argument('--shards', type=int, default=4)
+    args = parser.parse_args()
+
+    for shards in (0, args.shards):
+        rate, slowest = run(shards, args.processes, args.records)
+        label = 'single file' if shards == 0 else f'{shards} shards'
+        print(f"{label:12} {rate:8.0f} inserts/s   slowest save {slowest:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
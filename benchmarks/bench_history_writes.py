@@ -0,0 +1,85 @@
+"""
+Time to save a burst of analyses with synchronous inserts versus the
+write-behind history writer.
+
+    python benchmarks/bench_history_writes.py [--records 2000] [--threads 8]
+
+Runs against a throwaway database in a temp directory. "request latency" is
+what /upload and /analyze_symptoms wait for; "until durable" includes
+ensure_written(), i.e. the batches actually committing.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ANALYSIS = {
+    'detected_symptoms': ['headache'], 'possible_conditions': [{'name': 'Tension headache'}],
+    'urgency_level': 'low', 'recommendations': ['Rest', 'Drink water'],
+    'safety_tips': ['Avoid screens'], 'disclaimer': 'Not medical advice.',
+}
+
+
+def burst(save, records, threads, user_id):
+    """Save `records` analyses from `threads` threads; returns the mean
+    per-call latency in milliseconds."""
+    per_thread = records // threads
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        mine = []
+        for _ in range(per_thread):
+            started = time.perf_counter()
+            save(user_id, 'headache', ANALYSIS)
+            mine.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(mine)
+        db.close_connection()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return 1000 * sum(latencies) / len(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'bench.db')
+        global db
+        import database as db
+        from history_writer import HistoryWriter
+        db.init_db()
+        user_id = db.create_user('bench', 'bench@example.com', 'benchmark-password')['id']
+
+        started = time.perf_counter()
+        sync_latency = burst(db.save_symptom_analysis, args.records, args.threads, user_id)
+        sync_total = time.perf_counter() - started
+
+        # Queue sized to the burst so every record takes the write-behind path.
+        writer = HistoryWriter(enabled=True, queue_size=args.records)
+        started = time.perf_counter()
+        queued_latency = burst(writer.save_symptom_analysis, args.records, args.threads, user_id)
+        writer.ensure_written(timeout=60)
+        queued_total = time.perf_counter() - started
+        writer.stop()
+
+        print(f"synchronous:  {sync_latency:7.3f} ms request latency, {sync_total:6.2f} s until durable")
+        print(f"write-behind: {queued_latency:7.3f} ms request latency, {queued_total:6.2f} s until durable")
+        db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
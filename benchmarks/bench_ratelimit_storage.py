@@ -0,0 +1,82 @@
+"""
+Rate-limit check cost with memory:// versus the shared sqlite:// storage,
+and whether concurrent workers sharing the sqlite file over-admit.
+
+    python benchmarks/bench_ratelimit_storage.py [--checks 20000] [--processes 8] [--limit 1000]
+
+First times --checks fixed-window hits (flask-limiter's default strategy)
+against each storage in one process and reports microseconds per check.
+Then starts --processes worker processes (like gunicorn workers) that all
+hit one "--limit per hour" limit on the same sqlite file until each has
+tried --limit times, and reports how many hits were let through in total -
+it should be exactly --limit. With memory:// it would be --limit per worker.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _limiter(uri):
+    import ratelimit_storage  # noqa: F401 - registers sqlite://
+    from limits.storage import storage_from_string
+    from limits.strategies import FixedWindowRateLimiter
+    return FixedWindowRateLimiter(storage_from_string(uri))
+
+
+def time_checks(uri, checks):
+    from limits import parse
+    limiter = _limiter(uri)
+    limit = parse('1000000/hour')
+    started = time.perf_counter()
+    for i in range(checks):
+        limiter.hit(limit, 'login', f'10.0.{i % 64}.1')
+    return (time.perf_counter() - started) / checks * 1_000_000
+
+
+def worker(uri, limit_amount, start, results):
+    from limits import parse
+    limiter = _limiter(uri)
+    limit = parse(f'{limit_amount}/hour')
+    start.wait()
+    results.put(sum(limiter.hit(limit, 'login', '10.0.0.1') for _ in range(limit_amount)))
+
+
+def admitted_across_workers(uri, processes, limit_amount):
+    ctx = multiprocessing.get_context('spawn')
+    start = ctx.Barrier(processes)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=worker, args=(uri, limit_amount, start, results)) for _ in range(processes)]
+    for w in workers:
+        w.start()
+    admitted = sum(results.get() for _ in workers)
+    for w in workers:
+        w.join()
+    return admitted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--checks', type=int, default=20000)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_uri = 'sqlite:///' + os.path.join(tmp, 'ratelimits.db')
+        for label, uri in (('memory://', 'memory://'), ('sqlite://', sqlite_uri)):
+            print(f"{label:10} {time_checks(uri, args.checks):8.1f} us per check")
+
+        admitted = admitted_across_workers(sqlite_uri, args.processes, args.limit)
+        print(f"{args.processes} workers x {args.limit} tries against {args.limit}/hour: "
+              f"{admitted} admitted ({'exact' if admitted == args.limit else 'WRONG'})")
+
+
+if __name__ == '__main__':
+    main()
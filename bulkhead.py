@@ -0,0 +1,109 @@
+"""
+Per-process concurrency limit ("bulkhead") for outbound Gemini calls.
+
+A Gemini request can take several seconds, and gunicorn's sync workers only
+have so many threads. Without a cap, a traffic spike parks every thread on
+an upstream call and unrelated requests (logins, /emergency) time out
+behind them. The bulkhead lets at most GEMINI_MAX_CONCURRENT calls run at
+once, with up to GEMINI_MAX_QUEUE more waiting at most
+GEMINI_QUEUE_TIMEOUT_SECONDS each for a slot. Anything past that is shed:
+the analyzers fall back to their rule-based basic mode (flagged in the
+response) instead of piling up, so the service stays responsive under
+overload.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from logging_config import get_logger
+
+logger = get_logger('bulkhead')
+
+
+class Bulkhead:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, max_wait_seconds: float):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.max_wait_seconds = max(0.0, max_wait_seconds)
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._shed = 0
+
+    def acquire(self) -> bool:
+        """
+        Take a slot, waiting in the bounded queue if every slot is busy.
+        Returns False (without taking a slot) if the queue is already full
+        or the wait runs past its deadline - the caller should shed the
+        work rather than call upstream.
+        """
+        with self._cond:
+            if self._active < self.max_concurrent:
+                self._active += 1
+                return True
+
+            if self._waiting >= self.max_queue:
+                self._shed += 1
+                logger.warning(
+                    "%s bulkhead full (%d active, %d queued) - shedding request",
+                    self.name, self._active, self._waiting
+                )
+                return False
+
+            self._waiting += 1
+            deadline = time.monotonic() + self.max_wait_seconds
+            try:
+                while self._active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._shed += 1
+                        logger.warning(
+                            "%s bulkhead wait exceeded %.1fs - shedding request",
+                            self.name, self.max_wait_seconds
+                        )
+                        return False
+                    self._cond.wait(remaining)
+                self._active += 1
+                return True
+            finally:
+                self._waiting -= 1
+
+    def release(self) -> None:
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self):
+        """`with bulkhead.slot() as admitted:` - admitted is False when the
+        request was shed, and the slot is only released if it was taken."""
+        admitted = self.acquire()
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                'active': self._active,
+                'queued': self._waiting,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'shed_total': self._shed,
+            }
+
+
+# One shared bulkhead for every Gemini caller in this process (image
+# analysis, symptom checks and follow-up questions all count against it).
+gemini_bulkhead = Bulkhead(
+    'gemini',
+    max_concurrent=int(os.getenv('GEMINI_MAX_CONCURRENT', '4')),
+    max_queue=int(os.getenv('GEMINI_MAX_QUEUE', '8')),
+    max_wait_seconds=float(os.getenv('GEMINI_QUEUE_TIMEOUT_SECONDS', '5')),
+)
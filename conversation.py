@@ -5,32 +5,154 @@ Each image/symptom analysis can be the start of a short conversation - the
 user can ask "is this serious?" or "what if it doesn't improve in 2 days?"
 and get an answer that's aware of both the original analysis and anything
 already asked. This only works when Gemini is configured: the rule-based
-basic mode has no way to hold a conversation, so it returns a clear message
-saying so instead of pretending to understand.
+basic mode has no way to hold a conversation, so it raises
+FollowUpUnavailable with a clear message saying so instead of pretending
+to understand.
+
+Turns are stored server-side (database.follow_ups), and each question is
+sent with a bounded context rather than the whole thread: the original
+analysis, a rolling summary of older turns, and only the most recent
+CONTEXT_WINDOW_TURNS turns verbatim. When a turn slides out of the window
+it is folded into the summary on its own (fold_into_summary, run in the
+background - see app.py), so the summary is updated incrementally instead
+of being recomputed each time.
 """
 
-from typing import Dict, List, Optional
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
 from google import genai
 from google.genai import types
 from google.genai.types import Content, Part
 import os
+import re
 
 from logging_config import get_logger
+from bulkhead import gemini_bulkhead
+import model_router
 from localization import prompt_context, DEFAULT_REGION
 
 logger = get_logger('conversation')
 
-MODEL_NAME = 'gemini-flash-latest'
-
 NO_GEMINI_MESSAGE = (
     "Follow-up questions need Gemini to be configured (basic mode can only "
     "run a single one-shot analysis, it can't hold a conversation). Ask your "
     "administrator to set GEMINI_API_KEY, or consult a healthcare professional directly."
 )
 
+# How many recent question/answer turns are sent verbatim; older ones only
+# reach the model through the rolling summary, capped at SUMMARY_MAX_CHARS.
+CONTEXT_WINDOW_TURNS = int(os.getenv('FOLLOW_UP_CONTEXT_TURNS', '4'))
+SUMMARY_MAX_CHARS = 1500
+
+# Context caching: how long an idle conversation's cached preamble lives,
+# and the smallest preamble worth caching (Gemini rejects caches below a
+# model-dependent minimum token count - roughly 4 characters per token).
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv('FOLLOW_UP_CACHE_TTL_SECONDS', '900'))
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv('FOLLOW_UP_CACHE_MIN_CHARS', '4096'))
+# How many conversations' cache entries each process remembers; the least
+# recently used are forgotten beyond that (the upstream cache then simply
+# expires after its TTL).
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv('FOLLOW_UP_CACHE_MAX_ENTRIES', '10000'))
+
+EMPTY_ANSWER_MESSAGE = "I wasn't able to generate a response to that. Could you rephrase your question?"
+
+FAILED_MESSAGE = (
+    "Sorry, I couldn't process that follow-up question right now. "
+    "Please try again, or consult a healthcare professional directly."
+)
+
+BUSY_MESSAGE = (
+    "The AI assistant is handling a lot of requests right now, so I couldn't "
+    "answer that follow-up. Please try again in a moment, or consult a "
+    "healthcare professional directly."
+)
+
+
+class FollowUpUnavailable(Exception):
+    """No answer could be produced. `message` is what to show the user
+    instead (one of the *_MESSAGE texts above) - it's raised rather than
+    returned so it can never be stored as the answer to a turn.
+    `retryable` is False only when Gemini isn't configured at all."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.message = message
+        self.retryable = retryable
+
+
+class FollowUpInterrupted(FollowUpUnavailable):
+    """A streamed answer broke off after some of it had already been
+    yielded - the pieces so far are an incomplete answer and should be
+    discarded, not shown or stored as if it had finished."""
+
+
+class ContextCacheBackend(ABC):
+    """Where cached conversation prefixes live. create() returns a name that
+    generate_content can reference via `cached_content`."""
+
+    @abstractmethod
+    def create(self, model: str, contents: List[Content], ttl_seconds: int) -> str:
+        ...
+
+    @abstractmethod
+    def touch(self, name: str, ttl_seconds: int) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, name: str) -> None:
+        ...
+
+
+class GeminiContextCache(ContextCacheBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, model: str, contents: List[Content], ttl_seconds: int) -> str:
+        cached = self.client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=contents,
+                ttl=f'{ttl_seconds}s',
+                display_name='quickaid-follow-up',
+            ),
+        )
+        return cached.name
+
+    def touch(self, name: str, ttl_seconds: int) -> None:
+        self.client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f'{ttl_seconds}s'))
+
+    def delete(self, name: str) -> None:
+        self.client.caches.delete(name=name)
+
+
+class InMemoryContextCache(ContextCacheBackend):
+    """Stand-in for tests: keeps prefixes in a dict and records calls."""
 
-class ConversationService:
     def __init__(self):
+        self.entries: Dict[str, Dict] = {}
+        self.created = 0
+
+    def create(self, model: str, contents: List[Content], ttl_seconds: int) -> str:
+        name = f'cachedContents/{uuid.uuid4().hex}'
+        self.entries[name] = {'model': model, 'contents': contents, 'expires_at': time.time() + ttl_seconds}
+        self.created += 1
+        return name
+
+    def touch(self, name: str, ttl_seconds: int) -> None:
+        if name not in self.entries:
+            raise KeyError(name)
+        self.entries[name]['expires_at'] = time.time() + ttl_seconds
+
+    def delete(self, name: str) -> None:
+        self.entries.pop(name, None)
+
+
+class ConversationService:
+    def __init__(self, context_cache: Optional[ContextCacheBackend] = None):
         api_key = os.getenv('GEMINI_API_KEY')
         if api_key and api_key != 'your_gemini_api_key_here':
             self.client = genai.Client(api_key=api_key)
@@ -39,6 +161,16 @@ class ConversationService:
             self.client = None
             self.use_gemini = False
 
+        if context_cache is None and self.use_gemini:
+            context_cache = GeminiContextCache(self.client)
+        self.context_cache = context_cache
+        # (user_id, analysis_type, analysis_id, model) -> {'name', 'expires_at'},
+        # least recently used first, at most CONTEXT_CACHE_MAX_ENTRIES. A
+        # None name marks a prefix that's too small / failed to cache, so
+        # it's sent inline without retrying until the entry expires.
+        self._cached_prefixes: 'OrderedDict[Tuple, Dict]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+
     def _build_system_context(self, analysis_type: str, analysis_summary: str, region: str) -> str:
         kind = "an uploaded image" if analysis_type == 'image' else "symptoms the user described"
         return f"""
@@ -55,6 +187,44 @@ class ConversationService:
         definitive diagnosis. {prompt_context(region)}
         """.strip()
 
+    def build_contents(
+        self,
+        analysis_type: str,
+        analysis_summary: str,
+        history: List[Dict],
+        question: str,
+        region: str = DEFAULT_REGION,
+        summary: Optional[str] = None,
+    ) -> List[Content]:
+        """
+        The prompt for one follow-up: the analysis context and its canned
+        acknowledgement, then the rolling summary of older turns (if any),
+        then the recent `history` turns and finally the new question.
+        """
+        return (
+            self._prefix_contents(analysis_type, analysis_summary, region)
+            + self._turn_contents(history, question, summary)
+        )
+
+    def _prefix_contents(self, analysis_type: str, analysis_summary: str, region: str) -> List[Content]:
+        """The per-analysis preamble - identical on every turn, so cacheable."""
+        return [
+            Content(role='user', parts=[Part(text=self._build_system_context(analysis_type, analysis_summary, region))]),
+            Content(role='model', parts=[Part(text="Understood - I have the original analysis. What would you like to know?")]),
+        ]
+
+    def _turn_contents(self, history: List[Dict], question: str, summary: Optional[str]) -> List[Content]:
+        contents: List[Content] = []
+        if summary:
+            contents.append(Content(role='user', parts=[Part(text=f"Summary of our earlier follow-up conversation:\n{summary}")]))
+            contents.append(Content(role='model', parts=[Part(text="Thanks, I'll keep that in mind.")]))
+        for turn in history:
+            role = 'model' if turn.get('role') == 'model' else 'user'
+            contents.append(Content(role=role, parts=[Part(text=turn.get('content', ''))]))
+
+        contents.append(Content(role='user', parts=[Part(text=question)]))
+        return contents
+
     def ask_follow_up(
         self,
         analysis_type: str,
@@ -62,44 +232,296 @@ class ConversationService:
         history: List[Dict],
         question: str,
         region: str = DEFAULT_REGION,
+        summary: Optional[str] = None,
+        cache_key: Optional[Tuple[int, str, int]] = None,
     ) -> str:
         """
         Answer a follow-up question in the context of a prior analysis and
         any earlier follow-up turns. `history` is a list of
-        {'role': 'user'|'model', 'content': str} dicts, oldest first.
-        Returns the assistant's plain-text answer.
+        {'role': 'user'|'model', 'content': str} dicts, oldest first - the
+        recent window only, with anything older passed in as `summary`.
+        `cache_key` - (user_id, analysis_type, analysis_id) - lets the
+        analysis preamble be served from the context cache.
+        Returns the assistant's plain-text answer; raises
+        FollowUpUnavailable if there isn't one.
         """
         if not self.use_gemini:
-            return NO_GEMINI_MESSAGE
+            raise FollowUpUnavailable(NO_GEMINI_MESSAGE, retryable=False)
+
+        with gemini_bulkhead.slot() as admitted:
+            if not admitted:
+                raise FollowUpUnavailable(BUSY_MESSAGE)
+            return self._generate_follow_up(
+                analysis_type, analysis_summary, history, question, region, summary, cache_key
+            )
 
+    def _generate_follow_up(self, analysis_type: str, analysis_summary: str, history: List[Dict],
+                            question: str, region: str, summary: Optional[str],
+                            cache_key: Optional[Tuple[int, str, int]]) -> str:
         try:
-            contents: List[Content] = [
-                Content(role='user', parts=[Part(text=self._build_system_context(analysis_type, analysis_summary, region))]),
-                Content(role='model', parts=[Part(text="Understood - I have the original analysis. What would you like to know?")]),
+            route = model_router.route_follow_up(question, len(history))
+            prefix = self._prefix_contents(analysis_type, analysis_summary, region)
+            turns = self._turn_contents(history, question, summary)
+            cache_name = self._cached_prefix_name(cache_key, route.model, prefix)
+
+            with model_router.timed(route):
+                if cache_name:
+                    try:
+                        response = self.client.models.generate_content(
+                            model=route.model,
+                            contents=turns,
+                            config=types.GenerateContentConfig(max_output_tokens=500, cached_content=cache_name),
+                        )
+                    except Exception:
+                        # Most likely expired/evicted upstream - forget it and
+                        # answer this turn with the preamble inline instead.
+                        logger.warning("Cached follow-up context %s unusable - resending inline", cache_name, exc_info=True)
+                        self._drop_cached_prefix(cache_key, route.model)
+                        cache_name = None
+                if not cache_name:
+                    response = self.client.models.generate_content(
+                        model=route.model,
+                        contents=prefix + turns,
+                        config=types.GenerateContentConfig(
+                            max_output_tokens=500,
+                        ),
+                    )
+
+            answer = (response.text or '').strip()
+        except Exception:
+            logger.error("Gemini follow-up request failed", exc_info=True)
+            raise FollowUpUnavailable(FAILED_MESSAGE)
+        if not answer:
+            logger.warning("Gemini follow-up returned an empty response")
+            raise FollowUpUnavailable(EMPTY_ANSWER_MESSAGE)
+        return answer
+
+    def stream_follow_up(
+        self,
+        analysis_type: str,
+        analysis_summary: str,
+        history: List[Dict],
+        question: str,
+        region: str = DEFAULT_REGION,
+        summary: Optional[str] = None,
+        cache_key: Optional[Tuple[int, str, int]] = None,
+    ) -> Iterator[str]:
+        """
+        Same as ask_follow_up, but yields the answer in pieces as Gemini
+        generates them. If the consumer stops early and closes this
+        generator (the HTTP client went away), the upstream stream is closed
+        too, so the model stops generating and the bulkhead slot is freed.
+        Raises FollowUpUnavailable, from the first next(), if there's no
+        answer to give, or FollowUpInterrupted if generation fails after
+        pieces have been yielded.
+        """
+        if not self.use_gemini:
+            raise FollowUpUnavailable(NO_GEMINI_MESSAGE, retryable=False)
+
+        with gemini_bulkhead.slot() as admitted:
+            if not admitted:
+                raise FollowUpUnavailable(BUSY_MESSAGE)
+
+            route = model_router.route_follow_up(question, len(history))
+            prefix = self._prefix_contents(analysis_type, analysis_summary, region)
+            turns = self._turn_contents(history, question, summary)
+            cache_name = self._cached_prefix_name(cache_key, route.model, prefix)
+            produced = False
+            stream = None
+            try:
+                with model_router.timed(route):
+                    if cache_name:
+                        try:
+                            stream = self._open_stream(route.model, turns, cache_name)
+                            for text in stream:
+                                produced = True
+                                yield text
+                        except GeneratorExit:
+                            raise
+                        except Exception:
+                            if produced:
+                                raise
+                            logger.warning("Cached follow-up context %s unusable - resending inline", cache_name, exc_info=True)
+                            self._drop_cached_prefix(cache_key, route.model)
+                            stream.close()
+                            cache_name = None
+                    if not cache_name:
+                        stream = self._open_stream(route.model, prefix + turns, None)
+                        for text in stream:
+                            produced = True
+                            yield text
+            except GeneratorExit:
+                logger.info("Follow-up stream abandoned by the client - cancelling the upstream request")
+                raise
+            except Exception:
+                if produced:
+                    logger.error("Gemini follow-up stream failed part-way through the answer", exc_info=True)
+                    raise FollowUpInterrupted(FAILED_MESSAGE)
+                logger.error("Gemini follow-up stream failed", exc_info=True)
+                raise FollowUpUnavailable(FAILED_MESSAGE)
+            finally:
+                if stream is not None:
+                    stream.close()
+            if not produced:
+                logger.warning("Gemini follow-up stream returned an empty response")
+                raise FollowUpUnavailable(EMPTY_ANSWER_MESSAGE)
+
+    def _open_stream(self, model: str, contents: List[Content], cache_name: Optional[str]) -> Iterator[str]:
+        """Text pieces of a streamed generation. Closing this generator
+        closes the SDK's stream, which drops the upstream HTTP response."""
+        upstream = self.client.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=types.GenerateContentConfig(max_output_tokens=500, cached_content=cache_name),
+        )
+        try:
+            for chunk in upstream:
+                if chunk.text:
+                    yield chunk.text
+        finally:
+            close = getattr(upstream, 'close', None)
+            if close is not None:
+                close()
+
+    # -----------------------------------------------------------------------
+    # Context caching of the per-analysis preamble
+    # -----------------------------------------------------------------------
+
+    def _cached_prefix_name(self, cache_key: Optional[Tuple[int, str, int]], model: str,
+                            prefix: List[Content]) -> Optional[str]:
+        """Name of the cached preamble for this analysis and model, creating
+        it on first use and extending its TTL once it's past half-life.
+        None means send the preamble inline (no backend/key, too small to
+        cache, or the cache call failed)."""
+        if self.context_cache is None or cache_key is None:
+            return None
+        key = tuple(cache_key) + (model,)
+        now = time.time()
+        with self._cache_lock:
+            entry = self._cached_prefixes.get(key)
+            if entry is not None and entry['expires_at'] <= now:
+                # Gone upstream as well by now - start over.
+                del self._cached_prefixes[key]
+                entry = None
+            elif entry is not None:
+                self._cached_prefixes.move_to_end(key)
+
+        if entry is not None:
+            if entry['name'] is None:
+                return None
+            if entry['expires_at'] - now < CONTEXT_CACHE_TTL_SECONDS / 2:
+                try:
+                    self.context_cache.touch(entry['name'], CONTEXT_CACHE_TTL_SECONDS)
+                    entry['expires_at'] = now + CONTEXT_CACHE_TTL_SECONDS
+                except Exception:
+                    logger.warning("Could not extend cached follow-up context %s", entry['name'], exc_info=True)
+                    self._drop_cached_prefix(cache_key, model)
+                    return None
+            return entry['name']
+
+        prefix_chars = sum(len(part.text or '') for content in prefix for part in content.parts)
+        if prefix_chars < CONTEXT_CACHE_MIN_CHARS:
+            self._remember_prefix(key, None, now)
+            return None
+
+        try:
+            name = self.context_cache.create(model, prefix, CONTEXT_CACHE_TTL_SECONDS)
+        except Exception:
+            logger.warning("Could not cache follow-up context for %s - sending it inline", key, exc_info=True)
+            self._remember_prefix(key, None, now)
+            return None
+        logger.info("Cached follow-up context for %s as %s", key, name)
+        self._remember_prefix(key, name, now)
+        return name
+
+    def _remember_prefix(self, key: Tuple, name: Optional[str], now: float) -> None:
+        with self._cache_lock:
+            self._cached_prefixes[key] = {'name': name, 'expires_at': now + CONTEXT_CACHE_TTL_SECONDS}
+            self._cached_prefixes.move_to_end(key)
+            while len(self._cached_prefixes) > CONTEXT_CACHE_MAX_ENTRIES:
+                self._cached_prefixes.popitem(last=False)
+
+    def _drop_cached_prefix(self, cache_key: Tuple[int, str, int], model: str) -> None:
+        with self._cache_lock:
+            self._cached_prefixes.pop(tuple(cache_key) + (model,), None)
+
+    def forget_cached_contexts(self, user_id: int, analysis_type: Optional[str] = None,
+                               analysis_id: Optional[int] = None) -> None:
+        """Delete the cached preambles for a user's conversations (all of
+        them, or one analysis) - called when their history goes away."""
+        with self._cache_lock:
+            doomed = [
+                key for key in self._cached_prefixes
+                if key[0] == user_id
+                and (analysis_type is None or key[1] == analysis_type)
+                and (analysis_id is None or key[2] == analysis_id)
             ]
-            for turn in history:
-                role = 'model' if turn.get('role') == 'model' else 'user'
-                contents.append(Content(role=role, parts=[Part(text=turn.get('content', ''))]))
+            entries = [self._cached_prefixes.pop(key) for key in doomed]
+        for entry in entries:
+            if entry['name'] and self.context_cache is not None:
+                try:
+                    self.context_cache.delete(entry['name'])
+                except Exception:
+                    logger.warning("Could not delete cached follow-up context %s", entry['name'], exc_info=True)
 
-            contents.append(Content(role='user', parts=[Part(text=question)]))
+    def fold_into_summary(self, previous_summary: Optional[str], evicted_turns: List[Dict]) -> str:
+        """
+        Return the rolling summary updated with `evicted_turns` (stored
+        follow_ups rows, oldest first) - only the new turns are sent, never
+        the whole conversation. Uses the fast model when it's available and
+        falls back to a plain extractive digest otherwise.
+        """
+        if self.use_gemini:
+            with gemini_bulkhead.slot() as admitted:
+                if admitted:
+                    folded = self._fold_with_gemini(previous_summary, evicted_turns)
+                    if folded:
+                        return folded[:SUMMARY_MAX_CHARS]
+        return _extractive_fold(previous_summary, evicted_turns)
 
-            response = self.client.models.generate_content(
-                model=MODEL_NAME,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    max_output_tokens=500,
-                ),
-            )
+    def _fold_with_gemini(self, previous_summary: Optional[str], evicted_turns: List[Dict]) -> Optional[str]:
+        exchanges = "\n".join(f"User: {t['question']}\nAssistant: {t['answer']}" for t in evicted_turns)
+        prompt = f"""
+        You maintain a short running summary of a follow-up conversation about a medical analysis.
+        Current summary (may be empty):
+        {previous_summary or '(none yet)'}
 
-            answer = (response.text or '').strip()
-            if not answer:
-                logger.warning("Gemini follow-up returned an empty response")
-                return "I wasn't able to generate a response to that. Could you rephrase your question?"
-            return answer
+        New exchanges to add:
+        {exchanges}
 
+        Return the updated summary as a few plain-text bullet points, under {SUMMARY_MAX_CHARS}
+        characters. Keep what the user asked about and any advice given; drop pleasantries.
+        """.strip()
+        route = model_router.RouteDecision('follow_up_summary', model_router.FAST_TIER, 'summary fold')
+        try:
+            with model_router.timed(route):
+                response = self.client.models.generate_content(
+                    model=route.model,
+                    contents=prompt,
+                    config=types.GenerateContentConfig(max_output_tokens=400),
+                )
+            return (response.text or '').strip() or None
         except Exception:
-            logger.error("Gemini follow-up request failed", exc_info=True)
-            return (
-                "Sorry, I couldn't process that follow-up question right now. "
-                "Please try again, or consult a healthcare professional directly."
-            )
+            logger.warning("Gemini summary fold failed - using extractive summary", exc_info=True)
+            return None
+
+
+def history_from_turns(turns: List[Dict]) -> List[Dict]:
+    """Stored follow_ups rows -> the role/content history ask_follow_up takes."""
+    history = []
+    for turn in turns:
+        history.append({'role': 'user', 'content': turn['question']})
+        history.append({'role': 'model', 'content': turn['answer']})
+    return history
+
+
+def _extractive_fold(previous_summary: Optional[str], evicted_turns: List[Dict]) -> str:
+    """Append one line per evicted turn (question plus the answer's first
+    sentence), dropping the oldest lines once over SUMMARY_MAX_CHARS."""
+    lines = previous_summary.splitlines() if previous_summary else []
+    for turn in evicted_turns:
+        first_sentence = re.split(r'(?<=[.!?])\s', turn['answer'].strip(), maxsplit=1)[0]
+        lines.append(f"- Asked: {turn['question'][:150]} -> {first_sentence[:200]}")
+    while len(lines) > 1 and len("\n".join(lines)) > SUMMARY_MAX_CHARS:
+        lines.pop(0)
+    return "\n".join(lines)[:SUMMARY_MAX_CHARS]
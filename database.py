@@ -8,15 +8,23 @@ for the AI-analysis features.
 
 import sqlite3
 import json
+import base64
 import os
 import hashlib
+import re
 import secrets
+import threading
+import time
+import functools
+import zlib
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
-from typing import Dict, List, Optional
-from werkzeug.security import generate_password_hash, check_password_hash
+from typing import Dict, Iterator, List, Optional, Tuple
+from flask import current_app, g, has_request_context
 
 from logging_config import get_logger
+import password_hashing
 
 logger = get_logger('database')
 
@@ -30,117 +38,791 @@ if _db_dir:
     os.makedirs(_db_dir, exist_ok=True)
 
 
-@contextmanager
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
+# Connection tuning, applied to every pooled connection (see _connect()).
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+MMAP_SIZE_BYTES = int(os.getenv('SQLITE_MMAP_SIZE_BYTES', str(64 * 1024 * 1024)))
+CACHE_SIZE_KIB = int(os.getenv('SQLITE_CACHE_SIZE_KIB', str(16 * 1024)))
+STATEMENT_CACHE_SIZE = int(os.getenv('SQLITE_STATEMENT_CACHE_SIZE', '256'))
+
+# One long-lived connection per thread per process, instead of a fresh
+# sqlite3.connect() (plus pragma round trips) on every call. sqlite3
+# connections can't be shared across threads, and one inherited across a
+# fork (gunicorn workers) must never be reused by the child, so each entry
+# records the pid that opened it. _pool is the main database's; each history
+# shard file (see "History shards" below) gets its own, keyed by slot.
+_pool = threading.local()
+_shard_pools: Dict[int, threading.local] = {}
+_shard_pools_lock = threading.Lock()
+
+
+class _Connection(sqlite3.Connection):
+    """A sqlite3 connection that remembers which file it is on: `shard` is
+    the history shard's slot, or None for the main database."""
+    shard: Optional[int] = None
+
+
+def _pool_for(shard: Optional[int]) -> threading.local:
+    if shard is None:
+        return _pool
+    pool = _shard_pools.get(shard)
+    if pool is None:
+        with _shard_pools_lock:
+            pool = _shard_pools.setdefault(shard, threading.local())
+    return pool
+
+
+def _connect(shard: Optional[int] = None) -> sqlite3.Connection:
+    """
+    Open a connection tuned for a small multi-process web app:
+    - WAL lets readers run alongside the single writer, and with
+      synchronous=NORMAL a commit doesn't fsync (durable at checkpoint;
+      a power cut can lose the last few commits, never corrupt the file).
+    - busy_timeout makes a writer wait for the lock instead of failing
+      straight away with "database is locked" when two workers collide.
+    - mmap_size / cache_size keep hot pages in memory; cached_statements
+      keeps compiled queries around for the life of the connection.
+    Transactions are handled explicitly by get_connection() (autocommit
+    mode), not by sqlite3's implicit BEGIN-before-DML.
+    """
+    conn = sqlite3.connect(
+        DB_PATH if shard is None else shard_path(shard),
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        factory=_Connection,
+    )
+    conn.shard = shard
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE_BYTES}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
     conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def _pooled_connection(shard: Optional[int] = None) -> sqlite3.Connection:
+    """This thread's connection, opening a new one on first use or after a fork."""
+    pool = _pool_for(shard)
+    pid = os.getpid()
+    if getattr(pool, 'pid', None) != pid:
+        # Anything inherited from the parent is abandoned, not closed -
+        # closing it could disturb the parent's still-open handle.
+        pool.conn = _connect(shard)
+        pool.pid = pid
+        pool.depth = 0
+    return pool.conn
+
+
+def close_connection() -> None:
+    """Close this thread's pooled connections (they reopen on next use)."""
+    for pool in [_pool, *list(_shard_pools.values())]:
+        conn = getattr(pool, 'conn', None)
+        if conn is not None and getattr(pool, 'pid', None) == os.getpid():
+            conn.close()
+        pool.__dict__.clear()
+
+
+@contextmanager
+def get_connection(write: bool = False, exclusive: bool = False, shard: Optional[int] = None):
+    """
+    `with get_connection() as conn:` runs the block in a transaction on this
+    thread's pooled connection: committed on success, rolled back if it
+    raises. Nested blocks (a helper called from inside another block) use a
+    SAVEPOINT, so an inner failure - e.g. an IntegrityError that the caller
+    catches - only undoes the inner block's work.
+
+    Pass write=True for a block that reads before it writes. A plain BEGIN
+    only takes the write lock at the first write, and if another connection
+    committed in between, SQLite can't upgrade the read snapshot and fails
+    with "database is locked" straight away instead of waiting out
+    busy_timeout. BEGIN IMMEDIATE takes the lock up front, so it waits.
+    exclusive=True (BEGIN EXCLUSIVE) is for schema migrations.
+
+    Inside a @unit_of_work view, write=True blocks - and any block after
+    the first of them - are nested in the request's transaction instead
+    (see below). So a block that writes to the main database passes
+    write=True, or inside such a view it would commit on its own.
+
+    `shard` picks a history shard file instead of the main database; the
+    history functions route there themselves (_history_connection). A
+    request's unit of work only spans the main database.
+    """
+    pool = _pool_for(shard)
+    conn = _pooled_connection(shard)
+    if shard is None and write:
+        _begin_request_session(conn)
+    depth = pool.depth
+    savepoint = f"sp_{depth}"
+    if depth == 0:
+        conn.execute("BEGIN EXCLUSIVE" if exclusive else "BEGIN IMMEDIATE" if write else "BEGIN")
+    else:
+        conn.execute(f"SAVEPOINT {savepoint}")
+    pool.depth = depth + 1
     try:
         yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
+    except BaseException:
+        if depth == 0:
+            conn.execute("ROLLBACK")
+        else:
+            conn.execute(f"ROLLBACK TO {savepoint}")
+            conn.execute(f"RELEASE {savepoint}")
+        _forget_uncommitted_fragments(pool)
         raise
+    else:
+        if depth > 0:
+            conn.execute(f"RELEASE {savepoint}")
+        else:
+            try:
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                # e.g. still busy after busy_timeout - don't leave the
+                # pooled connection stuck inside an open transaction.
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                    _forget_uncommitted_fragments(pool)
+                raise
     finally:
-        conn.close()
+        pool.depth = depth
+        if depth == 0:
+            pool.wrote_fragments = False
 
 
-def init_db():
-    """Create tables if they don't already exist, then apply any schema
-    migrations needed to bring an older existing database up to date.
-    Safe to call on every startup."""
-    with get_connection() as conn:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                email TEXT NOT NULL UNIQUE,
-                password_hash TEXT NOT NULL,
-                has_password INTEGER NOT NULL DEFAULT 1,
-                email_verified INTEGER NOT NULL DEFAULT 0,
-                oauth_provider TEXT,
-                oauth_sub TEXT,
-                totp_secret TEXT,
-                totp_enabled INTEGER NOT NULL DEFAULT 0,
-                created_at TEXT NOT NULL
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS image_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                created_at TEXT NOT NULL,
-                original_filename TEXT,
-                detected_conditions TEXT NOT NULL,
-                confidence TEXT,
-                urgency TEXT,
-                recommendations TEXT NOT NULL,
-                safety_tips TEXT,
-                disclaimer TEXT
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS symptom_analyses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                created_at TEXT NOT NULL,
-                symptom_text TEXT NOT NULL,
-                detected_symptoms TEXT,
-                possible_conditions TEXT,
-                urgency_level TEXT,
-                emergency_alert INTEGER,
-                recommendations TEXT NOT NULL,
-                safety_tips TEXT,
-                disclaimer TEXT
-            )
-        """)
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                purpose TEXT NOT NULL,
-                token_hash TEXT NOT NULL UNIQUE,
-                created_at TEXT NOT NULL,
-                expires_at TEXT NOT NULL,
-                used_at TEXT
-            )
-        """)
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_image_user ON image_analyses(user_id, created_at)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_symptom_user ON symptom_analyses(user_id, created_at)")
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_user_tokens_lookup ON user_tokens(purpose, token_hash)")
-        # Column migrations must run BEFORE any index that references a
-        # possibly-new column (e.g. oauth_provider on a pre-OAuth database).
-        _migrate_users_table(conn)
-        conn.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_oauth "
-            "ON users(oauth_provider, oauth_sub) WHERE oauth_provider IS NOT NULL"
-        )
-    logger.info("Database initialized at %s", DB_PATH)
-
-
-def _migrate_users_table(conn):
-    """Add columns introduced after the initial release to a users table
-    that predates them - CREATE TABLE IF NOT EXISTS above is a no-op on an
-    existing table, so new columns have to be bolted on explicitly."""
-    existing_columns = {row['name'] for row in conn.execute("PRAGMA table_info(users)")}
-    migrations = [
-        ("has_password", "ALTER TABLE users ADD COLUMN has_password INTEGER NOT NULL DEFAULT 1"),
-        ("email_verified", "ALTER TABLE users ADD COLUMN email_verified INTEGER NOT NULL DEFAULT 0"),
-        ("oauth_provider", "ALTER TABLE users ADD COLUMN oauth_provider TEXT"),
-        ("oauth_sub", "ALTER TABLE users ADD COLUMN oauth_sub TEXT"),
-        ("totp_secret", "ALTER TABLE users ADD COLUMN totp_secret TEXT"),
-        ("totp_enabled", "ALTER TABLE users ADD COLUMN totp_enabled INTEGER NOT NULL DEFAULT 0"),
-    ]
-    for column_name, ddl in migrations:
-        if column_name not in existing_columns:
-            conn.execute(ddl)
-            logger.info("Migrated users table: added column %s", column_name)
+# ---------------------------------------------------------------------------
+# Request-scoped unit of work
+# ---------------------------------------------------------------------------
+#
+# By default every database.* call is its own transaction. A view decorated
+# with @unit_of_work instead runs its writes inside one transaction for the
+# whole request: e.g. reset_password's "use up the token" and "set the
+# password" commit together or not at all (and with one fsync), committed
+# after the response is built and rolled back if the view fails. Call
+# sites don't change - the functions below pick the session up from
+# flask.g through get_connection(). Outside a request (tests, scripts)
+# nothing changes either.
+#
+# The transaction only begins at the view's first write=True block, and
+# holds the write lock - every other writer in every worker waits on it -
+# until the response. Reads before that run on their own, so looking up a
+# token or checking a password takes no lock at all. Anything slow - above
+# all hashing or verifying a password, which can wait in the hashing pool
+# (see password_hashing.py) longer than busy_timeout - must happen before
+# the first write: the write functions hash before they open their block,
+# and views verify before they change anything. A check that must hold
+# when the change lands goes in the write itself (consume_token() only
+# uses up a token that's still unused), not in a read before it.
+
+_SESSIONS_EXTENSION = 'quickaid_db_sessions'
+
+
+def init_request_sessions(app) -> None:
+    """Register the commit/rollback hooks @unit_of_work views rely on."""
+    app.extensions[_SESSIONS_EXTENSION] = True
+    app.after_request(_finish_request_session)
+    app.teardown_request(_abort_request_session)
+
+
+def unit_of_work(view):
+    """Run every database call this view makes in one transaction."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_app.extensions.get(_SESSIONS_EXTENSION):
+            raise RuntimeError("unit_of_work used without database.init_request_sessions(app)")
+        g._db_session = {'begun': False, 'closed': False}
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _request_session() -> Optional[Dict]:
+    if not has_request_context():
+        return None
+    session = g.get('_db_session')
+    return session if session is not None and not session['closed'] else None
+
+
+def _begin_request_session(conn: sqlite3.Connection) -> None:
+    """Open the request's transaction at its first write=True block. It
+    takes the write lock up front (IMMEDIATE): later blocks may read then
+    write, and upgrading a read transaction mid-way fails outright if
+    another worker committed in between."""
+    session = _request_session()
+    if session is None or session['begun']:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    session['begun'] = True
+    _pool.depth = 1
+
+
+def _end_request_session(commit: bool) -> None:
+    session = _request_session()
+    if session is None:
+        return
+    # Anything that still runs in this request afterwards - a streamed
+    # response body - goes back to a transaction per call.
+    session['closed'] = True
+    if not session['begun']:
+        return
+    conn = _pooled_connection()
+    committed = False
+    try:
+        conn.execute("COMMIT" if commit else "ROLLBACK")
+        committed = commit
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if not committed:
+            _forget_uncommitted_fragments(_pool)
+        _pool.depth = 0
+        _pool.wrote_fragments = False
+        # Committed or not, users cached during the request may be wrong.
+        for user_id in session.get('changed_users', ()):
+            _user_changed(user_id)
+
+
+def _finish_request_session(response):
+    _end_request_session(commit=response.status_code < 500)
+    return response
+
+
+def _abort_request_session(exc):
+    # Only still open if the view (or another after_request hook) raised.
+    _end_request_session(commit=False)
+
+
+# ---------------------------------------------------------------------------
+# Schema migrations
+# ---------------------------------------------------------------------------
+#
+# The schema is built by an ordered list of numbered migrations, registered
+# with @_migration(version, description). The number of the last one applied
+# is kept in the database file itself (PRAGMA user_version), so init_db() on
+# an up-to-date database is a single PRAGMA read - no DDL, no table_info.
+#
+# Pending migrations run in one BEGIN EXCLUSIVE transaction, together with
+# the user_version bump: either all of them land or none do, and when several
+# gunicorn workers start at once, one migrates while the others wait for the
+# lock and then find nothing left to do.
+#
+# Databases from before versioning report user_version 0 but may already
+# have any of the tables and columns below, so migrations 1-5 are written to
+# be idempotent (IF NOT EXISTS, _add_column). New migrations just append the
+# next number.
+
+_MIGRATIONS: Dict[int, tuple] = {}
+# History shard files (see "History shards" below) have their own, shorter
+# list, versioned the same way in each file's user_version.
+_SHARD_MIGRATIONS: Dict[int, tuple] = {}
+
+# How long a starting process waits for another one's migration to finish.
+MIGRATION_LOCK_TIMEOUT_SECONDS = float(os.getenv('MIGRATION_LOCK_TIMEOUT_SECONDS', '120'))
+
+
+def _migration(version: int, description: str, registry: Dict[int, tuple] = _MIGRATIONS):
+    def register(func):
+        if version in registry:
+            raise ValueError(f"Duplicate schema migration {version}")
+        registry[version] = (description, func)
+        return func
+    return register
+
+
+def schema_version() -> int:
+    """The latest migration number this code knows about."""
+    return max(_MIGRATIONS)
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, ddl: str) -> None:
+    """ALTER TABLE ... ADD COLUMN, unless the column is already there."""
+    existing_columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in existing_columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        logger.info("Migrated %s table: added column %s", table, column)
+
+
+def _pending_migrations(registry: Dict[int, tuple], current: int):
+    return [(version, *registry[version]) for version in sorted(registry) if version > current]
+
+
+def init_db(check_history_layout: bool = True):
+    """Bring the database schema up to date (creating it if the file is
+    new), along with every history shard file. Cheap when there's nothing
+    to do - safe to call on every startup. check_history_layout=False skips
+    matching the shards to HISTORY_SHARDS, for reshard() to change them."""
+    global _active_shards
+    _migrate()
+    _active_shards = None
+    if check_history_layout:
+        _ensure_history_layout()
+    for shard in _active_history_shards():
+        _migrate(shard)
+
+
+def _migrate(shard: Optional[int] = None) -> None:
+    """Apply pending migrations to the main database or one shard file."""
+    registry = _MIGRATIONS if shard is None else _SHARD_MIGRATIONS
+    latest = max(registry)
+    conn = _pooled_connection(shard)
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    if current >= latest:
+        return
+
+    deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT_SECONDS
+    while True:
+        try:
+            with get_connection(exclusive=True, shard=shard) as conn:
+                # Re-read under the lock: another process may have just done it.
+                current = conn.execute("PRAGMA user_version").fetchone()[0]
+                for version, description, migrate in _pending_migrations(registry, current):
+                    logger.info("Applying schema migration %d to %s: %s",
+                                version, _database_label(shard), description)
+                    migrate(conn)
+                    conn.execute(f"PRAGMA user_version = {int(version)}")
+            break
+        except sqlite3.OperationalError as e:
+            # Another worker is migrating and took longer than busy_timeout.
+            if 'locked' not in str(e) or time.monotonic() > deadline:
+                raise
+            logger.info("Waiting for another process to finish schema migrations")
+            time.sleep(0.5)
+    logger.info("Database initialized at %s (schema version %d)",
+                DB_PATH if shard is None else shard_path(shard), latest)
+
+
+def _database_label(shard: Optional[int]) -> str:
+    return "main database" if shard is None else f"history shard {shard}"
+
+
+@_migration(1, "core tables")
+def _migration_core_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            email TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            purpose TEXT NOT NULL,
+            token_hash TEXT NOT NULL UNIQUE,
+            created_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            used_at TEXT
+        )
+    """)
+    _create_history_tables(conn, _USER_REFERENCE)
+
+
+# How history rows point at their user in the main database. Shard files
+# have no users table, so there the column is a plain integer.
+_USER_REFERENCE = "REFERENCES users(id) ON DELETE CASCADE"
+
+
+def _create_history_tables(conn: sqlite3.Connection, user_ref: str) -> None:
+    """The analysis and follow-up tables, as first released (later
+    migrations add to them)."""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS image_analyses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL {user_ref},
+            created_at TEXT NOT NULL,
+            original_filename TEXT,
+            detected_conditions TEXT NOT NULL,
+            confidence TEXT,
+            urgency TEXT,
+            recommendations TEXT NOT NULL,
+            safety_tips TEXT,
+            disclaimer TEXT
+        )
+    """)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS symptom_analyses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL {user_ref},
+            created_at TEXT NOT NULL,
+            symptom_text TEXT NOT NULL,
+            detected_symptoms TEXT,
+            possible_conditions TEXT,
+            urgency_level TEXT,
+            emergency_alert INTEGER,
+            recommendations TEXT NOT NULL,
+            safety_tips TEXT,
+            disclaimer TEXT
+        )
+    """)
+    # One row per follow-up question/answer turn, attached to exactly one
+    # analysis row of either kind (so both cascade-delete with it).
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS follow_ups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL {user_ref},
+            image_analysis_id INTEGER REFERENCES image_analyses(id) ON DELETE CASCADE,
+            symptom_analysis_id INTEGER REFERENCES symptom_analyses(id) ON DELETE CASCADE,
+            created_at TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            CHECK ((image_analysis_id IS NULL) != (symptom_analysis_id IS NULL))
+        )
+    """)
+    # Rolling summary of the turns that have slid out of the context
+    # window, and the id of the last turn folded into it.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS follow_up_summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_analysis_id INTEGER UNIQUE REFERENCES image_analyses(id) ON DELETE CASCADE,
+            symptom_analysis_id INTEGER UNIQUE REFERENCES symptom_analyses(id) ON DELETE CASCADE,
+            summary TEXT NOT NULL,
+            through_follow_up_id INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_user ON image_analyses(user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_symptom_user ON symptom_analyses(user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_follow_ups_image ON follow_ups(image_analysis_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_follow_ups_symptom ON follow_ups(symptom_analysis_id, id)")
+
+
+@_migration(2, "account columns: password flag, email verification, OAuth, 2FA")
+def _migration_account_columns(conn):
+    _add_column(conn, 'users', 'has_password', "INTEGER NOT NULL DEFAULT 1")
+    _add_column(conn, 'users', 'email_verified', "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, 'users', 'oauth_provider', "TEXT")
+    _add_column(conn, 'users', 'oauth_sub', "TEXT")
+    _add_column(conn, 'users', 'totp_secret', "TEXT")
+    _add_column(conn, 'users', 'totp_enabled', "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_oauth "
+        "ON users(oauth_provider, oauth_sub) WHERE oauth_provider IS NOT NULL"
+    )
+
+
+@_migration(3, "speculative follow-up answers and shared text fragments")
+def _migration_history_columns(conn):
+    # Each distinct recommendation / safety tip / disclaimer string, stored
+    # once and addressed by its SHA-256 (see "Text fragments" below).
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS text_fragments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash TEXT NOT NULL UNIQUE,
+            text TEXT NOT NULL
+        )
+    """)
+    for table in ('image_analyses', 'symptom_analyses'):
+        _add_column(conn, table, 'speculative_answers', "TEXT")
+        _add_column(conn, table, 'disclaimer_id', "INTEGER REFERENCES text_fragments(id)")
+
+
+@_migration(4, "token expiry as epoch seconds, partial index on unused tokens")
+def _migration_token_expiry(conn):
+    _add_column(conn, 'user_tokens', 'expires_epoch', "INTEGER")
+    backfilled = conn.execute(
+        "UPDATE user_tokens SET expires_epoch = CAST(strftime('%s', expires_at) AS INTEGER) "
+        "WHERE expires_epoch IS NULL"
+    ).rowcount
+    if backfilled:
+        logger.info("Backfilled expires_epoch for %d tokens", backfilled)
+    # Redundant with token_hash's UNIQUE index, which is what lookups probe.
+    conn.execute("DROP INDEX IF EXISTS idx_user_tokens_lookup")
+    # Unused tokens only, for invalidate_tokens(): stays as small as the
+    # number of outstanding links however many dead rows pile up.
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_tokens_unused "
+        "ON user_tokens(user_id, purpose) WHERE used_at IS NULL"
+    )
+
+
+@_migration(5, "full-text history search")
+def _migration_history_search(conn):
+    _create_history_search(conn)
+
+
+@_migration(6, "history shard registry")
+def _migration_history_shards(conn):
+    # One row per history shard file ever created. `slot` names the file and
+    # fixes the id range its rows are numbered from; `position` is where the
+    # shard sits in the routing order; state is 'pending' while a reshard is
+    # filling it, then 'active', then 'retired' once replaced.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_shards (
+            slot INTEGER PRIMARY KEY AUTOINCREMENT,
+            position INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+
+
+@_migration(7, "deferred deletion: user tombstones and cleared-history marks")
+def _migration_deferred_deletion(conn):
+    # Set when an account is deleted; the row itself goes once purge_deleted()
+    # has removed everything it owns. The partial index is what the purge
+    # scans for, and stays empty the rest of the time.
+    _add_column(conn, 'users', 'deleted_at', "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_deleted ON users(id) WHERE deleted_at IS NOT NULL")
+    _create_history_tombstones(conn)
+
+
+def _create_history_tombstones(conn: sqlite3.Connection) -> None:
+    # One row per user whose history was cleared: everything they have with
+    # created_at <= cleared_at is hidden, and deleted by purge_deleted().
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_tombstones (
+            user_id INTEGER PRIMARY KEY,
+            cleared_at TEXT NOT NULL
+        )
+    """)
+    # For purging a user's follow-ups ahead of their analyses, a batch at a
+    # time, instead of all at once in the analyses' cascade.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_follow_ups_user ON follow_ups(user_id, created_at)")
+
+
+@_migration(8, "compressed history archive")
+def _migration_history_archive(conn):
+    _create_history_archive(conn)
+
+
+def _create_history_archive(conn: sqlite3.Connection) -> None:
+    # Analyses older than HISTORY_ARCHIVE_AFTER_DAYS, moved out of the hot
+    # tables by archive_history() (see "History archive" below). A block is
+    # up to HISTORY_ARCHIVE_BLOCK_SIZE of one user's analyses from one
+    # month, with their follow-ups, as zlib-compressed JSON.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history_archive_blocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            last_created_at TEXT NOT NULL,
+            entry_count INTEGER NOT NULL,
+            payload BLOB NOT NULL
+        )
+    """)
+    # Which block each archived analysis is in, keyed like history_search
+    # rowids: analysis id * 2, plus 1 for a symptom analysis.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archived_analyses (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            block_id INTEGER NOT NULL REFERENCES history_archive_blocks(id) ON DELETE CASCADE
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_blocks_user ON history_archive_blocks(user_id, last_created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_user ON archived_analyses(user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_block ON archived_analyses(block_id)")
+
+
+@_migration(9, "analytics rollups")
+def _migration_rollups(conn):
+    _create_rollups(conn)
+
+
+def _create_rollups(conn: sqlite3.Connection) -> None:
+    # Per-day analysis counts, kept up to date by the save functions (see
+    # "Analytics rollups" below). Counts are summed across history shards.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS analysis_rollups (
+            day TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            urgency TEXT NOT NULL,
+            analyses INTEGER NOT NULL,
+            emergency_alerts INTEGER NOT NULL,
+            PRIMARY KEY (day, kind, urgency)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS condition_rollups (
+            day TEXT NOT NULL,
+            condition TEXT NOT NULL,
+            analyses INTEGER NOT NULL,
+            PRIMARY KEY (day, condition)
+        )
+    """)
+
+
+@_migration(10, "email outbox")
+def _migration_email_outbox(conn):
+    # Mail waiting for the background sender (see "Email outbox" below).
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_epoch INTEGER NOT NULL,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(next_attempt_epoch) "
+                 "WHERE status IN ('pending', 'sending')")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_recipient ON email_outbox(recipient)")
+
+
+@_migration(11, "text fragment sweep marks")
+def _migration_fragment_sweep(conn):
+    # Set by sweep_text_fragments() on fragments it's about to delete as
+    # unused, cleared by _intern_fragment() if one is used again meanwhile.
+    _add_column(conn, 'text_fragments', 'unreferenced_at', "TEXT")
+
+
+@_migration(1, "history tables", registry=_SHARD_MIGRATIONS)
+def _shard_migration_history_tables(conn):
+    _create_history_tables(conn, "")
+    _migration_history_columns(conn)
+
+
+@_migration(2, "full-text history search", registry=_SHARD_MIGRATIONS)
+def _shard_migration_history_search(conn):
+    _create_history_search(conn)
+
+
+@_migration(3, "cleared-history marks", registry=_SHARD_MIGRATIONS)
+def _shard_migration_history_tombstones(conn):
+    _create_history_tombstones(conn)
+
+
+@_migration(4, "compressed history archive", registry=_SHARD_MIGRATIONS)
+def _shard_migration_history_archive(conn):
+    _create_history_archive(conn)
+    # Number blocks from the bottom of the shard's id range, like the
+    # tables _prepare_shard() sets up.
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('history_archive_blocks', ?)",
+                 (conn.shard * _SHARD_ID_RANGE,))
+
+
+@_migration(5, "analytics rollups", registry=_SHARD_MIGRATIONS)
+def _shard_migration_rollups(conn):
+    _create_rollups(conn)
+
+
+@_migration(6, "text fragment sweep marks", registry=_SHARD_MIGRATIONS)
+def _shard_migration_fragment_sweep(conn):
+    _migration_fragment_sweep(conn)
 
 
 def _now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+# ---------------------------------------------------------------------------
+# User cache
+# ---------------------------------------------------------------------------
+#
+# Flask-Login reloads the logged-in user on every request (auth.load_user),
+# which made even a history poll pay a users-table query first.
+# get_cached_user() keeps recently loaded users in an in-process LRU for up
+# to USER_CACHE_TTL_SECONDS instead. Every function that changes a users
+# row calls _user_changed() once the change is committed, which drops the
+# user here and - so other gunicorn workers drop their copies too -
+# replaces a small signal file next to the database. Each lookup stats that
+# file (a syscall, not a query) and clears the whole cache when it has
+# changed; account changes are rare enough that starting over costs
+# nothing noticeable. With USER_CACHE_SIGNAL off, other workers can serve
+# a changed or deleted account for up to the TTL. USER_CACHE_SIZE=0 turns
+# the cache off.
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL_SECONDS = float(os.getenv('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_SIGNAL = os.getenv('USER_CACHE_SIGNAL', 'True').lower() in ('1', 'true', 'yes')
+
+# user id -> (monotonic expiry, user dict)
+_user_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_user_cache_lock = threading.Lock()
+# Bumped by every invalidation: a lookup that started before one doesn't
+# store what it read, which may be the old row.
+_user_cache_generation = 0
+_user_cache_signal_seen = None
+
+
+def _user_cache_signal_path() -> str:
+    return DB_PATH + '.users-changed'
+
+
+def get_cached_user(user_id: int) -> Optional[Dict]:
+    """get_user_by_id(), answered from the user cache when possible."""
+    if USER_CACHE_SIZE <= 0:
+        return get_user_by_id(user_id)
+    _check_user_cache_signal()
+    now = time.monotonic()
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached and cached[0] > now:
+            _user_cache.move_to_end(user_id)
+            return dict(cached[1])
+        generation = _user_cache_generation
+
+    user = get_user_by_id(user_id)
+    # Not while a request's transaction is open: the row read may hold
+    # its uncommitted changes.
+    if user is not None and _request_session() is None:
+        with _user_cache_lock:
+            if generation == _user_cache_generation:
+                _user_cache[user_id] = (now + USER_CACHE_TTL_SECONDS, dict(user))
+                _user_cache.move_to_end(user_id)
+                while len(_user_cache) > USER_CACHE_SIZE:
+                    _user_cache.popitem(last=False)
+    return user
+
+
+def _forget_cached_users(user_id: Optional[int] = None) -> None:
+    """Drop one user from this process' cache, or everyone."""
+    global _user_cache_generation
+    with _user_cache_lock:
+        _user_cache_generation += 1
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(user_id, None)
+
+
+def _user_changed(user_id: int) -> None:
+    """Call after committing a change to a users row."""
+    _forget_cached_users(user_id)
+    session = _request_session()
+    if session is not None and session['begun']:
+        # Inside a @unit_of_work view nothing is committed yet: again, and
+        # the signal, once the request's transaction ends.
+        session.setdefault('changed_users', set()).add(user_id)
+        return
+    _signal_user_change()
+
+
+def _signal_user_change() -> None:
+    if not USER_CACHE_SIGNAL or USER_CACHE_SIZE <= 0:
+        return
+    path = _user_cache_signal_path()
+    # Written aside and renamed over the old one, so it's a new file (new
+    # inode) each time whatever the filesystem's timestamp resolution.
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(secrets.token_hex(8))
+        os.replace(temp_path, path)
+    except OSError:
+        logger.warning("Could not update the user cache signal file %s", path, exc_info=True)
+
+
+def _check_user_cache_signal() -> None:
+    global _user_cache_signal_seen
+    if not USER_CACHE_SIGNAL:
+        return
+    try:
+        stat = os.stat(_user_cache_signal_path())
+        seen = (stat.st_ino, stat.st_mtime_ns)
+    except FileNotFoundError:
+        seen = None
+    if seen != _user_cache_signal_seen:
+        _forget_cached_users()
+        _user_cache_signal_seen = seen
+
+
 # ---------------------------------------------------------------------------
 # Users
 # ---------------------------------------------------------------------------
@@ -149,10 +831,11 @@ def create_user(username: str, email: str, password: str) -> Optional[Dict]:
     """
     Create a new user with a hashed password.
     Returns the created user dict, or None if the username/email is taken.
+    Raises password_hashing.PasswordHashingBusy under a signup burst.
     """
-    password_hash = generate_password_hash(password)
+    password_hash = password_hashing.hash_password(password)
     try:
-        with get_connection() as conn:
+        with get_connection(write=True) as conn:
             cursor = conn.execute(
                 "INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, ?, ?)",
                 (username, email, password_hash, _now())
@@ -167,25 +850,52 @@ def create_user(username: str, email: str, password: str) -> Optional[Dict]:
 
 def get_user_by_id(user_id: int) -> Optional[Dict]:
     with get_connection() as conn:
-        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        row = conn.execute("SELECT * FROM users WHERE id = ? AND deleted_at IS NULL", (user_id,)).fetchone()
     return dict(row) if row else None
 
 
 def get_user_by_username(username: str) -> Optional[Dict]:
     with get_connection() as conn:
-        row = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+        row = conn.execute("SELECT * FROM users WHERE username = ? AND deleted_at IS NULL", (username,)).fetchone()
     return dict(row) if row else None
 
 
 def verify_password(user: Dict, password: str) -> bool:
+    """Check a password against the user's stored hash. A correct password
+    whose hash was made with other work factors than configured now is
+    re-hashed. Raises password_hashing.PasswordHashingBusy when hashing is
+    overloaded."""
     if not user.get('has_password', 1):
         return False
-    return check_password_hash(user['password_hash'], password)
+    if not password_hashing.check_password(user['password_hash'], password):
+        return False
+    if password_hashing.needs_rehash(user['password_hash']):
+        _rehash_password(user, password)
+    return True
+
+
+def _rehash_password(user: Dict, password: str) -> None:
+    try:
+        new_hash = password_hashing.hash_password(password)
+    except password_hashing.PasswordHashingBusy:
+        return  # the login still succeeds; it's redone at the next one
+    # Not write=True: in a @unit_of_work view this commits by itself rather
+    # than starting the request's transaction, which would then hold the
+    # write lock while the view goes on to e.g. hash a new password.
+    with get_connection() as conn:
+        # Only if the password hasn't been changed meanwhile.
+        updated = conn.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+            (new_hash, user['id'], user['password_hash'])
+        ).rowcount
+    if updated:
+        _user_changed(user['id'])
+        logger.info("Re-hashed password for user_id=%s with the current work factors", user['id'])
 
 
 def get_user_by_email(email: str) -> Optional[Dict]:
     with get_connection() as conn:
-        row = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
+        row = conn.execute("SELECT * FROM users WHERE email = ? AND deleted_at IS NULL", (email,)).fetchone()
     return dict(row) if row else None
 
 
@@ -210,8 +920,9 @@ def email_taken(email: str, exclude_user_id: Optional[int] = None) -> bool:
 def update_username(user_id: int, new_username: str) -> bool:
     """Rename a user. Returns False if the username is already taken."""
     try:
-        with get_connection() as conn:
+        with get_connection(write=True) as conn:
             conn.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
+        _user_changed(user_id)
         logger.info("Username updated for user_id=%s -> %s", user_id, new_username)
         return True
     except sqlite3.IntegrityError:
@@ -222,41 +933,92 @@ def update_email(user_id: int, new_email: str) -> bool:
     """Change a user's email and reset verification - they must re-verify
     the new address. Returns False if the email is already taken."""
     try:
-        with get_connection() as conn:
+        with get_connection(write=True) as conn:
             conn.execute(
                 "UPDATE users SET email = ?, email_verified = 0 WHERE id = ?",
                 (new_email, user_id)
             )
+        _user_changed(user_id)
         logger.info("Email updated for user_id=%s", user_id)
         return True
     except sqlite3.IntegrityError:
         return False
 
 
+def update_profile(user_id: int, new_username: str, new_email: str) -> Optional[str]:
+    """Change a user's username and email together: both or neither. The
+    checks that they're free run under the same write lock as the updates,
+    so a concurrent signup can't take one in between. Returns None on
+    success, else 'username' or 'email' - whichever is taken. A changed
+    email has to be verified again."""
+    with get_connection(write=True) as conn:
+        row = conn.execute("SELECT username, email FROM users WHERE id = ?", (user_id,)).fetchone()
+        if new_username != row['username'] and username_taken(new_username, exclude_user_id=user_id):
+            return 'username'
+        if new_email != row['email'] and email_taken(new_email, exclude_user_id=user_id):
+            return 'email'
+        conn.execute(
+            """
+            UPDATE users SET username = ?, email = ?,
+                email_verified = CASE WHEN email = ? THEN email_verified ELSE 0 END
+            WHERE id = ?
+            """,
+            (new_username, new_email, new_email, user_id)
+        )
+    _user_changed(user_id)
+    return None
+
+
 def set_password(user_id: int, new_password: str) -> None:
     """Set/replace a user's password (also used the first time an
     OAuth-only account adds a password)."""
-    password_hash = generate_password_hash(new_password)
-    with get_connection() as conn:
+    set_password_hash(user_id, password_hashing.hash_password(new_password))
+
+
+def set_password_hash(user_id: int, password_hash: str) -> None:
+    """set_password() with the hash already made - for a @unit_of_work view
+    that has to write something else first (hashing must not happen while
+    the request holds the write lock)."""
+    with get_connection(write=True) as conn:
         conn.execute(
             "UPDATE users SET password_hash = ?, has_password = 1 WHERE id = ?",
             (password_hash, user_id)
         )
+    _user_changed(user_id)
     logger.info("Password set/changed for user_id=%s", user_id)
 
 
 def set_email_verified(user_id: int) -> None:
-    with get_connection() as conn:
+    with get_connection(write=True) as conn:
         conn.execute("UPDATE users SET email_verified = 1 WHERE id = ?", (user_id,))
+    _user_changed(user_id)
     logger.info("Email verified for user_id=%s", user_id)
 
 
 def delete_user(user_id: int) -> None:
-    """Permanently delete a user and everything owned by them (history,
-    tokens - all via ON DELETE CASCADE). Irreversible."""
-    with get_connection() as conn:
-        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    logger.info("Deleted user_id=%s and all owned data", user_id)
+    """Permanently delete a user and everything owned by them. Irreversible.
+
+    Only the users row is touched here, so this returns at once: it's
+    marked deleted (get_user_by_id() stops finding it, so every session
+    ends), its tokens are dropped, and its username, email and Google link
+    are overwritten so they're free to sign up again. purge_deleted() then
+    removes the user's history in small batches, and the row last."""
+    with get_connection(write=True) as conn:
+        # Mail to the account not sent yet, or kept after sending - before
+        # its address is overwritten below.
+        conn.execute("DELETE FROM email_outbox WHERE recipient = (SELECT email FROM users WHERE id = ?)",
+                     (user_id,))
+        conn.execute(
+            """
+            UPDATE users SET deleted_at = ?, username = ?, email = ?,
+                oauth_provider = NULL, oauth_sub = NULL, totp_secret = NULL
+            WHERE id = ? AND deleted_at IS NULL
+            """,
+            (_now(), f'deleted:{user_id}', f'deleted:{user_id}', user_id)
+        )
+        conn.execute("DELETE FROM user_tokens WHERE user_id = ?", (user_id,))
+    _user_changed(user_id)
+    logger.info("Deleted user_id=%s; owned data queued for purging", user_id)
 
 
 # ---------------------------------------------------------------------------
@@ -266,25 +1028,28 @@ def delete_user(user_id: int) -> None:
 def set_pending_totp_secret(user_id: int, secret: str) -> None:
     """Store a not-yet-confirmed TOTP secret (totp_enabled stays 0 until
     the user proves they can generate a valid code for it)."""
-    with get_connection() as conn:
+    with get_connection(write=True) as conn:
         conn.execute(
             "UPDATE users SET totp_secret = ?, totp_enabled = 0 WHERE id = ?",
             (secret, user_id)
         )
+    _user_changed(user_id)
 
 
 def enable_totp(user_id: int) -> None:
-    with get_connection() as conn:
+    with get_connection(write=True) as conn:
         conn.execute("UPDATE users SET totp_enabled = 1 WHERE id = ?", (user_id,))
+    _user_changed(user_id)
     logger.info("2FA enabled for user_id=%s", user_id)
 
 
 def disable_totp(user_id: int) -> None:
-    with get_connection() as conn:
+    with get_connection(write=True) as conn:
         conn.execute(
             "UPDATE users SET totp_enabled = 0, totp_secret = NULL WHERE id = ?",
             (user_id,)
         )
+    _user_changed(user_id)
     logger.info("2FA disabled for user_id=%s", user_id)
 
 
@@ -295,18 +1060,19 @@ def disable_totp(user_id: int) -> None:
 def get_user_by_oauth(provider: str, sub: str) -> Optional[Dict]:
     with get_connection() as conn:
         row = conn.execute(
-            "SELECT * FROM users WHERE oauth_provider = ? AND oauth_sub = ?",
+            "SELECT * FROM users WHERE oauth_provider = ? AND oauth_sub = ? AND deleted_at IS NULL",
             (provider, sub)
         ).fetchone()
     return dict(row) if row else None
 
 
 def link_oauth_to_user(user_id: int, provider: str, sub: str) -> None:
-    with get_connection() as conn:
+    with get_connection(write=True) as conn:
         conn.execute(
             "UPDATE users SET oauth_provider = ?, oauth_sub = ? WHERE id = ?",
             (provider, sub, user_id)
         )
+    _user_changed(user_id)
     logger.info("Linked %s OAuth to user_id=%s", provider, user_id)
 
 
@@ -319,9 +1085,9 @@ def create_oauth_user(username: str, email: str, provider: str, sub: str) -> Opt
     The provider's email is trusted as pre-verified (Google verifies email
     ownership before issuing an ID token).
     """
-    unusable_hash = generate_password_hash(secrets.token_urlsafe(32))
+    unusable_hash = password_hashing.hash_password(secrets.token_urlsafe(32))
     try:
-        with get_connection() as conn:
+        with get_connection(write=True) as conn:
             cursor = conn.execute(
                 """
                 INSERT INTO users
@@ -343,6 +1109,10 @@ def create_oauth_user(username: str, email: str, provider: str, sub: str) -> Opt
 # Password reset / email verification tokens
 # ---------------------------------------------------------------------------
 
+# Dead (used or expired) tokens deleted per transaction by compact_tokens().
+TOKEN_COMPACT_BATCH_SIZE = int(os.getenv('TOKEN_COMPACT_BATCH_SIZE', '500'))
+
+
 def _hash_token(raw_token: str) -> str:
     return hashlib.sha256(raw_token.encode('utf-8')).hexdigest()
 
@@ -353,17 +1123,19 @@ def create_token(user_id: int, purpose: str, ttl_seconds: int) -> str:
     'email_verify') and return the RAW token to email to the user. Only a
     hash of it is stored, so a database leak alone can't be used to reset
     accounts. Any previous unused tokens of the same purpose for this user
-    are invalidated first, so only the newest link/code ever works.
+    are invalidated in the same transaction, so only the newest link/code
+    ever works - even when two requests race.
     """
-    invalidate_tokens(user_id, purpose)
     raw_token = secrets.token_urlsafe(32)
     token_hash = _hash_token(raw_token)
-    expires_at = (datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)).isoformat()
-    with get_connection() as conn:
+    now = datetime.now(timezone.utc)
+    expires = now + timedelta(seconds=ttl_seconds)
+    with get_connection(write=True) as conn:
+        invalidate_tokens(user_id, purpose)
         conn.execute(
-            "INSERT INTO user_tokens (user_id, purpose, token_hash, created_at, expires_at) "
-            "VALUES (?, ?, ?, ?, ?)",
-            (user_id, purpose, token_hash, _now(), expires_at)
+            "INSERT INTO user_tokens (user_id, purpose, token_hash, created_at, expires_at, expires_epoch) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, purpose, token_hash, now.isoformat(), expires.isoformat(), int(expires.timestamp()))
         )
     return raw_token
 
@@ -374,29 +1146,52 @@ def get_valid_token(raw_token: str, purpose: str) -> Optional[Dict]:
     token_hash = _hash_token(raw_token)
     with get_connection() as conn:
         row = conn.execute(
-            "SELECT * FROM user_tokens WHERE token_hash = ? AND purpose = ?",
-            (token_hash, purpose)
+            "SELECT * FROM user_tokens "
+            "WHERE token_hash = ? AND purpose = ? AND used_at IS NULL AND expires_epoch > ?",
+            (token_hash, purpose, int(time.time()))
         ).fetchone()
-    if row is None:
-        return None
-    token = dict(row)
-    if token['used_at'] is not None:
-        return None
-    if datetime.fromisoformat(token['expires_at']) < datetime.now(timezone.utc):
-        return None
-    return token
+    return dict(row) if row else None
 
 
-def consume_token(token_id: int) -> None:
-    with get_connection() as conn:
-        conn.execute("UPDATE user_tokens SET used_at = ? WHERE id = ?", (_now(), token_id))
+def consume_token(token_id: int) -> bool:
+    """Mark a token used. Returns False if it already was - e.g. by a
+    concurrent request since it was looked up - so it's only ever used once."""
+    with get_connection(write=True) as conn:
+        return conn.execute(
+            "UPDATE user_tokens SET used_at = ? WHERE id = ? AND used_at IS NULL", (_now(), token_id)
+        ).rowcount == 1
+
+
+def compact_tokens(batch_size: int = TOKEN_COMPACT_BATCH_SIZE) -> int:
+    """
+    Delete used and expired tokens, `batch_size` rows per transaction so a
+    large backlog never holds the write lock for long. Returns how many
+    were deleted. Run periodically (see maintenance.py) and from
+    `manage.py compact-tokens`.
+    """
+    deleted, last_id = 0, 0
+    while True:
+        with get_connection(write=True) as conn:
+            ids = [row['id'] for row in conn.execute(
+                "SELECT id FROM user_tokens WHERE id > ? AND (used_at IS NOT NULL OR expires_epoch <= ?) "
+                "ORDER BY id LIMIT ?",
+                (last_id, int(time.time()), batch_size)
+            )]
+            if not ids:
+                break
+            conn.execute(f"DELETE FROM user_tokens WHERE id IN ({','.join('?' * len(ids))})", ids)
+        deleted += len(ids)
+        last_id = ids[-1]
+    if deleted:
+        logger.info("Compacted user_tokens: deleted %d used/expired tokens", deleted)
+    return deleted
 
 
 def invalidate_tokens(user_id: int, purpose: str) -> None:
     """Mark all of a user's not-yet-used tokens for this purpose as used,
     so an old reset link/verification link can't be reused alongside a
     freshly requested one."""
-    with get_connection() as conn:
+    with get_connection(write=True) as conn:
         conn.execute(
             "UPDATE user_tokens SET used_at = ? WHERE user_id = ? AND purpose = ? AND used_at IS NULL",
             (_now(), user_id, purpose)
@@ -404,63 +1199,536 @@ def invalidate_tokens(user_id: int, purpose: str) -> None:
 
 
 # ---------------------------------------------------------------------------
-# History
+# Email outbox
 # ---------------------------------------------------------------------------
+#
+# mailer.send_email() only adds a row here - inside the request's
+# transaction, so mail about a registration that rolled back is never sent -
+# and mailer.deliver_outbox() sends it from the periodic-jobs thread. Every
+# worker runs the sender, so claim_outbox_batch() hands each message to one
+# of them: claiming marks it 'sending' and pushes next_attempt_epoch out by
+# a lease, after which a message whose sender died is claimed again. Once
+# sent, the body (which may carry a live reset link) is blanked; the row
+# itself is kept EMAIL_OUTBOX_KEEP_DAYS for troubleshooting.
+
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '50'))
+EMAIL_OUTBOX_LEASE_SECONDS = int(os.getenv('EMAIL_OUTBOX_LEASE_SECONDS', '300'))
+EMAIL_OUTBOX_KEEP_DAYS = int(os.getenv('EMAIL_OUTBOX_KEEP_DAYS', '7'))
+
+
+def enqueue_email(recipient: str, subject: str, body: str) -> int:
+    with get_connection(write=True) as conn:
+        return conn.execute(
+            "INSERT INTO email_outbox (recipient, subject, body, next_attempt_epoch, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (recipient, subject, body, int(time.time()), _now())
+        ).lastrowid
+
+
+def claim_outbox_batch(limit: int = EMAIL_OUTBOX_BATCH_SIZE,
+                       lease_seconds: int = EMAIL_OUTBOX_LEASE_SECONDS) -> List[Dict]:
+    """Claim up to `limit` messages that are due, oldest first, and count
+    the attempt. Nobody else claims them until the lease runs out."""
+    now = int(time.time())
+    with get_connection(write=True) as conn:
+        rows = conn.execute(
+            "SELECT * FROM email_outbox WHERE status IN ('pending', 'sending') AND next_attempt_epoch <= ? "
+            "ORDER BY id LIMIT ?",
+            (now, limit)
+        ).fetchall()
+        if not rows:
+            return []
+        ids = [row['id'] for row in rows]
+        conn.execute(
+            f"UPDATE email_outbox SET status = 'sending', attempts = attempts + 1, next_attempt_epoch = ? "
+            f"WHERE id IN ({','.join('?' * len(ids))})",
+            (now + lease_seconds, *ids)
+        )
+    return [dict(row, status='sending', attempts=row['attempts'] + 1) for row in rows]
 
-def save_image_analysis(user_id: int, original_filename: str, analysis: Dict) -> None:
-    """Persist one image-analysis result for this user."""
-    with get_connection() as conn:
+
+def mark_email_sent(email_id: int) -> None:
+    with get_connection(write=True) as conn:
         conn.execute(
+            "UPDATE email_outbox SET status = 'sent', sent_at = ?, body = '', last_error = NULL WHERE id = ?",
+            (_now(), email_id)
+        )
+
+
+def mark_email_failed(email_id: int, error: str, retry_in_seconds: Optional[float] = None) -> None:
+    """Schedule another attempt in `retry_in_seconds`, or with None give up
+    on the message for good."""
+    with get_connection(write=True) as conn:
+        if retry_in_seconds is None:
+            conn.execute("UPDATE email_outbox SET status = 'failed', body = '', last_error = ? WHERE id = ?",
+                         (error, email_id))
+        else:
+            conn.execute(
+                "UPDATE email_outbox SET status = 'pending', last_error = ?, next_attempt_epoch = ? WHERE id = ?",
+                (error, int(time.time() + retry_in_seconds), email_id)
+            )
+
+
+def release_emails(email_ids: List[int], retry_in_seconds: float) -> None:
+    """Hand claimed messages back untried, without counting the attempt."""
+    if not email_ids:
+        return
+    with get_connection(write=True) as conn:
+        conn.execute(
+            f"UPDATE email_outbox SET status = 'pending', attempts = attempts - 1, next_attempt_epoch = ? "
+            f"WHERE id IN ({','.join('?' * len(email_ids))})",
+            (int(time.time() + retry_in_seconds), *email_ids)
+        )
+
+
+def purge_sent_emails(older_than_days: int = EMAIL_OUTBOX_KEEP_DAYS) -> int:
+    """Delete sent and failed messages older than `older_than_days`."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=older_than_days)).isoformat()
+    with get_connection(write=True) as conn:
+        deleted = conn.execute(
+            "DELETE FROM email_outbox WHERE status IN ('sent', 'failed') AND created_at < ?", (cutoff,)
+        ).rowcount
+    if deleted:
+        logger.info("Purged %d delivered/failed emails from the outbox", deleted)
+    return deleted
+
+
+def outbox_stats() -> Dict[str, int]:
+    with get_connection() as conn:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall())
+    return {status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'failed')}
+
+
+# ---------------------------------------------------------------------------
+# Text fragments
+# ---------------------------------------------------------------------------
+#
+# Recommendations, safety tips and disclaimers are mostly the same few dozen
+# boilerplate strings (basic-mode advice, fallback lists, the disclaimer),
+# so storing them verbatim per analysis grew the database by kilobytes of
+# duplicate text per row. Each distinct string is stored once in
+# text_fragments instead, addressed by its SHA-256; analysis rows hold JSON
+# arrays of fragment ids ("[3,7,12]") and a disclaimer_id. Fragments are
+# immutable, so reads resolve ids through an in-process LRU and only hit
+# the table for ids it hasn't seen. Rows written before this still hold
+# the strings themselves until `python manage.py encode-fragments`
+# rewrites them - the readers accept both.
+#
+# Purging and archiving analyses leaves behind the fragments only they
+# used - for free-text advice, most of them. sweep_text_fragments() deletes
+# those after each purge_deleted() / archive_history() run that removed
+# analyses. Ids are never reused (AUTOINCREMENT), so an id some worker
+# still has cached can't come to mean another text.
+
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', '4096'))
+
+# Keyed by (shard, id): each history shard file numbers its own fragments.
+_fragment_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_fragment_cache_lock = threading.Lock()
+
+# SQLite's default limit on ? placeholders in one statement is 999+.
+_MAX_IN_PARAMS = 500
+
+
+def _intern_fragment(conn: sqlite3.Connection, text: str) -> int:
+    """Id of the fragment holding exactly `text`, inserting it if new."""
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    row = conn.execute("SELECT id, unreferenced_at FROM text_fragments WHERE hash = ?", (digest,)).fetchone()
+    if row:
+        if row['unreferenced_at'] is not None:
+            # A sweep has it down for deletion - not any more.
+            conn.execute("UPDATE text_fragments SET unreferenced_at = NULL WHERE id = ?", (row['id'],))
+        return row['id']
+    # Noted so a rollback can drop cached ids this transaction may have
+    # handed out (see _forget_uncommitted_fragments).
+    _pool_for(conn.shard).wrote_fragments = True
+    cursor = conn.execute(
+        "INSERT INTO text_fragments (hash, text) VALUES (?, ?) ON CONFLICT(hash) DO NOTHING", (digest, text)
+    )
+    if cursor.rowcount:
+        return cursor.lastrowid
+    # Another worker inserted the same text between our SELECT and INSERT.
+    return conn.execute("SELECT id FROM text_fragments WHERE hash = ?", (digest,)).fetchone()['id']
+
+
+def _encode_texts(conn: sqlite3.Connection, texts) -> str:
+    """A list of strings (or an already-encoded mix) -> JSON id array."""
+    ids = [t if isinstance(t, int) else _intern_fragment(conn, str(t)) for t in texts or []]
+    return json.dumps(ids, separators=(',', ':'))
+
+
+def _encode_disclaimer(conn: sqlite3.Connection, text: Optional[str]) -> Optional[int]:
+    return _intern_fragment(conn, text) if text else None
+
+
+def _resolve_fragments(conn: sqlite3.Connection, ids) -> Dict[int, str]:
+    """{id: text} for these fragment ids - from the LRU where possible."""
+    found: Dict[int, str] = {}
+    missing = []
+    shard = conn.shard
+    with _fragment_cache_lock:
+        for fragment_id in set(ids):
+            text = _fragment_cache.get((shard, fragment_id))
+            if text is None:
+                missing.append(fragment_id)
+            else:
+                _fragment_cache.move_to_end((shard, fragment_id))
+                found[fragment_id] = text
+
+    loaded = {}
+    for start in range(0, len(missing), _MAX_IN_PARAMS):
+        chunk = missing[start:start + _MAX_IN_PARAMS]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(f"SELECT id, text FROM text_fragments WHERE id IN ({placeholders})", chunk):
+            loaded[row['id']] = row['text']
+
+    if loaded:
+        with _fragment_cache_lock:
+            _fragment_cache.update(((shard, fragment_id), text) for fragment_id, text in loaded.items())
+            while len(_fragment_cache) > FRAGMENT_CACHE_SIZE:
+                _fragment_cache.popitem(last=False)
+        found.update(loaded)
+    return found
+
+
+def _forget_uncommitted_fragments(pool: threading.local) -> None:
+    """After a rollback that undid fragment inserts, their ids can be handed
+    out again for different text - drop anything cached under them."""
+    if getattr(pool, 'wrote_fragments', False):
+        with _fragment_cache_lock:
+            _fragment_cache.clear()
+
+
+def _fragment_ids(value: Optional[str]) -> List[int]:
+    return [item for item in json.loads(value or '[]') if isinstance(item, int)]
+
+
+def _decode_texts(value: Optional[str], fragments: Dict[int, str]) -> List[str]:
+    """JSON column -> list of strings; ids are resolved, and legacy rows
+    holding the strings themselves pass through unchanged."""
+    return [fragments[item] if isinstance(item, int) else item for item in json.loads(value or '[]')]
+
+
+def _decode_disclaimer(row: sqlite3.Row, fragments: Dict[int, str]) -> Optional[str]:
+    if row['disclaimer'] is not None:
+        return row['disclaimer']
+    return fragments.get(row['disclaimer_id'])
+
+
+def _row_fragments(conn: sqlite3.Connection, rows) -> Dict[int, str]:
+    """{id: text} of every fragment these analysis rows refer to."""
+    ids = set()
+    for row in rows:
+        ids.update(_fragment_ids(row['recommendations']))
+        ids.update(_fragment_ids(row['safety_tips']))
+        if row['disclaimer_id'] is not None:
+            ids.add(row['disclaimer_id'])
+    return _resolve_fragments(conn, ids) if ids else {}
+
+
+def _rows_to_dicts(conn: sqlite3.Connection, to_dict, rows) -> List[Dict]:
+    """Full analysis dicts for these rows, resolving all their fragment ids
+    in one go."""
+    fragments = _row_fragments(conn, rows)
+    return [to_dict(row, fragments) for row in rows]
+
+
+def encode_text_fragments(batch_size: int = 500) -> Dict[str, int]:
+    """
+    Rewrite analysis rows that still store recommendations / safety tips /
+    disclaimer as literal text into fragment ids, `batch_size` rows per
+    transaction, in every history database. Safe to re-run; returns how
+    many rows each table had rewritten.
+    """
+    rewritten = {}
+    for table, _ in _ANALYSIS_TABLES.values():
+        count = 0
+        for shard in _history_databases():
+            count += _encode_table_fragments(table, batch_size, shard)
+        rewritten[table] = count
+        logger.info("Encoded text fragments for %d %s rows", count, table)
+    return rewritten
+
+
+def _encode_table_fragments(table: str, batch_size: int, shard: Optional[int]) -> int:
+    count, last_id = 0, 0
+    while True:
+        with get_connection(write=True, shard=shard) as conn:
+            rows = conn.execute(
+                f"""
+                SELECT id, recommendations, safety_tips, disclaimer FROM {table}
+                WHERE id > ? AND (disclaimer IS NOT NULL
+                                  OR recommendations LIKE '["%' OR safety_tips LIKE '["%')
+                ORDER BY id LIMIT ?
+                """,
+                (last_id, batch_size)
+            ).fetchall()
+            for row in rows:
+                conn.execute(
+                    f"""
+                    UPDATE {table}
+                    SET recommendations = ?, safety_tips = ?, disclaimer = NULL,
+                        disclaimer_id = COALESCE(?, disclaimer_id)
+                    WHERE id = ?
+                    """,
+                    (
+                        _encode_texts(conn, json.loads(row['recommendations'] or '[]')),
+                        _encode_texts(conn, json.loads(row['safety_tips'] or '[]')),
+                        _encode_disclaimer(conn, row['disclaimer']),
+                        row['id'],
+                    )
+                )
+        if not rows:
+            break
+        count += len(rows)
+        last_id = rows[-1]['id']
+    return count
+
+
+def _unreferenced_fragments_sql() -> str:
+    """Ids of the fragments no analysis row in this database refers to."""
+    references = []
+    for table, _ in _ANALYSIS_TABLES.values():
+        for column in ('recommendations', 'safety_tips'):
+            references.append(
+                f"SELECT j.value FROM {table}, "
+                f"json_each(CASE WHEN json_valid({column}) THEN {column} ELSE '[]' END) AS j "
+                "WHERE j.type = 'integer'"
+            )
+        references.append(f"SELECT disclaimer_id FROM {table} WHERE disclaimer_id IS NOT NULL")
+    return f"SELECT id FROM text_fragments WHERE id NOT IN ({' UNION '.join(references)}) ORDER BY id"
+
+
+def sweep_text_fragments(databases: Optional[List[Optional[int]]] = None,
+                         batch_size: int = 500) -> int:
+    """
+    Delete the text fragments no analysis refers to any more, in the given
+    databases (None: the main one and every history shard); returns how
+    many. Finding them means reading every analysis row but takes no lock;
+    the deletes go `batch_size` per transaction.
+
+    A fragment that looks unused may be picked up again by an analysis
+    being written meanwhile, so they're marked first and the rows read
+    again after: a reference written before the mark shows up in that
+    second read, and one written after it cleared the mark
+    (_intern_fragment). Only what's still marked and still unused goes.
+    """
+    swept = 0
+    for shard in (_all_databases() if databases is None else databases):
+        swept += _sweep_fragments(shard, min(batch_size, _MAX_IN_PARAMS))
+    if swept:
+        logger.info("Swept %d unused text fragments", swept)
+    return swept
+
+
+def _sweep_fragments(shard: Optional[int], batch_size: int) -> int:
+    query = _unreferenced_fragments_sql()
+    with get_connection(shard=shard) as conn:
+        candidates = [row['id'] for row in conn.execute(query)]
+    if not candidates:
+        return 0
+    marked_at = _now()
+    for start in range(0, len(candidates), batch_size):
+        chunk = candidates[start:start + batch_size]
+        with get_connection(write=True, shard=shard) as conn:
+            conn.execute(f"UPDATE text_fragments SET unreferenced_at = ? "
+                         f"WHERE id IN ({','.join('?' * len(chunk))})", (marked_at, *chunk))
+    with get_connection(shard=shard) as conn:
+        still_unused = {row['id'] for row in conn.execute(query)}
+    doomed = [fragment_id for fragment_id in candidates if fragment_id in still_unused]
+    deleted = 0
+    for start in range(0, len(doomed), batch_size):
+        chunk = doomed[start:start + batch_size]
+        with get_connection(write=True, shard=shard) as conn:
+            # Another worker's sweep may have re-marked some meanwhile -
+            # then they're for that one to delete.
+            deleted += conn.execute(f"DELETE FROM text_fragments WHERE unreferenced_at = ? "
+                                    f"AND id IN ({','.join('?' * len(chunk))})", (marked_at, *chunk)).rowcount
+        time.sleep(_DELETION_BATCH_PAUSE_SECONDS)
+    return deleted
+
+
+def database_size() -> Dict[str, int]:
+    """Bytes the database files (main and history shards) take on disk, and
+    bytes actually in use (excluding free pages that only VACUUM hands back)."""
+    size = {'file_bytes': 0, 'used_bytes': 0}
+    for shard in _all_databases():
+        with get_connection(shard=shard) as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        size['file_bytes'] += os.path.getsize(DB_PATH if shard is None else shard_path(shard))
+        size['used_bytes'] += (page_count - free_pages) * page_size
+    return size
+
+
+def _outside_transaction(sql: str, shard: Optional[int] = None) -> None:
+    """Run a statement SQLite refuses inside a transaction (VACUUM, WAL
+    checkpoints) on this thread's connection."""
+    if getattr(_pool_for(shard), 'depth', 0):
+        raise RuntimeError(f"{sql} can't run inside get_connection()")
+    _pooled_connection(shard).execute(sql)
+
+
+def vacuum() -> None:
+    """Checkpoint the WAL and rebuild each file so freed pages are returned
+    to the filesystem."""
+    for shard in _all_databases():
+        _outside_transaction("PRAGMA wal_checkpoint(TRUNCATE)", shard)
+        _outside_transaction("VACUUM", shard)
+
+
+# ---------------------------------------------------------------------------
+# History
+# ---------------------------------------------------------------------------
+
+def save_image_analysis(user_id: int, original_filename: str, analysis: Dict,
+                        analysis_id: Optional[int] = None, created_at: Optional[str] = None,
+                        rollup: bool = True) -> int:
+    """
+    Persist one image-analysis result for this user; returns its id.
+    `analysis_id` / `created_at` are only passed by the write-behind
+    history writer, which hands ids out before the row is written (see
+    reserve_analysis_ids) and stamps the time the analysis finished.
+    rollup=False leaves the analytics rollups alone, for an analysis that
+    was counted when it was first saved.
+    """
+    created_at = created_at or _now()
+    with _history_connection(user_id, write=True) as conn:
+        cursor = conn.execute(
             """
             INSERT INTO image_analyses
-                (user_id, created_at, original_filename, detected_conditions,
-                 confidence, urgency, recommendations, safety_tips, disclaimer)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                (id, user_id, created_at, original_filename, detected_conditions,
+                 confidence, urgency, recommendations, safety_tips, disclaimer_id,
+                 speculative_answers)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
+                analysis_id,
                 user_id,
-                _now(),
+                created_at,
                 original_filename,
                 json.dumps(analysis.get('detected_conditions', [])),
                 analysis.get('confidence'),
                 analysis.get('urgency'),
-                json.dumps(analysis.get('recommendations', [])),
-                json.dumps(analysis.get('safety_tips', [])),
-                analysis.get('disclaimer'),
+                _encode_texts(conn, analysis.get('recommendations', [])),
+                _encode_texts(conn, analysis.get('safety_tips', [])),
+                _encode_disclaimer(conn, analysis.get('disclaimer')),
+                _speculative_answers_json(analysis),
             )
         )
-
-
-def save_symptom_analysis(user_id: int, symptom_text: str, analysis: Dict) -> None:
-    """Persist one symptom-check result for this user."""
+        if rollup:
+            _add_to_rollups(conn, _rollup_counts(
+                'image', created_at, analysis.get('urgency'), False, analysis.get('detected_conditions')
+            ))
+    return cursor.lastrowid
+
+
+def save_symptom_analysis(user_id: int, symptom_text: str, analysis: Dict,
+                          analysis_id: Optional[int] = None, created_at: Optional[str] = None,
+                          rollup: bool = True) -> int:
+    """Persist one symptom-check result for this user; returns its id.
+    See save_image_analysis for `analysis_id` / `created_at` / `rollup`."""
     emergency = analysis.get('emergency_alert', {})
     is_emergency = bool(emergency.get('alert')) if isinstance(emergency, dict) else bool(emergency)
 
-    with get_connection() as conn:
-        conn.execute(
+    created_at = created_at or _now()
+    with _history_connection(user_id, write=True) as conn:
+        cursor = conn.execute(
             """
             INSERT INTO symptom_analyses
-                (user_id, created_at, symptom_text, detected_symptoms,
+                (id, user_id, created_at, symptom_text, detected_symptoms,
                  possible_conditions, urgency_level, emergency_alert,
-                 recommendations, safety_tips, disclaimer)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 recommendations, safety_tips, disclaimer_id, speculative_answers)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """,
             (
+                analysis_id,
                 user_id,
-                _now(),
+                created_at,
                 symptom_text,
                 json.dumps(analysis.get('detected_symptoms', [])),
                 json.dumps(analysis.get('possible_conditions', [])),
                 analysis.get('urgency_level'),
                 1 if is_emergency else 0,
-                json.dumps(analysis.get('recommendations', [])),
-                json.dumps(analysis.get('safety_tips', [])),
-                analysis.get('disclaimer'),
+                _encode_texts(conn, analysis.get('recommendations', [])),
+                _encode_texts(conn, analysis.get('safety_tips', [])),
+                _encode_disclaimer(conn, analysis.get('disclaimer')),
+                _speculative_answers_json(analysis),
             )
         )
+        if rollup:
+            _add_to_rollups(conn, _rollup_counts(
+                'symptom', created_at, analysis.get('urgency_level'), is_emergency,
+                analysis.get('possible_conditions')
+            ))
+    return cursor.lastrowid
 
 
-def _row_to_image_dict(row: sqlite3.Row) -> Dict:
+def reserve_analysis_ids(analysis_type: str, count: int, shard: Optional[int] = None) -> int:
+    """
+    Claim `count` consecutive ids of this analysis type for rows that will
+    be inserted later with explicit ids; returns the first one. AUTOINCREMENT
+    never hands out an id at or below sqlite_sequence.seq, so bumping it
+    past the block keeps every other writer - in any process - clear of it.
+    With history shards, ids are reserved in one shard (history_shard(user_id))
+    and only good for rows of users routed there.
+    """
+    table, _ = _ANALYSIS_TABLES[analysis_type]
+    with get_connection(write=True, shard=shard) as conn:
+        # Write first, so the transaction holds the write lock before it reads.
+        bumped = conn.execute(
+            "UPDATE sqlite_sequence SET seq = seq + ? WHERE name = ?", (count, table)
+        ).rowcount
+        if not bumped:
+            # No row yet - the table has never had an AUTOINCREMENT insert.
+            highest = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, highest + count))
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()[0]
+    return seq - count + 1
+
+
+def save_history_batch(records: List[Dict]) -> int:
+    """
+    Insert a batch of queued history records in one transaction. Each record
+    is {'type', 'user_id', 'label', 'analysis', 'analysis_id', 'created_at'}
+    where label is the filename / symptom text. A record that fails (e.g.
+    its user was deleted meanwhile) is logged and skipped without undoing
+    the rest. Returns how many were written. With history shards it's one
+    transaction per shard the batch touches.
+    """
+    savers = {'image': save_image_analysis, 'symptom': save_symptom_analysis}
+    by_shard: Dict[Optional[int], List[Dict]] = {}
+    for record in records:
+        by_shard.setdefault(history_shard(record['user_id']), []).append(record)
+
+    written = 0
+    for shard, shard_records in by_shard.items():
+        with get_connection(write=True, shard=shard):
+            for record in shard_records:
+                try:
+                    savers[record['type']](
+                        record['user_id'], record['label'], record['analysis'],
+                        analysis_id=record['analysis_id'], created_at=record['created_at'],
+                    )
+                    written += 1
+                except sqlite3.Error:
+                    logger.error(
+                        "Dropping queued %s analysis id=%s for user_id=%s",
+                        record['type'], record['analysis_id'], record['user_id'], exc_info=True
+                    )
+    return written
+
+
+def _speculative_answers_json(analysis: Dict) -> Optional[str]:
+    """The analysis' {intent: answer} pre-answered follow-ups (see
+    follow_up_intents), or NULL when there are none - basic mode never
+    produces any."""
+    answers = analysis.get('follow_up_answers')
+    return json.dumps(answers) if answers else None
+
+
+def _row_to_image_dict(row: sqlite3.Row, fragments: Dict[int, str]) -> Dict:
     return {
         'id': row['id'],
         'type': 'image',
@@ -469,13 +1737,13 @@ def _row_to_image_dict(row: sqlite3.Row) -> Dict:
         'detected_conditions': json.loads(row['detected_conditions'] or '[]'),
         'confidence': row['confidence'],
         'urgency': row['urgency'],
-        'recommendations': json.loads(row['recommendations'] or '[]'),
-        'safety_tips': json.loads(row['safety_tips'] or '[]'),
-        'disclaimer': row['disclaimer'],
+        'recommendations': _decode_texts(row['recommendations'], fragments),
+        'safety_tips': _decode_texts(row['safety_tips'], fragments),
+        'disclaimer': _decode_disclaimer(row, fragments),
     }
 
 
-def _row_to_symptom_dict(row: sqlite3.Row) -> Dict:
+def _row_to_symptom_dict(row: sqlite3.Row, fragments: Dict[int, str]) -> Dict:
     return {
         'id': row['id'],
         'type': 'symptom',
@@ -485,35 +1753,1410 @@ def _row_to_symptom_dict(row: sqlite3.Row) -> Dict:
         'possible_conditions': json.loads(row['possible_conditions'] or '[]'),
         'urgency_level': row['urgency_level'],
         'emergency_alert': bool(row['emergency_alert']),
-        'recommendations': json.loads(row['recommendations'] or '[]'),
-        'safety_tips': json.loads(row['safety_tips'] or '[]'),
-        'disclaimer': row['disclaimer'],
+        'recommendations': _decode_texts(row['recommendations'], fragments),
+        'safety_tips': _decode_texts(row['safety_tips'], fragments),
+        'disclaimer': _decode_disclaimer(row, fragments),
     }
 
 
+def get_analysis(user_id: int, analysis_type: str, analysis_id: int) -> Optional[Dict]:
+    """One of this user's analyses by type ('image'/'symptom') and id, or
+    None if it doesn't exist or belongs to someone else. Looks in the
+    archive when it isn't in the hot tables."""
+    table, to_dict = _ANALYSIS_TABLES[analysis_type]
+    with _history_connection(user_id) as conn:
+        cleared_at = _cleared_at(conn, user_id)
+        row = conn.execute(
+            f"SELECT * FROM {table} WHERE id = ? AND user_id = ? AND created_at > ?",
+            (analysis_id, user_id, cleared_at)
+        ).fetchone()
+        if row:
+            return _rows_to_dicts(conn, to_dict, [row])[0]
+        key = (analysis_type, analysis_id)
+        entry = _archived_entries(conn, user_id, [key], cleared_at).get(key)
+        return _archived_analysis(entry) if entry else None
+
+
+def get_speculative_answer(user_id: int, analysis_type: str, analysis_id: int, intent: str) -> Optional[str]:
+    """The answer stored at analysis time for this follow-up intent, if any."""
+    table, _ = _ANALYSIS_TABLES[analysis_type]
+    with _history_connection(user_id) as conn:
+        row = conn.execute(
+            f"SELECT speculative_answers FROM {table} WHERE id = ? AND user_id = ? AND created_at > ?",
+            (analysis_id, user_id, _cleared_at(conn, user_id))
+        ).fetchone()
+    if not row or not row['speculative_answers']:
+        return None
+    return json.loads(row['speculative_answers']).get(intent)
+
+
 def get_history(user_id: int, limit: int = 50) -> List[Dict]:
     """
     Return this user's image + symptom history, newest first, combined into
     a single chronological list capped at `limit` entries.
     """
-    with get_connection() as conn:
-        image_rows = conn.execute(
-            "SELECT * FROM image_analyses WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-            (user_id, limit)
+    return get_history_page(user_id, limit, full=True)['entries']
+
+
+# What a history *listing* shows per entry - title, urgency, timestamp -
+# read from these columns only. The JSON list columns (conditions,
+# recommendations, safety tips) are left unread and undecoded until an
+# entry is expanded and fetched in full through get_analysis().
+_HISTORY_SUMMARY_COLUMNS = {
+    'image': 'id, created_at, original_filename, urgency, confidence',
+    'symptom': 'id, created_at, symptom_text, urgency_level, emergency_alert',
+}
+
+
+def _row_to_image_summary(row: sqlite3.Row) -> Dict:
+    return {
+        'id': row['id'],
+        'type': 'image',
+        'created_at': row['created_at'],
+        'original_filename': row['original_filename'],
+        'urgency': row['urgency'],
+        'confidence': row['confidence'],
+    }
+
+
+def _row_to_symptom_summary(row: sqlite3.Row) -> Dict:
+    return {
+        'id': row['id'],
+        'type': 'symptom',
+        'created_at': row['created_at'],
+        'symptom_text': row['symptom_text'],
+        'urgency_level': row['urgency_level'],
+        'emergency_alert': bool(row['emergency_alert']),
+    }
+
+
+HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 100
+
+# Keyset query for one page of combined history. Each branch walks its own
+# (user_id, created_at) index backwards from the cursor and stops after
+# `limit` + 1 rows, so a page costs the same however far back it is, and the
+# merge happens in SQL. Order is (created_at, kind, id) descending - kind
+# breaks ties between an image and a symptom row with the same timestamp.
+# Only keys come back; the page's rows are then fetched by id. The third
+# branch does the same for archived analyses (see "History archive"), which
+# for most users is one probe finding nothing. :cleared_at
+# bounds the walk from below, so a cleared history that's still waiting to
+# be purged costs nothing to skip.
+_HISTORY_PAGE_SQL = """
+    SELECT kind, id, created_at FROM (
+        SELECT 'image' AS kind, id, created_at FROM image_analyses
+        WHERE user_id = :user_id AND created_at <= :created_at AND created_at > :cleared_at
+          AND (created_at < :created_at OR 'image' < :kind OR ('image' = :kind AND id < :id))
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
+    )
+    UNION ALL
+    SELECT kind, id, created_at FROM (
+        SELECT 'symptom' AS kind, id, created_at FROM symptom_analyses
+        WHERE user_id = :user_id AND created_at <= :created_at AND created_at > :cleared_at
+          AND (created_at < :created_at OR 'symptom' < :kind OR ('symptom' = :kind AND id < :id))
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
+    )
+    UNION ALL
+    SELECT kind, id, created_at FROM (
+        SELECT kind, id, created_at FROM (
+            SELECT CASE id & 1 WHEN 1 THEN 'symptom' ELSE 'image' END AS kind, id >> 1 AS id, created_at
+            FROM archived_analyses
+            WHERE user_id = :user_id AND created_at <= :created_at AND created_at > :cleared_at
+        )
+        WHERE created_at < :created_at OR kind < :kind OR (kind = :kind AND id < :id)
+        ORDER BY created_at DESC, kind DESC, id DESC
+        LIMIT :limit
+    )
+    ORDER BY created_at DESC, kind DESC, id DESC
+    LIMIT :limit
+"""
+
+# Sorts after every real (created_at, kind, id) key - where the first page starts.
+_HISTORY_START = ('\uffff', '\uffff', 0)
+
+
+def encode_history_cursor(created_at: str, kind: str, entry_id: int) -> str:
+    """Opaque cursor pointing just past this entry."""
+    raw = json.dumps([created_at, kind, entry_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_history_cursor(cursor: str):
+    """Inverse of encode_history_cursor; raises ValueError on a bad cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, kind, entry_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid history cursor") from e
+    if not isinstance(created_at, str) or kind not in _ANALYSIS_TABLES or not isinstance(entry_id, int):
+        raise ValueError("Invalid history cursor")
+    return created_at, kind, entry_id
+
+
+def get_history_page(user_id: int, limit: int = HISTORY_PAGE_SIZE, cursor: Optional[str] = None,
+                     full: bool = False) -> Dict:
+    """
+    One page of this user's combined history, newest first:
+    {'entries': [...], 'next_cursor': str or None}. Pass next_cursor back
+    to get the following page; it's None on the last page. Raises
+    ValueError for a malformed cursor.
+
+    Entries are listing summaries unless `full` is set, in which case they
+    are complete analyses, as get_analysis() returns them.
+    """
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    created_at, kind, entry_id = decode_history_cursor(cursor) if cursor else _HISTORY_START
+
+    with _history_connection(user_id) as conn:
+        keys = conn.execute(_HISTORY_PAGE_SQL, {
+            'user_id': user_id, 'created_at': created_at, 'kind': kind, 'id': entry_id, 'limit': limit + 1,
+            'cleared_at': _cleared_at(conn, user_id),
+        }).fetchall()
+        has_more = len(keys) > limit
+        keys = keys[:limit]
+        entries = _fetch_history_entries(conn, user_id, [(key['kind'], key['id']) for key in keys], full)
+
+    next_cursor = None
+    if has_more:
+        last = keys[-1]
+        next_cursor = encode_history_cursor(last['created_at'], last['kind'], last['id'])
+    return {'entries': entries, 'next_cursor': next_cursor}
+
+
+def _fetch_history_entries(conn: sqlite3.Connection, user_id: int, keys, full: bool) -> List[Dict]:
+    """This user's history entries for a list of (kind, id) keys, in the
+    same order - summaries, or complete analyses with `full`. Keys that
+    don't exist (or aren't this user's, or were cleared) are skipped; keys
+    not in the hot tables are looked for in the archive.
+
+    The unary + in `+user_id` keeps SQLite from picking the (user_id,
+    created_at) index - which walks all of the user's rows - over the
+    primary key lookups."""
+    rows = {}
+    cleared_at = _cleared_at(conn, user_id)
+    for analysis_type, (table, to_dict) in _ANALYSIS_TABLES.items():
+        ids = [entry_id for kind, entry_id in keys if kind == analysis_type]
+        if ids:
+            placeholders = ','.join('?' * len(ids))
+            if full:
+                fetched = conn.execute(
+                    f"SELECT * FROM {table} WHERE id IN ({placeholders}) AND +user_id = ? AND created_at > ?",
+                    [*ids, user_id, cleared_at]
+                ).fetchall()
+                entries = _rows_to_dicts(conn, to_dict, fetched)
+            else:
+                columns = _HISTORY_SUMMARY_COLUMNS[analysis_type]
+                fetched = conn.execute(
+                    f"SELECT {columns} FROM {table} WHERE id IN ({placeholders}) AND +user_id = ? AND created_at > ?",
+                    [*ids, user_id, cleared_at]
+                ).fetchall()
+                entries = [_HISTORY_SUMMARIES[analysis_type](row) for row in fetched]
+            for entry in entries:
+                rows[(analysis_type, entry['id'])] = entry
+    archived = _archived_entries(conn, user_id, [key for key in keys if key not in rows], cleared_at)
+    for (analysis_type, entry_id), entry in archived.items():
+        analysis = _archived_analysis(entry)
+        rows[(analysis_type, entry_id)] = analysis if full else dict(
+            _HISTORY_SUMMARIES[analysis_type](analysis), archived=True
+        )
+    return [rows[key] for key in keys if key in rows]
+
+
+_ANALYSIS_TABLES = {
+    'image': ('image_analyses', _row_to_image_dict),
+    'symptom': ('symptom_analyses', _row_to_symptom_dict),
+}
+
+_HISTORY_SUMMARIES = {
+    'image': _row_to_image_summary,
+    'symptom': _row_to_symptom_summary,
+}
+
+def delete_history(user_id: int) -> None:
+    """Clear all stored history for this user. Returns at once: a tombstone
+    hides everything up to now from every read, and purge_deleted() deletes
+    the rows in small batches later. Clearing again just moves it forward."""
+    with _history_connection(user_id, write=True) as conn:
+        conn.execute(
+            """
+            INSERT INTO history_tombstones (user_id, cleared_at) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET cleared_at = MAX(cleared_at, excluded.cleared_at)
+            """,
+            (user_id, _now())
+        )
+    logger.info("Cleared history for user_id=%s", user_id)
+
+
+def _cleared_at(conn: sqlite3.Connection, user_id: int) -> str:
+    """When this user last cleared their history ('' if never): rows
+    created at or before it are hidden until purge_deleted() gets to them."""
+    row = conn.execute("SELECT cleared_at FROM history_tombstones WHERE user_id = ?", (user_id,)).fetchone()
+    return row['cleared_at'] if row else ''
+
+
+# ---------------------------------------------------------------------------
+# History search
+# ---------------------------------------------------------------------------
+#
+# history_search is an FTS5 index over every analysis: its title (symptom
+# text / filename), its conditions and its recommendations. Triggers on the
+# two analysis tables keep it in step, so nothing in Python writes to it.
+#
+# Each analysis is one FTS row. rowid = id * 2 + (0 for image, 1 for
+# symptom), so a trigger finds its row without a lookup table and results
+# map straight back to (kind, id). Per-user scoping is an `owner` column
+# holding a single "u<user_id>" token that every query ANDs in - it's
+# matched from the index, unlike a WHERE on an UNINDEXED column.
+#
+# Ranking is FTS5's own bm25(), column-weighted, in ORDER BY ... LIMIT /
+# OFFSET: it scores the words as the porter tokenizer indexed them ("itching"
+# and "itchy" are one term), every match can be paged to, and a query ranks
+# the same however many matches it has. The price is that bm25() works out
+# each term's document frequency over the whole index - the owner term
+# matches every one of the user's rows - and scores every match before
+# sorting: well under a millisecond for a typical history, but 10-80 ms for
+# a common word in a 100k-analysis one (benchmarks/bench_history_search.py).
+# Snippets are only built for the page being returned.
+
+MAX_SEARCH_TERMS = 8
+
+# Wrapped around matched terms in snippets; app.py escapes the snippet and
+# turns these into <mark> tags. Control characters, so no analysis text
+# realistically contains them.
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+# bm25() weight of a match in owner, title, conditions, recommendations -
+# the owner column matches every row, so it doesn't count.
+_SEARCH_COLUMN_WEIGHTS = (0.0, 10.0, 5.0, 1.0)
+
+_SEARCH_KIND_BIT = {'image': 0, 'symptom': 1}
+
+
+def _search_list_sql(column: str) -> str:
+    """SQL text of a JSON list column's items joined by spaces - fragment
+    ids resolved through text_fragments, legacy plain strings as they are,
+    {'name': ...} objects by name."""
+    return f"""(
+        SELECT group_concat(
+            CASE j.type WHEN 'integer' THEN f.text
+                        WHEN 'object' THEN json_extract(j.value, '$.name')
+                        ELSE j.value END, ' ')
+        FROM json_each(CASE WHEN json_valid({column}) THEN {column} ELSE '[]' END) AS j
+        LEFT JOIN text_fragments AS f ON j.type = 'integer' AND f.id = j.value
+    )"""
+
+
+def _search_document_sql(kind: str, row: str) -> str:
+    """The rowid, owner, title, conditions, recommendations values of one
+    analysis' FTS row, as SQL over `row` (NEW / OLD in a trigger, the
+    table's name in a backfill)."""
+    if kind == 'image':
+        title = f"{row}.original_filename"
+        conditions = _search_list_sql(f"{row}.detected_conditions")
+    else:
+        title = f"{row}.symptom_text"
+        conditions = (f"COALESCE({_search_list_sql(f'{row}.detected_symptoms')}, '') || ' ' || "
+                      f"COALESCE({_search_list_sql(f'{row}.possible_conditions')}, '')")
+    return (f"{row}.id * 2 + {_SEARCH_KIND_BIT[kind]}, 'u' || {row}.user_id, {title}, "
+            f"{conditions}, {_search_list_sql(f'{row}.recommendations')}")
+
+
+_SEARCH_INDEXED_COLUMNS = {
+    'image': 'user_id, original_filename, detected_conditions, recommendations',
+    'symptom': 'user_id, symptom_text, detected_symptoms, possible_conditions, recommendations',
+}
+
+
+def _create_history_search(conn: sqlite3.Connection) -> None:
+    """Create the FTS index and its triggers, backfilling it from the
+    existing analyses the first time."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_search'"
+    ).fetchone()
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS history_search USING fts5(
+            owner, title, conditions, recommendations,
+            tokenize = 'porter unicode61 remove_diacritics 2'
+        )
+    """)
+    for kind, (table, _) in _ANALYSIS_TABLES.items():
+        bit = _SEARCH_KIND_BIT[kind]
+        insert_new = (f"INSERT INTO history_search (rowid, owner, title, conditions, recommendations) "
+                      f"VALUES ({_search_document_sql(kind, 'NEW')});")
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN
+                {insert_new}
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN
+                DELETE FROM history_search WHERE rowid = OLD.id * 2 + {bit};
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_search_update
+            AFTER UPDATE OF {_SEARCH_INDEXED_COLUMNS[kind]} ON {table} BEGIN
+                DELETE FROM history_search WHERE rowid = OLD.id * 2 + {bit};
+                {insert_new}
+            END
+        """)
+    if not exists:
+        indexed = _index_history_search(conn)
+        if indexed:
+            logger.info("Backfilled history_search with %d existing analyses", indexed)
+
+
+def _index_history_search(conn: sqlite3.Connection, kind: Optional[str] = None,
+                          after_id: int = 0, limit: int = -1) -> int:
+    """(Re)index analyses with id > after_id, up to `limit` of them per
+    kind (-1: all). Returns how many rows were written."""
+    indexed = 0
+    for table_kind, (table, _) in _ANALYSIS_TABLES.items():
+        if kind is None or kind == table_kind:
+            indexed += conn.execute(
+                f"INSERT OR REPLACE INTO history_search (rowid, owner, title, conditions, recommendations) "
+                f"SELECT {_search_document_sql(table_kind, table)} FROM {table} "
+                f"WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)
+            ).rowcount
+    return indexed
+
+
+def rebuild_history_search(batch_size: int = 500) -> int:
+    """
+    Re-index every analysis, `batch_size` rows per transaction, and drop
+    index rows whose analysis no longer exists; returns how many analyses
+    were indexed. Only needed if the index is suspected out of step -
+    the triggers keep it current otherwise.
+    """
+    total = sum(_rebuild_shard_search(batch_size, shard) for shard in _history_databases())
+    logger.info("Rebuilt history_search: %d analyses indexed", total)
+    return total
+
+
+def _rebuild_shard_search(batch_size: int, shard: Optional[int]) -> int:
+    total = 0
+    for kind, (table, _) in _ANALYSIS_TABLES.items():
+        last_id = 0
+        while True:
+            with get_connection(write=True, shard=shard) as conn:
+                ids = [row['id'] for row in conn.execute(
+                    f"SELECT id FROM {table} WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+                )]
+                if not ids:
+                    break
+                _index_history_search(conn, kind, last_id, len(ids))
+            total += len(ids)
+            last_id = ids[-1]
+    with get_connection(write=True, shard=shard) as conn:
+        conn.execute(f"""
+            DELETE FROM history_search
+            WHERE (rowid % 2 = {_SEARCH_KIND_BIT['image']} AND rowid / 2 NOT IN (SELECT id FROM image_analyses))
+               OR (rowid % 2 = {_SEARCH_KIND_BIT['symptom']} AND rowid / 2 NOT IN (SELECT id FROM symptom_analyses))
+        """)
+        conn.execute("INSERT INTO history_search (history_search) VALUES ('optimize')")
+    return total
+
+
+def _search_terms(query: str) -> List[str]:
+    return re.findall(r'\w+', query.lower())[:MAX_SEARCH_TERMS]
+
+
+def _search_match(user_id: int, query: str) -> Optional[str]:
+    """The FTS5 MATCH expression for a user's free-text query, or None if
+    it has no searchable words. Every word is quoted, so nothing the user
+    types is parsed as FTS syntax."""
+    terms = _search_terms(query)
+    if not terms:
+        return None
+    quoted = ' '.join(f'"{term}"' for term in terms)
+    return f'owner:u{int(user_id)} AND {{title conditions recommendations}}: ({quoted})'
+
+
+def _search_snippet(conn: sqlite3.Connection, match: str, rowid: int) -> str:
+    """A short excerpt of the first column (title, conditions,
+    recommendations) with a matched word in it. snippet()'s own choice of
+    column (-1) would often pick the owner token, which matches every time."""
+    snippets = conn.execute(
+        f"SELECT {', '.join(f'snippet(history_search, {column}, :start, :end, :ellipsis, 12)' for column in (1, 2, 3))} "
+        "FROM history_search WHERE history_search MATCH :match AND rowid = :rowid",
+        {'start': SNIPPET_START, 'end': SNIPPET_END, 'ellipsis': '…', 'match': match, 'rowid': rowid}
+    ).fetchone()
+    for snippet in snippets:
+        if snippet and SNIPPET_START in snippet:
+            return snippet
+    return snippets[0] or ''
+
+
+def search_history(user_id: int, query: str, limit: int = HISTORY_PAGE_SIZE, offset: int = 0) -> Dict:
+    """
+    Rank this user's analyses against a free-text query, best match first:
+    {'results': [summary + 'snippet', ...], 'next_offset': int or None}.
+    Snippets mark matched words with SNIPPET_START / SNIPPET_END.
+    """
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    offset = max(0, offset)
+    match = _search_match(user_id, query)
+    if match is None:
+        return {'results': [], 'next_offset': None}
+
+    weights = ', '.join(str(weight) for weight in _SEARCH_COLUMN_WEIGHTS)
+    with _history_connection(user_id) as conn:
+        # One row past the page, to tell whether there's another.
+        page = conn.execute(
+            f"SELECT rowid FROM history_search WHERE history_search MATCH ? "
+            f"ORDER BY bm25(history_search, {weights}), rowid DESC LIMIT ? OFFSET ?",
+            (match, limit + 1, offset)
+        ).fetchall()
+        more = len(page) > limit
+        page = page[:limit]
+
+        keys = [('symptom' if row['rowid'] & 1 else 'image', row['rowid'] >> 1) for row in page]
+        entries = _fetch_history_entries(conn, user_id, keys, full=False)
+        by_key = {(entry['type'], entry['id']): entry for entry in entries}
+        results = []
+        for key, row in zip(keys, page):
+            entry = by_key.get(key)
+            if entry is None:
+                continue
+            entry['snippet'] = _search_snippet(conn, match, row['rowid'])
+            results.append(entry)
+
+    return {'results': results, 'next_offset': offset + limit if more else None}
+
+
+
+# ---------------------------------------------------------------------------
+# Follow-up conversations
+# ---------------------------------------------------------------------------
+
+# follow_ups / follow_up_summaries point at their analysis through one of
+# two nullable foreign keys, depending on the analysis type.
+_FOLLOW_UP_FK = {'image': 'image_analysis_id', 'symptom': 'symptom_analysis_id'}
+
+
+def save_follow_up(user_id: int, analysis_type: str, analysis_id: int, question: str, answer: str) -> int:
+    """Store one follow-up question/answer turn; returns its id."""
+    fk = _FOLLOW_UP_FK[analysis_type]
+    with _history_connection(user_id) as conn:
+        cursor = conn.execute(
+            f"INSERT INTO follow_ups (user_id, {fk}, created_at, question, answer) VALUES (?, ?, ?, ?, ?)",
+            (user_id, analysis_id, _now(), question, answer)
+        )
+    return cursor.lastrowid
+
+
+def get_follow_ups(user_id: int, analysis_type: str, analysis_id: int) -> List[Dict]:
+    """Every stored follow-up turn for an analysis, oldest first."""
+    fk = _FOLLOW_UP_FK[analysis_type]
+    with _history_connection(user_id) as conn:
+        rows = conn.execute(
+            f"SELECT id, created_at, question, answer FROM follow_ups WHERE {fk} = ? ORDER BY id",
+            (analysis_id,)
         ).fetchall()
-        symptom_rows = conn.execute(
-            "SELECT * FROM symptom_analyses WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-            (user_id, limit)
+    return [dict(row) for row in rows]
+
+
+def get_follow_up_context(user_id: int, analysis_type: str, analysis_id: int, window: int) -> Dict:
+    """
+    What a follow-up prompt needs, without replaying the whole thread:
+    the rolling summary of older turns, the `window` most recent turns
+    verbatim, and `evicted` - turns that have slid out of the window but
+    aren't in the summary yet (the caller folds those in incrementally).
+    Only turns newer than the summary are read.
+    """
+    fk = _FOLLOW_UP_FK[analysis_type]
+    with _history_connection(user_id) as conn:
+        summary_row = conn.execute(
+            f"SELECT summary, through_follow_up_id FROM follow_up_summaries WHERE {fk} = ?",
+            (analysis_id,)
+        ).fetchone()
+        through_id = summary_row['through_follow_up_id'] if summary_row else 0
+        rows = conn.execute(
+            f"SELECT id, created_at, question, answer FROM follow_ups WHERE {fk} = ? AND id > ? ORDER BY id",
+            (analysis_id, through_id)
         ).fetchall()
 
-    combined = [_row_to_image_dict(r) for r in image_rows] + [_row_to_symptom_dict(r) for r in symptom_rows]
-    combined.sort(key=lambda entry: entry['created_at'], reverse=True)
-    return combined[:limit]
+    turns = [dict(row) for row in rows]
+    split = max(0, len(turns) - window)
+    return {
+        'summary': summary_row['summary'] if summary_row else None,
+        'recent': turns[split:],
+        'evicted': turns[:split],
+    }
 
 
-def delete_history(user_id: int) -> None:
-    """Clear all stored history for this user."""
+def save_follow_up_summary(user_id: int, analysis_type: str, analysis_id: int, summary: str,
+                           through_follow_up_id: int) -> None:
+    """Replace the rolling summary, recording the last turn folded into it."""
+    fk = _FOLLOW_UP_FK[analysis_type]
+    with _history_connection(user_id) as conn:
+        conn.execute(
+            f"""
+            INSERT INTO follow_up_summaries ({fk}, summary, through_follow_up_id, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT({fk}) DO UPDATE SET
+                summary = excluded.summary,
+                through_follow_up_id = excluded.through_follow_up_id,
+                updated_at = excluded.updated_at
+            """,
+            (analysis_id, summary, through_follow_up_id, _now())
+        )
+
+
+# ---------------------------------------------------------------------------
+# History archive
+# ---------------------------------------------------------------------------
+#
+# History only grows, and almost nobody reads entries from months ago - but
+# they sit in the same tables, indexes and page cache as this week's. With
+# HISTORY_ARCHIVE_AFTER_DAYS set, archive_history() moves whole calendar
+# months of analyses older than that out of image_analyses /
+# symptom_analyses into history_archive_blocks: each block holds up to
+# HISTORY_ARCHIVE_BLOCK_SIZE analyses of one user and one month, with
+# their follow-ups, as zlib-compressed JSON (fragment ids resolved, so a
+# block means the same in any file). archived_analyses keeps one small row
+# per archived analysis - enough for history pages to find it.
+#
+# Reads are transparent: get_analysis() and history pages fall back to the
+# archive, at the cost of decompressing a block (entries from it carry
+# 'archived': True). Search only covers the hot tables. Asking a follow-up
+# about an archived analysis moves it back (restore_archived_analysis()),
+# and an analysis with recent follow-ups is never archived.
+
+HISTORY_ARCHIVE_AFTER_DAYS = int(os.getenv('HISTORY_ARCHIVE_AFTER_DAYS', '0'))
+HISTORY_ARCHIVE_BLOCK_SIZE = int(os.getenv('HISTORY_ARCHIVE_BLOCK_SIZE', '50'))
+
+_HISTORY_LABELS = {'image': 'original_filename', 'symptom': 'symptom_text'}
+
+
+def _archive_key(analysis_type: str, analysis_id: int) -> int:
+    return analysis_id * 2 + _SEARCH_KIND_BIT[analysis_type]
+
+
+def _pack_block(entries: List[Dict]) -> bytes:
+    return zlib.compress(json.dumps(entries, separators=(',', ':')).encode(), 9)
+
+
+def _unpack_block(payload: bytes) -> List[Dict]:
+    return json.loads(zlib.decompress(payload))
+
+
+def _archive_cutoff(older_than_days: int) -> str:
+    """The start of the month `older_than_days` ago: only months that ended
+    before it are archived, so each month's blocks are written once."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    return cutoff.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
+
+
+def archive_history(older_than_days: int = HISTORY_ARCHIVE_AFTER_DAYS,
+                    block_size: int = HISTORY_ARCHIVE_BLOCK_SIZE) -> int:
+    """
+    Move analyses from months that ended more than `older_than_days` ago
+    into compressed archive blocks, one block per transaction; returns how
+    many were moved. Does nothing when older_than_days is 0. Run
+    periodically (see app.py) and from `manage.py archive-history`.
+    """
+    if older_than_days <= 0:
+        return 0
+    cutoff = _archive_cutoff(older_than_days)
+    archived = 0
+    for shard in _history_databases():
+        for analysis_type, (table, _) in _ANALYSIS_TABLES.items():
+            user_id = 0
+            while True:
+                # The next user's oldest analysis: one seek into (user_id, created_at).
+                with get_connection(shard=shard) as conn:
+                    row = conn.execute(
+                        f"SELECT user_id, created_at FROM {table} WHERE user_id > ? "
+                        "ORDER BY user_id, created_at LIMIT 1",
+                        (user_id,)
+                    ).fetchone()
+                if row is None:
+                    break
+                user_id = row['user_id']
+                if row['created_at'] < cutoff:
+                    archived += _archive_user_history(shard, user_id, analysis_type, cutoff, block_size)
+    if archived:
+        logger.info("Archived %d analyses from before %s", archived, cutoff)
+        # Blocks hold the texts themselves, so the fragments only the moved
+        # rows used are unused now.
+        sweep_text_fragments(_history_databases())
+    return archived
+
+
+def _archive_user_history(shard: Optional[int], user_id: int, analysis_type: str, cutoff: str,
+                          block_size: int) -> int:
+    table, to_dict = _ANALYSIS_TABLES[analysis_type]
+    fk = _FOLLOW_UP_FK[analysis_type]
+    archived = 0
+    while True:
+        with get_connection(write=True, shard=shard) as conn:
+            rows = conn.execute(
+                f"""
+                SELECT * FROM {table} AS a
+                WHERE user_id = ? AND created_at < ? AND created_at > ?
+                  AND NOT EXISTS (SELECT 1 FROM follow_ups WHERE {fk} = a.id AND created_at >= ?)
+                ORDER BY created_at LIMIT ?
+                """,
+                (user_id, cutoff, _cleared_at(conn, user_id), cutoff, block_size)
+            ).fetchall()
+            if not rows:
+                return archived
+            month = rows[0]['created_at'][:7]
+            rows = [row for row in rows if row['created_at'][:7] == month]
+            ids = [row['id'] for row in rows]
+            placeholders = ','.join('?' * len(ids))
+            follow_ups: Dict[int, List[Dict]] = {}
+            for follow_up in conn.execute(f"SELECT * FROM follow_ups WHERE {fk} IN ({placeholders}) ORDER BY id", ids):
+                follow_ups.setdefault(follow_up[fk], []).append(dict(follow_up))
+            # Without their ids - nothing refers to them.
+            summaries = {summary[fk]: {key: summary[key] for key in summary.keys() if key != 'id'}
+                         for summary in conn.execute(
+                             f"SELECT * FROM follow_up_summaries WHERE {fk} IN ({placeholders})", ids)}
+
+            entries = [{
+                'analysis': analysis,
+                'follow_up_answers': json.loads(row['speculative_answers'] or 'null'),
+                'follow_ups': follow_ups.get(row['id'], []),
+                'summary': summaries.get(row['id']),
+            } for row, analysis in zip(rows, _rows_to_dicts(conn, to_dict, rows))]
+            block_id = conn.execute(
+                "INSERT INTO history_archive_blocks (user_id, last_created_at, entry_count, payload) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id, rows[-1]['created_at'], len(rows), _pack_block(entries))
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO archived_analyses (id, user_id, created_at, block_id) VALUES (?, ?, ?, ?)",
+                [(_archive_key(analysis_type, row['id']), user_id, row['created_at'], block_id) for row in rows]
+            )
+            # Follow-ups, summaries and search entries go with them.
+            conn.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", ids)
+        archived += len(rows)
+
+
+def _archived_entries(conn: sqlite3.Connection, user_id: int, keys, cleared_at: str) -> Dict[tuple, Dict]:
+    """{(kind, id): archive entry} for those of these keys that are this
+    user's archived analyses, decompressing each block needed once."""
+    by_key = {_archive_key(kind, entry_id): (kind, entry_id) for kind, entry_id in keys}
+    if not by_key:
+        return {}
+    placeholders = ','.join('?' * len(by_key))
+    located = conn.execute(
+        f"SELECT id, block_id FROM archived_analyses WHERE id IN ({placeholders}) AND +user_id = ? AND created_at > ?",
+        [*by_key, user_id, cleared_at]
+    ).fetchall()
+    blocks: Dict[int, List[int]] = {}
+    for row in located:
+        blocks.setdefault(row['block_id'], []).append(row['id'])
+
+    entries = {}
+    for block_id, archive_keys in blocks.items():
+        payload = conn.execute("SELECT payload FROM history_archive_blocks WHERE id = ?", (block_id,)).fetchone()[0]
+        in_block = {_archive_key(entry['analysis']['type'], entry['analysis']['id']): entry
+                    for entry in _unpack_block(payload)}
+        for archive_key in archive_keys:
+            entries[by_key[archive_key]] = in_block[archive_key]
+    return entries
+
+
+def _insert_row(conn: sqlite3.Connection, table: str, values: Dict) -> None:
+    conn.execute(f"INSERT INTO {table} ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+                 list(values.values()))
+
+
+def _archived_analysis(entry: Dict) -> Dict:
+    return dict(entry['analysis'], archived=True)
+
+
+def restore_archived_analysis(user_id: int, analysis_type: str, analysis_id: int) -> bool:
+    """Move one archived analysis, with its follow-ups, back into the hot
+    tables under its old id. Returns False if it isn't this user's
+    archived analysis."""
+    table, _ = _ANALYSIS_TABLES[analysis_type]
+    saver = {'image': save_image_analysis, 'symptom': save_symptom_analysis}[analysis_type]
+    key = (analysis_type, analysis_id)
+    with _history_connection(user_id, write=True) as conn:
+        entry = _archived_entries(conn, user_id, [key], _cleared_at(conn, user_id)).get(key)
+        if entry is None:
+            return False
+        analysis = dict(entry['analysis'], follow_up_answers=entry['follow_up_answers'])
+        saver(user_id, analysis[_HISTORY_LABELS[analysis_type]], analysis,
+              analysis_id=analysis_id, created_at=analysis['created_at'], rollup=False)
+        for follow_up in entry['follow_ups']:
+            _insert_row(conn, 'follow_ups', follow_up)
+        if entry['summary']:
+            _insert_row(conn, 'follow_up_summaries', entry['summary'])
+        archive_key = _archive_key(*key)
+        block_id = conn.execute("SELECT block_id FROM archived_analyses WHERE id = ?", (archive_key,)).fetchone()[0]
+        conn.execute("DELETE FROM archived_analyses WHERE id = ?", (archive_key,))
+        # The block keeps the entry's copy until none of its entries are left.
+        conn.execute(
+            "DELETE FROM history_archive_blocks WHERE id = ? "
+            "AND NOT EXISTS (SELECT 1 FROM archived_analyses WHERE block_id = ?)",
+            (block_id, block_id)
+        )
+    logger.info("Restored archived %s analysis %s for user_id=%s", analysis_type, analysis_id, user_id)
+    return True
+
+
+# ---------------------------------------------------------------------------
+# History export
+# ---------------------------------------------------------------------------
+#
+# A complete copy of one user's history - every analysis in full, hot or
+# archived, with its follow-up turns - for the user or for compliance
+# requests. export_history() walks it newest first with the history page
+# query, HISTORY_EXPORT_CHUNK_SIZE entries per short read transaction, and
+# yields them one by one: memory use stays flat however long the history
+# is, and no transaction is held open while a slow client reads. Every
+# entry comes with a cursor that resumes the export just after it.
+
+HISTORY_EXPORT_CHUNK_SIZE = int(os.getenv('HISTORY_EXPORT_CHUNK_SIZE', '200'))
+
+
+def export_history(user_id: int, cursor: Optional[str] = None,
+                   chunk_size: int = HISTORY_EXPORT_CHUNK_SIZE) -> Iterator[Tuple[Dict, str]]:
+    """
+    (entry, cursor) for each of this user's analyses, newest first, each
+    as get_analysis() returns it plus 'follow_ups' (oldest first). Passing
+    an entry's cursor back starts after that entry. Raises ValueError for
+    a malformed cursor straight away, before anything is read.
+    """
+    start = decode_history_cursor(cursor) if cursor else _HISTORY_START
+    return _export_chunks(user_id, start, max(1, chunk_size))
+
+
+def _export_chunks(user_id: int, start: tuple, chunk_size: int) -> Iterator[Tuple[Dict, str]]:
+    created_at, kind, entry_id = start
+    while True:
+        with _history_connection(user_id) as conn:
+            keys = conn.execute(_HISTORY_PAGE_SQL, {
+                'user_id': user_id, 'created_at': created_at, 'kind': kind, 'id': entry_id, 'limit': chunk_size,
+                'cleared_at': _cleared_at(conn, user_id),
+            }).fetchall()
+            entries = _fetch_history_entries(conn, user_id, [(key['kind'], key['id']) for key in keys], full=True)
+            _attach_follow_ups(conn, user_id, entries)
+        for entry in entries:
+            yield entry, encode_history_cursor(entry['created_at'], entry['type'], entry['id'])
+        if len(keys) < chunk_size:
+            return
+        created_at, kind, entry_id = keys[-1]['created_at'], keys[-1]['kind'], keys[-1]['id']
+
+
+def _attach_follow_ups(conn: sqlite3.Connection, user_id: int, entries: List[Dict]) -> None:
+    """Add each entry's follow-up turns - from follow_ups, or for archived
+    entries from their archive block."""
+    turns: Dict[tuple, List[Dict]] = {}
+    for analysis_type, fk in _FOLLOW_UP_FK.items():
+        ids = [entry['id'] for entry in entries if entry['type'] == analysis_type and not entry.get('archived')]
+        if ids:
+            rows = conn.execute(
+                f"SELECT {fk} AS analysis_id, created_at, question, answer FROM follow_ups "
+                f"WHERE {fk} IN ({','.join('?' * len(ids))}) ORDER BY id", ids
+            )
+            for row in rows:
+                turns.setdefault((analysis_type, row['analysis_id']), []).append(
+                    {'created_at': row['created_at'], 'question': row['question'], 'answer': row['answer']}
+                )
+    archived = [(entry['type'], entry['id']) for entry in entries if entry.get('archived')]
+    for key, entry in _archived_entries(conn, user_id, archived, _cleared_at(conn, user_id)).items():
+        turns[key] = [{'created_at': turn['created_at'], 'question': turn['question'], 'answer': turn['answer']}
+                      for turn in entry['follow_ups']]
+    for entry in entries:
+        entry['follow_ups'] = turns.get((entry['type'], entry['id']), [])
+
+
+# ---------------------------------------------------------------------------
+# Analytics rollups
+# ---------------------------------------------------------------------------
+#
+# Daily trends - how many analyses, how urgent, how many emergency alerts,
+# which conditions come up most - would otherwise mean decoding the JSON of
+# every history row. Instead each save adds its analysis to two small tables
+# in the same transaction: analysis_rollups, counting per (day, kind,
+# urgency), and condition_rollups, per (day, condition). They count analyses
+# as they are made - deleting or archiving history doesn't take them back
+# out. rollup_report() reads only these, so what it costs depends on the
+# days asked for, not on how much history there is. rebuild_rollups()
+# recomputes them from the stored history, for backfilling.
+
+ROLLUP_MAX_DAYS = 366
+_MAX_CONDITION_LENGTH = 100
+_MAX_URGENCY_LENGTH = 20
+
+
+def _condition_names(conditions) -> List[str]:
+    """Distinct, lower-cased names from a conditions list - plain strings,
+    or dicts with a 'name' (both occur)."""
+    names = set()
+    for condition in conditions or []:
+        name = condition.get('name') if isinstance(condition, dict) else condition
+        if isinstance(name, str) and name.strip():
+            names.add(name.strip().lower()[:_MAX_CONDITION_LENGTH])
+    return sorted(names)
+
+
+def _rollup_counts(analysis_type: str, created_at: str, urgency: Optional[str], emergency: bool,
+                   conditions) -> Dict:
+    """One analysis' contribution to the rollups:
+    {'analyses': {(day, kind, urgency): [analyses, emergency_alerts]},
+     'conditions': {(day, condition): analyses}}."""
+    day = created_at[:10]
+    urgency = str(urgency).strip().lower()[:_MAX_URGENCY_LENGTH] if urgency else 'unknown'
+    return {
+        'analyses': {(day, analysis_type, urgency): [1, 1 if emergency else 0]},
+        'conditions': {(day, name): 1 for name in _condition_names(conditions)},
+    }
+
+
+def _merge_rollup_counts(total: Dict, counts: Dict, sign: int = 1) -> Dict:
+    for key, (analyses, alerts) in counts['analyses'].items():
+        current = total['analyses'].setdefault(key, [0, 0])
+        current[0] += sign * analyses
+        current[1] += sign * alerts
+    for key, analyses in counts['conditions'].items():
+        total['conditions'][key] = total['conditions'].get(key, 0) + sign * analyses
+    return total
+
+
+def _add_to_rollups(conn: sqlite3.Connection, counts: Dict) -> None:
+    conn.executemany(
+        """
+        INSERT INTO analysis_rollups (day, kind, urgency, analyses, emergency_alerts) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day, kind, urgency) DO UPDATE SET
+            analyses = analyses + excluded.analyses,
+            emergency_alerts = emergency_alerts + excluded.emergency_alerts
+        """,
+        [(*key, analyses, alerts) for key, (analyses, alerts) in counts['analyses'].items()]
+    )
+    conn.executemany(
+        """
+        INSERT INTO condition_rollups (day, condition, analyses) VALUES (?, ?, ?)
+        ON CONFLICT(day, condition) DO UPDATE SET analyses = analyses + excluded.analyses
+        """,
+        [(*key, analyses) for key, analyses in counts['conditions'].items()]
+    )
+
+
+def _read_rollups(conn: sqlite3.Connection) -> Dict:
+    return {
+        'analyses': {(row['day'], row['kind'], row['urgency']): [row['analyses'], row['emergency_alerts']]
+                     for row in conn.execute("SELECT * FROM analysis_rollups")},
+        'conditions': {(row['day'], row['condition']): row['analyses']
+                       for row in conn.execute("SELECT * FROM condition_rollups")},
+    }
+
+
+def _empty_rollups() -> Dict:
+    return {'analyses': {}, 'conditions': {}}
+
+
+def rollup_report(days: int = 30, top: int = 10) -> Dict:
+    """
+    The last `days` days (UTC, today included) of rollups, summed over
+    every history database:
+    {'since': 'YYYY-MM-DD', 'days': [{'day', 'analyses', 'by_kind',
+     'by_urgency', 'emergency_alerts', 'top_conditions'}, ...] (oldest
+     first, days without analyses left out), 'top_conditions': [...]}
+    with each top_conditions list the `top` most frequent
+    [{'condition', 'analyses'}].
+    """
+    days = max(1, min(days, ROLLUP_MAX_DAYS))
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date().isoformat()
+    per_day: Dict[str, Dict] = {}
+    conditions: Dict[str, Dict[str, int]] = {}
+    for shard in _history_databases():
+        with get_connection(shard=shard) as conn:
+            for row in conn.execute("SELECT * FROM analysis_rollups WHERE day >= ?", (since,)):
+                day = per_day.setdefault(row['day'], {'day': row['day'], 'analyses': 0, 'by_kind': {},
+                                                      'by_urgency': {}, 'emergency_alerts': 0})
+                day['analyses'] += row['analyses']
+                day['by_kind'][row['kind']] = day['by_kind'].get(row['kind'], 0) + row['analyses']
+                day['by_urgency'][row['urgency']] = day['by_urgency'].get(row['urgency'], 0) + row['analyses']
+                day['emergency_alerts'] += row['emergency_alerts']
+            for row in conn.execute("SELECT * FROM condition_rollups WHERE day >= ?", (since,)):
+                counts = conditions.setdefault(row['day'], {})
+                counts[row['condition']] = counts.get(row['condition'], 0) + row['analyses']
+
+    def most_common(counts: Dict[str, int]) -> List[Dict]:
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:top]
+        return [{'condition': name, 'analyses': count} for name, count in ranked]
+
+    overall: Dict[str, int] = {}
+    for day_counts in conditions.values():
+        for name, count in day_counts.items():
+            overall[name] = overall.get(name, 0) + count
+    for day, entry in per_day.items():
+        entry['top_conditions'] = most_common(conditions.get(day, {}))
+    return {
+        'since': since,
+        'days': [per_day[day] for day in sorted(per_day)],
+        'top_conditions': most_common(overall),
+    }
+
+
+def rebuild_rollups() -> int:
+    """
+    Recompute the rollups from the history that's stored - hot and
+    archived - replacing what's there; returns how many analyses were
+    counted. Used to backfill history saved before rollups existed.
+
+    Each database is read in one snapshot while the app carries on
+    writing. Whatever was saved meanwhile has already been added to the
+    live rollups by the save functions, so that difference is carried over
+    when the result is written, in one short transaction.
+    """
+    counted = 0
+    for shard in _history_databases():
+        counts = _empty_rollups()
+        with get_connection(shard=shard) as conn:
+            before = _read_rollups(conn)
+            for row in conn.execute("SELECT created_at, urgency, detected_conditions FROM image_analyses"):
+                _merge_rollup_counts(counts, _rollup_counts(
+                    'image', row['created_at'], row['urgency'], False, json.loads(row['detected_conditions'] or '[]')
+                ))
+                counted += 1
+            for row in conn.execute(
+                "SELECT created_at, urgency_level, emergency_alert, possible_conditions FROM symptom_analyses"
+            ):
+                _merge_rollup_counts(counts, _rollup_counts(
+                    'symptom', row['created_at'], row['urgency_level'], bool(row['emergency_alert']),
+                    json.loads(row['possible_conditions'] or '[]')
+                ))
+                counted += 1
+            for block in conn.execute("SELECT payload FROM history_archive_blocks"):
+                for entry in _unpack_block(block['payload']):
+                    analysis = entry['analysis']
+                    if analysis['type'] == 'image':
+                        contribution = _rollup_counts('image', analysis['created_at'], analysis['urgency'],
+                                                      False, analysis['detected_conditions'])
+                    else:
+                        contribution = _rollup_counts('symptom', analysis['created_at'], analysis['urgency_level'],
+                                                      analysis['emergency_alert'], analysis['possible_conditions'])
+                    _merge_rollup_counts(counts, contribution)
+                    counted += 1
+
+        with get_connection(write=True, shard=shard) as conn:
+            saved_meanwhile = _merge_rollup_counts(_read_rollups(conn), before, sign=-1)
+            _merge_rollup_counts(counts, saved_meanwhile)
+            conn.execute("DELETE FROM analysis_rollups")
+            conn.execute("DELETE FROM condition_rollups")
+            _add_to_rollups(conn, {
+                'analyses': {key: value for key, value in counts['analyses'].items() if value[0]},
+                'conditions': {key: value for key, value in counts['conditions'].items() if value},
+            })
+    logger.info("Rebuilt analytics rollups from %d analyses", counted)
+    return counted
+
+
+# ---------------------------------------------------------------------------
+# Deferred deletion
+# ---------------------------------------------------------------------------
+#
+# Deleting an account or clearing history used to be one DELETE, with the
+# follow-ups, summaries and search entries going in its cascade - for a
+# heavy user, seconds of holding the write lock that every other writer
+# waits on. Now delete_user() / delete_history() only leave a tombstone
+# (users.deleted_at, a history_tombstones row) that hides the data at once,
+# and purge_deleted() deletes it DELETION_BATCH_SIZE rows per transaction,
+# pausing between batches so queued writers get the lock. All of its
+# progress is the data itself - a crashed or interrupted purge just carries
+# on from what's left next time. It runs as a periodic job (see app.py) and
+# from `manage.py purge-deleted`.
+
+DELETION_BATCH_SIZE = int(os.getenv('DELETION_BATCH_SIZE', '500'))
+
+# Between batches: long enough for a writer in SQLite's busy handler (which
+# polls at growing intervals) to grab the lock before the next batch does.
+_DELETION_BATCH_PAUSE_SECONDS = 0.02
+
+# Sorts after every created_at: "all of it", for deleted accounts.
+_ALL_HISTORY = '\uffff'
+
+# Table and the column its age is judged by. Follow-ups first, so an
+# analysis' cascade never has many to take with it; archive index rows
+# before the blocks they point into.
+_PURGED_TABLES = (
+    ('follow_ups', 'created_at'),
+    ('image_analyses', 'created_at'),
+    ('symptom_analyses', 'created_at'),
+    ('archived_analyses', 'created_at'),
+    ('history_archive_blocks', 'last_created_at'),
+)
+
+
+def purge_deleted(batch_size: int = DELETION_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Delete what delete_user() and delete_history() left tombstoned: the
+    history of deleted accounts and then their users row, and cleared
+    history, then the text fragments only that history used. Returns
+    {'history_rows': ..., 'users': ..., 'fragments': ...} purged.
+    """
+    purged = {'history_rows': 0, 'users': 0, 'fragments': 0}
+    purged_from = set()
     with get_connection() as conn:
-        conn.execute("DELETE FROM image_analyses WHERE user_id = ?", (user_id,))
-        conn.execute("DELETE FROM symptom_analyses WHERE user_id = ?", (user_id,))
-    logger.info("Cleared history for user_id=%s", user_id)
+        deleted_users = [row['id'] for row in conn.execute("SELECT id FROM users WHERE deleted_at IS NOT NULL")]
+    for user_id in deleted_users:
+        shard = history_shard(user_id)
+        rows = _purge_history(shard, user_id, _ALL_HISTORY, batch_size)
+        if rows:
+            purged['history_rows'] += rows
+            purged_from.add(shard)
+        with get_connection(write=True) as conn:
+            purged['users'] += conn.execute(
+                "DELETE FROM users WHERE id = ? AND deleted_at IS NOT NULL", (user_id,)
+            ).rowcount
+
+    for shard in _history_databases():
+        with get_connection(shard=shard) as conn:
+            tombstones = conn.execute("SELECT user_id, cleared_at FROM history_tombstones").fetchall()
+        for tombstone in tombstones:
+            rows = _purge_history(shard, tombstone['user_id'], tombstone['cleared_at'], batch_size)
+            if rows:
+                purged['history_rows'] += rows
+                purged_from.add(shard)
+            with get_connection(write=True, shard=shard) as conn:
+                # Unless the user cleared again meanwhile - then it's next run's.
+                conn.execute("DELETE FROM history_tombstones WHERE user_id = ? AND cleared_at = ?",
+                             (tombstone['user_id'], tombstone['cleared_at']))
+
+    if purged_from:
+        purged['fragments'] = sweep_text_fragments(list(purged_from), batch_size)
+    if any(purged.values()):
+        logger.info("Purged deleted data: %d history rows, %d users, %d text fragments",
+                    purged['history_rows'], purged['users'], purged['fragments'])
+    return purged
+
+
+def _purge_history(shard: Optional[int], user_id: int, through: str, batch_size: int) -> int:
+    """Delete this user's follow-ups and analyses, hot and archived, created
+    at or before `through`, `batch_size` rows per transaction; returns how
+    many. A follow-up is always newer than its analysis, so one created
+    after `through` stays even when its analysis is deleted here - the
+    ON DELETE CASCADE on follow_ups (and follow_up_summaries) removes it
+    with the analysis."""
+    deleted = 0
+    for table, created_at in _PURGED_TABLES:
+        while True:
+            with get_connection(write=True, shard=shard) as conn:
+                count = conn.execute(
+                    f"DELETE FROM {table} WHERE rowid IN "
+                    f"(SELECT rowid FROM {table} WHERE user_id = ? AND {created_at} <= ? LIMIT ?)",
+                    (user_id, through, batch_size)
+                ).rowcount
+            deleted += count
+            if count < batch_size:
+                break
+            time.sleep(_DELETION_BATCH_PAUSE_SECONDS)
+    return deleted
+
+
+# ---------------------------------------------------------------------------
+# History shards
+# ---------------------------------------------------------------------------
+#
+# SQLite has one writer per file, so with all history in quickaid.db every
+# worker's history insert queues behind every other's (and behind account
+# writes). With HISTORY_SHARDS=N the analysis, follow-up, fragment and
+# search tables live in N extra files next to the main database instead,
+# and each user's history goes to the file picked by a hash of their id -
+# inserts for users on different shards commit in parallel. users and
+# user_tokens stay in the main database; shard rows can't have a foreign
+# key to them, so purge_deleted() deletes a deleted user's history explicitly.
+#
+# The layout is recorded in the history_shards table. Each shard file is
+# named after its slot there, and numbers its analyses and follow-ups from
+# slot * _SHARD_ID_RANGE up, so ids are unique across every shard ever
+# created and rows keep theirs when reshard() moves them to a new layout.
+# HISTORY_SHARDS=0 (the default) keeps history in the main database.
+
+HISTORY_SHARDS = int(os.getenv('HISTORY_SHARDS', '0'))
+
+_SHARD_ID_RANGE = 1 << 32
+_SHARD_SEQUENCED_TABLES = ('image_analyses', 'symptom_analyses', 'follow_ups', 'history_archive_blocks')
+
+# Active shard slots in routing order, loaded from history_shards on first
+# use (None: not loaded yet).
+_active_shards: Optional[List[int]] = None
+
+
+def shard_path(slot: int) -> str:
+    """The file history shard `slot` lives in."""
+    return f"{os.path.splitext(DB_PATH)[0]}.history-{slot}.db"
+
+
+def _load_history_shards() -> List[int]:
+    rows = _pooled_connection().execute(
+        "SELECT slot FROM history_shards WHERE state = 'active' ORDER BY position"
+    ).fetchall()
+    return [row['slot'] for row in rows]
+
+
+def _active_history_shards() -> List[int]:
+    global _active_shards
+    if _active_shards is None:
+        _active_shards = _load_history_shards()
+    return _active_shards
+
+
+def _user_hash(user_id: int) -> int:
+    # Fibonacci hashing: spreads consecutive ids evenly over any shard count.
+    return ((int(user_id) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32
+
+
+def _route(user_id: int, shards: List[Optional[int]]) -> Optional[int]:
+    return shards[_user_hash(user_id) % len(shards)] if shards else None
+
+
+def history_shard(user_id: int) -> Optional[int]:
+    """Slot of the shard holding this user's history, or None when history
+    is in the main database."""
+    return _route(user_id, _active_history_shards())
+
+
+def _history_connection(user_id: int, write: bool = False):
+    """get_connection() on the database holding this user's history."""
+    return get_connection(write=write, shard=history_shard(user_id))
+
+
+def _history_databases() -> List[Optional[int]]:
+    """Every database history is stored in (None: the main one)."""
+    return _active_history_shards() or [None]
+
+
+def _all_databases() -> List[Optional[int]]:
+    return [None, *_active_history_shards()]
+
+
+def _prepare_shard(slot: int) -> None:
+    """Create (or finish creating) a shard file: schema, plus sequences
+    starting at the bottom of the slot's id range."""
+    _migrate(slot)
+    with get_connection(write=True, shard=slot) as conn:
+        for table in _SHARD_SEQUENCED_TABLES:
+            base = slot * _SHARD_ID_RANGE
+            if not conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (base, table)).rowcount:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, base))
+
+
+def _register_shards(conn: sqlite3.Connection, count: int) -> List[int]:
+    """Add `count` pending shards to history_shards; returns their slots."""
+    return [
+        conn.execute(
+            "INSERT INTO history_shards (position, state, created_at) VALUES (?, 'pending', ?)",
+            (position, _now())
+        ).lastrowid
+        for position in range(count)
+    ]
+
+
+def _activate_shards(conn: sqlite3.Connection, slots: List[int]) -> None:
+    conn.execute("UPDATE history_shards SET state = 'retired' WHERE state = 'active'")
+    conn.executemany("UPDATE history_shards SET state = 'active' WHERE slot = ?", [(slot,) for slot in slots])
+
+
+def _forget_shards(slots: List[int]) -> None:
+    """Close this thread's connections to these shards and delete their files."""
+    for slot in slots:
+        pool = _shard_pools.pop(slot, None)
+        conn = getattr(pool, 'conn', None)
+        if conn is not None and getattr(pool, 'pid', None) == os.getpid():
+            conn.close()
+        path = shard_path(slot)
+        for leftover in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def _history_is_empty(shards: List[Optional[int]]) -> bool:
+    for shard in shards:
+        with get_connection(shard=shard) as conn:
+            for table, _ in _ANALYSIS_TABLES.values():
+                if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                    return False
+    return True
+
+
+def _ensure_history_layout() -> None:
+    """Make the recorded layout match HISTORY_SHARDS. While there's no
+    history yet that just means creating the shard files (so a new
+    deployment needs no extra step); otherwise moving history is reshard()'s
+    job, and starting with a different count would route users to the
+    wrong files, so it's refused."""
+    global _active_shards
+    if len(_active_history_shards()) == HISTORY_SHARDS:
+        return
+    # Under the write lock, so workers starting together create one layout.
+    with get_connection(write=True) as conn:
+        current = _load_history_shards()
+        if len(current) != HISTORY_SHARDS:
+            if not _history_is_empty(current or [None]):
+                raise RuntimeError(
+                    f"HISTORY_SHARDS is {HISTORY_SHARDS} but history is stored in {len(current)} shard(s); "
+                    f"run `python manage.py reshard --shards {HISTORY_SHARDS}` first"
+                )
+            slots = _register_shards(conn, HISTORY_SHARDS)
+            for slot in slots:
+                _prepare_shard(slot)
+            _activate_shards(conn, slots)
+            logger.info("Created %d history shard(s)", HISTORY_SHARDS)
+    _active_shards = None
+    if len(current) != HISTORY_SHARDS:
+        _forget_shards(current)
+
+
+def reshard(shard_count: int, batch_size: int = 500, keep_old_files: bool = False) -> Dict[str, int]:
+    """
+    Move all history into a new layout of `shard_count` shard files (0:
+    back into the main database) and make it the active one; returns how
+    many rows of each table were copied. Run it with the app stopped, then
+    start the app with HISTORY_SHARDS set to the new count.
+
+    Rows are copied `batch_size` at a time, keeping their ids; the old
+    layout is only switched off once everything is across, so an
+    interrupted run leaves history where it was and can simply be re-run.
+    History of users that no longer exist is dropped on the way.
+    """
+    global _active_shards
+    if shard_count < 0:
+        raise ValueError("shard_count must be 0 or more")
+    _active_shards = None
+    source = _active_history_shards()
+    copied = {table: 0 for table in (*_SHARD_SEQUENCED_TABLES, 'follow_up_summaries', 'archived_analyses')}
+    if len(source) == shard_count:
+        return copied
+
+    with get_connection(write=True) as conn:
+        # Leftovers of an interrupted reshard.
+        abandoned = [row['slot'] for row in conn.execute("SELECT slot FROM history_shards WHERE state = 'pending'")]
+        conn.execute("DELETE FROM history_shards WHERE state = 'pending'")
+        targets = _register_shards(conn, shard_count)
+    _forget_shards(abandoned)
+    for slot in targets:
+        _prepare_shard(slot)
+
+    # Nothing tombstoned gets copied, to reappear without its tombstone.
+    purge_deleted(batch_size)
+    with get_connection() as conn:
+        user_ids = {row['id'] for row in conn.execute("SELECT id FROM users")}
+    destinations = targets or [None]
+    for shard in source or [None]:
+        for table in copied:
+            copied[table] += _copy_history_table(table, shard, destinations, user_ids, batch_size)
+        # Rollups aren't per user - they're summed over all shards, so any one will do.
+        with get_connection(shard=shard) as src:
+            rollups = _read_rollups(src)
+        with get_connection(write=True, shard=destinations[0]) as dst:
+            _add_to_rollups(dst, rollups)
+
+    with get_connection(write=True) as conn:
+        _activate_shards(conn, targets)
+    _active_shards = None
+    if not source:
+        # History moved out of the main database.
+        _clear_main_history(batch_size)
+    if not keep_old_files:
+        _forget_shards(source)
+    logger.info("Resharded history from %d to %d shard(s): %s", len(source), shard_count, copied)
+    return copied
+
+
+def _copy_history_table(table: str, source: Optional[int], destinations: List[Optional[int]],
+                        user_ids: set, batch_size: int) -> int:
+    """Copy one table's rows from `source` to the destination each row's
+    user routes to; returns how many were copied."""
+    if table == 'follow_up_summaries':
+        # Summaries don't record their user - take it from the analysis.
+        select = """
+            SELECT s.*, COALESCE(i.user_id, y.user_id) AS owner FROM follow_up_summaries AS s
+            LEFT JOIN image_analyses AS i ON i.id = s.image_analysis_id
+            LEFT JOIN symptom_analyses AS y ON y.id = s.symptom_analysis_id
+            WHERE s.id > ? ORDER BY s.id LIMIT ?
+        """
+    else:
+        select = f"SELECT *, user_id AS owner FROM {table} WHERE id > ? ORDER BY id LIMIT ?"
+
+    count, last_id = 0, 0
+    while True:
+        with get_connection(shard=source) as src:
+            rows = src.execute(select, (last_id, batch_size)).fetchall()
+            fragments = _row_fragments(src, rows) if table in ('image_analyses', 'symptom_analyses') else {}
+        if not rows:
+            return count
+        last_id = rows[-1]['id']
+
+        by_destination: Dict[Optional[int], list] = {}
+        for row in rows:
+            if row['owner'] in user_ids:
+                by_destination.setdefault(_route(row['owner'], destinations), []).append(row)
+        for destination, dest_rows in by_destination.items():
+            with get_connection(write=True, shard=destination) as dst:
+                for row in dest_rows:
+                    values = {key: row[key] for key in row.keys() if key != 'owner'}
+                    if table == 'follow_up_summaries':
+                        del values['id']  # nothing refers to it
+                    elif table in ('image_analyses', 'symptom_analyses'):
+                        # Fragment ids are per file: re-intern the text here.
+                        values['recommendations'] = _encode_texts(dst, _decode_texts(row['recommendations'], fragments))
+                        if row['safety_tips'] is not None:
+                            values['safety_tips'] = _encode_texts(dst, _decode_texts(row['safety_tips'], fragments))
+                        values['disclaimer_id'] = _encode_disclaimer(dst, _decode_disclaimer(row, fragments))
+                        values['disclaimer'] = None
+                    columns = ', '.join(values)
+                    placeholders = ', '.join('?' * len(values))
+                    dst.execute(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", list(values.values()))
+            count += len(dest_rows)
+
+
+def _clear_main_history(batch_size: int) -> None:
+    """Delete the main database's copy of history after it moved to shards
+    (follow-ups and index rows go with it via cascade and triggers)."""
+    for table in ('image_analyses', 'symptom_analyses', 'archived_analyses', 'history_archive_blocks',
+                  'analysis_rollups', 'condition_rollups'):
+        while True:
+            with get_connection(write=True) as conn:
+                deleted = conn.execute(
+                    f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} LIMIT ?)", (batch_size,)
+                ).rowcount
+            if not deleted:
+                break
+
+
+def query_history_shards(sql: str, params=()) -> List[Dict]:
+    """
+    Run one read-only query against every history database and return all
+    the rows, each with a 'shard' key (None: the main database) - for admin
+    reports that span every user. Each shard answers separately, so
+    aggregates come back per shard for the caller to combine.
+    """
+    results = []
+    for shard in _history_databases():
+        with get_connection(shard=shard) as conn:
+            conn.execute("PRAGMA query_only = ON")
+            try:
+                results.extend({'shard': shard, **dict(row)} for row in conn.execute(sql, params))
+            finally:
+                conn.execute("PRAGMA query_only = OFF")
+    return results
+
+
+def history_stats() -> Dict:
+    """Row counts per history database and in total: analyses of each
+    kind, follow-up turns and users with any history."""
+    per_shard = query_history_shards("""
+        SELECT (SELECT COUNT(*) FROM image_analyses) AS image_analyses,
+               (SELECT COUNT(*) FROM symptom_analyses) AS symptom_analyses,
+               (SELECT COUNT(*) FROM follow_ups) AS follow_ups,
+               (SELECT COUNT(*) FROM (SELECT user_id FROM image_analyses
+                                      UNION SELECT user_id FROM symptom_analyses)) AS users
+    """)
+    keys = ('image_analyses', 'symptom_analyses', 'follow_ups', 'users')
+    return {
+        'shards': per_shard,
+        'totals': {key: sum(shard[key] for shard in per_shard) for key in keys},
+    }
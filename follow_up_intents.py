@@ -0,0 +1,113 @@
+"""
+Speculative answers to the follow-up questions almost everyone asks.
+
+After nearly every analysis the first follow-up is one of a handful of
+questions - "is this serious?", "when should I see a doctor?", "what if it
+doesn't improve?". Rather than paying a separate Gemini round trip for each,
+the initial structured analysis call also answers the configured set of
+likely follow-ups (the `likely_follow_ups` field of its response schema).
+Those answers are stored with the analysis, and a later follow-up whose
+normalized wording matches one of these intents is answered straight from
+the store.
+
+SPECULATIVE_FOLLOW_UPS (comma-separated intent ids) picks which intents are
+requested; set it empty to turn the feature off.
+"""
+
+import os
+import re
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+class SpeculativeAnswer(BaseModel):
+    """One entry of the `likely_follow_ups` field in the analysis schemas."""
+    intent: str
+    answer: str
+
+
+# intent id -> the canonical question sent to Gemini, and the phrasings
+# (after normalize()) that count as asking it.
+INTENTS: Dict[str, Dict] = {
+    'is_serious': {
+        'question': 'Is this serious?',
+        'phrases': [
+            'is this serious', 'is it serious', 'how serious is this', 'how serious is it',
+            'should i be worried', 'should i worry', 'is this bad', 'is it bad',
+            'is this dangerous', 'is it dangerous',
+        ],
+    },
+    'see_doctor': {
+        'question': 'When should I see a doctor?',
+        'phrases': [
+            'when should i see a doctor', 'should i see a doctor', 'do i need a doctor',
+            'do i need to see a doctor', 'when to see a doctor', 'should i go to the doctor',
+            'should i go to a doctor', 'do i need to go to the doctor',
+        ],
+    },
+    'not_improving': {
+        'question': "What if it doesn't improve in 2 days?",
+        'phrases': [
+            'what if it doesnt improve', 'what if it does not improve', 'what if it doesnt get better',
+            'what if it does not get better', 'what if it gets worse', 'what if it doesnt go away',
+            'what if it persists',
+        ],
+    },
+}
+
+ENABLED_INTENTS: List[str] = [
+    intent for intent in (
+        part.strip() for part in os.getenv('SPECULATIVE_FOLLOW_UPS', ','.join(INTENTS)).split(',')
+    )
+    if intent in INTENTS
+]
+
+# A question only matches if it's about as short as the phrase it contains -
+# "is this serious?" matches, "is this serious given my heart condition?"
+# has extra context the canned answer didn't see and goes to the model.
+MAX_EXTRA_WORDS = 3
+
+
+def normalize(question: str) -> str:
+    """Lowercase, drop punctuation/apostrophes and collapse whitespace."""
+    text = question.lower().replace('’', "'").replace("'", '')
+    text = re.sub(r'[^a-z0-9\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def match_intent(question: str) -> Optional[str]:
+    """The enabled intent this question is asking, if any."""
+    normalized = normalize(question)
+    words = len(normalized.split())
+    for intent in ENABLED_INTENTS:
+        for phrase in INTENTS[intent]['phrases']:
+            if phrase in normalized and words <= len(phrase.split()) + MAX_EXTRA_WORDS:
+                return intent
+    return None
+
+
+def prompt_instructions() -> str:
+    """The bit of the analysis prompt asking for the speculative answers."""
+    if not ENABLED_INTENTS:
+        return "Leave likely_follow_ups empty."
+    lines = "\n".join(f'        - {intent}: "{INTENTS[intent]["question"]}"' for intent in ENABLED_INTENTS)
+    return (
+        "Also fill likely_follow_ups with a short (2-3 sentence) answer to each of these follow-up\n"
+        "        questions the user is likely to ask next, grounded in this analysis, using these exact intent ids:\n"
+        f"{lines}"
+    )
+
+
+def collect_answers(entries) -> Dict[str, str]:
+    """likely_follow_ups from a parsed response -> {intent: answer}, keeping
+    only enabled intents with a non-empty answer."""
+    answers: Dict[str, str] = {}
+    for entry in entries or []:
+        if isinstance(entry, dict):
+            intent, answer = entry.get('intent'), entry.get('answer')
+        else:
+            intent, answer = getattr(entry, 'intent', None), getattr(entry, 'answer', None)
+        if intent in ENABLED_INTENTS and isinstance(answer, str) and answer.strip():
+            answers[intent] = answer.strip()
+    return answers
@@ -0,0 +1,92 @@
+"""
+Serializing a history export (database.export_history()) as NDJSON or CSV.
+
+Both formats are produced line by line from the entries as they're read,
+so the web endpoint can stream them and manage.py can write them to a file
+without ever holding the whole export.
+
+NDJSON is the complete record: one JSON object per analysis, as
+get_analysis() returns it plus its follow-ups and a `cursor`. CSV flattens
+that for spreadsheets - list fields joined with "; ", follow-ups as a JSON
+column - and has a header row unless the export is resumed from a cursor,
+so a resumed download can be appended to the part already saved. Either
+way, every record's `cursor` resumes the export right after it.
+"""
+
+import csv
+import io
+import json
+from typing import Dict, Iterable, Iterator, Tuple
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CSV_COLUMNS = [
+    'cursor', 'type', 'id', 'created_at', 'archived', 'title', 'urgency', 'emergency_alert', 'confidence',
+    'conditions', 'detected_symptoms', 'recommendations', 'safety_tips', 'disclaimer', 'follow_ups',
+]
+
+# Leading characters that make spreadsheet apps evaluate a cell as a formula.
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def ndjson_lines(entries: Iterable[Tuple[Dict, str]]) -> Iterator[str]:
+    for entry, cursor in entries:
+        yield json.dumps(dict(entry, cursor=cursor), ensure_ascii=False) + '\n'
+
+
+def csv_lines(entries: Iterable[Tuple[Dict, str]], header: bool = True) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(CSV_COLUMNS)
+    for entry, cursor in entries:
+        writer.writerow([_cell(value) for value in _csv_row(entry, cursor)])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # An empty export still gets its header.
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+def export_lines(fmt: str, entries: Iterable[Tuple[Dict, str]], resumed: bool = False) -> Iterator[str]:
+    """The export in `fmt` (a key of FORMATS), one line at a time."""
+    if fmt == 'csv':
+        return csv_lines(entries, header=not resumed)
+    return ndjson_lines(entries)
+
+
+def _csv_row(entry: Dict, cursor: str) -> list:
+    is_image = entry['type'] == 'image'
+    conditions = entry['detected_conditions'] if is_image else entry['possible_conditions']
+    return [
+        cursor,
+        entry['type'],
+        entry['id'],
+        entry['created_at'],
+        bool(entry.get('archived')),
+        entry['original_filename'] if is_image else entry['symptom_text'],
+        entry['urgency'] if is_image else entry['urgency_level'],
+        '' if is_image else entry['emergency_alert'],
+        entry['confidence'] if is_image else '',
+        _join(c.get('name', '') if isinstance(c, dict) else c for c in conditions),
+        '' if is_image else _join(entry['detected_symptoms']),
+        _join(entry['recommendations']),
+        _join(entry['safety_tips']),
+        entry['disclaimer'] or '',
+        json.dumps(entry.get('follow_ups', []), ensure_ascii=False),
+    ]
+
+
+def _join(values) -> str:
+    return '; '.join(str(value) for value in values)
+
+
+def _cell(value):
+    """Neutralize text a spreadsheet would run as a formula."""
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
@@ -0,0 +1,239 @@
+"""
+Optional write-behind for analysis history inserts.
+
+By default /upload and /analyze_symptoms save their result with a
+synchronous insert-and-commit before responding. With HISTORY_WRITE_BEHIND
+enabled, the record goes onto a bounded in-process queue instead and a
+background thread writes queued records in batches - one transaction per
+HISTORY_WRITE_BATCH_SIZE records or HISTORY_WRITE_BATCH_MS milliseconds,
+whichever comes first - so the response doesn't wait on the disk and a
+burst of analyses costs one commit instead of one each.
+
+The response still carries the analysis_id: ids are handed out up front
+from blocks reserved in the database (database.reserve_analysis_ids), so
+they're final before the row exists. Until the batch lands, that id isn't
+readable yet - callers that look an analysis up right after creating it
+(follow-ups, history) call ensure_written() first.
+
+If the queue is full the record is written synchronously, as if
+write-behind were off. A batch that can't be written (the database locked
+past busy_timeout, the disk full) is never given up on, since its ids
+have already been handed out: the thread keeps retrying it, backing off
+up to HISTORY_WRITE_RETRY_MAX_SECONDS, and meanwhile the queue fills up
+and new records take the synchronous path. Anything still queued is
+flushed at interpreter exit; a hard kill loses at most the queued records.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import database as db
+from logging_config import get_logger
+
+logger = get_logger('history_writer')
+
+WRITE_BEHIND_ENABLED = os.getenv('HISTORY_WRITE_BEHIND', 'False').lower() in ('true', '1', 'yes')
+BATCH_SIZE = int(os.getenv('HISTORY_WRITE_BATCH_SIZE', '100'))
+BATCH_MS = int(os.getenv('HISTORY_WRITE_BATCH_MS', '50'))
+QUEUE_SIZE = int(os.getenv('HISTORY_WRITE_QUEUE_SIZE', '1000'))
+ID_BLOCK_SIZE = int(os.getenv('HISTORY_ID_BLOCK_SIZE', '100'))
+RETRY_MAX_SECONDS = float(os.getenv('HISTORY_WRITE_RETRY_MAX_SECONDS', '5'))
+
+
+class IdAllocator:
+    """Hands out ids from blocks reserved with database.reserve_analysis_ids
+    ("hi/lo"): one database round trip per `block_size` ids. With history
+    shards there's one allocator per shard, since each numbers its own rows."""
+
+    def __init__(self, analysis_type: str, block_size: int, shard: Optional[int] = None):
+        self.analysis_type = analysis_type
+        self.block_size = max(1, block_size)
+        self.shard = shard
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._next = db.reserve_analysis_ids(self.analysis_type, self.block_size, self.shard)
+                self._end = self._next + self.block_size
+            allocated = self._next
+            self._next += 1
+            return allocated
+
+
+class HistoryWriter:
+    def __init__(self, enabled: bool = WRITE_BEHIND_ENABLED, batch_size: int = BATCH_SIZE,
+                 batch_ms: int = BATCH_MS, queue_size: int = QUEUE_SIZE, id_block_size: int = ID_BLOCK_SIZE):
+        self.enabled = enabled
+        self.batch_size = max(1, batch_size)
+        self.batch_seconds = max(0, batch_ms) / 1000
+        self.id_block_size = id_block_size
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize=max(1, queue_size))
+        self._allocators: Dict[tuple, IdAllocator] = {}
+        self._state_lock = threading.Lock()
+        self._idle = threading.Condition(self._state_lock)
+        self._pending = 0
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._stopping = False
+
+    # -- public API -------------------------------------------------------
+
+    def save_image_analysis(self, user_id: int, original_filename: str, analysis: Dict) -> int:
+        if not self.enabled:
+            return db.save_image_analysis(user_id, original_filename, analysis)
+        return self._enqueue('image', user_id, original_filename, analysis)
+
+    def save_symptom_analysis(self, user_id: int, symptom_text: str, analysis: Dict) -> int:
+        if not self.enabled:
+            return db.save_symptom_analysis(user_id, symptom_text, analysis)
+        return self._enqueue('symptom', user_id, symptom_text, analysis)
+
+    def ensure_written(self, timeout: float = 5.0) -> bool:
+        """Block until everything queued so far is in the database (no-op
+        when nothing is). Returns False if `timeout` ran out first."""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush what's queued and stop the background thread."""
+        with self._state_lock:
+            thread = self._thread if self._pid == os.getpid() else None
+            self._stopping = True
+        if thread is not None:
+            self.ensure_written(timeout)
+            try:
+                self._queue.put_nowait(None)  # wake the thread so it sees _stopping
+            except queue.Full:
+                pass
+            thread.join(timeout)
+            unwritten = self.stats()['pending']
+            if unwritten:
+                logger.error("Stopping with %d history records still unwritten", unwritten)
+
+    def stats(self) -> Dict:
+        with self._state_lock:
+            return {'enabled': self.enabled, 'pending': self._pending, 'queue_capacity': self._queue.maxsize}
+
+    # -- internals --------------------------------------------------------
+
+    def _enqueue(self, analysis_type: str, user_id: int, label: str, analysis: Dict) -> int:
+        self._ensure_started()
+        key = (analysis_type, db.history_shard(user_id))
+        allocator = self._allocators.get(key)
+        if allocator is None:
+            allocator = self._allocators.setdefault(key, IdAllocator(analysis_type, self.id_block_size, key[1]))
+        record = {
+            'type': analysis_type,
+            'user_id': user_id,
+            'label': label,
+            'analysis': analysis,
+            'analysis_id': allocator.next_id(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+
+        with self._state_lock:
+            self._pending += 1
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+            logger.warning("History write queue full - writing %s analysis synchronously", analysis_type)
+            db.save_history_batch([record])
+        return record['analysis_id']
+
+    def _ensure_started(self) -> None:
+        """Start the writer thread on first use in this process - a thread
+        started before a fork doesn't exist in the child."""
+        with self._state_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # Inherited from a forking parent: its queue and id blocks
+                # belong to the parent.
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._allocators = {}
+                self._pending = 0
+            self._stopping = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                first = None
+            if first is None:
+                if self._stopping:
+                    return
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.batch_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is None:
+                    break
+                batch.append(record)
+
+            try:
+                self._write(batch)
+            finally:
+                with self._idle:
+                    self._pending -= len(batch)
+                    self._idle.notify_all()
+
+    def _write(self, batch) -> None:
+        """Write the batch, retrying until it's in. The records' ids went
+        out in responses already, so dropping them would turn those into
+        dead links; a record the database turns down for good (its user
+        deleted meanwhile) is skipped inside save_history_batch, so what's
+        left failing is the database being unavailable, which passes."""
+        # One transaction per shard, so a retry only repeats the shards
+        # that didn't commit - re-inserting a committed record would fail
+        # on its id.
+        unwritten: Dict[Optional[int], list] = {}
+        for record in batch:
+            unwritten.setdefault(db.history_shard(record['user_id']), []).append(record)
+        attempt = 0
+        while unwritten:
+            shard, records = next(iter(unwritten.items()))
+            try:
+                written = db.save_history_batch(records)
+            except Exception:
+                attempt += 1
+                delay = min(0.1 * 2 ** (attempt - 1), RETRY_MAX_SECONDS)
+                log = logger.warning if attempt < 5 else logger.error
+                log("History batch write failed (attempt %d, %d records unwritten), retrying in %.1fs",
+                    attempt, sum(len(r) for r in unwritten.values()), delay, exc_info=True)
+                time.sleep(delay)
+                continue
+            logger.debug("Wrote %d/%d queued history records", written, len(records))
+            del unwritten[shard]
+
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.stop)
@@ -6,13 +6,25 @@ mail or crashing, send_email() logs the message when SMTP_* isn't set,
 so the reset/verification flows are fully exercisable in dev and tests
 without a real mail server. Set SMTP_HOST/SMTP_USERNAME/SMTP_PASSWORD in
 .env to actually deliver mail in production.
+
+With SMTP configured, send_email() doesn't talk to the mail server at all:
+it adds the message to the email_outbox table (see "Email outbox" in
+database.py), so a slow or unreachable server no longer holds up
+registration or a password reset. deliver_outbox() - run every
+EMAIL_OUTBOX_INTERVAL_SECONDS by the periodic-jobs thread in each worker
+(see app.py) - sends everything that's due over one SMTP connection,
+doing STARTTLS and login once rather than per message. A message the
+server refuses for good (a 5xx reply) is marked failed; anything else is
+retried with exponential backoff, up to EMAIL_OUTBOX_MAX_ATTEMPTS tries.
 """
 
 import os
 import smtplib
 import ssl
 from email.message import EmailMessage
+from typing import Dict, Optional
 
+import database as db
 from logging_config import get_logger
 
 logger = get_logger('mailer')
@@ -22,8 +34,19 @@ SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
 SMTP_USERNAME = os.getenv('SMTP_USERNAME')
 SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
 SMTP_USE_TLS = os.getenv('SMTP_USE_TLS', 'True').lower() in ('1', 'true', 'yes')
+# How the connection is secured: 'starttls', 'ssl' (implicit TLS) or 'none'
+# (only for a relay on localhost or a local test server). Unset, it
+# follows SMTP_USE_TLS: True is starttls, False is ssl.
+SMTP_SECURITY = (os.getenv('SMTP_SECURITY') or ('starttls' if SMTP_USE_TLS else 'ssl')).lower()
+SMTP_TIMEOUT_SECONDS = float(os.getenv('SMTP_TIMEOUT_SECONDS', '10'))
 MAIL_FROM = os.getenv('MAIL_FROM', 'Quick Aid <no-reply@quickaid.local>')
 
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '8'))
+# Retry n waits EMAIL_OUTBOX_RETRY_SECONDS * 2^(n-1), at most an hour:
+# with the defaults, 8 attempts span about two hours.
+EMAIL_OUTBOX_RETRY_SECONDS = float(os.getenv('EMAIL_OUTBOX_RETRY_SECONDS', '30'))
+MAX_RETRY_DELAY_SECONDS = 3600
+
 
 def is_configured() -> bool:
     return bool(SMTP_HOST and SMTP_USERNAME and SMTP_PASSWORD)
@@ -31,12 +54,12 @@ def is_configured() -> bool:
 
 def send_email(to: str, subject: str, body: str) -> bool:
     """
-    Send a plain-text email. Returns True if it was handed off to the SMTP
-    server successfully. If SMTP isn't configured, logs the content instead
-    (at WARNING level, since a real deployment should have this set up) and
-    returns False - callers should NOT treat a False return as a hard
-    failure to show the user, since the account action itself (token
-    creation, etc.) already succeeded.
+    Queue a plain-text email for delivery. Returns True if it was queued.
+    If SMTP isn't configured, logs the content instead (at WARNING level,
+    since a real deployment should have this set up) and returns False -
+    callers should NOT treat a False return as a hard failure to show the
+    user, since the account action itself (token creation, etc.) already
+    succeeded.
     """
     if not is_configured():
         logger.warning(
@@ -45,26 +68,103 @@ def send_email(to: str, subject: str, body: str) -> bool:
         )
         return False
 
+    email_id = db.enqueue_email(to, subject, body)
+    logger.info("Queued email id=%s to=%s subject=%s", email_id, to, subject)
+    return True
+
+
+def deliver_outbox(batch_size: int = db.EMAIL_OUTBOX_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Send every queued message that's due, over one SMTP connection opened
+    on the first message and closed at the end. Returns counts of messages
+    'sent', 'retrying' and 'failed'. If the connection can't be opened or
+    drops, the message at hand is retried later, the rest of the batch is
+    handed back untried, and this run stops.
+    """
+    counts = {'sent': 0, 'retrying': 0, 'failed': 0}
+    if not is_configured():
+        return counts
+    server: Optional[smtplib.SMTP] = None
+    try:
+        while True:
+            batch = db.claim_outbox_batch(limit=batch_size)
+            for position, email in enumerate(batch):
+                try:
+                    if server is None:
+                        server = _open_connection()
+                    server.send_message(_message(email))
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    # The server turned down this one message and is still
+                    # talking to us - carry on with the next.
+                    counts[_failed(email, e, _reply_code(e))] += 1
+                    continue
+                except (smtplib.SMTPException, OSError) as e:
+                    # Connecting, logging in or the connection itself failed
+                    # - nothing to do with this message, so never final.
+                    counts[_failed(email, e, None)] += 1
+                    db.release_emails([other['id'] for other in batch[position + 1:]], EMAIL_OUTBOX_RETRY_SECONDS)
+                    return counts
+                db.mark_email_sent(email['id'])
+                counts['sent'] += 1
+            if len(batch) < batch_size:
+                return counts
+    finally:
+        _close(server)
+        if any(counts.values()):
+            logger.info("Email outbox: sent %d, retrying %d, failed %d",
+                        counts['sent'], counts['retrying'], counts['failed'])
+
+
+def _open_connection() -> smtplib.SMTP:
+    if SMTP_SECURITY == 'ssl':
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ssl.create_default_context(),
+                                  timeout=SMTP_TIMEOUT_SECONDS)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+        if SMTP_SECURITY == 'starttls':
+            server.starttls(context=ssl.create_default_context())
+    try:
+        server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    except BaseException:
+        _close(server)
+        raise
+    return server
+
+
+def _close(server: Optional[smtplib.SMTP]) -> None:
+    if server is None:
+        return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+def _message(email: Dict) -> EmailMessage:
     msg = EmailMessage()
-    msg['Subject'] = subject
+    msg['Subject'] = email['subject']
     msg['From'] = MAIL_FROM
-    msg['To'] = to
-    msg.set_content(body)
+    msg['To'] = email['recipient']
+    msg.set_content(email['body'])
+    return msg
 
-    try:
-        if SMTP_USE_TLS:
-            context = ssl.create_default_context()
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=10) as server:
-                server.starttls(context=context)
-                server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                server.send_message(msg)
-        else:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=10) as server:
-                server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                server.send_message(msg)
-        logger.info("Email sent to=%s subject=%s", to, subject)
-        return True
-    except Exception:
-        logger.error("Failed to send email to=%s subject=%s", to, subject, exc_info=True)
-        return False
+
+def _reply_code(error: Exception) -> Optional[int]:
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return min(code for code, _ in error.recipients.values())
+    return getattr(error, 'smtp_code', None)
+
+
+def _failed(email: Dict, error: Exception, code: Optional[int]) -> str:
+    """Record a failed attempt; returns 'failed' or 'retrying'."""
+    description = f"{type(error).__name__}: {error}"[:500]
+    if (code is not None and code >= 500) or email['attempts'] >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+        db.mark_email_failed(email['id'], description)
+        logger.error("Giving up on email id=%s to=%s after %d attempt(s): %s",
+                     email['id'], email['recipient'], email['attempts'], description)
+        return 'failed'
+    delay = min(EMAIL_OUTBOX_RETRY_SECONDS * 2 ** (email['attempts'] - 1), MAX_RETRY_DELAY_SECONDS)
+    db.mark_email_failed(email['id'], description, retry_in_seconds=delay)
+    logger.warning("Email id=%s to=%s failed (attempt %d), retrying in %.0fs: %s",
+                   email['id'], email['recipient'], email['attempts'], delay, description)
+    return 'retrying'
@@ -0,0 +1,104 @@
+"""
+In-process registry of periodic housekeeping jobs.
+
+Jobs are registered by name with an interval and run on one background
+thread per process, started on first use (app.py starts it from a
+before_request hook, so each gunicorn worker gets its own after the fork).
+Registering a name again replaces the job - handy for tests and for
+reconfiguring without a restart. A failing job is logged and retried at
+its next interval; it never takes the thread down.
+
+Every job must be safe to run concurrently from several workers (they all
+run the same schedule), e.g. database.compact_tokens deletes in small
+idempotent batches.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from logging_config import get_logger
+
+logger = get_logger('maintenance')
+
+# How often the scheduler thread checks for due jobs.
+TICK_SECONDS = 1.0
+
+
+class PeriodicJobs:
+    def __init__(self, tick_seconds: float = TICK_SECONDS):
+        self.tick_seconds = tick_seconds
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._stopping = False
+
+    def register(self, name: str, func: Callable[[], object], interval_seconds: float,
+                 run_at_start: bool = False) -> None:
+        """Run `func` every `interval_seconds` (first run one interval from
+        now, or on the next tick with run_at_start). Replaces any job
+        already registered under `name`."""
+        first_run = time.monotonic() + (0 if run_at_start else interval_seconds)
+        with self._lock:
+            self._jobs[name] = {'func': func, 'interval': interval_seconds, 'next_run': first_run,
+                                'last_error': None, 'runs': 0}
+        self._wake.set()
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            self._jobs.pop(name, None)
+
+    def run_due(self, now: Optional[float] = None) -> List[str]:
+        """Run every job whose time has come; returns their names. Called by
+        the scheduler thread, and directly by tests."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = [(name, job) for name, job in self._jobs.items() if job['next_run'] <= now]
+            for _, job in due:
+                job['next_run'] = now + job['interval']
+        for name, job in due:
+            try:
+                job['func']()
+                job['last_error'] = None
+            except Exception as exc:
+                job['last_error'] = repr(exc)
+                logger.error("Periodic job %s failed", name, exc_info=True)
+            job['runs'] += 1
+        return [name for name, _ in due]
+
+    def ensure_started(self) -> None:
+        """Start the scheduler thread if this process doesn't have one yet
+        (cheap enough to call on every request)."""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='periodic-jobs', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {name: {'interval_seconds': job['interval'], 'runs': job['runs'],
+                           'last_error': job['last_error']}
+                    for name, job in self._jobs.items()}
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self.run_due()
+            self._wake.wait(self.tick_seconds)
+            self._wake.clear()
+
+
+periodic_jobs = PeriodicJobs()
@@ -0,0 +1,251 @@
+"""
+Maintenance commands for Quick Aid's database.
+
+    python manage.py init-db
+    python manage.py encode-fragments [--batch-size N] [--vacuum]
+    python manage.py compact-tokens [--batch-size N]
+    python manage.py purge-deleted [--batch-size N] [--sweep-fragments]
+    python manage.py archive-history [--older-than-days N] [--block-size N] [--vacuum]
+    python manage.py rebuild-search [--batch-size N]
+    python manage.py rebuild-rollups
+    python manage.py export-history --user-id N [--format ndjson|csv] [--cursor C] [--output FILE]
+    python manage.py history-stats
+    python manage.py deliver-email
+    python manage.py reshard --shards N [--batch-size N] [--keep-old-files]
+
+Uses the same DATABASE_PATH (and .env) as the app. Safe to run while the
+app is up - every command works in short transactions - except reshard,
+which moves history between files and needs the app stopped.
+"""
+
+import argparse
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import database as db  # noqa: E402 - DATABASE_PATH must come from .env first
+import history_export  # noqa: E402
+import mailer  # noqa: E402
+
+
+def _format_bytes(count: int) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024 or unit == 'GiB':
+            return f"{count:.0f} {unit}" if unit == 'B' else f"{count:.1f} {unit}"
+        count /= 1024
+
+
+def _print_size(label: str, size) -> None:
+    print(f"{label}: {_format_bytes(size['used_bytes'])} in use, "
+          f"{_format_bytes(size['file_bytes'])} on disk")
+
+
+def cmd_init_db(args) -> int:
+    db.init_db()
+    print(f"Database ready at {db.DB_PATH} (schema version {db.schema_version()})")
+    return 0
+
+
+def cmd_encode_fragments(args) -> int:
+    """Re-encode history rows that predate text_fragments, reporting the
+    database size before and after."""
+    db.init_db()
+    before = db.database_size()
+    rewritten = db.encode_text_fragments(batch_size=args.batch_size)
+    if args.vacuum:
+        db.vacuum()
+    after = db.database_size()
+
+    for table, count in rewritten.items():
+        print(f"{table}: re-encoded {count} rows")
+    _print_size("Before", before)
+    _print_size("After ", after)
+    if not args.vacuum:
+        print("Freed pages stay in the file until you re-run with --vacuum.")
+    return 0
+
+
+def cmd_compact_tokens(args) -> int:
+    db.init_db()
+    deleted = db.compact_tokens(batch_size=args.batch_size)
+    print(f"Deleted {deleted} used/expired tokens")
+    return 0
+
+
+def cmd_purge_deleted(args) -> int:
+    db.init_db()
+    purged = db.purge_deleted(batch_size=args.batch_size)
+    if args.sweep_fragments:
+        purged['fragments'] += db.sweep_text_fragments(batch_size=args.batch_size)
+    print(f"Purged {purged['history_rows']} history rows, {purged['users']} deleted accounts "
+          f"and {purged['fragments']} unused text fragments")
+    return 0
+
+
+def cmd_archive_history(args) -> int:
+    db.init_db()
+    if args.older_than_days <= 0:
+        print("Set HISTORY_ARCHIVE_AFTER_DAYS or pass --older-than-days to archive history")
+        return 1
+    archived = db.archive_history(older_than_days=args.older_than_days, block_size=args.block_size)
+    print(f"Archived {archived} analyses")
+    if args.vacuum:
+        db.vacuum()
+    _print_size("Database size", db.database_size())
+    return 0
+
+
+def cmd_rebuild_search(args) -> int:
+    db.init_db()
+    indexed = db.rebuild_history_search(batch_size=args.batch_size)
+    print(f"Re-indexed {indexed} analyses for history search")
+    return 0
+
+
+def cmd_rebuild_rollups(args) -> int:
+    db.init_db()
+    counted = db.rebuild_rollups()
+    print(f"Rebuilt analytics rollups from {counted} analyses")
+    return 0
+
+
+def cmd_export_history(args) -> int:
+    """Write one user's history to --output (default stdout). With
+    --cursor, the export resumes after that record and is appended."""
+    db.init_db()
+    if db.get_user_by_id(args.user_id) is None:
+        print(f"No user with id {args.user_id}", file=sys.stderr)
+        return 1
+    try:
+        entries = db.export_history(args.user_id, cursor=args.cursor)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    out = open(args.output, 'a' if args.cursor else 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for line in history_export.export_lines(args.format, entries, resumed=args.cursor is not None):
+            out.write(line)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+def cmd_history_stats(args) -> int:
+    db.init_db()
+    stats = db.history_stats()
+    for shard in stats['shards']:
+        label = 'main database' if shard['shard'] is None else f"shard {shard['shard']}"
+        print(f"{label}: {shard['users']} users, {shard['image_analyses']} image / "
+              f"{shard['symptom_analyses']} symptom analyses, {shard['follow_ups']} follow-ups")
+    totals = stats['totals']
+    print(f"total: {totals['users']} users, {totals['image_analyses']} image / "
+          f"{totals['symptom_analyses']} symptom analyses, {totals['follow_ups']} follow-ups")
+    return 0
+
+
+def cmd_deliver_email(args) -> int:
+    db.init_db()
+    if not mailer.is_configured():
+        print("SMTP isn't configured - set SMTP_HOST/SMTP_USERNAME/SMTP_PASSWORD to send email")
+        return 1
+    sent = mailer.deliver_outbox()
+    print(f"Sent {sent['sent']} emails, {sent['retrying']} to retry, {sent['failed']} failed")
+    print("Outbox: " + ", ".join(f"{count} {status}" for status, count in db.outbox_stats().items()))
+    return 0
+
+
+def cmd_reshard(args) -> int:
+    """Move history into a new set of shard files. The app must be stopped,
+    and started again with HISTORY_SHARDS set to the new count."""
+    db.init_db(check_history_layout=False)
+    copied = db.reshard(args.shards, batch_size=args.batch_size, keep_old_files=args.keep_old_files)
+    for table, count in copied.items():
+        print(f"{table}: copied {count} rows")
+    print(f"History is now in {args.shards} shard(s) - set HISTORY_SHARDS={args.shards} before starting the app.")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='manage.py', description="Quick Aid database maintenance")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    init = commands.add_parser('init-db', help="create tables / apply schema migrations")
+    init.set_defaults(handler=cmd_init_db)
+
+    encode = commands.add_parser(
+        'encode-fragments', help="store repeated history text once, as text_fragments ids"
+    )
+    encode.add_argument('--batch-size', type=int, default=500, help="rows per transaction (default 500)")
+    encode.add_argument('--vacuum', action='store_true', help="rebuild the file afterwards to reclaim space")
+    encode.set_defaults(handler=cmd_encode_fragments)
+
+    compact = commands.add_parser('compact-tokens', help="delete used and expired reset/verification tokens")
+    compact.add_argument(
+        '--batch-size', type=int, default=db.TOKEN_COMPACT_BATCH_SIZE,
+        help=f"rows per transaction (default {db.TOKEN_COMPACT_BATCH_SIZE})"
+    )
+    compact.set_defaults(handler=cmd_compact_tokens)
+
+    purge = commands.add_parser('purge-deleted', help="finish deleting accounts and cleared history")
+    purge.add_argument(
+        '--batch-size', type=int, default=db.DELETION_BATCH_SIZE,
+        help=f"rows per transaction (default {db.DELETION_BATCH_SIZE})"
+    )
+    purge.add_argument(
+        '--sweep-fragments', action='store_true',
+        help="also delete unused text fragments in every database, not just where history was purged"
+    )
+    purge.set_defaults(handler=cmd_purge_deleted)
+
+    archive = commands.add_parser('archive-history', help="move old history into compressed archive blocks")
+    archive.add_argument(
+        '--older-than-days', type=int, default=db.HISTORY_ARCHIVE_AFTER_DAYS,
+        help=f"archive months that ended this long ago (default {db.HISTORY_ARCHIVE_AFTER_DAYS})"
+    )
+    archive.add_argument(
+        '--block-size', type=int, default=db.HISTORY_ARCHIVE_BLOCK_SIZE,
+        help=f"analyses per compressed block (default {db.HISTORY_ARCHIVE_BLOCK_SIZE})"
+    )
+    archive.add_argument('--vacuum', action='store_true', help="rebuild the file afterwards to reclaim space")
+    archive.set_defaults(handler=cmd_archive_history)
+
+    search = commands.add_parser('rebuild-search', help="re-index every analysis for history search")
+    search.add_argument('--batch-size', type=int, default=500, help="rows per transaction (default 500)")
+    search.set_defaults(handler=cmd_rebuild_search)
+
+    rollups = commands.add_parser('rebuild-rollups', help="recompute the analytics rollups from stored history")
+    rollups.set_defaults(handler=cmd_rebuild_rollups)
+
+    export = commands.add_parser('export-history', help="write one user's complete history as NDJSON or CSV")
+    export.add_argument('--user-id', type=int, required=True)
+    export.add_argument('--format', choices=sorted(history_export.FORMATS), default='ndjson')
+    export.add_argument('--cursor', help="resume after the record carrying this cursor")
+    export.add_argument('--output', help="file to write (appended to with --cursor); default stdout")
+    export.set_defaults(handler=cmd_export_history)
+
+    stats = commands.add_parser('history-stats', help="row counts per history shard")
+    stats.set_defaults(handler=cmd_history_stats)
+
+    deliver = commands.add_parser('deliver-email', help="send queued email now and show the outbox counts")
+    deliver.set_defaults(handler=cmd_deliver_email)
+
+    reshard = commands.add_parser('reshard', help="move history into N shard files (0: the main database)")
+    reshard.add_argument('--shards', type=int, required=True, help="new number of history shards")
+    reshard.add_argument('--batch-size', type=int, default=500, help="rows per transaction (default 500)")
+    reshard.add_argument('--keep-old-files', action='store_true',
+                         help="leave the old shard files on disk instead of deleting them")
+    reshard.set_defaults(handler=cmd_reshard)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
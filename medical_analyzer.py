@@ -5,9 +5,13 @@ import os
 from typing import Dict, List, Literal
 from google import genai
 from google.genai import types
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from logging_config import get_logger
+from bulkhead import gemini_bulkhead
+import model_router
+import follow_up_intents
+from follow_up_intents import SpeculativeAnswer
 
 load_dotenv()
 
@@ -21,16 +25,12 @@ class ImageAnalysisResult(BaseModel):
     recommendations: List[str]
     urgency: Literal['low', 'medium', 'high']
     safety_tips: List[str]
+    # Answers to the follow-ups users almost always ask next, generated in
+    # this same call (see follow_up_intents).
+    likely_follow_ups: List[SpeculativeAnswer] = Field(default_factory=list)
 
 
 class MedicalAnalyzer:
-    # "gemini-flash-latest" is Google's stable alias for their current-generation
-    # Flash model, so this keeps working as Google ships new versions instead of
-    # pointing at a specific release (like the old 'gemini-1.5-flash') that gets
-    # deprecated and shut down over time. Pin to an exact version instead if you
-    # need reproducible/deterministic behavior across releases.
-    MODEL_NAME = 'gemini-flash-latest'
-
     def __init__(self):
         api_key = os.getenv('GEMINI_API_KEY')
         if api_key and api_key != 'your_gemini_api_key_here':
@@ -113,7 +113,10 @@ class MedicalAnalyzer:
         """Analyze medical image and provide recommendations"""
         try:
             if self.use_gemini:
-                return self._analyze_with_gemini(image_path)
+                with gemini_bulkhead.slot() as admitted:
+                    if admitted:
+                        return self._analyze_with_gemini(image_path)
+                return self._shed_to_basic(image_path)
             else:
                 return self._analyze_basic(image_path)
 
@@ -134,6 +137,8 @@ class MedicalAnalyzer:
                 arr = np.array(img_rgb)
                 channel_std = np.std(arr, axis=(0, 1))
                 is_grayscale_like = float(np.mean(channel_std)) < 5.0
+                detail = float(np.std(np.dot(arr[..., :3], [0.2989, 0.5870, 0.1140]))) / 255.0
+                route = model_router.route_image(image.width, image.height, detail, is_grayscale_like)
 
                 if is_grayscale_like:
                     prompt = """
@@ -153,15 +158,19 @@ class MedicalAnalyzer:
                     Be specific in detected_conditions. If uncertain, state uncertainty clearly.
                     recommendations should be specific treatment/care steps.
                     """
+                prompt += f"""
+                    {follow_up_intents.prompt_instructions()}
+                    """
 
-                response = self.client.models.generate_content(
-                    model=self.MODEL_NAME,
-                    contents=[prompt, img_rgb],
-                    config=types.GenerateContentConfig(
-                        response_mime_type='application/json',
-                        response_schema=ImageAnalysisResult,
-                    ),
-                )
+                with model_router.timed(route):
+                    response = self.client.models.generate_content(
+                        model=route.model,
+                        contents=[prompt, img_rgb],
+                        config=types.GenerateContentConfig(
+                            response_mime_type='application/json',
+                            response_schema=ImageAnalysisResult,
+                        ),
+                    )
 
                 return self._parse_gemini_response(response)
 
@@ -172,6 +181,18 @@ class MedicalAnalyzer:
             )
             return self._analyze_basic(image_path)
 
+    def _shed_to_basic(self, image_path: str) -> Dict:
+        """Basic analysis for a request the Gemini bulkhead turned away
+        under load, flagged so the client can tell the user why."""
+        logger.info("Gemini overloaded - serving basic image analysis for %s", image_path)
+        result = self._analyze_basic(image_path)
+        result['degraded'] = True
+        result['disclaimer'] = (
+            'AI analysis is temporarily busy, so this is a basic analysis only. '
+            'Try again shortly, and consult healthcare professionals.'
+        )
+        return result
+
     def _parse_gemini_response(self, response) -> Dict:
         """
         Turn the Gemini response into our standard dict shape.
@@ -205,7 +226,8 @@ class MedicalAnalyzer:
             ],
             'urgency': result.get('urgency', 'medium'),
             'safety_tips': result.get('safety_tips') or self._get_safety_tips(),
-            'disclaimer': 'AI analysis for educational purposes only. Consult healthcare professionals.'
+            'disclaimer': 'AI analysis for educational purposes only. Consult healthcare professionals.',
+            'follow_up_answers': follow_up_intents.collect_answers(result.get('likely_follow_ups')),
         }
 
     def _analyze_basic(self, image_path: str) -> Dict:
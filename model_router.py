@@ -0,0 +1,155 @@
+"""
+Routes each Gemini call to a fast/cheap or a strong model tier based on how
+complex the input looks.
+
+Most requests are simple - "headache and a runny nose", a small photo of a
+scrape - and don't need the strongest model. Those go to the fast tier;
+X-rays, long multi-symptom narratives, anything high-urgency, and inputs
+the deterministic matcher can't make sense of escalate to the strong tier.
+Every decision is logged with its reason, and per-tier latency is logged
+and kept in-process (surfaced on /health), so the thresholds below can be
+tuned from real traffic.
+
+Both models default to Google's "-latest" aliases, so this keeps working
+as Google ships new versions instead of pointing at a specific release that
+gets deprecated and shut down over time. Pin GEMINI_FAST_MODEL /
+GEMINI_STRONG_MODEL to exact versions if you need reproducible behavior.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable
+
+from logging_config import get_logger
+
+logger = get_logger('model_router')
+
+FAST_TIER = 'fast'
+STRONG_TIER = 'strong'
+
+FAST_MODEL = os.getenv('GEMINI_FAST_MODEL', 'gemini-flash-lite-latest')
+STRONG_MODEL = os.getenv('GEMINI_STRONG_MODEL', 'gemini-flash-latest')
+
+# Symptom text: short descriptions the keyword matcher fully covers - every
+# word is a matched keyword or filler - are simple; long narratives or many
+# distinct symptoms are complex.
+SIMPLE_SYMPTOM_MAX_CHARS = int(os.getenv('ROUTE_SIMPLE_SYMPTOM_MAX_CHARS', '160'))
+COMPLEX_SYMPTOM_MIN_CHARS = int(os.getenv('ROUTE_COMPLEX_SYMPTOM_MIN_CHARS', '500'))
+COMPLEX_SYMPTOM_MIN_COUNT = int(os.getenv('ROUTE_COMPLEX_SYMPTOM_MIN_COUNT', '3'))
+
+# Images: small and low-detail (grayscale std-dev / 255, the same texture
+# measure basic mode uses) is simple. X-rays always go to the strong tier.
+SIMPLE_IMAGE_MAX_PIXELS = int(os.getenv('ROUTE_SIMPLE_IMAGE_MAX_PIXELS', str(512 * 512)))
+SIMPLE_IMAGE_MAX_DETAIL = float(os.getenv('ROUTE_SIMPLE_IMAGE_MAX_DETAIL', '0.12'))
+
+# Follow-ups: a short question early in the conversation is simple.
+SIMPLE_FOLLOW_UP_MAX_CHARS = int(os.getenv('ROUTE_SIMPLE_FOLLOW_UP_MAX_CHARS', '120'))
+SIMPLE_FOLLOW_UP_MAX_TURNS = int(os.getenv('ROUTE_SIMPLE_FOLLOW_UP_MAX_TURNS', '4'))
+
+_MODELS = {FAST_TIER: FAST_MODEL, STRONG_TIER: STRONG_MODEL}
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    task: str
+    tier: str
+    reason: str
+
+    @property
+    def model(self) -> str:
+        return _MODELS[self.tier]
+
+
+def _decide(task: str, tier: str, reason: str) -> RouteDecision:
+    decision = RouteDecision(task, tier, reason)
+    logger.info("Routing %s to %s tier (%s): %s", task, tier, decision.model, reason)
+    return decision
+
+
+def route_symptoms(symptom_text: str, matched_symptoms: Iterable[str],
+                   known_symptoms: Dict[str, Dict], unmatched_words: Iterable[str]) -> RouteDecision:
+    """
+    `matched_symptoms` is what SymptomChecker._extract_symptoms found,
+    `known_symptoms` its symptom_database (for urgency) and
+    `unmatched_words` what SymptomChecker._unmatched_words left of the
+    text - the input counts as fully covered only if that's nothing.
+    """
+    matched = list(matched_symptoms)
+    unmatched = list(unmatched_words)
+    length = len(symptom_text)
+
+    if length >= COMPLEX_SYMPTOM_MIN_CHARS:
+        return _decide('symptoms', STRONG_TIER, f'long narrative ({length} chars)')
+    if len(matched) >= COMPLEX_SYMPTOM_MIN_COUNT:
+        return _decide('symptoms', STRONG_TIER, f'{len(matched)} distinct symptoms')
+    if not matched:
+        return _decide('symptoms', STRONG_TIER, 'no symptoms recognized by the matcher')
+    if any(known_symptoms.get(s, {}).get('urgency') == 'high' for s in matched):
+        return _decide('symptoms', STRONG_TIER, 'high-urgency symptom matched')
+    if unmatched:
+        return _decide('symptoms', STRONG_TIER, f'not fully covered by the matcher ({" ".join(unmatched[:5])})')
+    if length > SIMPLE_SYMPTOM_MAX_CHARS:
+        return _decide('symptoms', STRONG_TIER, f'longer description ({length} chars)')
+    return _decide('symptoms', FAST_TIER, f'short, fully covered ({", ".join(sorted(matched))})')
+
+
+def route_image(width: int, height: int, detail: float, is_xray: bool) -> RouteDecision:
+    if is_xray:
+        return _decide('image', STRONG_TIER, 'grayscale heuristic flagged an X-ray')
+    pixels = width * height
+    if pixels > SIMPLE_IMAGE_MAX_PIXELS:
+        return _decide('image', STRONG_TIER, f'large image ({width}x{height})')
+    if detail > SIMPLE_IMAGE_MAX_DETAIL:
+        return _decide('image', STRONG_TIER, f'high detail ({detail:.3f})')
+    return _decide('image', FAST_TIER, f'small, low-detail image ({width}x{height}, detail {detail:.3f})')
+
+
+def route_follow_up(question: str, prior_turns: int) -> RouteDecision:
+    if len(question) > SIMPLE_FOLLOW_UP_MAX_CHARS:
+        return _decide('follow_up', STRONG_TIER, f'long question ({len(question)} chars)')
+    if prior_turns > SIMPLE_FOLLOW_UP_MAX_TURNS:
+        return _decide('follow_up', STRONG_TIER, f'long conversation ({prior_turns} prior turns)')
+    return _decide('follow_up', FAST_TIER, 'short question early in the conversation')
+
+
+# ---------------------------------------------------------------------------
+# Per-tier latency
+# ---------------------------------------------------------------------------
+
+_stats_lock = threading.Lock()
+_latency: Dict[str, Dict[str, float]] = {}
+
+
+@contextmanager
+def timed(decision: RouteDecision):
+    """Wrap the Gemini call for `decision` to log and record its latency
+    (failed calls included - slow failures are worth seeing too)."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with _stats_lock:
+            entry = _latency.setdefault(decision.tier, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            entry['calls'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+        logger.info(
+            "Gemini %s call on %s tier (%s) took %.0fms",
+            decision.task, decision.tier, decision.model, elapsed_ms
+        )
+
+
+def latency_stats() -> Dict[str, Dict[str, float]]:
+    with _stats_lock:
+        return {
+            tier: {
+                'calls': int(entry['calls']),
+                'avg_ms': round(entry['total_ms'] / entry['calls'], 1),
+                'max_ms': round(entry['max_ms'], 1),
+            }
+            for tier, entry in _latency.items()
+        }
@@ -11,20 +11,30 @@ redirect URI of <your-domain>/login/google/callback, then set:
 
     GOOGLE_CLIENT_ID=...
     GOOGLE_CLIENT_SECRET=...
+
+Google's discovery document and signing keys are cached on disk and
+shared by the workers (see oidc_cache.py), so a sign-in doesn't wait on
+fetching them and still works while Google's discovery endpoint is down.
 """
 
 import os
+from typing import Dict, Optional
 
 from authlib.integrations.flask_client import OAuth
 
+import database as db
 from logging_config import get_logger
+from oidc_cache import OIDCMetadataCache
 
 logger = get_logger('oauth')
 
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
+GOOGLE_DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
 
 oauth = OAuth()
+# Set up by init_oauth() when Google sign-in is configured.
+google_metadata: Optional[OIDCMetadataCache] = None
 
 
 def is_google_oauth_configured() -> bool:
@@ -32,16 +42,42 @@ def is_google_oauth_configured() -> bool:
 
 
 def init_oauth(app):
+    global google_metadata
     oauth.init_app(app)
     if is_google_oauth_configured():
         oauth.register(
             name='google',
             client_id=GOOGLE_CLIENT_ID,
             client_secret=GOOGLE_CLIENT_SECRET,
-            server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+            server_metadata_url=GOOGLE_DISCOVERY_URL,
             client_kwargs={'scope': 'openid email profile'},
         )
+        google_metadata = OIDCMetadataCache(
+            GOOGLE_DISCOVERY_URL, os.getenv('OIDC_CACHE_PATH') or db.DB_PATH + '.oidc-google.json'
+        )
+        # Whatever an earlier run or another worker left on disk; the
+        # refresh_google_metadata job brings it up to date in the background.
+        _install_google_metadata(google_metadata.load())
         logger.info("Google OAuth configured and registered.")
     else:
         logger.info("Google OAuth not configured (GOOGLE_CLIENT_ID/SECRET unset) - Google sign-in disabled.")
     return oauth
+
+
+def refresh_google_metadata() -> None:
+    """Periodic job (see app.py): refresh the cached discovery document and
+    keys if they're due, and hand them to the Google client."""
+    if google_metadata is not None:
+        _install_google_metadata(google_metadata.refresh())
+
+
+def google_metadata_stats() -> Optional[Dict]:
+    return google_metadata.stats() if google_metadata is not None else None
+
+
+def _install_google_metadata(document: Optional[Dict]) -> None:
+    # Authlib only fetches the discovery document while server_metadata has
+    # no '_loaded_at', and the keys while it has no 'jwks'.
+    if document:
+        oauth.google.server_metadata.update(document['metadata'], jwks=document['jwks'],
+                                            _loaded_at=document['fetched_at'])
@@ -0,0 +1,130 @@
+"""
+OpenID Connect discovery document and signing keys (JWKS), cached in
+memory and on disk.
+
+Left to itself Authlib fetches the discovery document on the first Google
+sign-in in each worker, after every restart, and the signing keys on the
+first id_token it checks - two extra round trips on a user's login, and
+no login at all while accounts.google.com's discovery endpoint is down.
+
+OIDCMetadataCache keeps both in one JSON file (written atomically, so
+every gunicorn worker on the host can share it) and in memory. load()
+reads whatever copy is on disk without any network access, for a worker
+that just started. refresh() - run in the background by the periodic-jobs
+thread (see app.py), first thing in each worker and then every
+OIDC_REFRESH_INTERVAL_SECONDS - re-fetches once the copy is older than
+OIDC_CACHE_TTL_SECONDS. It first looks at the file in case another worker
+already did that. If the issuer can't be reached, the copy it has is kept
+and used; Authlib still re-fetches the keys by itself when a token is
+signed with a key it doesn't know yet (Google rotating its keys).
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+from logging_config import get_logger
+
+logger = get_logger('oidc_cache')
+
+OIDC_CACHE_TTL_SECONDS = int(os.getenv('OIDC_CACHE_TTL_SECONDS', '3600'))
+OIDC_FETCH_TIMEOUT_SECONDS = float(os.getenv('OIDC_FETCH_TIMEOUT_SECONDS', '5'))
+
+
+class OIDCMetadataCache:
+    def __init__(self, discovery_url: str, path: str, ttl_seconds: int = OIDC_CACHE_TTL_SECONDS):
+        self.discovery_url = discovery_url
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        # {'fetched_at': epoch seconds, 'metadata': {...}, 'jwks': {'keys': [...]}}
+        self._document: Optional[Dict] = None
+        self._last_error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> Optional[Dict]:
+        """The copy in memory, else the one on disk (however old); None if
+        there's neither. Never touches the network."""
+        if self._document is None:
+            self._document = self._read_file()
+        return self._document
+
+    def refresh(self) -> Optional[Dict]:
+        """Bring the copy up to date if it's older than the TTL - from the
+        file if another worker has fetched since, else from the issuer.
+        Never raises: if the issuer fails, logs it and returns the copy it
+        already had (None only if there has never been one)."""
+        with self._lock:
+            document = self.load()
+            if self._fresh(document):
+                return document
+            on_disk = self._read_file()
+            if self._fresh(on_disk):
+                self._document = on_disk
+                return on_disk
+            try:
+                self._document = self._fetch()
+            except (requests.RequestException, ValueError) as e:
+                self._last_error = f"{type(e).__name__}: {e}"
+                logger.warning("Couldn't refresh OIDC metadata from %s (%s); using the %s",
+                               self.discovery_url, self._last_error,
+                               "cached copy" if document else "issuer directly at sign-in")
+                return document
+            self._last_error = None
+            self._write_file(self._document)
+            logger.info("Refreshed OIDC metadata from %s", self.discovery_url)
+            return self._document
+
+    def stats(self) -> Dict:
+        document = self._document
+        return {
+            'cached': document is not None,
+            'age_seconds': round(time.time() - document['fetched_at']) if document else None,
+            'last_error': self._last_error,
+        }
+
+    def _fresh(self, document: Optional[Dict]) -> bool:
+        return document is not None and time.time() - document['fetched_at'] < self.ttl_seconds
+
+    def _fetch(self) -> Dict:
+        metadata = self._get_json(self.discovery_url)
+        if not metadata.get('issuer') or not metadata.get('jwks_uri'):
+            raise ValueError("discovery document has no issuer/jwks_uri")
+        jwks = self._get_json(metadata['jwks_uri'])
+        if not isinstance(jwks.get('keys'), list) or not jwks['keys']:
+            raise ValueError("JWKS has no keys")
+        return {'fetched_at': time.time(), 'metadata': metadata, 'jwks': jwks}
+
+    @staticmethod
+    def _get_json(url: str) -> Dict:
+        resp = requests.get(url, timeout=OIDC_FETCH_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+        body = resp.json()
+        if not isinstance(body, dict):
+            raise ValueError(f"{url} didn't return a JSON object")
+        return body
+
+    def _read_file(self) -> Optional[Dict]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                document = json.load(f)
+            if document.get('metadata', {}).get('jwks_uri') and document.get('jwks', {}).get('keys'):
+                return document
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, AttributeError):
+            logger.warning("Ignoring unreadable OIDC metadata cache %s", self.path, exc_info=True)
+        return None
+
+    def _write_file(self, document: Dict) -> None:
+        # Write-then-rename, so another worker never reads half a file.
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(document, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logger.warning("Couldn't write OIDC metadata cache %s", self.path, exc_info=True)
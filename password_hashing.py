@@ -0,0 +1,120 @@
+"""
+Password hashing, off the request threads and behind back-pressure.
+
+Password hashes are deliberately expensive (scrypt by default), and
+hashing used to run inline in whichever request thread needed it. A few
+concurrent logins - or a credential-stuffing burst - kept every worker's
+CPU busy, and /upload and /emergency waited behind them. Now each process
+hashes in a pool of PASSWORD_HASH_WORKERS child processes, so hashing can
+use at most that many cores. A Bulkhead (see bulkhead.py) sits in front:
+up to PASSWORD_HASH_MAX_QUEUE more requests wait at most
+PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS for a slot. Anything beyond that gets
+PasswordHashingBusy, which the app answers with a 503 and Retry-After
+instead of queueing without limit.
+
+PASSWORD_HASH_METHOD is the werkzeug method string with its work factors,
+e.g. scrypt:32768:8:1 or pbkdf2:sha256:1000000. Stored hashes carry the
+parameters they were made with. needs_rehash() compares them with the
+configured ones, and database.verify_password() re-hashes the password on
+a successful login when they differ, so raising the work factor takes
+effect as users sign in. PASSWORD_HASH_WORKERS=0 hashes in the calling
+thread (still behind the bulkhead) - for tests and one-off scripts.
+"""
+
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from bulkhead import Bulkhead
+from logging_config import get_logger
+
+logger = get_logger('password_hashing')
+
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+
+hashing_bulkhead = Bulkhead(
+    'password hashing',
+    max_concurrent=max(1, PASSWORD_HASH_WORKERS),
+    max_queue=int(os.getenv('PASSWORD_HASH_MAX_QUEUE', '16')),
+    max_wait_seconds=float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS', '10')),
+)
+
+# Created on first use, per process: a pool inherited through a fork (e.g.
+# gunicorn --preload) would belong to the parent.
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+
+class PasswordHashingBusy(Exception):
+    """Every hashing slot is busy and the queue is full or timed out."""
+
+
+def hash_password(password: str) -> str:
+    return _run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def check_password(password_hash: str, password: str) -> bool:
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """True if this hash wasn't made with the configured method and work
+    factors."""
+    return password_hash.split('$', 1)[0] != _configured_prefix()
+
+
+@functools.lru_cache(maxsize=None)
+def _configured_prefix() -> str:
+    # werkzeug fills in defaults ("scrypt" is stored as "scrypt:32768:8:1"),
+    # so ask it rather than parse the setting - one hash, once per process.
+    return generate_password_hash('', PASSWORD_HASH_METHOD).split('$', 1)[0]
+
+
+def _run(fn, *args):
+    with hashing_bulkhead.slot() as admitted:
+        if not admitted:
+            raise PasswordHashingBusy()
+        if PASSWORD_HASH_WORKERS <= 0:
+            return fn(*args)
+        try:
+            return _get_pool().submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A child died (e.g. OOM-killed). Start a fresh pool next time;
+            # this one call runs here rather than failing the request.
+            logger.error("Password hashing pool broke - restarting it", exc_info=True)
+            _reset_pool()
+            return fn(*args)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # spawn, not fork: forking a process that has threads running
+            # can leave locks held in the child.
+            _pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+            logger.info("Started password hashing pool with %d processes", PASSWORD_HASH_WORKERS)
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def stats() -> Dict:
+    return dict(hashing_bulkhead.stats(), method=PASSWORD_HASH_METHOD.split(':', 1)[0],
+                workers=PASSWORD_HASH_WORKERS)
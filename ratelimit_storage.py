@@ -0,0 +1,182 @@
+"""
+Rate-limit storage for flask-limiter shared by every worker on a host,
+kept in a local SQLite file - no Redis needed.
+
+With `memory://` each gunicorn worker counts on its own, so with `-w 2` a
+client really gets twice the configured limits. Importing this module
+registers a `sqlite://` storage scheme with the `limits` library: the
+counters live in one WAL-mode SQLite file that every worker process opens.
+Each check is a single upsert statement (or, for the moving-window
+strategy, one short write transaction) on a per-thread connection, so it
+stays atomic across processes and costs tens of microseconds -
+`python benchmarks/bench_ratelimit_storage.py` measures it against
+memory:// and checks that concurrent workers don't over-admit.
+
+    RATELIMIT_STORAGE_URI=sqlite:////var/lib/quickaid/ratelimits.db   (absolute)
+    RATELIMIT_STORAGE_URI=sqlite:///ratelimits.db                     (relative)
+
+The counters are throwaway: the file uses synchronous=OFF, since losing the
+last moments of counts in a power cut only means a fresh window. It only
+works for processes on one host - several hosts still need Redis.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+from limits.errors import ConfigurationError
+from limits.storage import MovingWindowSupport, Storage
+
+# Short: a rate-limit check shouldn't hold a request up for long even when
+# every worker is checking at once.
+BUSY_TIMEOUT_MS = 2000
+# Expired rows are deleted every this many writes (per process) rather
+# than on every check.
+SWEEP_EVERY_WRITES = 1000
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS counters (
+        key TEXT PRIMARY KEY,
+        count INTEGER NOT NULL,
+        expires REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_counters_expires ON counters(expires);
+    CREATE TABLE IF NOT EXISTS window_entries (
+        key TEXT NOT NULL,
+        at REAL NOT NULL,
+        expires REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_window_entries_key ON window_entries(key, at);
+    CREATE INDEX IF NOT EXISTS idx_window_entries_expires ON window_entries(expires);
+"""
+
+# One statement, so it's atomic across processes without an explicit
+# transaction: a counter whose window has ended starts over.
+_INCR_SQL = """
+    INSERT INTO counters (key, count, expires) VALUES (:key, :amount, :now + :expiry)
+    ON CONFLICT(key) DO UPDATE SET
+        count = CASE WHEN expires <= :now THEN :amount ELSE count + :amount END,
+        expires = CASE WHEN expires <= :now THEN :now + :expiry ELSE expires END
+    RETURNING count
+"""
+
+
+class SQLiteStorage(Storage, MovingWindowSupport):
+    """`limits` storage over a SQLite file, for the fixed-window (the
+    flask-limiter default) and moving-window strategies."""
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        path = urllib.parse.urlparse(uri).path
+        # sqlite:///relative.db and sqlite:////absolute.db, as SQLAlchemy has it.
+        path = path[1:] if path.startswith('/') else path
+        if not path:
+            raise ConfigurationError("sqlite:// rate-limit storage needs a file, e.g. sqlite:////tmp/ratelimits.db")
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self._connection().executescript(_SCHEMA)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self) -> sqlite3.Connection:
+        # Per thread, and per process: a connection inherited through a
+        # fork mustn't be used by the child.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                   timeout=BUSY_TIMEOUT_MS / 1000)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _write_transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _wrote(self, conn: sqlite3.Connection, now: float) -> None:
+        self._writes += 1
+        if self._writes % SWEEP_EVERY_WRITES == 0:
+            conn.execute("DELETE FROM counters WHERE expires <= ?", (now,))
+            conn.execute("DELETE FROM window_entries WHERE expires <= ?", (now,))
+
+    # -- fixed window ------------------------------------------------------
+
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        conn = self._connection()
+        now = time.time()
+        count = conn.execute(_INCR_SQL, {'key': key, 'amount': amount, 'now': now, 'expiry': expiry}).fetchone()[0]
+        self._wrote(conn, now)
+        return count
+
+    def get(self, key: str) -> int:
+        row = self._connection().execute(
+            "SELECT count FROM counters WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT expires FROM counters WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone()
+        return row[0] if row else now
+
+    # -- moving window -----------------------------------------------------
+
+    def acquire_entry(self, key: str, limit: int, expiry: int, amount: int = 1) -> bool:
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._write_transaction() as conn:
+            conn.execute("DELETE FROM window_entries WHERE key = ? AND at <= ?", (key, now - expiry))
+            taken = conn.execute("SELECT COUNT(*) FROM window_entries WHERE key = ?", (key,)).fetchone()[0]
+            if taken + amount > limit:
+                return False
+            conn.executemany("INSERT INTO window_entries (key, at, expires) VALUES (?, ?, ?)",
+                             [(key, now, now + expiry)] * amount)
+            self._wrote(conn, now)
+        return True
+
+    def get_moving_window(self, key: str, limit: int, expiry: int):
+        now = time.time()
+        oldest, count = self._connection().execute(
+            "SELECT MIN(at), COUNT(*) FROM window_entries WHERE key = ? AND at > ?", (key, now - expiry)
+        ).fetchone()
+        return (oldest if count else now), count
+
+    # -- housekeeping ------------------------------------------------------
+
+    def check(self) -> bool:
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> int:
+        with self._write_transaction() as conn:
+            removed = conn.execute("DELETE FROM counters").rowcount
+            removed += conn.execute("DELETE FROM window_entries").rowcount
+        return removed
+
+    def clear(self, key: str) -> None:
+        with self._write_transaction() as conn:
+            conn.execute("DELETE FROM counters WHERE key = ?", (key,))
+            conn.execute("DELETE FROM window_entries WHERE key = ?", (key,))
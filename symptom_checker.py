@@ -1,17 +1,48 @@
 import json
 import os
+import re
 from typing import Dict, List, Literal
 from collections import defaultdict
 from google import genai
 from google.genai import types
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from logging_config import get_logger
+from bulkhead import gemini_bulkhead
+import model_router
+import follow_up_intents
+from follow_up_intents import SpeculativeAnswer
 
 load_dotenv()
 
 logger = get_logger('symptom_checker')
 
+# Keywords and variations the basic matcher looks for, per symptom.
+SYMPTOM_PATTERNS = {
+    'fever': ['fever', 'high temperature', 'hot', 'burning up'],
+    'headache': ['headache', 'head pain', 'migraine', 'head hurts'],
+    'chest_pain': ['chest pain', 'chest hurts', 'heart pain', 'chest tightness'],
+    'cough': ['cough', 'coughing', 'hacking'],
+    'abdominal_pain': ['stomach pain', 'belly pain', 'abdominal pain', 'stomach ache'],
+    'shortness_of_breath': ['shortness of breath', 'hard to breathe', 'breathing difficulty', 'cant breathe'],
+    'nausea': ['nausea', 'nauseous', 'sick to stomach', 'queasy'],
+    'fatigue': ['tired', 'fatigue', 'exhausted', 'weak', 'no energy'],
+    'dizziness': ['dizzy', 'lightheaded', 'spinning', 'vertigo'],
+    'sore_throat': ['sore throat', 'throat pain', 'throat hurts']
+}
+
+# Words that say nothing about what's wrong: once the matched keywords are
+# taken out of a description, anything else left over is something the
+# matcher didn't understand (see _unmatched_words).
+FILLER_WORDS = frozenset("""
+    a an the and or but with of in on at to for from about also too so
+    i i'm im i've ive me my it it's its this that there
+    am is are was were be been have has had having got get getting
+    feel feels feeling felt keep keeps kept just now still again
+    very really quite pretty bit little lot kind sort some bad badly mild slight slightly
+    today tonight yesterday morning afternoon evening night all day days week weeks since ago hours time
+""".split())
+
 
 class SymptomAnalysisResult(BaseModel):
     """Schema Gemini is constrained to reply in - no more find('{')/rfind('}') guessing."""
@@ -21,16 +52,12 @@ class SymptomAnalysisResult(BaseModel):
     recommendations: List[str]
     emergency_alert: bool
     safety_tips: List[str]
+    # Answers to the follow-ups users almost always ask next, generated in
+    # this same call (see follow_up_intents).
+    likely_follow_ups: List[SpeculativeAnswer] = Field(default_factory=list)
 
 
 class SymptomChecker:
-    # "gemini-flash-latest" is Google's stable alias for their current-generation
-    # Flash model, so this keeps working as Google ships new versions instead of
-    # pointing at a specific release (like the old 'gemini-1.5-flash') that gets
-    # deprecated and shut down over time. Pin to an exact version instead if you
-    # need reproducible/deterministic behavior across releases.
-    MODEL_NAME = 'gemini-flash-latest'
-
     def __init__(self):
         api_key = os.getenv('GEMINI_API_KEY')
         if api_key and api_key != 'your_gemini_api_key_here':
@@ -136,7 +163,10 @@ class SymptomChecker:
         """Analyze symptoms and provide medical recommendations"""
         try:
             if self.use_gemini:
-                return self._analyze_with_gemini(symptom_text)
+                with gemini_bulkhead.slot() as admitted:
+                    if admitted:
+                        return self._analyze_with_gemini(symptom_text)
+                return self._shed_to_basic(symptom_text)
             else:
                 return self._analyze_basic_symptoms(symptom_text)
 
@@ -163,17 +193,25 @@ class SymptomChecker:
         Be accurate and specific. If symptoms suggest emergency conditions (chest pain,
         difficulty breathing, severe bleeding, stroke signs), clearly set emergency_alert
         to true and urgency_level to "high".
+
+        {follow_up_intents.prompt_instructions()}
         """
 
+        text = symptom_text.lower()
+        route = model_router.route_symptoms(
+            symptom_text, self._extract_symptoms(text), self.symptom_database, self._unmatched_words(text)
+        )
+
         try:
-            response = self.client.models.generate_content(
-                model=self.MODEL_NAME,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    response_mime_type='application/json',
-                    response_schema=SymptomAnalysisResult,
-                ),
-            )
+            with model_router.timed(route):
+                response = self.client.models.generate_content(
+                    model=route.model,
+                    contents=prompt,
+                    config=types.GenerateContentConfig(
+                        response_mime_type='application/json',
+                        response_schema=SymptomAnalysisResult,
+                    ),
+                )
 
             return self._parse_gemini_symptom_response(response)
 
@@ -184,6 +222,18 @@ class SymptomChecker:
             )
             return self._analyze_basic_symptoms(symptom_text)
 
+    def _shed_to_basic(self, symptom_text: str) -> Dict:
+        """Basic analysis for a request the Gemini bulkhead turned away
+        under load, flagged so the client can tell the user why."""
+        logger.info("Gemini overloaded - serving basic symptom analysis")
+        result = self._analyze_basic_symptoms(symptom_text)
+        result['degraded'] = True
+        result['disclaimer'] = (
+            'AI analysis is temporarily busy, so this is a basic analysis only. '
+            'Try again shortly, and always consult healthcare professionals.'
+        )
+        return result
+
     def _parse_gemini_symptom_response(self, response) -> Dict:
         """
         Turn the Gemini response into our standard dict shape.
@@ -221,7 +271,8 @@ class SymptomChecker:
                 'action': 'Call 911 or go to nearest emergency room immediately' if is_emergency else ''
             },
             'safety_tips': [str(t) for t in result.get('safety_tips', [])] or self._get_symptom_safety_tips(),
-            'disclaimer': 'AI analysis for educational purposes only. Always consult healthcare professionals.'
+            'disclaimer': 'AI analysis for educational purposes only. Always consult healthcare professionals.',
+            'follow_up_answers': follow_up_intents.collect_answers(result.get('likely_follow_ups')),
         }
 
     def _analyze_basic_symptoms(self, symptom_text: str) -> Dict:
@@ -253,21 +304,7 @@ class SymptomChecker:
         """Extract symptoms from text input"""
         detected_symptoms = []
 
-        # Define symptom keywords and variations
-        symptom_patterns = {
-            'fever': ['fever', 'high temperature', 'hot', 'burning up'],
-            'headache': ['headache', 'head pain', 'migraine', 'head hurts'],
-            'chest_pain': ['chest pain', 'chest hurts', 'heart pain', 'chest tightness'],
-            'cough': ['cough', 'coughing', 'hacking'],
-            'abdominal_pain': ['stomach pain', 'belly pain', 'abdominal pain', 'stomach ache'],
-            'shortness_of_breath': ['shortness of breath', 'hard to breathe', 'breathing difficulty', 'cant breathe'],
-            'nausea': ['nausea', 'nauseous', 'sick to stomach', 'queasy'],
-            'fatigue': ['tired', 'fatigue', 'exhausted', 'weak', 'no energy'],
-            'dizziness': ['dizzy', 'lightheaded', 'spinning', 'vertigo'],
-            'sore_throat': ['sore throat', 'throat pain', 'throat hurts']
-        }
-
-        for symptom, patterns in symptom_patterns.items():
+        for symptom, patterns in SYMPTOM_PATTERNS.items():
             for pattern in patterns:
                 if pattern in text:
                     detected_symptoms.append(symptom)
@@ -275,6 +312,15 @@ class SymptomChecker:
 
         return list(set(detected_symptoms))  # Remove duplicates
 
+    def _unmatched_words(self, text: str) -> List[str]:
+        """The words of `text` (lowercased) that no symptom keyword covers
+        and that aren't filler - what the matcher would be ignoring. Empty
+        means it understood the whole description."""
+        # Longest keywords first, so "chest pain" goes before "pain" would.
+        for pattern in sorted((p for patterns in SYMPTOM_PATTERNS.values() for p in patterns), key=len, reverse=True):
+            text = text.replace(pattern, ' ')
+        return [word for word in re.findall(r"[a-z0-9']+", text) if word not in FILLER_WORDS]
+
     def _analyze_symptom_combination(self, symptoms: List[str]) -> Dict:
         """Analyze combination of symptoms"""
         conditions = defaultdict(int)
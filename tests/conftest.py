@@ -6,6 +6,7 @@ any app/database import happens) so tests never touch the real quickaid.db
 and can't interfere with each other or a running dev server.
 """
 
+import glob
 import os
 import sys
 import tempfile
@@ -23,8 +24,18 @@ def temp_db_path(monkeypatch):
     os.remove(path)  # start with no file - init_db() will create it
     monkeypatch.setenv('DATABASE_PATH', path)
     yield path
-    if os.path.exists(path):
-        os.remove(path)
+    # Close this thread's pooled connections first so SQLite can let go of
+    # the WAL, then remove the database along with its -wal/-shm files, the
+    # user cache signal file, the rate-limit counters, the cached Google
+    # OIDC metadata and any history shard files.
+    import database
+    database.close_connection()
+    shard_files = glob.glob(glob.escape(os.path.splitext(path)[0]) + '.history-*')
+    ratelimit_files = glob.glob(glob.escape(path) + '.ratelimits*')
+    for leftover in (path, path + '-wal', path + '-shm', path + '.users-changed', path + '.oidc-google.json',
+                     *shard_files, *ratelimit_files):
+        if os.path.exists(leftover):
+            os.remove(leftover)
 
 
 @pytest.fixture()
@@ -42,6 +53,24 @@ def db_module(temp_db_path):
     return database
 
 
+@pytest.fixture()
+def alice(db_module):
+    """A plain account to own the history a test saves."""
+    return db_module.create_user('alice', 'alice@example.com', 'password123')
+
+
+def save_symptom(db_module, user, text, created_at=None, **analysis):
+    """Save a symptom analysis for `user`; `analysis` fields override the
+    default single recommendation. Returns its id."""
+    analysis.setdefault('recommendations', ['Rest and stay hydrated'])
+    return db_module.save_symptom_analysis(user['id'], text, analysis, created_at=created_at)
+
+
+def count_rows(db_module, table, shard=None):
+    with db_module.get_connection(shard=shard) as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
 @pytest.fixture()
 def app(temp_db_path, monkeypatch):
     """A configured Flask app instance, isolated to a temp DB, for testing."""
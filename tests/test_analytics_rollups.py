@@ -0,0 +1,151 @@
+"""
+Tests for the analytics rollups: counts kept up to date by every save,
+rollup_report() summing them over shards, rebuild_rollups() backfilling
+from stored history, and the token-protected admin endpoint.
+"""
+
+import threading
+from datetime import datetime, timezone
+
+import pytest
+
+from tests.conftest import save_symptom
+
+
+def _today():
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def _symptom(db_module, user, urgency='low', conditions=(), emergency=False, created_at=None):
+    return save_symptom(db_module, user, 'headache', created_at, urgency_level=urgency,
+                        possible_conditions=list(conditions), emergency_alert={'alert': emergency})
+
+
+def _rollups(db_module, shard=None):
+    with db_module.get_connection(shard=shard) as conn:
+        return db_module._read_rollups(conn)
+
+
+class TestCounting:
+    def test_saves_are_counted_by_day_kind_and_urgency(self, db_module, alice):
+        _symptom(db_module, alice, 'High', [{'name': 'Migraine'}, 'Tension headache'])
+        _symptom(db_module, alice, 'high', ['migraine'], emergency=True)
+        db_module.save_image_analysis(alice['id'], 'arm.png', {'urgency': 'low', 'detected_conditions': ['Eczema'],
+                                                               'recommendations': []})
+
+        [day] = db_module.rollup_report()['days']
+        assert day['day'] == _today()
+        assert day['analyses'] == 3
+        assert day['by_kind'] == {'image': 1, 'symptom': 2}
+        assert day['by_urgency'] == {'high': 2, 'low': 1}
+        assert day['emergency_alerts'] == 1
+        assert day['top_conditions'][0] == {'condition': 'migraine', 'analyses': 2}
+
+    def test_report_covers_only_the_requested_days(self, db_module, alice):
+        _symptom(db_module, alice, created_at='2020-03-01T10:00:00+00:00')
+        _symptom(db_module, alice)
+        report = db_module.rollup_report(days=7)
+        assert [day['day'] for day in report['days']] == [_today()]
+
+    def test_top_conditions_are_limited_and_ranked(self, db_module, alice):
+        for name, count in (('flu', 3), ('cold', 2), ('rash', 1)):
+            for _ in range(count):
+                _symptom(db_module, alice, conditions=[name])
+        assert db_module.rollup_report(top=2)['top_conditions'] == [
+            {'condition': 'flu', 'analyses': 3}, {'condition': 'cold', 'analyses': 2}
+        ]
+
+    def test_clearing_and_archiving_history_keep_the_counts(self, db_module, alice):
+        analysis_id = _symptom(db_module, alice, 'high', created_at='2020-03-01T10:00:00+00:00')
+        _symptom(db_module, alice, 'high', created_at='2020-03-02T10:00:00+00:00')
+        before = _rollups(db_module)
+
+        db_module.archive_history(older_than_days=30)
+        db_module.restore_archived_analysis(alice['id'], 'symptom', analysis_id)
+        assert _rollups(db_module) == before
+
+        db_module.delete_history(alice['id'])
+        db_module.purge_deleted()
+        assert _rollups(db_module) == before
+
+
+class TestRebuild:
+    def test_backfills_from_hot_and_archived_history(self, db_module, alice):
+        _symptom(db_module, alice, 'high', ['flu'], created_at='2020-03-01T10:00:00+00:00')
+        _symptom(db_module, alice, 'low', ['cold'], emergency=True)
+        db_module.archive_history(older_than_days=30)
+        expected = _rollups(db_module)
+        with db_module.get_connection() as conn:
+            conn.execute("DELETE FROM analysis_rollups")
+            conn.execute("DELETE FROM condition_rollups")
+
+        assert db_module.rebuild_rollups() == 2
+        assert _rollups(db_module) == expected
+
+    def test_analyses_saved_during_the_rebuild_are_kept(self, db_module, alice, monkeypatch):
+        _symptom(db_module, alice, 'high')
+        real_read = db_module._read_rollups
+
+        def save_concurrently():
+            _symptom(db_module, alice, 'low')
+            db_module.close_connection()
+
+        def read_then_save(conn):
+            counts = real_read(conn)
+            if not saved:  # right after the rebuild's read snapshot starts
+                saved.append(True)
+                thread = threading.Thread(target=save_concurrently)
+                thread.start()
+                thread.join()
+            return counts
+
+        saved = []
+        monkeypatch.setattr(db_module, '_read_rollups', read_then_save)
+        assert db_module.rebuild_rollups() == 1  # the snapshot only sees the first
+
+        [day] = db_module.rollup_report()['days']
+        assert day['by_urgency'] == {'high': 1, 'low': 1}
+
+
+class TestShards:
+    def test_report_sums_every_shard_and_survives_resharding(self, db_module):
+        users = [db_module.create_user(f'user{i}', f'user{i}@example.com', 'password123') for i in range(4)]
+        for user in users:
+            _symptom(db_module, user, 'high', ['flu'])
+        report = db_module.rollup_report()
+
+        db_module.reshard(3)
+        assert _rollups(db_module) == {'analyses': {}, 'conditions': {}}  # moved out of the main database
+        assert db_module.rollup_report() == report
+        _symptom(db_module, users[0], 'high', ['flu'])
+        assert db_module.rollup_report()['days'][0]['analyses'] == 5
+
+        db_module.reshard(0)
+        assert db_module.rollup_report()['days'][0]['analyses'] == 5
+
+
+class TestAdminEndpoint:
+    @pytest.fixture()
+    def token(self, app, monkeypatch):
+        import app as app_module
+        monkeypatch.setattr(app_module, 'ADMIN_API_TOKEN', 's3cret')
+        return 's3cret'
+
+    def test_returns_the_report(self, client, token, registered_user):
+        client.post('/analyze_symptoms', json={'symptoms': 'headache and fever'})
+        resp = client.get('/api/admin/rollups?days=7', headers={'Authorization': f'Bearer {token}'})
+        assert resp.status_code == 200
+        body = resp.get_json()
+        assert body['success'] is True
+        assert body['days'][0]['by_kind'] == {'symptom': 1}
+
+    def test_rejects_a_wrong_token(self, client, token):
+        resp = client.get('/api/admin/rollups', headers={'Authorization': 'Bearer nope'})
+        assert resp.status_code == 401
+
+    def test_rejects_bad_parameters(self, client, token):
+        resp = client.get('/api/admin/rollups?top=0', headers={'Authorization': f'Bearer {token}'})
+        assert resp.status_code == 400
+
+    def test_does_not_exist_without_a_token(self, client):
+        assert client.get('/api/admin/rollups', headers={'Authorization': 'Bearer '}).status_code == 404
@@ -161,6 +161,47 @@ class TestHistoryEndpoint:
         client.post('/api/history/clear')
         assert len(client.get('/api/history').get_json()['history']) == 0
 
+    def test_history_is_paginated_with_a_cursor(self, client, registered_user):
+        for i in range(3):
+            client.post('/analyze_symptoms', json={'symptoms': f'headache number {i}'})
+
+        first = client.get('/api/history?limit=2').get_json()
+        assert len(first['history']) == 2
+        second = client.get(f"/api/history?limit=2&cursor={first['next_cursor']}").get_json()
+        assert len(second['history']) == 1
+        assert second['next_cursor'] is None
+        assert second['history'][0]['symptom_text'] == 'headache number 0'
+
+    def test_listing_is_summary_and_detail_is_full(self, client, registered_user):
+        client.post('/analyze_symptoms', json={'symptoms': 'headache and nausea'})
+        entry = client.get('/api/history').get_json()['history'][0]
+        assert 'recommendations' not in entry
+
+        resp = client.get(f"/api/history/symptom/{entry['id']}")
+        assert resp.status_code == 200
+        detail = resp.get_json()['entry']
+        assert detail['recommendations']
+        assert detail['symptom_text'] == 'headache and nausea'
+
+    def test_history_detail_is_private(self, client, registered_user):
+        entry_id = client.post('/analyze_symptoms', json={'symptoms': 'headache'}).get_json()['analysis_id']
+        client.post('/logout')
+        client.post('/register', data={
+            'username': 'otheruser', 'email': 'other@example.com', 'password': 'supersecret123'
+        })
+        assert client.get(f'/api/history/symptom/{entry_id}').status_code == 404
+        assert client.get(f'/api/history/bogus/{entry_id}').status_code == 404
+
+    def test_invalid_history_cursor_rejected(self, client, registered_user):
+        assert client.get('/api/history?cursor=garbage').status_code == 400
+
+    def test_history_page_offers_load_more(self, client, registered_user, monkeypatch):
+        import database as db
+        monkeypatch.setattr(db, 'HISTORY_PAGE_SIZE', 1)
+        client.post('/analyze_symptoms', json={'symptoms': 'headache'})
+        client.post('/analyze_symptoms', json={'symptoms': 'cough'})
+        assert b'id="loadMoreBtn"' in client.get('/history').data
+
 
 class TestMiscRoutes:
     def test_unknown_route_returns_404_not_500(self, client):
@@ -0,0 +1,120 @@
+"""
+Tests for the Gemini bulkhead: slot accounting, bounded queueing with a
+wait deadline, and the analyzers shedding to basic mode when it's full.
+"""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+from unittest.mock import MagicMock
+
+from bulkhead import Bulkhead
+from medical_analyzer import MedicalAnalyzer
+from symptom_checker import SymptomChecker
+from conversation import ConversationService, FollowUpUnavailable, BUSY_MESSAGE
+
+
+class TestBulkhead:
+    def test_admits_up_to_max_concurrent(self):
+        bh = Bulkhead('test', max_concurrent=2, max_queue=0, max_wait_seconds=0)
+        assert bh.acquire() is True
+        assert bh.acquire() is True
+        assert bh.acquire() is False
+        assert bh.stats()['shed_total'] == 1
+
+    def test_release_frees_a_slot(self):
+        bh = Bulkhead('test', max_concurrent=1, max_queue=0, max_wait_seconds=0)
+        assert bh.acquire() is True
+        bh.release()
+        assert bh.acquire() is True
+
+    def test_queued_request_gives_up_after_deadline(self):
+        bh = Bulkhead('test', max_concurrent=1, max_queue=1, max_wait_seconds=0.05)
+        assert bh.acquire() is True
+        started = time.monotonic()
+        assert bh.acquire() is False
+        assert time.monotonic() - started >= 0.05
+        assert bh.stats()['queued'] == 0
+
+    def test_queued_request_admitted_when_slot_frees(self):
+        bh = Bulkhead('test', max_concurrent=1, max_queue=1, max_wait_seconds=2)
+        assert bh.acquire() is True
+        result = {}
+
+        def waiter():
+            result['admitted'] = bh.acquire()
+
+        t = threading.Thread(target=waiter)
+        t.start()
+        time.sleep(0.05)
+        assert bh.stats()['queued'] == 1
+        bh.release()
+        t.join(timeout=2)
+        assert result['admitted'] is True
+        assert bh.stats()['active'] == 1
+
+    def test_slot_only_releases_when_admitted(self):
+        bh = Bulkhead('test', max_concurrent=1, max_queue=0, max_wait_seconds=0)
+        with bh.slot() as first:
+            assert first is True
+            with bh.slot() as second:
+                assert second is False
+            assert bh.stats()['active'] == 1
+        assert bh.stats()['active'] == 0
+
+
+@pytest.fixture()
+def full_bulkhead(monkeypatch):
+    """Swap the shared gemini bulkhead for one with no free capacity."""
+    bh = Bulkhead('gemini', max_concurrent=1, max_queue=0, max_wait_seconds=0)
+    bh.acquire()
+    import medical_analyzer
+    import symptom_checker
+    import conversation
+    for module in (medical_analyzer, symptom_checker, conversation):
+        monkeypatch.setattr(module, 'gemini_bulkhead', bh)
+    return bh
+
+
+class TestLoadShedding:
+    def test_symptom_checker_sheds_to_basic(self, full_bulkhead):
+        checker = SymptomChecker()
+        checker.use_gemini = True
+        checker.client = MagicMock()
+
+        result = checker.analyze_symptoms("i have a fever and a headache")
+
+        checker.client.models.generate_content.assert_not_called()
+        assert result['degraded'] is True
+        assert 'fever' in result['detected_symptoms']
+
+    def test_medical_analyzer_sheds_to_basic(self, full_bulkhead, tmp_path):
+        path = tmp_path / 'img.png'
+        Image.fromarray(np.full((20, 20, 3), [200, 40, 40], dtype=np.uint8)).save(path)
+        analyzer = MedicalAnalyzer()
+        analyzer.use_gemini = True
+        analyzer.client = MagicMock()
+
+        result = analyzer.analyze_image(str(path))
+
+        analyzer.client.models.generate_content.assert_not_called()
+        assert result['degraded'] is True
+        assert result['detected_conditions']
+
+    def test_follow_up_raises_busy_message(self, full_bulkhead):
+        cs = ConversationService()
+        cs.use_gemini = True
+        cs.client = MagicMock()
+
+        with pytest.raises(FollowUpUnavailable) as excinfo:
+            cs.ask_follow_up('symptom', '{}', [], 'is this serious?')
+        assert excinfo.value.message == BUSY_MESSAGE
+        cs.client.models.generate_content.assert_not_called()
+
+    def test_admitted_request_is_not_flagged(self):
+        checker = SymptomChecker()
+        result = checker.analyze_symptoms("i have a headache")
+        assert 'degraded' not in result
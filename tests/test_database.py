@@ -1,5 +1,7 @@
 """Tests for database.py: user accounts and history persistence."""
 
+import json
+
 import pytest
 
 
@@ -161,3 +163,271 @@ class TestHistory:
 
         history = db_module.get_history(user['id'], limit=3)
         assert len(history) == 3
+
+
+class TestFollowUps:
+    def _make_analysis(self, db_module):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        analysis_id = db_module.save_symptom_analysis(user['id'], "headache", {
+            "detected_symptoms": ["headache"], "possible_conditions": ["migraine"],
+            "urgency_level": "low", "emergency_alert": {"alert": False},
+            "recommendations": ["rest"], "safety_tips": [], "disclaimer": ""
+        })
+        return user, analysis_id
+
+    def test_save_returns_analysis_id_and_get_analysis_is_scoped(self, db_module):
+        user, analysis_id = self._make_analysis(db_module)
+        other = db_module.create_user("bob", "bob@example.com", "password123")
+        assert db_module.get_analysis(user['id'], 'symptom', analysis_id)['symptom_text'] == 'headache'
+        assert db_module.get_analysis(other['id'], 'symptom', analysis_id) is None
+
+    def test_follow_ups_stored_in_order(self, db_module):
+        user, analysis_id = self._make_analysis(db_module)
+        db_module.save_follow_up(user['id'], 'symptom', analysis_id, "q1", "a1")
+        db_module.save_follow_up(user['id'], 'symptom', analysis_id, "q2", "a2")
+        turns = db_module.get_follow_ups(user['id'], 'symptom', analysis_id)
+        assert [t['question'] for t in turns] == ['q1', 'q2']
+
+    def test_context_window_splits_recent_and_evicted(self, db_module):
+        user, analysis_id = self._make_analysis(db_module)
+        for i in range(5):
+            db_module.save_follow_up(user['id'], 'symptom', analysis_id, f"q{i}", f"a{i}")
+        context = db_module.get_follow_up_context(user['id'], 'symptom', analysis_id, window=3)
+        assert context['summary'] is None
+        assert [t['question'] for t in context['recent']] == ['q2', 'q3', 'q4']
+        assert [t['question'] for t in context['evicted']] == ['q0', 'q1']
+
+    def test_summary_hides_already_folded_turns(self, db_module):
+        user, analysis_id = self._make_analysis(db_module)
+        ids = [db_module.save_follow_up(user['id'], 'symptom', analysis_id, f"q{i}", f"a{i}") for i in range(5)]
+        db_module.save_follow_up_summary(user['id'], 'symptom', analysis_id, "first two", ids[1])
+        db_module.save_follow_up_summary(user['id'], 'symptom', analysis_id, "first three", ids[2])
+        context = db_module.get_follow_up_context(user['id'], 'symptom', analysis_id, window=3)
+        assert context['summary'] == "first three"
+        assert [t['question'] for t in context['recent']] == ['q3', 'q4']
+        assert context['evicted'] == []
+
+    def test_follow_ups_deleted_with_history(self, db_module):
+        user, analysis_id = self._make_analysis(db_module)
+        db_module.save_follow_up(user['id'], 'symptom', analysis_id, "q", "a")
+        db_module.delete_history(user['id'])
+        db_module.purge_deleted()
+        assert db_module.get_follow_ups(user['id'], 'symptom', analysis_id) == []
+
+
+class TestConnectionPool:
+    def test_connection_reused_within_a_thread(self, db_module):
+        with db_module.get_connection() as first:
+            pass
+        with db_module.get_connection() as second:
+            pass
+        assert first is second
+
+    def test_each_thread_gets_its_own_connection(self, db_module):
+        import threading
+        with db_module.get_connection() as main_conn:
+            pass
+        seen = {}
+
+        def worker():
+            with db_module.get_connection() as conn:
+                seen['conn'] = conn
+                seen['users'] = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+            db_module.close_connection()
+
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        assert seen['conn'] is not main_conn
+        assert seen['users'] == 0
+
+    def test_pragmas_applied(self, db_module):
+        with db_module.get_connection() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+            assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+            assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == db_module.BUSY_TIMEOUT_MS
+
+    def test_new_connection_after_fork(self, db_module, monkeypatch):
+        import os
+        with db_module.get_connection() as parent_conn:
+            pass
+        monkeypatch.setattr(os, 'getpid', lambda: -1)
+        with db_module.get_connection() as child_conn:
+            pass
+        assert child_conn is not parent_conn
+
+    def test_outer_block_rolls_back_as_a_whole(self, db_module):
+        with pytest.raises(RuntimeError):
+            with db_module.get_connection() as conn:
+                conn.execute(
+                    "INSERT INTO users (username, email, password_hash, created_at) VALUES ('a', 'a@x', 'h', 'now')"
+                )
+                raise RuntimeError("boom")
+        assert db_module.get_user_by_username('a') is None
+
+    def test_failed_inner_block_only_undoes_itself(self, db_module):
+        with db_module.get_connection() as conn:
+            conn.execute(
+                "INSERT INTO users (username, email, password_hash, created_at) VALUES ('a', 'a@x', 'h', 'now')"
+            )
+            # create_user's own block fails on the duplicate and is caught inside it
+            assert db_module.create_user('a', 'other@x', 'password123') is None
+            assert not conn.execute("SELECT 1 FROM users WHERE email = 'other@x'").fetchone()
+        assert db_module.get_user_by_username('a') is not None
+
+    def test_concurrent_history_saves_wait_for_the_lock(self, db_module):
+        # Each save reads text_fragments before it inserts; these used to
+        # fail with "database is locked" instead of waiting their turn.
+        import threading
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(25):
+                    db_module.save_symptom_analysis(user['id'], 'headache', {
+                        'recommendations': [f'tip {n}-{i}'], 'safety_tips': ['Rest'],
+                    })
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                db_module.close_connection()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        with db_module.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM symptom_analyses").fetchone()[0] == 150
+
+
+class TestHistoryPages:
+    def _fill(self, db_module, count):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        for i in range(count):
+            if i % 2:
+                db_module.save_image_analysis(user['id'], f"{i}.jpg", {"recommendations": []})
+            else:
+                db_module.save_symptom_analysis(user['id'], f"symptom {i}", {"recommendations": []})
+        return user
+
+    def _walk(self, db_module, user_id, limit):
+        entries, cursor, pages = [], None, 0
+        while True:
+            page = db_module.get_history_page(user_id, limit, cursor)
+            entries += page['entries']
+            pages += 1
+            cursor = page['next_cursor']
+            if cursor is None:
+                return entries, pages
+
+    def test_pages_cover_everything_once_newest_first(self, db_module):
+        user = self._fill(db_module, 7)
+        entries, pages = self._walk(db_module, user['id'], limit=3)
+        assert pages == 3
+        assert len({(e['type'], e['id']) for e in entries}) == 7
+        keys = [(e['created_at'], e['type'], e['id']) for e in entries]
+        assert keys == sorted(keys, reverse=True)
+
+    def test_identical_timestamps_are_not_skipped(self, db_module, monkeypatch):
+        monkeypatch.setattr(db_module, '_now', lambda: '2024-01-01T00:00:00+00:00')
+        user = self._fill(db_module, 6)
+        entries, _ = self._walk(db_module, user['id'], limit=4)
+        assert len({(e['type'], e['id']) for e in entries}) == 6
+
+    def test_last_page_has_no_cursor(self, db_module):
+        user = self._fill(db_module, 2)
+        page = db_module.get_history_page(user['id'], limit=2)
+        assert len(page['entries']) == 2
+        assert page['next_cursor'] is None
+
+    def test_malformed_cursor_rejected(self, db_module):
+        user = self._fill(db_module, 1)
+        with pytest.raises(ValueError):
+            db_module.get_history_page(user['id'], cursor='not-a-cursor')
+        with pytest.raises(ValueError):
+            db_module.get_history_page(user['id'], cursor=db_module.encode_history_cursor('x', 'bogus', 1))
+
+    def test_pages_hold_summaries_unless_full(self, db_module):
+        user = self._fill(db_module, 2)
+        summary = db_module.get_history_page(user['id'])['entries']
+        assert all('recommendations' not in e for e in summary)
+        assert {e['type'] for e in summary} == {'image', 'symptom'}
+        full = db_module.get_history_page(user['id'], full=True)['entries']
+        assert all('recommendations' in e for e in full)
+        assert [e['id'] for e in full] == [e['id'] for e in summary]
+
+
+class TestTextFragments:
+    ANALYSIS = {
+        "recommendations": ["Rest and stay hydrated", "See a doctor if it persists"],
+        "safety_tips": ["Rest and stay hydrated"],
+        "disclaimer": "Educational use only.",
+    }
+
+    def _fragment_count(self, db_module):
+        with db_module.get_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM text_fragments").fetchone()[0]
+
+    def test_repeated_text_stored_once(self, db_module):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        for _ in range(3):
+            db_module.save_symptom_analysis(user['id'], "headache", dict(self.ANALYSIS))
+        assert self._fragment_count(db_module) == 3  # two recommendations (one shared) + disclaimer
+
+        with db_module.get_connection() as conn:
+            row = conn.execute("SELECT recommendations, disclaimer FROM symptom_analyses LIMIT 1").fetchone()
+        assert all(isinstance(i, int) for i in json.loads(row['recommendations']))
+        assert row['disclaimer'] is None
+
+    def test_round_trip(self, db_module):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        analysis_id = db_module.save_image_analysis(user['id'], "a.jpg", dict(self.ANALYSIS))
+        entry = db_module.get_analysis(user['id'], 'image', analysis_id)
+        assert entry['recommendations'] == self.ANALYSIS['recommendations']
+        assert entry['safety_tips'] == self.ANALYSIS['safety_tips']
+        assert entry['disclaimer'] == self.ANALYSIS['disclaimer']
+
+    def _insert_legacy_row(self, db_module, user_id):
+        with db_module.get_connection() as conn:
+            return conn.execute(
+                """
+                INSERT INTO symptom_analyses (user_id, created_at, symptom_text, recommendations, safety_tips, disclaimer)
+                VALUES (?, '2024-01-01', 'cough', ?, ?, ?)
+                """,
+                (user_id, json.dumps(self.ANALYSIS['recommendations']),
+                 json.dumps(self.ANALYSIS['safety_tips']), self.ANALYSIS['disclaimer'])
+            ).lastrowid
+
+    def test_legacy_rows_still_readable_and_re_encodable(self, db_module):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        legacy_id = self._insert_legacy_row(db_module, user['id'])
+        assert db_module.get_analysis(user['id'], 'symptom', legacy_id)['recommendations'] == \
+            self.ANALYSIS['recommendations']
+
+        assert db_module.encode_text_fragments(batch_size=1) == {'image_analyses': 0, 'symptom_analyses': 1}
+        assert db_module.encode_text_fragments() == {'image_analyses': 0, 'symptom_analyses': 0}
+
+        entry = db_module.get_analysis(user['id'], 'symptom', legacy_id)
+        assert entry['recommendations'] == self.ANALYSIS['recommendations']
+        assert entry['disclaimer'] == self.ANALYSIS['disclaimer']
+
+    def test_lru_is_bounded(self, db_module, monkeypatch):
+        monkeypatch.setattr(db_module, 'FRAGMENT_CACHE_SIZE', 2)
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        analysis_id = db_module.save_symptom_analysis(user['id'], "headache", dict(self.ANALYSIS))
+        db_module.get_analysis(user['id'], 'symptom', analysis_id)
+        assert len(db_module._fragment_cache) == 2
+
+    def test_rollback_drops_cached_fragments(self, db_module):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        with pytest.raises(RuntimeError):
+            with db_module.get_connection():
+                analysis_id = db_module.save_symptom_analysis(user['id'], "headache", dict(self.ANALYSIS))
+                db_module.get_analysis(user['id'], 'symptom', analysis_id)
+                assert db_module._fragment_cache
+                raise RuntimeError("undo")
+        assert not db_module._fragment_cache
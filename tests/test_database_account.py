@@ -58,6 +58,71 @@ class TestTokens:
         db_module.delete_user(user['id'])
         assert db_module.get_valid_token(raw, 'password_reset') is None
 
+    def test_expiry_stored_as_epoch(self, db_module):
+        user = self._make_user(db_module)
+        before = int(time.time())
+        db_module.create_token(user['id'], 'password_reset', ttl_seconds=3600)
+        with db_module.get_connection() as conn:
+            row = conn.execute("SELECT expires_epoch FROM user_tokens").fetchone()
+        assert before + 3600 <= row['expires_epoch'] <= int(time.time()) + 3600
+
+    def test_failed_issue_keeps_the_previous_token(self, db_module, monkeypatch):
+        user = self._make_user(db_module)
+        first = db_module.create_token(user['id'], 'password_reset', ttl_seconds=3600)
+        # Same raw token again -> the INSERT hits the UNIQUE token_hash.
+        monkeypatch.setattr(db_module.secrets, 'token_urlsafe', lambda n: first)
+        with pytest.raises(db_module.sqlite3.IntegrityError):
+            db_module.create_token(user['id'], 'password_reset', ttl_seconds=3600)
+        # ...and the invalidation that preceded it was rolled back with it.
+        assert db_module.get_valid_token(first, 'password_reset') is not None
+
+    def test_compact_deletes_only_dead_tokens_in_batches(self, db_module):
+        user = self._make_user(db_module)
+        for _ in range(7):
+            db_module.create_token(user['id'], 'password_reset', ttl_seconds=3600)  # each invalidates the last
+        db_module.create_token(user['id'], 'email_verify', ttl_seconds=-10)
+        live = db_module.create_token(user['id'], 'password_reset', ttl_seconds=3600)
+
+        assert db_module.compact_tokens(batch_size=3) == 8
+        with db_module.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM user_tokens").fetchone()[0] == 1
+        assert db_module.get_valid_token(live, 'password_reset') is not None
+        assert db_module.compact_tokens() == 0
+
+    def test_invalidation_uses_the_partial_index(self, db_module):
+        with db_module.get_connection() as conn:
+            plan = conn.execute(
+                "EXPLAIN QUERY PLAN UPDATE user_tokens SET used_at = 'x' "
+                "WHERE user_id = 1 AND purpose = 'password_reset' AND used_at IS NULL"
+            ).fetchall()
+        assert 'idx_user_tokens_unused' in plan[0]['detail']
+
+    def test_existing_tokens_get_epoch_backfilled(self, temp_db_path):
+        import importlib
+        import sqlite3
+        import database
+
+        importlib.reload(database)
+        database.init_db()
+        user = database.create_user("alice", "alice@example.com", "password123")
+        with database.get_connection() as conn:
+            # A token issued before expires_epoch existed.
+            conn.execute(
+                "INSERT INTO user_tokens (user_id, purpose, token_hash, created_at, expires_at) "
+                "VALUES (?, 'password_reset', ?, '2024-01-01T00:00:00+00:00', '2999-01-01T00:00:00+00:00')",
+                (user['id'], database._hash_token('legacy'))
+            )
+            # ...in a database from before that migration.
+            conn.execute("PRAGMA user_version = 3")
+        database.close_connection()
+
+        importlib.reload(database)
+        database.init_db()
+        assert database.get_valid_token('legacy', 'password_reset') is not None
+        conn = sqlite3.connect(temp_db_path)
+        assert conn.execute("SELECT expires_epoch FROM user_tokens").fetchone()[0] == 32472144000
+        conn.close()
+
 
 class TestProfileUpdates:
     def _make_user(self, db_module):
@@ -88,6 +153,23 @@ class TestProfileUpdates:
         user = self._make_user(db_module)
         assert db_module.update_email(user['id'], 'bob@example.com') is False
 
+    def test_update_profile_changes_both_or_neither(self, db_module):
+        db_module.create_user("bob", "bob@example.com", "password123")
+        user = self._make_user(db_module)
+        db_module.set_email_verified(user['id'])
+
+        assert db_module.update_profile(user['id'], 'alice2', 'bob@example.com') == 'email'
+        assert db_module.update_profile(user['id'], 'bob', 'alice2@example.com') == 'username'
+        unchanged = db_module.get_user_by_id(user['id'])
+        assert (unchanged['username'], unchanged['email']) == ('alice', 'alice@example.com')
+
+        assert db_module.update_profile(user['id'], 'alice2', 'alice@example.com') is None
+        assert db_module.get_user_by_id(user['id'])['email_verified'] == 1  # same email, still verified
+        assert db_module.update_profile(user['id'], 'alice2', 'alice2@example.com') is None
+        updated = db_module.get_user_by_id(user['id'])
+        assert (updated['username'], updated['email'], updated['email_verified']) == \
+            ('alice2', 'alice2@example.com', 0)
+
     def test_set_password_changes_hash_and_has_password(self, db_module):
         user = self._make_user(db_module)
         old_hash = user['password_hash']
@@ -106,6 +188,7 @@ class TestProfileUpdates:
         })
         db_module.delete_user(user['id'])
         assert db_module.get_user_by_id(user['id']) is None
+        assert db_module.purge_deleted() == {'history_rows': 1, 'users': 1, 'fragments': 0}
         assert db_module.get_history(user['id']) == []
 
 
@@ -0,0 +1,173 @@
+"""
+Tests for deferred deletion: delete_user() / delete_history() tombstoning
+data so it's hidden at once, and purge_deleted() removing it afterwards in
+small, resumable batches - along with the text fragments only it used.
+"""
+
+import pytest
+
+from tests.conftest import count_rows, save_symptom
+
+
+class TestClearHistory:
+    def test_cleared_history_is_hidden_before_it_is_purged(self, db_module, alice):
+        analysis_id = save_symptom(db_module, alice, 'rash on arm')
+        db_module.save_follow_up(alice['id'], 'symptom', analysis_id, 'q', 'a')
+
+        db_module.delete_history(alice['id'])
+        assert db_module.get_history(alice['id']) == []
+        assert db_module.get_analysis(alice['id'], 'symptom', analysis_id) is None
+        assert db_module.search_history(alice['id'], 'rash')['results'] == []
+        assert count_rows(db_module, 'symptom_analyses') == 1  # still there, just hidden
+
+        assert db_module.purge_deleted() == {'history_rows': 2, 'users': 0, 'fragments': 1}
+        assert count_rows(db_module, 'symptom_analyses') == 0
+        assert count_rows(db_module, 'follow_ups') == 0
+        assert count_rows(db_module, 'history_tombstones') == 0
+
+    def test_history_added_after_clearing_stays_visible(self, db_module, alice):
+        save_symptom(db_module, alice, 'headache')
+        db_module.delete_history(alice['id'])
+        newer = save_symptom(db_module, alice, 'sore throat')
+
+        assert [entry['id'] for entry in db_module.get_history(alice['id'])] == [newer]
+        db_module.purge_deleted()
+        assert [entry['id'] for entry in db_module.get_history(alice['id'])] == [newer]
+
+    def test_other_users_are_untouched(self, db_module, alice):
+        bob = db_module.create_user('bob', 'bob@example.com', 'password123')
+        save_symptom(db_module, alice, 'headache')
+        kept = save_symptom(db_module, bob, 'headache')
+        db_module.delete_history(alice['id'])
+        db_module.purge_deleted()
+        assert [entry['id'] for entry in db_module.get_history(bob['id'])] == [kept]
+
+
+class TestDeleteUser:
+    def test_account_is_hidden_and_its_names_freed_at_once(self, db_module, alice):
+        save_symptom(db_module, alice, 'headache')
+        db_module.delete_user(alice['id'])
+
+        assert db_module.get_user_by_id(alice['id']) is None
+        assert db_module.get_user_by_username('alice') is None
+        assert db_module.get_user_by_email('alice@example.com') is None
+        assert db_module.create_user('alice', 'alice@example.com', 'password123') is not None
+
+    def test_lookups_skip_the_tombstone_row(self, db_module, alice):
+        db_module.delete_user(alice['id'])
+        placeholder = f"deleted:{alice['id']}"  # what its username and email became
+        assert db_module.get_user_by_username(placeholder) is None
+        assert db_module.get_user_by_email(placeholder) is None
+
+    def test_purge_removes_history_then_the_row(self, db_module, alice):
+        for i in range(3):
+            save_symptom(db_module, alice, f'headache {i}')
+        db_module.delete_user(alice['id'])
+        assert count_rows(db_module, 'users') == 1
+
+        assert db_module.purge_deleted() == {'history_rows': 3, 'users': 1, 'fragments': 1}
+        assert count_rows(db_module, 'users') == 0
+        assert count_rows(db_module, 'symptom_analyses') == 0
+        assert count_rows(db_module, 'history_search') == 0
+
+
+class TestFragmentSweep:
+    def _fragments(self, db_module):
+        with db_module.get_connection() as conn:
+            return {row['text'] for row in conn.execute("SELECT text FROM text_fragments")}
+
+    def test_purge_drops_the_texts_only_purged_history_used(self, db_module, alice):
+        bob = db_module.create_user('bob', 'bob@example.com', 'password123')
+        db_module.save_symptom_analysis(alice['id'], 'rash', {
+            'recommendations': ['Rest', 'Alice-only advice'], 'disclaimer': 'Not medical advice'
+        })
+        db_module.save_symptom_analysis(bob['id'], 'rash', {'recommendations': ['Rest']})
+        db_module.delete_user(alice['id'])
+
+        assert db_module.purge_deleted()['fragments'] == 2
+        assert self._fragments(db_module) == {'Rest'}
+
+    def test_nothing_purged_means_no_sweep(self, db_module, alice, monkeypatch):
+        monkeypatch.setattr(db_module, 'sweep_text_fragments', None)  # would fail if called
+        save_symptom(db_module, alice, 'headache')
+        assert db_module.purge_deleted()['fragments'] == 0
+
+    def test_a_fragment_used_again_mid_sweep_is_kept(self, db_module, alice, monkeypatch):
+        with db_module.get_connection(write=True) as conn:
+            for text in ('Orphan A', 'Orphan B'):
+                db_module._intern_fragment(conn, text)
+        reused = []
+
+        def reuse_between_batches(seconds):
+            if not reused:
+                reused.append(db_module.save_symptom_analysis(alice['id'], 'x', {'recommendations': ['Orphan B']}))
+
+        monkeypatch.setattr(db_module.time, 'sleep', reuse_between_batches)
+        assert db_module.sweep_text_fragments(batch_size=1) == 1
+        assert self._fragments(db_module) == {'Orphan B'}
+        assert db_module.get_analysis(alice['id'], 'symptom', reused[0])['recommendations'] == ['Orphan B']
+
+    def test_manage_command_can_sweep_every_database(self, db_module, capsys):
+        import manage
+        with db_module.get_connection(write=True) as conn:
+            db_module._intern_fragment(conn, 'Left by an old purge')
+
+        assert manage.main(['purge-deleted']) == 0
+        assert self._fragments(db_module) == {'Left by an old purge'}
+        assert manage.main(['purge-deleted', '--sweep-fragments']) == 0
+        assert '1 unused text fragments' in capsys.readouterr().out
+        assert self._fragments(db_module) == set()
+
+
+class TestBatching:
+    def test_each_batch_is_its_own_short_transaction(self, db_module, alice):
+        for i in range(5):
+            save_symptom(db_module, alice, f'headache {i}')
+        db_module.delete_history(alice['id'])
+
+        statements = []
+        db_module._pooled_connection().set_trace_callback(statements.append)
+        db_module.purge_deleted(batch_size=2)
+        db_module._pooled_connection().set_trace_callback(None)
+
+        # (Triggered statements are traced too, so count transactions.)
+        batches = [after for before, after in zip(statements, statements[1:])
+                   if before == 'BEGIN IMMEDIATE' and after.startswith('DELETE FROM symptom_analyses')]
+        assert len(batches) == 3  # 2 + 2 + 1
+        assert count_rows(db_module, 'symptom_analyses') == 0
+
+    def test_interrupted_purge_resumes_where_it_stopped(self, db_module, alice, monkeypatch):
+        for i in range(6):
+            save_symptom(db_module, alice, f'headache {i}')
+        db_module.delete_user(alice['id'])
+
+        def crash(seconds):
+            raise KeyboardInterrupt  # the process dying between two batches
+
+        monkeypatch.setattr(db_module.time, 'sleep', crash)
+        with pytest.raises(KeyboardInterrupt):
+            db_module.purge_deleted(batch_size=4)
+        assert count_rows(db_module, 'symptom_analyses') == 2  # the first batch stuck
+        monkeypatch.undo()
+
+        assert db_module.purge_deleted(batch_size=4) == {'history_rows': 2, 'users': 1, 'fragments': 1}
+        assert count_rows(db_module, 'users') == 0
+
+
+class TestEndpoints:
+    def test_clear_history_answers_before_purging(self, client, registered_user):
+        client.post('/analyze_symptoms', json={'symptoms': 'headache'})
+        assert client.post('/api/history/clear').get_json()['success'] is True
+        assert client.get('/api/history').get_json()['history'] == []
+
+        import database as db
+        assert count_rows(db, 'symptom_analyses') == 1
+        db.purge_deleted()
+        assert count_rows(db, 'symptom_analyses') == 0
+
+    def test_deleted_account_can_register_again(self, client, registered_user):
+        client.post('/account/delete', data={
+            'current_password': registered_user['password'], 'confirm_text': 'DELETE'
+        })
+        resp = client.post('/register', data=registered_user)
+        assert resp.status_code == 302
@@ -0,0 +1,214 @@
+"""
+Tests for the email outbox: send_email() only queueing, deliver_outbox()
+sending batches over one SMTP connection, retries with backoff and final
+failures, and the account flows queueing mail instead of sending it inline.
+Delivery runs against FakeSMTPServer, a local stand-in for a mail server.
+"""
+
+import email
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+import mailer
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Just enough SMTP for smtplib (EHLO, AUTH, MAIL, RCPT, DATA, RSET,
+    QUIT), on a free local port. Records connections, logins and the
+    messages it accepted; recipients in `refuse` get the reply given there
+    instead of 250."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.port = self.server_address[1]
+        self.connections = 0
+        self.logins = 0
+        self.messages = []
+        self.refuse = {}
+
+    def subjects(self):
+        return [message['Subject'] for message in self.messages]
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply('220 fake ESMTP ready')
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            verb = line.split(' ', 1)[0].upper()
+            if not line or verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            if verb == 'EHLO':
+                self.reply('250-fake')
+                self.reply('250 AUTH PLAIN')
+            elif verb == 'AUTH':
+                server.logins += 1
+                self.reply('235 authenticated')
+            elif verb == 'RCPT':
+                address = line.split(':', 1)[1].strip().strip('<>')
+                self.reply(server.refuse.get(address, '250 ok'))
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = b''
+                while (chunk := self.rfile.readline()) != b'.\r\n':
+                    data += chunk
+                server.messages.append(email.message_from_bytes(data))
+                self.reply('250 queued')
+            else:  # MAIL, RSET, NOOP
+                self.reply('250 ok')
+
+
+@pytest.fixture()
+def smtp_server(monkeypatch):
+    server = FakeSMTPServer()
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    monkeypatch.setattr(mailer, 'SMTP_HOST', '127.0.0.1')
+    monkeypatch.setattr(mailer, 'SMTP_PORT', server.port)
+    monkeypatch.setattr(mailer, 'SMTP_USERNAME', 'quickaid')
+    monkeypatch.setattr(mailer, 'SMTP_PASSWORD', 'secret')
+    monkeypatch.setattr(mailer, 'SMTP_SECURITY', 'none')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def no_smtp_server(smtp_server, monkeypatch):
+    """Configured, but nothing listening on the port."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(mailer, 'SMTP_PORT', port)
+
+
+def _outbox(db_module):
+    with db_module.get_connection() as conn:
+        return [dict(row) for row in conn.execute("SELECT * FROM email_outbox ORDER BY id")]
+
+
+class TestDelivery:
+    def test_send_email_only_queues(self, db_module, smtp_server):
+        assert mailer.send_email('a@example.com', 'Hello', 'Body')
+        assert smtp_server.connections == 0
+        assert db_module.outbox_stats()['pending'] == 1
+
+    def test_batches_share_one_authenticated_connection(self, db_module, smtp_server):
+        for n in range(5):
+            mailer.send_email(f'user{n}@example.com', f'Message {n}', 'Body')
+
+        assert mailer.deliver_outbox(batch_size=2) == {'sent': 5, 'retrying': 0, 'failed': 0}
+        assert smtp_server.connections == 1 and smtp_server.logins == 1
+        assert smtp_server.subjects() == [f'Message {n}' for n in range(5)]
+        assert smtp_server.messages[0]['To'] == 'user0@example.com'
+        rows = _outbox(db_module)
+        assert {row['status'] for row in rows} == {'sent'}
+        assert {row['body'] for row in rows} == {''}  # reset links don't linger
+
+    def test_permanent_refusal_fails_only_that_message(self, db_module, smtp_server):
+        smtp_server.refuse['gone@example.com'] = '550 no such user'
+        mailer.send_email('gone@example.com', 'First', 'Body')
+        mailer.send_email('here@example.com', 'Second', 'Body')
+
+        assert mailer.deliver_outbox() == {'sent': 1, 'retrying': 0, 'failed': 1}
+        gone, here = _outbox(db_module)
+        assert gone['status'] == 'failed' and '550' in gone['last_error']
+        assert here['status'] == 'sent'
+
+    def test_temporary_refusal_is_retried_with_backoff(self, db_module, smtp_server):
+        smtp_server.refuse['busy@example.com'] = '451 try again later'
+        mailer.send_email('busy@example.com', 'Hello', 'Body')
+
+        assert mailer.deliver_outbox()['retrying'] == 1
+        [row] = _outbox(db_module)
+        assert row['status'] == 'pending' and row['attempts'] == 1
+        assert row['next_attempt_epoch'] >= time.time() + mailer.EMAIL_OUTBOX_RETRY_SECONDS - 2
+        assert mailer.deliver_outbox()['retrying'] == 0  # not due yet
+
+        del smtp_server.refuse['busy@example.com']
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE email_outbox SET next_attempt_epoch = 0")
+        assert mailer.deliver_outbox()['sent'] == 1
+        assert smtp_server.subjects() == ['Hello']
+
+    def test_unreachable_server_hands_the_batch_back(self, db_module, no_smtp_server):
+        for n in range(3):
+            mailer.send_email(f'user{n}@example.com', 'Hello', 'Body')
+
+        assert mailer.deliver_outbox() == {'sent': 0, 'retrying': 1, 'failed': 0}
+        assert [row['attempts'] for row in _outbox(db_module)] == [1, 0, 0]
+        assert db_module.outbox_stats()['pending'] == 3
+
+    def test_gives_up_after_max_attempts(self, db_module, no_smtp_server, monkeypatch):
+        monkeypatch.setattr(mailer, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 1)
+        mailer.send_email('a@example.com', 'Hello', 'Body')
+        assert mailer.deliver_outbox()['failed'] == 1
+        assert db_module.outbox_stats()['failed'] == 1
+
+    def test_claim_lapses_if_the_sender_dies(self, db_module):
+        db_module.enqueue_email('a@example.com', 'Hello', 'Body')
+        [claimed] = db_module.claim_outbox_batch(lease_seconds=60)
+        assert db_module.claim_outbox_batch() == []  # another worker's now
+
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE email_outbox SET next_attempt_epoch = 0")
+        [reclaimed] = db_module.claim_outbox_batch()
+        assert reclaimed['id'] == claimed['id'] and reclaimed['attempts'] == 2
+
+
+class TestHousekeeping:
+    def test_old_delivered_mail_is_purged(self, db_module, smtp_server):
+        mailer.send_email('old@example.com', 'Old', 'Body')
+        mailer.deliver_outbox()
+        mailer.send_email('new@example.com', 'New', 'Body')
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE email_outbox SET created_at = '2020-01-01T00:00:00+00:00' "
+                         "WHERE recipient = 'old@example.com'")
+
+        assert db_module.purge_sent_emails(older_than_days=7) == 1
+        assert [row['recipient'] for row in _outbox(db_module)] == ['new@example.com']
+
+    def test_manage_command_sends_the_queue(self, db_module, smtp_server, capsys):
+        import manage
+        mailer.send_email('a@example.com', 'Hello', 'Body')
+        assert manage.main(['deliver-email']) == 0
+        assert 'Sent 1 emails' in capsys.readouterr().out
+        assert smtp_server.subjects() == ['Hello']
+
+    def test_deleting_an_account_drops_its_mail(self, db_module):
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        db_module.enqueue_email('alice@example.com', 'Hello', 'Body')
+        db_module.enqueue_email('bob@example.com', 'Hello', 'Body')
+        db_module.delete_user(user['id'])
+        assert [row['recipient'] for row in _outbox(db_module)] == ['bob@example.com']
+
+
+class TestAccountFlows:
+    def test_register_queues_the_verification_email(self, client, smtp_server):
+        import database as db
+        client.post('/register', data={'username': 'alice', 'email': 'alice@example.com',
+                                       'password': 'supersecret123'})
+        assert smtp_server.connections == 0
+        assert db.outbox_stats()['pending'] == 1
+
+        mailer.deliver_outbox()
+        [message] = smtp_server.messages
+        assert message['To'] == 'alice@example.com'
+        assert '/verify-email/' in message.get_payload()
+
+    def test_health_reports_the_outbox(self, client):
+        assert client.get('/health').get_json()['email_outbox'] == {
+            'pending': 0, 'sending': 0, 'sent': 0, 'failed': 0
+        }
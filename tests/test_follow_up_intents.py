@@ -0,0 +1,172 @@
+"""
+Tests for speculative follow-ups: intent matching, carrying the
+likely_follow_ups answers through the analyzers and the database, and the
+follow-up endpoints answering matched questions from the stored answer.
+"""
+
+import json
+import sqlite3
+
+import pytest
+from unittest.mock import MagicMock
+
+import follow_up_intents
+from follow_up_intents import match_intent, collect_answers, SpeculativeAnswer
+from symptom_checker import SymptomChecker, SymptomAnalysisResult
+
+
+class TestMatchIntent:
+    @pytest.mark.parametrize('question,intent', [
+        ('Is this serious?', 'is_serious'),
+        ('is it serious??', 'is_serious'),
+        ('Should I be worried', 'is_serious'),
+        ('When should I see a doctor?', 'see_doctor'),
+        ('do i need a doctor for this', 'see_doctor'),
+        ("What if it doesn't improve in 2 days?", 'not_improving'),
+        ('what if it doesn’t improve', 'not_improving'),
+    ])
+    def test_common_phrasings_match(self, question, intent):
+        assert match_intent(question) == intent
+
+    def test_unrelated_question_does_not_match(self):
+        assert match_intent('can I take ibuprofen with this?') is None
+
+    def test_question_with_extra_context_goes_to_the_model(self):
+        assert match_intent('is this serious given that I had heart surgery last year?') is None
+
+    def test_disabled_intents_never_match(self, monkeypatch):
+        monkeypatch.setattr(follow_up_intents, 'ENABLED_INTENTS', ['see_doctor'])
+        assert match_intent('is this serious?') is None
+        assert match_intent('should i see a doctor?') == 'see_doctor'
+
+
+class TestCollectAnswers:
+    def test_keeps_enabled_non_empty_answers(self):
+        answers = collect_answers([
+            {'intent': 'is_serious', 'answer': ' Probably not. '},
+            SpeculativeAnswer(intent='see_doctor', answer='If it lasts a week.'),
+            {'intent': 'made_up', 'answer': 'ignored'},
+            {'intent': 'not_improving', 'answer': ''},
+        ])
+        assert answers == {'is_serious': 'Probably not.', 'see_doctor': 'If it lasts a week.'}
+
+    def test_missing_field_gives_no_answers(self):
+        assert collect_answers(None) == {}
+
+    def test_prompt_lists_enabled_intents(self):
+        prompt = follow_up_intents.prompt_instructions()
+        for intent in follow_up_intents.ENABLED_INTENTS:
+            assert intent in prompt
+
+
+class TestAnalyzerCarriesAnswers:
+    def test_schema_field_is_optional(self):
+        result = SymptomAnalysisResult(
+            detected_symptoms=[], possible_conditions=[], urgency_level='low',
+            recommendations=[], emergency_alert=False, safety_tips=[],
+        )
+        assert result.likely_follow_ups == []
+
+    def test_parsed_answers_reach_the_result(self):
+        checker = SymptomChecker()
+        checker.use_gemini = True
+        checker.client = MagicMock()
+        checker.client.models.generate_content.return_value = MagicMock(parsed=None, text=json.dumps({
+            'detected_symptoms': ['headache'],
+            'likely_follow_ups': [{'intent': 'is_serious', 'answer': 'Usually not.'}],
+        }))
+
+        result = checker.analyze_symptoms('i have a headache')
+
+        assert result['follow_up_answers'] == {'is_serious': 'Usually not.'}
+        prompt = checker.client.models.generate_content.call_args.kwargs['contents']
+        assert 'likely_follow_ups' in prompt
+
+
+class TestStorage:
+    def test_answers_round_trip(self, db_module):
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        analysis_id = db_module.save_symptom_analysis(user['id'], 'headache', {
+            'recommendations': [], 'follow_up_answers': {'is_serious': 'Usually not.'}
+        })
+        assert db_module.get_speculative_answer(user['id'], 'symptom', analysis_id, 'is_serious') == 'Usually not.'
+        assert db_module.get_speculative_answer(user['id'], 'symptom', analysis_id, 'see_doctor') is None
+
+    def test_basic_mode_analysis_has_none(self, db_module):
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        analysis_id = db_module.save_image_analysis(user['id'], 'a.png', {'recommendations': []})
+        assert db_module.get_speculative_answer(user['id'], 'image', analysis_id, 'is_serious') is None
+
+    def test_existing_tables_gain_the_column(self, temp_db_path):
+        conn = sqlite3.connect(temp_db_path)
+        # Pre-speculative-answers versions of the analysis tables.
+        conn.execute(
+            "CREATE TABLE image_analyses (id INTEGER PRIMARY KEY, user_id INTEGER, created_at TEXT, "
+            "original_filename TEXT, detected_conditions TEXT, recommendations TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE symptom_analyses (id INTEGER PRIMARY KEY, user_id INTEGER, created_at TEXT, "
+            "symptom_text TEXT, detected_symptoms TEXT, possible_conditions TEXT, recommendations TEXT)"
+        )
+        conn.commit()
+        conn.close()
+
+        import importlib
+        import database
+        importlib.reload(database)
+        database.init_db()
+
+        conn = sqlite3.connect(temp_db_path)
+        for table in ('image_analyses', 'symptom_analyses'):
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            assert 'speculative_answers' in columns
+        conn.close()
+
+
+@pytest.fixture()
+def answered_analysis(client, registered_user):
+    """A symptom analysis stored with a pre-generated 'is_serious' answer."""
+    import database as db
+    user = db.get_user_by_username(registered_user['username'])
+    return db.save_symptom_analysis(user['id'], 'headache', {
+        'recommendations': ['Rest'], 'follow_up_answers': {'is_serious': 'Usually not serious.'}
+    })
+
+
+class TestSpeculativeEndpoints:
+    def test_matched_question_is_answered_from_storage(self, app, client, answered_analysis, monkeypatch):
+        import app as app_module
+        ask = MagicMock()
+        monkeypatch.setattr(app_module.conversation_service, 'ask_follow_up', ask)
+
+        resp = client.post('/api/follow_up', json={
+            'analysis_type': 'symptom', 'analysis_id': answered_analysis, 'question': 'Is this serious?'
+        })
+
+        data = resp.get_json()
+        assert data['answer'] == 'Usually not serious.'
+        assert data['speculative'] is True
+        assert len(data['follow_up_history']) == 2
+        ask.assert_not_called()
+
+    def test_other_questions_still_go_to_the_model(self, app, client, answered_analysis, monkeypatch):
+        import app as app_module
+        ask = MagicMock(return_value='Gentle exercise is fine.')
+        monkeypatch.setattr(app_module.conversation_service, 'ask_follow_up', ask)
+
+        resp = client.post('/api/follow_up', json={
+            'analysis_type': 'symptom', 'analysis_id': answered_analysis, 'question': 'can I exercise?'
+        })
+        assert resp.get_json()['speculative'] is False
+        ask.assert_called_once()
+
+    def test_stream_sends_stored_answer(self, client, registered_user, answered_analysis):
+        import database as db
+        user = db.get_user_by_username(registered_user['username'])
+        resp = client.post('/api/follow_up/stream', json={
+            'analysis_type': 'symptom', 'analysis_id': answered_analysis, 'question': 'is it serious'
+        })
+        body = resp.get_data(as_text=True)
+        assert 'Usually not serious.' in body
+        assert '"speculative": true' in body
+        assert len(db.get_follow_ups(user['id'], 'symptom', answered_analysis)) == 1
@@ -0,0 +1,152 @@
+"""
+Tests for the history archive: archive_history() moving old months into
+compressed blocks, transparent reads through get_analysis() and history
+pages, restoring on follow-up, and deletion reaching archived entries.
+"""
+
+import zlib
+
+from tests.conftest import count_rows, save_symptom
+
+
+class TestArchiving:
+    def test_old_months_move_into_compressed_blocks(self, db_module, alice):
+        old = [save_symptom(db_module, alice, f'rash {day}', f'2020-03-{day:02d}T10:00:00+00:00') for day in (1, 2, 3)]
+        april = save_symptom(db_module, alice, 'rash in april', '2020-04-01T10:00:00+00:00')
+        recent = save_symptom(db_module, alice, 'headache')
+
+        assert db_module.archive_history(older_than_days=30) == 4
+        assert count_rows(db_module, 'symptom_analyses') == 1
+        with db_module.get_connection() as conn:
+            blocks = conn.execute("SELECT * FROM history_archive_blocks ORDER BY id").fetchall()
+        assert [block['entry_count'] for block in blocks] == [3, 1]  # one block per month
+        entries = [entry['analysis']['id'] for entry in db_module._unpack_block(blocks[0]['payload'])]
+        assert entries == old
+        assert zlib.decompress(blocks[1]['payload'])  # really compressed
+        assert april not in entries
+        assert 'archived' not in db_module.get_analysis(alice['id'], 'symptom', recent)
+
+    def test_blocks_hold_at_most_block_size_entries(self, db_module, alice):
+        for day in range(1, 8):
+            save_symptom(db_module, alice, 'rash', f'2020-03-{day:02d}T10:00:00+00:00')
+        db_module.archive_history(older_than_days=30, block_size=3)
+        with db_module.get_connection() as conn:
+            counts = [row[0] for row in conn.execute("SELECT entry_count FROM history_archive_blocks ORDER BY id")]
+        assert counts == [3, 3, 1]
+
+    def test_disabled_by_default(self, db_module, alice):
+        save_symptom(db_module, alice, 'rash', '2020-03-01T10:00:00+00:00')
+        assert db_module.archive_history() == 0
+        assert count_rows(db_module, 'symptom_analyses') == 1
+
+    def test_analyses_with_recent_follow_ups_stay_hot(self, db_module, alice):
+        analysis_id = save_symptom(db_module, alice, 'rash', '2020-03-01T10:00:00+00:00')
+        db_module.save_follow_up(alice['id'], 'symptom', analysis_id, 'still itchy?', 'yes')
+        assert db_module.archive_history(older_than_days=30) == 0
+
+
+class TestReading:
+    def test_get_analysis_reads_through_to_the_archive(self, db_module, alice):
+        analysis_id = save_symptom(db_module, alice, 'itchy rash', '2020-03-01T10:00:00+00:00',
+                                   possible_conditions=['Eczema'], safety_tips=['Avoid scratching'],
+                               disclaimer='Educational use only.')
+        hot = db_module.get_analysis(alice['id'], 'symptom', analysis_id)
+        db_module.archive_history(older_than_days=30)
+
+        archived = db_module.get_analysis(alice['id'], 'symptom', analysis_id)
+        assert archived.pop('archived') is True
+        assert archived == hot
+
+    def test_archive_is_scoped_to_the_user(self, db_module, alice):
+        bob = db_module.create_user('bob', 'bob@example.com', 'password123')
+        analysis_id = save_symptom(db_module, alice, 'rash', '2020-03-01T10:00:00+00:00')
+        db_module.archive_history(older_than_days=30)
+        assert db_module.get_analysis(bob['id'], 'symptom', analysis_id) is None
+
+    def test_history_pages_merge_hot_and_archived_entries(self, db_module, alice):
+        ids = [save_symptom(db_module, alice, f'rash {day}', f'2020-03-{day:02d}T10:00:00+00:00') for day in range(1, 6)]
+        image_id = db_module.save_image_analysis(alice['id'], 'arm.png', {'recommendations': []},
+                                                 created_at='2020-03-03T12:00:00+00:00')
+        ids.append(save_symptom(db_module, alice, 'headache'))
+        expected = db_module.get_history(alice['id'])
+        db_module.archive_history(older_than_days=30)
+
+        seen, cursor = [], None
+        while True:
+            page = db_module.get_history_page(alice['id'], limit=2, cursor=cursor)
+            seen.extend(page['entries'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        assert [(e['type'], e['id']) for e in seen] == [(e['type'], e['id']) for e in expected]
+        assert [e.get('archived', False) for e in seen] == [False] + [True] * 6
+        assert next(e for e in seen if e['type'] == 'image')['id'] == image_id
+        assert seen[-1]['symptom_text'] == 'rash 1'
+
+
+class TestRestoreAndDelete:
+    def test_restore_brings_back_the_row_and_its_follow_ups(self, db_module, alice):
+        analysis_id = save_symptom(db_module, alice, 'rash', '2020-03-01T10:00:00+00:00',
+                                   follow_up_answers={'is_serious': 'Usually not.'})
+        first = db_module.save_follow_up(alice['id'], 'symptom', analysis_id, 'q1', 'a1')
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE follow_ups SET created_at = '2020-03-01T11:00:00+00:00'")
+        db_module.save_follow_up_summary(alice['id'], 'symptom', analysis_id, 'asked q1', first)
+        save_symptom(db_module, alice, 'rash again', '2020-03-02T10:00:00+00:00')
+        db_module.archive_history(older_than_days=30)
+        assert count_rows(db_module, 'follow_ups') == 0
+
+        assert db_module.restore_archived_analysis(alice['id'], 'symptom', analysis_id) is True
+        assert 'archived' not in db_module.get_analysis(alice['id'], 'symptom', analysis_id)
+        assert db_module.get_speculative_answer(alice['id'], 'symptom', analysis_id, 'is_serious') == 'Usually not.'
+        assert db_module.get_follow_up_context(alice['id'], 'symptom', analysis_id, window=4)['summary'] == 'asked q1'
+        assert [t['id'] for t in db_module.get_follow_ups(alice['id'], 'symptom', analysis_id)] == [first]
+        # The other entry in the block keeps it alive.
+        assert count_rows(db_module, 'history_archive_blocks') == 1
+        assert db_module.restore_archived_analysis(alice['id'], 'symptom', analysis_id) is False
+
+    def test_cleared_history_is_purged_from_the_archive(self, db_module, alice):
+        save_symptom(db_module, alice, 'rash', '2020-03-01T10:00:00+00:00')
+        db_module.archive_history(older_than_days=30)
+
+        db_module.delete_history(alice['id'])
+        assert db_module.get_history(alice['id']) == []
+        db_module.purge_deleted()
+        assert count_rows(db_module, 'archived_analyses') == 0
+        assert count_rows(db_module, 'history_archive_blocks') == 0
+
+    def test_follow_up_endpoint_restores_archived_analysis(self, client, registered_user, monkeypatch):
+        import app as app_module
+        import database as db
+        monkeypatch.setattr(app_module.conversation_service, 'ask_follow_up', lambda *args, **kwargs: 'See a doctor.')
+        user = db.get_user_by_username(registered_user['username'])
+        analysis_id = save_symptom(db, user, 'rash on arm', '2020-03-01T10:00:00+00:00')
+        db.archive_history(older_than_days=30)
+
+        resp = client.post('/api/follow_up', json={
+            'analysis_type': 'symptom', 'analysis_id': analysis_id, 'question': 'Should I see a doctor?'
+        })
+        assert resp.status_code == 200
+        assert len(db.get_follow_ups(user['id'], 'symptom', analysis_id)) == 1
+        assert count_rows(db, 'archived_analyses') == 0
+
+
+class TestShards:
+    def test_archive_lives_and_reshards_with_the_users_history(self, db_module, alice):
+        ids = [save_symptom(db_module, alice, f'rash {day}', f'2020-03-{day:02d}T10:00:00+00:00') for day in (1, 2)]
+        db_module.archive_history(older_than_days=30)
+
+        copied = db_module.reshard(3)
+        assert copied['history_archive_blocks'] == 1 and copied['archived_analyses'] == 2
+        assert count_rows(db_module, 'archived_analyses') == 0  # gone from the main database
+        for analysis_id in ids:
+            assert db_module.get_analysis(alice['id'], 'symptom', analysis_id)['archived'] is True
+
+        shard = db_module.history_shard(alice['id'])
+        newer = save_symptom(db_module, alice, 'rash 3', '2020-03-03T10:00:00+00:00')
+        db_module.archive_history(older_than_days=30)
+        with db_module.get_connection(shard=shard) as conn:
+            block_ids = [row[0] for row in conn.execute("SELECT id FROM history_archive_blocks ORDER BY id")]
+        # Numbered from the shard's own id range, clear of the copied block.
+        assert block_ids[-1] // db_module._SHARD_ID_RANGE == shard
+        assert db_module.get_analysis(alice['id'], 'symptom', newer)['archived'] is True
@@ -0,0 +1,139 @@
+"""
+Tests for history export: export_history() walking a user's history in
+chunks with resumable cursors, the NDJSON / CSV serializations, and the
+streaming user and admin endpoints.
+"""
+
+import csv
+import io
+import json
+
+import pytest
+
+import history_export
+from tests.conftest import save_symptom
+
+
+class TestExportHistory:
+    def test_exports_every_analysis_in_full_newest_first(self, db_module, alice):
+        ids = [save_symptom(db_module, alice, f'rash {day}', f'2024-03-{day:02d}T10:00:00+00:00',
+                            possible_conditions=['Eczema']) for day in range(1, 6)]
+        image_id = db_module.save_image_analysis(alice['id'], 'arm.png', {'recommendations': ['Keep it clean']},
+                                                 created_at='2024-03-03T12:00:00+00:00')
+        db_module.save_follow_up(alice['id'], 'symptom', ids[0], 'still itchy?', 'yes')
+
+        exported = [entry for entry, _ in db_module.export_history(alice['id'], chunk_size=2)]
+        assert [(e['type'], e['id']) for e in exported] == [(e['type'], e['id']) for e in db_module.get_history(alice['id'])]
+        assert next(e for e in exported if e['type'] == 'image')['id'] == image_id
+        oldest = exported[-1]
+        assert oldest['possible_conditions'] == ['Eczema']
+        assert [(t['question'], t['answer']) for t in oldest['follow_ups']] == [('still itchy?', 'yes')]
+
+    def test_each_chunk_is_its_own_read_transaction(self, db_module, alice):
+        for day in range(1, 6):
+            save_symptom(db_module, alice, 'rash', f'2024-03-{day:02d}T10:00:00+00:00')
+        entries = db_module.export_history(alice['id'], chunk_size=2)
+
+        statements = []
+        db_module._pooled_connection().set_trace_callback(statements.append)
+        first = next(entries)
+        assert statements.count('BEGIN') == 1  # nothing read beyond the first chunk yet
+        rest = list(entries)
+        db_module._pooled_connection().set_trace_callback(None)
+
+        assert len(rest) == 4
+        assert statements.count('BEGIN') == 3
+        assert first[0]['symptom_text'] == 'rash'
+
+    def test_cursor_resumes_after_its_entry(self, db_module, alice):
+        for day in range(1, 6):
+            save_symptom(db_module, alice, f'rash {day}', f'2024-03-{day:02d}T10:00:00+00:00')
+        everything = list(db_module.export_history(alice['id']))
+        _, cursor = everything[1]
+
+        resumed = [entry['symptom_text'] for entry, _ in db_module.export_history(alice['id'], cursor=cursor)]
+        assert resumed == [entry['symptom_text'] for entry, _ in everything[2:]]
+
+    def test_malformed_cursor_raises_before_reading(self, db_module, alice):
+        with pytest.raises(ValueError):
+            db_module.export_history(alice['id'], cursor='not-a-cursor')
+
+    def test_includes_archived_analyses_with_their_follow_ups(self, db_module, alice):
+        analysis_id = save_symptom(db_module, alice, 'rash', '2020-03-01T10:00:00+00:00')
+        db_module.save_follow_up(alice['id'], 'symptom', analysis_id, 'q1', 'a1')
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE follow_ups SET created_at = '2020-03-01T11:00:00+00:00'")
+        db_module.archive_history(older_than_days=30)
+
+        [(entry, _)] = db_module.export_history(alice['id'])
+        assert entry['archived'] is True
+        assert [(t['question'], t['answer']) for t in entry['follow_ups']] == [('q1', 'a1')]
+
+    def test_cleared_history_is_not_exported(self, db_module, alice):
+        save_symptom(db_module, alice, 'headache')
+        db_module.delete_history(alice['id'])
+        assert list(db_module.export_history(alice['id'])) == []
+
+
+class TestFormats:
+    def _entries(self, db_module, alice):
+        save_symptom(db_module, alice, '=HYPERLINK("x")', possible_conditions=[{'name': 'Flu'}, 'Cold'],
+                     detected_symptoms=['fever'])
+        return db_module.export_history(alice['id'])
+
+    def test_ndjson_is_one_object_per_line_with_its_cursor(self, db_module, alice):
+        [line] = history_export.ndjson_lines(self._entries(db_module, alice))
+        record = json.loads(line)
+        assert record['possible_conditions'] == [{'name': 'Flu'}, 'Cold']
+        assert db_module.decode_history_cursor(record['cursor'])[1] == 'symptom'
+
+    def test_csv_flattens_and_neutralizes_formulas(self, db_module, alice):
+        text = ''.join(history_export.csv_lines(self._entries(db_module, alice)))
+        [row] = list(csv.DictReader(io.StringIO(text)))
+        assert row['title'] == '\'=HYPERLINK("x")'
+        assert row['conditions'] == 'Flu; Cold'
+        assert row['recommendations'] == 'Rest and stay hydrated'
+        assert json.loads(row['follow_ups']) == []
+
+    def test_empty_csv_still_has_a_header_unless_resumed(self):
+        assert list(history_export.csv_lines([])) == [','.join(history_export.CSV_COLUMNS) + '\r\n']
+        assert list(history_export.export_lines('csv', [], resumed=True)) == []
+
+
+class TestEndpoints:
+    def test_streams_the_users_history(self, client, registered_user):
+        for text in ('headache and fever', 'sore throat'):
+            client.post('/analyze_symptoms', json={'symptoms': text})
+
+        resp = client.get('/api/history/export')
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/x-ndjson'
+        assert resp.is_streamed
+        records = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        assert [r['symptom_text'] for r in records] == ['sore throat', 'headache and fever']
+
+        resumed = client.get('/api/history/export', query_string={'format': 'csv', 'cursor': records[0]['cursor']})
+        rows = list(csv.reader(io.StringIO(resumed.get_data(as_text=True))))
+        assert [row[5] for row in rows] == ['headache and fever']  # no header when resuming
+
+    def test_rejects_bad_format_and_cursor(self, client, registered_user):
+        assert client.get('/api/history/export?format=xml').status_code == 400
+        assert client.get('/api/history/export?cursor=nope').status_code == 400
+
+    def test_requires_login(self, client):
+        assert client.get('/api/history/export').status_code in (302, 401)
+
+    def test_admin_can_export_any_user(self, client, registered_user, monkeypatch):
+        import app as app_module
+        import database as db
+        monkeypatch.setattr(app_module, 'ADMIN_API_TOKEN', 's3cret')
+        client.post('/analyze_symptoms', json={'symptoms': 'headache and fever'})
+        user = db.get_user_by_username(registered_user['username'])
+        client.post('/logout')
+
+        headers = {'Authorization': 'Bearer s3cret'}
+        resp = client.get(f"/api/admin/users/{user['id']}/history/export", headers=headers)
+        assert [json.loads(line)['symptom_text'] for line in resp.get_data(as_text=True).splitlines()] == [
+            'headache and fever'
+        ]
+        assert client.get('/api/admin/users/9999/history/export', headers=headers).status_code == 404
@@ -0,0 +1,175 @@
+"""
+Tests for full-text history search: the FTS index kept in step by triggers,
+per-user ranked results, the backfill of existing rows and the
+/api/history/search endpoint.
+"""
+
+import sqlite3
+
+from tests.conftest import save_symptom
+
+
+def _found(db_module, user, query):
+    return [(entry['type'], entry['id']) for entry in db_module.search_history(user['id'], query)['results']]
+
+
+class TestIndexing:
+    def test_title_conditions_and_recommendations_are_searchable(self, db_module, alice):
+        symptom_id = save_symptom(db_module, alice, 'itchy arm', possible_conditions=['Eczema'],
+                                  recommendations=['Apply a cold compress'])
+        image_id = db_module.save_image_analysis(alice['id'], 'knee.png', {
+            'detected_conditions': ['Bruise'], 'recommendations': ['Elevate the leg'],
+        })
+
+        assert _found(db_module, alice, 'itchy') == [('symptom', symptom_id)]
+        assert _found(db_module, alice, 'eczema') == [('symptom', symptom_id)]
+        assert _found(db_module, alice, 'compress') == [('symptom', symptom_id)]
+        assert _found(db_module, alice, 'bruises') == [('image', image_id)]  # porter stemming
+        assert _found(db_module, alice, 'elevate leg') == [('image', image_id)]
+
+    def test_deleted_analyses_leave_the_index(self, db_module, alice):
+        save_symptom(db_module, alice, 'rash on arm')
+        db_module.delete_history(alice['id'])
+        assert _found(db_module, alice, 'rash') == []
+
+        save_symptom(db_module, alice, 'rash on leg')
+        db_module.delete_user(alice['id'])
+        db_module.purge_deleted()
+        with db_module.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM history_search").fetchone()[0] == 0
+
+    def test_updates_are_reindexed(self, db_module, alice):
+        symptom_id = save_symptom(db_module, alice, 'rash on arm')
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE symptom_analyses SET symptom_text = 'sore throat' WHERE id = ?", (symptom_id,))
+        assert _found(db_module, alice, 'rash') == []
+        assert _found(db_module, alice, 'throat') == [('symptom', symptom_id)]
+
+    def test_existing_rows_are_backfilled(self, temp_db_path):
+        import importlib
+        import database
+
+        importlib.reload(database)
+        database.init_db()
+        user = database.create_user('alice', 'alice@example.com', 'password123')
+        symptom_id = database.save_symptom_analysis(user['id'], 'rash on arm', {'recommendations': ['Rest']})
+        database.close_connection()
+
+        # A database from before search existed.
+        conn = sqlite3.connect(temp_db_path)
+        for name in ('symptom_analyses_search_insert', 'symptom_analyses_search_delete',
+                     'symptom_analyses_search_update', 'image_analyses_search_insert',
+                     'image_analyses_search_delete', 'image_analyses_search_update'):
+            conn.execute(f"DROP TRIGGER {name}")
+        conn.execute("DROP TABLE history_search")
+        conn.execute("PRAGMA user_version = 4")
+        conn.commit()
+        conn.close()
+
+        importlib.reload(database)
+        database.init_db()
+        results = database.search_history(user['id'], 'rash')['results']
+        assert [(r['type'], r['id']) for r in results] == [('symptom', symptom_id)]
+
+    def test_rebuild_reindexes_and_drops_orphans(self, db_module, alice):
+        symptom_id = save_symptom(db_module, alice, 'rash on arm')
+        with db_module.get_connection() as conn:
+            conn.execute("DELETE FROM history_search")
+            conn.execute(
+                "INSERT INTO history_search (rowid, owner, title) VALUES (999 * 2 + 1, 'u1', 'ghost rash')"
+            )
+
+        assert db_module.rebuild_history_search(batch_size=1) == 1
+        assert _found(db_module, alice, 'rash') == [('symptom', symptom_id)]
+        with db_module.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM history_search").fetchone()[0] == 1
+
+
+class TestSearch:
+    def test_results_are_scoped_to_the_user(self, db_module, alice):
+        bob = db_module.create_user('bob', 'bob@example.com', 'password123')
+        save_symptom(db_module, bob, 'rash on arm')
+        assert _found(db_module, alice, 'rash') == []
+
+    def test_title_matches_rank_above_recommendation_matches(self, db_module, alice):
+        in_recommendations = save_symptom(db_module, alice, 'sore knee', recommendations=['Watch for a rash'])
+        in_title = save_symptom(db_module, alice, 'red rash', recommendations=['Rest'])
+        older_title = save_symptom(db_module, alice, 'rash again', recommendations=['Rest'])
+        found = _found(db_module, alice, 'rash')
+        assert found[-1] == ('symptom', in_recommendations)
+        assert set(found[:2]) == {('symptom', in_title), ('symptom', older_title)}
+
+    def test_words_are_anded_and_never_parsed_as_syntax(self, db_module, alice):
+        both = save_symptom(db_module, alice, 'itchy red rash')
+        save_symptom(db_module, alice, 'red eyes')
+        assert _found(db_module, alice, 'red rash') == [('symptom', both)]
+        assert _found(db_module, alice, 'rash" OR owner:u2 NOT (') == []
+        assert db_module.search_history(alice['id'], '!!!') == {'results': [], 'next_offset': None}
+
+    def test_paginates_with_an_offset(self, db_module, alice):
+        for i in range(5):
+            save_symptom(db_module, alice, f'rash number {i}')
+        first = db_module.search_history(alice['id'], 'rash', limit=3)
+        second = db_module.search_history(alice['id'], 'rash', limit=3, offset=first['next_offset'])
+        assert len(first['results']) == 3 and first['next_offset'] == 3
+        assert len(second['results']) == 2 and second['next_offset'] is None
+        ids = {e['id'] for e in first['results']} | {e['id'] for e in second['results']}
+        assert len(ids) == 5
+
+    def test_word_forms_rank_by_the_indexed_stem(self, db_module, alice):
+        in_title = save_symptom(db_module, alice, 'cut on my finger', recommendations=['Rest'])
+        save_symptom(db_module, alice, 'sore knee', recommendations=['Clean any cuts'])
+        # "cuts" and "cut" are one term to the porter tokenizer, so the
+        # title match wins - as it does when searching for "cut".
+        assert _found(db_module, alice, 'cuts')[0] == ('symptom', in_title)
+        assert _found(db_module, alice, 'cut')[0] == ('symptom', in_title)
+
+    def test_ranking_does_not_depend_on_how_many_matches_there_are(self, db_module, alice):
+        def ranked(query):
+            ids, offset = [], 0
+            while offset is not None:
+                page = db_module.search_history(alice['id'], query, limit=50, offset=offset)
+                ids += [entry['id'] for entry in page['results']]
+                offset = page['next_offset']
+            return ids
+
+        first = [save_symptom(db_module, alice, text, recommendations=recommendations) for text, recommendations in (
+            ('cut on my finger', ['Rest']), ('sore knee', ['Clean any cuts']), ('cut on my cut thumb', ['Rest']),
+        )]
+        before = ranked('cuts')
+        with db_module.get_connection(write=True):
+            for i in range(250):
+                save_symptom(db_module, alice, f'sore knee {i}', recommendations=['Clean any cuts'])
+
+        after = ranked('cuts')
+        assert len(after) == len(set(after)) == 253  # every match can be paged to
+        assert [analysis_id for analysis_id in after if analysis_id in first] == before
+        assert before[-1] == first[1]  # the recommendation-only match
+
+    def test_snippet_marks_the_matched_words(self, db_module, alice):
+        save_symptom(db_module, alice, 'itchy red rash on my arm')
+        snippet = db_module.search_history(alice['id'], 'rash')['results'][0]['snippet']
+        assert f'{db_module.SNIPPET_START}rash{db_module.SNIPPET_END}' in snippet
+
+
+class TestSearchEndpoint:
+    def test_returns_highlighted_escaped_snippets(self, client, registered_user):
+        client.post('/analyze_symptoms', json={'symptoms': '<b>rash</b> on my arm'})
+        data = client.get('/api/history/search?q=rash').get_json()
+        assert data['success'] is True
+        [entry] = data['results']
+        assert '<mark>rash</mark>' in entry['snippet_html']
+        assert '&lt;b&gt;' in entry['snippet_html']
+        assert 'snippet' not in entry
+        assert data['next_offset'] is None
+
+    def test_empty_query_rejected(self, client, registered_user):
+        assert client.get('/api/history/search?q=').status_code == 400
+
+    def test_requires_login(self, client):
+        resp = client.get('/api/history/search?q=rash')
+        assert resp.status_code in (302, 401)
+
+    def test_history_page_has_search_box(self, client, registered_user):
+        client.post('/analyze_symptoms', json={'symptoms': 'headache'})
+        assert b'id="searchForm"' in client.get('/history').data
@@ -0,0 +1,250 @@
+"""
+Tests for history sharding: per-user routing of history into shard files,
+ids that stay unique across shards, cross-shard admin queries, the layout
+check at startup and moving history between layouts with reshard().
+"""
+
+import importlib
+import os
+import sqlite3
+import threading
+
+import pytest
+
+from tests.conftest import save_symptom
+
+
+def _load_database(monkeypatch, shards):
+    monkeypatch.setenv('HISTORY_SHARDS', str(shards))
+    import database
+    importlib.reload(database)
+    database.init_db()
+    return database
+
+
+@pytest.fixture()
+def sharded(temp_db_path, monkeypatch):
+    return _load_database(monkeypatch, 4)
+
+
+def _users(db, count):
+    # Straight into the table - create_user()'s password hashing would
+    # dominate these tests' run time.
+    with db.get_connection() as conn:
+        start = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        for i in range(start, start + count):
+            conn.execute(
+                "INSERT INTO users (username, email, password_hash, created_at) VALUES (?, ?, 'x', '2024-01-01')",
+                (f'user{i}', f'user{i}@example.com')
+            )
+        rows = conn.execute("SELECT * FROM users ORDER BY id LIMIT -1 OFFSET ?", (start,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _rows_in(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+
+
+class TestRouting:
+    def test_history_goes_to_the_users_shard_file(self, sharded, temp_db_path):
+        users = _users(sharded, 12)
+        for user in users:
+            save_symptom(sharded, user, 'headache')
+
+        shards = sharded._active_history_shards()
+        assert len(shards) == 4
+        assert _rows_in(temp_db_path, 'symptom_analyses') == 0
+        per_shard = [_rows_in(sharded.shard_path(slot), 'symptom_analyses') for slot in shards]
+        assert sum(per_shard) == 12
+        assert sum(1 for count in per_shard if count) > 1  # spread out, not all on one
+
+        for user in users:
+            [entry] = sharded.get_history(user['id'])
+            assert entry['symptom_text'] == 'headache'
+            assert entry['recommendations'] == ['Rest and stay hydrated']
+
+    def test_ids_are_unique_across_shards(self, sharded):
+        ids = [save_symptom(sharded, user, 'headache') for user in _users(sharded, 8)]
+        assert len(set(ids)) == len(ids)
+        slots = {analysis_id // sharded._SHARD_ID_RANGE for analysis_id in ids}
+        assert slots <= set(sharded._active_history_shards())
+
+    def test_follow_ups_search_and_scoping_work_per_shard(self, sharded):
+        alice, bob = _users(sharded, 2)
+        analysis_id = save_symptom(sharded, alice, 'itchy rash', follow_up_answers={'is_serious': 'Usually not.'})
+        sharded.save_follow_up(alice['id'], 'symptom', analysis_id, 'q1', 'a1')
+
+        assert [t['question'] for t in sharded.get_follow_ups(alice['id'], 'symptom', analysis_id)] == ['q1']
+        assert sharded.get_speculative_answer(alice['id'], 'symptom', analysis_id, 'is_serious') == 'Usually not.'
+        assert [r['id'] for r in sharded.search_history(alice['id'], 'rash')['results']] == [analysis_id]
+        assert sharded.search_history(bob['id'], 'rash')['results'] == []
+        assert sharded.get_analysis(bob['id'], 'symptom', analysis_id) is None
+
+    def test_delete_user_removes_their_shard_history(self, sharded):
+        alice, bob = _users(sharded, 2)
+        analysis_id = save_symptom(sharded, alice, 'headache')
+        sharded.save_follow_up(alice['id'], 'symptom', analysis_id, 'q', 'a')
+        save_symptom(sharded, bob, 'cough')
+
+        sharded.delete_user(alice['id'])
+        sharded.purge_deleted()
+
+        totals = sharded.history_stats()['totals']
+        assert totals == {'image_analyses': 0, 'symptom_analyses': 1, 'follow_ups': 0, 'users': 1}
+
+    def test_write_behind_reserves_ids_in_each_shard(self, sharded):
+        from history_writer import HistoryWriter
+        writer = HistoryWriter(enabled=True, id_block_size=5)
+        users = _users(sharded, 6)
+        try:
+            ids = [writer.save_symptom_analysis(user['id'], 'headache', {'recommendations': []}) for user in users]
+            assert writer.ensure_written()
+        finally:
+            writer.stop()
+        for user, analysis_id in zip(users, ids):
+            assert sharded.get_analysis(user['id'], 'symptom', analysis_id) is not None
+            assert analysis_id // sharded._SHARD_ID_RANGE == sharded.history_shard(user['id'])
+
+    def test_concurrent_inserts_on_different_shards(self, sharded):
+        users = _users(sharded, 8)
+        errors = []
+
+        def insert(user):
+            try:
+                for _ in range(25):
+                    save_symptom(sharded, user, 'headache')
+            except Exception as exc:  # pragma: no cover - reported below
+                errors.append(exc)
+            finally:
+                sharded.close_connection()
+
+        threads = [threading.Thread(target=insert, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert sharded.history_stats()['totals']['symptom_analyses'] == 200
+
+
+class TestAdminQueries:
+    def test_stats_cover_every_shard(self, sharded):
+        users = _users(sharded, 6)
+        for user in users:
+            save_symptom(sharded, user, 'headache')
+        sharded.save_image_analysis(users[0]['id'], 'a.png', {'recommendations': []})
+
+        stats = sharded.history_stats()
+        assert [shard['shard'] for shard in stats['shards']] == sharded._active_history_shards()
+        assert stats['totals'] == {'image_analyses': 1, 'symptom_analyses': 6, 'follow_ups': 0, 'users': 6}
+
+    def test_fan_out_queries_are_read_only(self, sharded):
+        with pytest.raises(sqlite3.OperationalError):
+            sharded.query_history_shards("DELETE FROM symptom_analyses")
+        # ...and the shard connections are usable for writes afterwards.
+        save_symptom(sharded, _users(sharded, 1)[0], 'headache')
+
+    def test_unsharded_stats_read_the_main_database(self, db_module):
+        [user] = _users(db_module, 1)
+        save_symptom(db_module, user, 'headache')
+        [main] = db_module.history_stats()['shards']
+        assert main['shard'] is None and main['symptom_analyses'] == 1
+
+
+class TestLayout:
+    def test_changed_shard_count_with_history_is_refused(self, sharded, monkeypatch):
+        save_symptom(sharded, _users(sharded, 1)[0], 'headache')
+        sharded.close_connection()
+        with pytest.raises(RuntimeError, match='reshard'):
+            _load_database(monkeypatch, 2)
+
+    def test_changed_shard_count_without_history_just_recreates(self, sharded, monkeypatch):
+        old_files = [sharded.shard_path(slot) for slot in sharded._active_history_shards()]
+        sharded.close_connection()
+        db = _load_database(monkeypatch, 2)
+        assert len(db._active_history_shards()) == 2
+        assert not any(os.path.exists(path) for path in old_files)
+
+
+class TestReshard:
+    def _populate(self, db):
+        users = _users(db, 10)
+        entries = {}
+        for user in users:
+            analysis_id = save_symptom(db, user, f'rash number {user["id"]}',
+                                       safety_tips=['Avoid scratching'], disclaimer='Educational use only.')
+            image_id = db.save_image_analysis(user['id'], 'arm.png', {'recommendations': ['Keep it clean']})
+            db.save_follow_up(user['id'], 'symptom', analysis_id, 'q1', 'a1')
+            follow_up = db.save_follow_up(user['id'], 'symptom', analysis_id, 'q2', 'a2')
+            db.save_follow_up_summary(user['id'], 'symptom', analysis_id, 'asked q1', follow_up)
+            entries[user['id']] = (analysis_id, image_id)
+        return users, entries
+
+    def _assert_intact(self, db, users, entries):
+        for user in users:
+            analysis_id, image_id = entries[user['id']]
+            analysis = db.get_analysis(user['id'], 'symptom', analysis_id)
+            assert analysis['recommendations'] == ['Rest and stay hydrated']
+            assert analysis['safety_tips'] == ['Avoid scratching']
+            assert analysis['disclaimer'] == 'Educational use only.'
+            assert db.get_analysis(user['id'], 'image', image_id)['recommendations'] == ['Keep it clean']
+            context = db.get_follow_up_context(user['id'], 'symptom', analysis_id, window=4)
+            assert context['summary'] == 'asked q1' and context['recent'] == []
+            assert [r['id'] for r in db.search_history(user['id'], 'rash')['results']] == [analysis_id]
+
+    def test_moves_history_between_layouts_keeping_ids(self, db_module, temp_db_path):
+        users, entries = self._populate(db_module)
+
+        copied = db_module.reshard(3, batch_size=4)
+        assert copied == {'image_analyses': 10, 'symptom_analyses': 10, 'follow_ups': 20, 'follow_up_summaries': 10,
+                          'history_archive_blocks': 0, 'archived_analyses': 0}
+        assert len(db_module._active_history_shards()) == 3
+        assert _rows_in(temp_db_path, 'symptom_analyses') == 0
+        self._assert_intact(db_module, users, entries)
+
+        old_files = [db_module.shard_path(slot) for slot in db_module._active_history_shards()]
+        db_module.reshard(2, batch_size=4)
+        assert not any(os.path.exists(path) for path in old_files)
+        self._assert_intact(db_module, users, entries)
+        # New rows keep getting ids no earlier shard has used.
+        new_id = save_symptom(db_module, users[0], 'headache')
+        assert new_id not in {analysis_id for analysis_id, _ in entries.values()}
+
+        db_module.reshard(0)
+        assert db_module._active_history_shards() == []
+        assert _rows_in(temp_db_path, 'symptom_analyses') == 11
+        self._assert_intact(db_module, users, entries)
+
+    def test_history_of_deleted_users_is_dropped(self, sharded):
+        alice, bob = _users(sharded, 2)
+        save_symptom(sharded, alice, 'headache')
+        save_symptom(sharded, bob, 'headache')
+        with sharded.get_connection() as conn:
+            conn.execute("DELETE FROM users WHERE id = ?", (bob['id'],))  # skipping delete_user()
+
+        assert sharded.reshard(2)['symptom_analyses'] == 1
+
+    def test_interrupted_reshard_leaves_history_in_place(self, sharded, monkeypatch):
+        users, entries = self._populate(sharded)
+        layout = sharded._active_history_shards()
+
+        def crash(*args, **kwargs):
+            raise OSError("disk full")
+
+        real_copy = sharded._copy_history_table
+        monkeypatch.setattr(sharded, '_copy_history_table', crash)
+        with pytest.raises(OSError):
+            sharded.reshard(2)
+        assert sharded._active_history_shards() == layout
+        self._assert_intact(sharded, users, entries)
+
+        monkeypatch.setattr(sharded, '_copy_history_table', real_copy)
+        sharded.reshard(2)
+        with sharded.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM history_shards WHERE state = 'pending'").fetchone()[0] == 0
+        self._assert_intact(sharded, users, entries)
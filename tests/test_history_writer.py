@@ -0,0 +1,156 @@
+"""
+Tests for the write-behind history writer: ids handed out before the row
+exists, batched writes, the synchronous fallback when the queue is full and
+the app reading its own writes.
+"""
+
+import threading
+
+import pytest
+
+from history_writer import HistoryWriter, IdAllocator
+
+
+@pytest.fixture()
+def writer(db_module):
+    w = HistoryWriter(enabled=True, batch_size=10, batch_ms=20, queue_size=100, id_block_size=5)
+    yield w
+    w.stop()
+
+
+class TestReserveIds:
+    def test_blocks_do_not_overlap_autoincrement_inserts(self, db_module, alice):
+        first = db_module.save_symptom_analysis(alice['id'], 'headache', {'recommendations': []})
+        block = db_module.reserve_analysis_ids('symptom', 10)
+        assert block == first + 1
+        after = db_module.save_symptom_analysis(alice['id'], 'cough', {'recommendations': []})
+        assert after == block + 10
+
+    def test_empty_table_starts_at_one(self, db_module):
+        assert db_module.reserve_analysis_ids('image', 3) == 1
+        assert db_module.reserve_analysis_ids('image', 3) == 4
+
+    def test_allocator_reserves_a_block_at_a_time(self, db_module, monkeypatch):
+        calls = []
+        real = db_module.reserve_analysis_ids
+        monkeypatch.setattr(db_module, 'reserve_analysis_ids', lambda t, n, shard=None: calls.append(n) or real(t, n, shard))
+        allocator = IdAllocator('symptom', 4)
+        assert [allocator.next_id() for _ in range(6)] == [1, 2, 3, 4, 5, 6]
+        assert calls == [4, 4]
+
+
+class TestSaveHistoryBatch:
+    def test_failed_record_is_skipped(self, db_module, alice):
+        records = [
+            {'type': 'symptom', 'user_id': alice['id'], 'label': 'headache', 'analysis': {'recommendations': []},
+             'analysis_id': 10, 'created_at': '2026-01-01T00:00:00+00:00'},
+            # Unknown user - the foreign key fails for this one only.
+            {'type': 'symptom', 'user_id': 999, 'label': 'cough', 'analysis': {'recommendations': []},
+             'analysis_id': 11, 'created_at': '2026-01-01T00:00:01+00:00'},
+            {'type': 'image', 'user_id': alice['id'], 'label': 'a.png', 'analysis': {'recommendations': []},
+             'analysis_id': 12, 'created_at': '2026-01-01T00:00:02+00:00'},
+        ]
+        assert db_module.save_history_batch(records) == 2
+        assert db_module.get_analysis(alice['id'], 'symptom', 10)['created_at'] == '2026-01-01T00:00:00+00:00'
+        assert db_module.get_analysis(alice['id'], 'image', 12) is not None
+
+
+class TestHistoryWriter:
+    def test_disabled_writes_synchronously(self, db_module, alice):
+        w = HistoryWriter(enabled=False)
+        analysis_id = w.save_symptom_analysis(alice['id'], 'headache', {'recommendations': ['Rest']})
+        assert db_module.get_analysis(alice['id'], 'symptom', analysis_id) is not None
+        assert w.stats()['pending'] == 0
+
+    def test_queued_records_land_after_ensure_written(self, db_module, alice, writer):
+        ids = [writer.save_symptom_analysis(alice['id'], f'symptom {i}', {'recommendations': ['Rest']})
+               for i in range(12)]
+        image_id = writer.save_image_analysis(alice['id'], 'a.png', {'recommendations': []})
+
+        assert len(set(ids)) == 12
+        assert writer.ensure_written()
+        for analysis_id in ids:
+            assert db_module.get_analysis(alice['id'], 'symptom', analysis_id) is not None
+        assert db_module.get_analysis(alice['id'], 'image', image_id)['original_filename'] == 'a.png'
+        assert writer.stats()['pending'] == 0
+
+    def test_ids_do_not_collide_with_direct_inserts(self, db_module, alice, writer):
+        queued = writer.save_symptom_analysis(alice['id'], 'queued', {'recommendations': []})
+        direct = db_module.save_symptom_analysis(alice['id'], 'direct', {'recommendations': []})
+        assert direct != queued
+        writer.ensure_written()
+        assert len(db_module.get_history(alice['id'])) == 2
+
+    def test_full_queue_falls_back_to_a_synchronous_write(self, db_module, alice, monkeypatch):
+        busy, release = threading.Event(), threading.Event()
+        real = db_module.save_history_batch
+
+        def slow_batch(records):
+            if threading.current_thread().name == 'history-writer':
+                busy.set()
+                release.wait(5)
+            return real(records)
+
+        monkeypatch.setattr(db_module, 'save_history_batch', slow_batch)
+        w = HistoryWriter(enabled=True, batch_size=1, batch_ms=0, queue_size=1, id_block_size=10)
+        try:
+            # One record held by the blocked writer thread, one filling the queue...
+            w.save_symptom_analysis(alice['id'], 'first', {'recommendations': []})
+            assert busy.wait(5)
+            w.save_symptom_analysis(alice['id'], 'second', {'recommendations': []})
+            # ...so this one can't be queued and is written before returning.
+            overflow = w.save_symptom_analysis(alice['id'], 'third', {'recommendations': []})
+            assert db_module.get_analysis(alice['id'], 'symptom', overflow) is not None
+        finally:
+            release.set()
+            w.stop()
+        assert len(db_module.get_history(alice['id'])) == 3
+
+    def test_failing_batch_is_retried_until_written(self, db_module, alice, monkeypatch):
+        import history_writer
+        monkeypatch.setattr(history_writer, 'RETRY_MAX_SECONDS', 0.01)
+        real = db_module.save_history_batch
+        failures = []
+
+        def locked_for_a_while(records):
+            if len(failures) < 6:  # more than the old three attempts
+                failures.append(len(records))
+                raise db_module.sqlite3.OperationalError('database is locked')
+            return real(records)
+
+        monkeypatch.setattr(db_module, 'save_history_batch', locked_for_a_while)
+        w = HistoryWriter(enabled=True, batch_size=10, batch_ms=20, queue_size=100, id_block_size=5)
+        try:
+            ids = [w.save_symptom_analysis(alice['id'], f'symptom {i}', {'recommendations': []}) for i in range(3)]
+            assert w.ensure_written()
+        finally:
+            w.stop()
+        assert len(failures) == 6
+        for analysis_id in ids:
+            assert db_module.get_analysis(alice['id'], 'symptom', analysis_id) is not None
+
+
+class TestAppReadsItsOwnWrites:
+    @pytest.fixture()
+    def queued(self, monkeypatch, db_module):
+        import app as app_module
+        w = HistoryWriter(enabled=True, batch_size=50, batch_ms=200, queue_size=100, id_block_size=5)
+        monkeypatch.setattr(app_module, 'history_writer', w)
+        yield w
+        w.stop()
+
+    def test_detail_finds_a_just_queued_analysis(self, client, registered_user, queued):
+        import database as db
+        user = db.get_user_by_username(registered_user['username'])
+        analysis_id = queued.save_symptom_analysis(user['id'], 'headache', {'recommendations': ['Rest']})
+
+        resp = client.get(f'/api/history/symptom/{analysis_id}')
+        assert resp.status_code == 200
+        assert resp.get_json()['entry']['symptom_text'] == 'headache'
+
+    def test_history_listing_includes_queued_analyses(self, client, registered_user, queued):
+        import database as db
+        user = db.get_user_by_username(registered_user['username'])
+        queued.save_symptom_analysis(user['id'], 'headache', {'recommendations': []})
+        history = client.get('/api/history').get_json()['history']
+        assert [entry['symptom_text'] for entry in history] == ['headache']
@@ -3,10 +3,15 @@ Tests for localization (region-aware emergency numbers / temperature units)
 and multi-turn follow-up conversation support.
 """
 
+import json
+
 import pytest
 from unittest.mock import MagicMock
 from localization import localize_text, localize_analysis, fever_threshold_text, get_region_info, REGIONS
-from conversation import ConversationService, NO_GEMINI_MESSAGE
+from conversation import (
+    ConversationService, FollowUpInterrupted, FollowUpUnavailable, InMemoryContextCache, EMPTY_ANSWER_MESSAGE, FAILED_MESSAGE,
+    NO_GEMINI_MESSAGE, SUMMARY_MAX_CHARS, history_from_turns
+)
 
 
 # ---------------------------------------------------------------------------
@@ -58,11 +63,13 @@ class TestLocalization:
 # ---------------------------------------------------------------------------
 
 class TestConversationService:
-    def test_no_gemini_returns_clear_message(self):
+    def test_no_gemini_raises_clear_message(self):
         cs = ConversationService()
         assert cs.use_gemini is False
-        result = cs.ask_follow_up('symptom', '{}', [], 'is this serious?')
-        assert result == NO_GEMINI_MESSAGE
+        with pytest.raises(FollowUpUnavailable) as excinfo:
+            cs.ask_follow_up('symptom', '{}', [], 'is this serious?')
+        assert excinfo.value.message == NO_GEMINI_MESSAGE
+        assert excinfo.value.retryable is False
 
     def test_gemini_configured_builds_full_context(self):
         cs = ConversationService()
@@ -94,8 +101,9 @@ class TestConversationService:
         fake_response.text = ""
         cs.client.models.generate_content.return_value = fake_response
 
-        answer = cs.ask_follow_up('symptom', '{}', [], 'question')
-        assert "wasn't able" in answer.lower() or "rephrase" in answer.lower()
+        with pytest.raises(FollowUpUnavailable) as excinfo:
+            cs.ask_follow_up('symptom', '{}', [], 'question')
+        assert excinfo.value.message == EMPTY_ANSWER_MESSAGE
 
     def test_gemini_exception_returns_graceful_fallback(self):
         cs = ConversationService()
@@ -103,14 +111,74 @@ class TestConversationService:
         cs.client = MagicMock()
         cs.client.models.generate_content.side_effect = RuntimeError("down")
 
-        answer = cs.ask_follow_up('symptom', '{}', [], 'question')
-        assert "couldn't process" in answer.lower()
+        with pytest.raises(FollowUpUnavailable) as excinfo:
+            cs.ask_follow_up('symptom', '{}', [], 'question')
+        assert excinfo.value.message == FAILED_MESSAGE
+        assert excinfo.value.retryable is True
+
+
+    def test_summary_sent_between_context_and_recent_turns(self):
+        cs = ConversationService()
+        contents = cs.build_contents('symptom', '{}', [{'role': 'user', 'content': 'q3'}], 'q4', summary='- Asked: q1')
+        # context + ack + summary pair + 1 recent turn + question = 6
+        assert len(contents) == 6
+        assert 'q1' in contents[2].parts[0].text
+
+    def test_fold_without_gemini_appends_only_new_turns(self):
+        cs = ConversationService()
+        summary = cs.fold_into_summary(None, [{'question': 'is it bad?', 'answer': 'Probably not. Rest.'}])
+        assert summary == '- Asked: is it bad? -> Probably not.'
+        summary = cs.fold_into_summary(summary, [{'question': 'fever?', 'answer': 'Watch it.'}])
+        assert summary.splitlines() == ['- Asked: is it bad? -> Probably not.', '- Asked: fever? -> Watch it.']
+
+    def test_fold_drops_oldest_lines_when_too_long(self):
+        cs = ConversationService()
+        summary = None
+        for i in range(40):
+            summary = cs.fold_into_summary(summary, [{'question': f'question {i} ' + 'x' * 40, 'answer': 'y' * 60}])
+        assert len(summary) <= SUMMARY_MAX_CHARS
+        assert 'question 39' in summary
+        assert 'question 0 ' not in summary
+
+    def test_fold_with_gemini_sends_only_evicted_turns(self):
+        cs = ConversationService()
+        cs.use_gemini = True
+        cs.client = MagicMock()
+        cs.client.models.generate_content.return_value = MagicMock(text='- user asked about rest')
+
+        summary = cs.fold_into_summary('- earlier', [{'question': 'q5', 'answer': 'a5'}])
+        assert summary == '- user asked about rest'
+        prompt = cs.client.models.generate_content.call_args.kwargs['contents']
+        assert 'q5' in prompt and '- earlier' in prompt
+
+    def test_history_from_turns(self):
+        assert history_from_turns([{'question': 'q', 'answer': 'a'}]) == [
+            {'role': 'user', 'content': 'q'}, {'role': 'model', 'content': 'a'}
+        ]
 
 
 # ---------------------------------------------------------------------------
 # App-level: /api/follow_up, /api/region, /api/regions
 # ---------------------------------------------------------------------------
 
+@pytest.fixture()
+def gemini(app, monkeypatch):
+    """Gemini 'configured' for the app's follow-ups: every question is
+    answered "That sounds mild." (streamed in two pieces), and summary
+    folds use the extractive digest so they're predictable."""
+    import app as app_module
+    cs = app_module.conversation_service
+    client = MagicMock()
+    client.models.generate_content.return_value = MagicMock(text="That sounds mild.")
+    client.models.generate_content_stream.side_effect = lambda **kwargs: iter(
+        [MagicMock(text="That "), MagicMock(text="sounds mild.")]
+    )
+    monkeypatch.setattr(cs, 'use_gemini', True)
+    monkeypatch.setattr(cs, 'client', client)
+    monkeypatch.setattr(cs, '_fold_with_gemini', lambda *args: None)
+    return client
+
+
 class TestFollowUpEndpoint:
     def test_follow_up_requires_login(self, client):
         resp = client.post('/api/follow_up', json={
@@ -118,7 +186,7 @@ class TestFollowUpEndpoint:
         })
         assert resp.status_code == 401
 
-    def test_follow_up_on_own_analysis(self, client, registered_user):
+    def test_follow_up_on_own_analysis(self, client, registered_user, gemini):
         symptom_resp = client.post('/analyze_symptoms', json={'symptoms': 'headache and fever'})
         analysis_id = symptom_resp.get_json()['analysis_id']
 
@@ -128,9 +196,57 @@ class TestFollowUpEndpoint:
         assert resp.status_code == 200
         data = resp.get_json()
         assert data['success'] is True
-        assert 'answer' in data
+        assert data['answer'] == "That sounds mild."
         assert len(data['follow_up_history']) == 2
 
+    def test_follow_up_thread_persists_and_summarizes_old_turns(self, client, registered_user, gemini):
+        import app as app_module
+        import conversation
+        import database as db
+        analysis_id = client.post('/analyze_symptoms', json={'symptoms': 'headache'}).get_json()['analysis_id']
+
+        for i in range(conversation.CONTEXT_WINDOW_TURNS + 2):
+            resp = client.post('/api/follow_up', json={
+                'analysis_type': 'symptom', 'analysis_id': analysis_id, 'question': f'question {i}'
+            })
+        assert len(resp.get_json()['follow_up_history']) == 2 * (conversation.CONTEXT_WINDOW_TURNS + 2)
+        # Only answer calls so far - folding is left to the background job.
+        assert all(not isinstance(call.kwargs['contents'], str)
+                   for call in gemini.models.generate_content.call_args_list)
+
+        user = db.get_user_by_username(registered_user['username'])
+        context = db.get_follow_up_context(user['id'], 'symptom', analysis_id, conversation.CONTEXT_WINDOW_TURNS)
+        assert context['summary'] is None and len(context['evicted']) == 2
+
+        assert app_module.fold_pending_follow_up_summaries() == 1
+        context = db.get_follow_up_context(user['id'], 'symptom', analysis_id, conversation.CONTEXT_WINDOW_TURNS)
+        assert 'question 0' in context['summary'] and 'question 1' in context['summary']
+        assert len(context['recent']) == conversation.CONTEXT_WINDOW_TURNS
+        assert context['evicted'] == []
+        assert app_module.fold_pending_follow_up_summaries() == 0
+
+    def test_unfolded_turns_are_still_sent_verbatim(self, client, registered_user, gemini):
+        import conversation
+        analysis_id = client.post('/analyze_symptoms', json={'symptoms': 'headache'}).get_json()['analysis_id']
+        for i in range(conversation.CONTEXT_WINDOW_TURNS + 2):
+            client.post('/api/follow_up', json={
+                'analysis_type': 'symptom', 'analysis_id': analysis_id, 'question': f'question {i}'
+            })
+        prompt = [content.parts[0].text for content in gemini.models.generate_content.call_args.kwargs['contents']]
+        assert 'question 0' in prompt
+
+    def test_no_answer_is_a_503_and_nothing_is_stored(self, client, registered_user):
+        import database as db
+        analysis_id = client.post('/analyze_symptoms', json={'symptoms': 'headache'}).get_json()['analysis_id']
+
+        resp = client.post('/api/follow_up', json={
+            'analysis_type': 'symptom', 'analysis_id': analysis_id, 'question': 'what next?'
+        })
+        assert resp.status_code == 503
+        assert resp.get_json() == {'success': False, 'error': NO_GEMINI_MESSAGE, 'retryable': False}
+        user = db.get_user_by_username(registered_user['username'])
+        assert db.get_follow_ups(user['id'], 'symptom', analysis_id) == []
+
     def test_follow_up_on_nonexistent_analysis_404s(self, client, registered_user):
         resp = client.post('/api/follow_up', json={
             'analysis_type': 'symptom', 'analysis_id': 99999, 'question': 'test'
@@ -210,3 +326,230 @@ class TestRegionEndpoints:
         data = resp.get_json()
         assert '999' in data['analysis']['emergency_alert']['action']
         assert '911' not in data['analysis']['emergency_alert']['action']
+
+
+class TestFollowUpContextCache:
+    @pytest.fixture()
+    def service(self, monkeypatch):
+        import conversation
+        monkeypatch.setattr(conversation, 'CONTEXT_CACHE_MIN_CHARS', 0)
+        cache = InMemoryContextCache()
+        cs = ConversationService(context_cache=cache)
+        cs.use_gemini = True
+        cs.client = MagicMock()
+        cs.client.models.generate_content.return_value = MagicMock(text="Answer.")
+        return cs, cache
+
+    def _ask(self, cs, question, history=()):
+        return cs.ask_follow_up('symptom', '{"x": 1}', list(history), question, cache_key=(1, 'symptom', 7))
+
+    def test_prefix_registered_once_and_referenced(self, service):
+        cs, cache = service
+        self._ask(cs, 'q1')
+        self._ask(cs, 'q2', [{'role': 'user', 'content': 'q1'}, {'role': 'model', 'content': 'Answer.'}])
+
+        assert cache.created == 1
+        kwargs = cs.client.models.generate_content.call_args.kwargs
+        assert kwargs['config'].cached_content in cache.entries
+        # only the recent turns + question are sent, not the preamble
+        assert len(kwargs['contents']) == 3
+        assert kwargs['contents'][-1].parts[0].text == 'q2'
+
+    def test_small_prefix_sent_inline(self, service, monkeypatch):
+        import conversation
+        monkeypatch.setattr(conversation, 'CONTEXT_CACHE_MIN_CHARS', 10 ** 6)
+        cs, cache = service
+        self._ask(cs, 'q1')
+        assert cache.created == 0
+        assert len(cs.client.models.generate_content.call_args.kwargs['contents']) == 3
+
+    def test_unusable_cache_falls_back_inline(self, service):
+        cs, cache = service
+        cs.client.models.generate_content.side_effect = [RuntimeError("cache expired"), MagicMock(text="Inline.")]
+        assert self._ask(cs, 'q1') == "Inline."
+        assert cs.client.models.generate_content.call_args.kwargs['config'].cached_content is None
+
+    def test_forget_deletes_user_caches(self, service):
+        cs, cache = service
+        self._ask(cs, 'q1')
+        assert len(cache.entries) == 1
+        cs.forget_cached_contexts(1)
+        assert cache.entries == {}
+        self._ask(cs, 'q2')
+        assert cache.created == 2
+
+    def test_no_cache_key_means_no_caching(self, service):
+        cs, cache = service
+        cs.ask_follow_up('symptom', '{}', [], 'q1')
+        assert cache.created == 0
+
+    def test_expired_entry_is_dropped_and_recreated(self, service):
+        cs, cache = service
+        self._ask(cs, 'q1')
+        [entry] = cs._cached_prefixes.values()
+        entry['expires_at'] = 0
+        self._ask(cs, 'q2')
+        assert cache.created == 2
+        assert len(cs._cached_prefixes) == 1
+
+    def test_uncacheable_marker_expires(self, service, monkeypatch):
+        import conversation
+        monkeypatch.setattr(conversation, 'CONTEXT_CACHE_MIN_CHARS', 10 ** 6)
+        cs, cache = service
+        self._ask(cs, 'q1')
+        [entry] = cs._cached_prefixes.values()
+        assert entry['name'] is None
+        entry['expires_at'] = 0
+        monkeypatch.setattr(conversation, 'CONTEXT_CACHE_MIN_CHARS', 0)
+        self._ask(cs, 'q2')
+        assert cache.created == 1
+
+    def test_entries_are_bounded_least_recently_used_first(self, service, monkeypatch):
+        import conversation
+        monkeypatch.setattr(conversation, 'CONTEXT_CACHE_MAX_ENTRIES', 2)
+        cs, cache = service
+        for analysis_id in (1, 2):
+            cs.ask_follow_up('symptom', '{}', [], 'q', cache_key=(1, 'symptom', analysis_id))
+        cs.ask_follow_up('symptom', '{}', [], 'q', cache_key=(1, 'symptom', 1))  # 2 is now the oldest
+        cs.ask_follow_up('symptom', '{}', [], 'q', cache_key=(1, 'symptom', 3))
+        assert [key[2] for key in cs._cached_prefixes] == [1, 3]
+
+    def test_backend_must_implement_every_method(self):
+        from conversation import ContextCacheBackend
+
+        class Partial(ContextCacheBackend):
+            def create(self, model, contents, ttl_seconds):
+                return 'name'
+
+        with pytest.raises(TypeError):
+            Partial()
+
+
+class TestFollowUpStreaming:
+    def _service(self, chunks):
+        cs = ConversationService()
+        cs.use_gemini = True
+        cs.client = MagicMock()
+        state = {'closed': False, 'yielded': 0}
+
+        def upstream():
+            try:
+                for text in chunks:
+                    state['yielded'] += 1
+                    yield MagicMock(text=text)
+            finally:
+                state['closed'] = True
+
+        cs.client.models.generate_content_stream.side_effect = lambda **kwargs: upstream()
+        return cs, state
+
+    def test_yields_pieces_as_generated(self):
+        cs, state = self._service(['That ', 'sounds ', 'mild.'])
+        assert list(cs.stream_follow_up('symptom', '{}', [], 'q')) == ['That ', 'sounds ', 'mild.']
+        assert state['closed'] is True
+
+    def test_closing_early_cancels_upstream(self):
+        cs, state = self._service(['one ', 'two ', 'three ', 'four '])
+        stream = cs.stream_follow_up('symptom', '{}', [], 'q')
+        assert next(stream) == 'one '
+        stream.close()
+        assert state['closed'] is True
+        assert state['yielded'] == 1
+
+    def test_upstream_error_raises_fallback_message(self):
+        cs = ConversationService()
+        cs.use_gemini = True
+        cs.client = MagicMock()
+        cs.client.models.generate_content_stream.side_effect = RuntimeError("down")
+        with pytest.raises(FollowUpUnavailable) as excinfo:
+            list(cs.stream_follow_up('symptom', '{}', [], 'q'))
+        assert excinfo.value.message == FAILED_MESSAGE
+
+    def test_error_after_pieces_raises_interrupted(self):
+        cs = ConversationService()
+        cs.use_gemini = True
+        cs.client = MagicMock()
+
+        def upstream():
+            yield MagicMock(text='That ')
+            raise RuntimeError("connection reset")
+
+        cs.client.models.generate_content_stream.side_effect = lambda **kwargs: upstream()
+        pieces = []
+        with pytest.raises(FollowUpInterrupted) as excinfo:
+            for piece in cs.stream_follow_up('symptom', '{}', [], 'q'):
+                pieces.append(piece)
+        assert pieces == ['That ']
+        assert excinfo.value.message == FAILED_MESSAGE
+
+    def test_empty_stream_raises(self):
+        cs, _ = self._service([])
+        with pytest.raises(FollowUpUnavailable) as excinfo:
+            list(cs.stream_follow_up('symptom', '{}', [], 'q'))
+        assert excinfo.value.message == EMPTY_ANSWER_MESSAGE
+
+    def test_no_gemini_raises_clear_message(self):
+        with pytest.raises(FollowUpUnavailable) as excinfo:
+            list(ConversationService().stream_follow_up('symptom', '{}', [], 'q'))
+        assert excinfo.value.message == NO_GEMINI_MESSAGE
+
+
+class TestFollowUpStreamEndpoint:
+    def test_stream_requires_login(self, client):
+        resp = client.post('/api/follow_up/stream', json={
+            'analysis_type': 'symptom', 'analysis_id': 1, 'question': 'test'
+        })
+        assert resp.status_code == 401
+
+    def test_stream_sends_chunks_then_done_and_saves_turn(self, client, registered_user, gemini):
+        import database as db
+        analysis_id = client.post('/analyze_symptoms', json={'symptoms': 'headache'}).get_json()['analysis_id']
+
+        resp = client.post('/api/follow_up/stream', json={
+            'analysis_type': 'symptom', 'analysis_id': analysis_id, 'question': 'is this serious?'
+        })
+        assert resp.status_code == 200
+        assert resp.mimetype == 'text/event-stream'
+        body = resp.get_data(as_text=True)
+        assert body.startswith('event: chunk\n')
+        assert 'event: done\n' in body
+        user = db.get_user_by_username(registered_user['username'])
+        [turn] = db.get_follow_ups(user['id'], 'symptom', analysis_id)
+        assert turn['answer'] == "That sounds mild."
+
+    def test_stream_without_answer_sends_error_and_saves_nothing(self, client, registered_user):
+        import database as db
+        analysis_id = client.post('/analyze_symptoms', json={'symptoms': 'headache'}).get_json()['analysis_id']
+
+        body = client.post('/api/follow_up/stream', json={
+            'analysis_type': 'symptom', 'analysis_id': analysis_id, 'question': 'what next?'
+        }).get_data(as_text=True)
+        assert body.startswith('event: error\n')
+        assert 'event: chunk' not in body and 'event: done' not in body
+        user = db.get_user_by_username(registered_user['username'])
+        assert db.get_follow_ups(user['id'], 'symptom', analysis_id) == []
+
+    def test_stream_broken_off_ends_with_error_and_saves_nothing(self, client, registered_user, gemini):
+        import database as db
+        analysis_id = client.post('/analyze_symptoms', json={'symptoms': 'headache'}).get_json()['analysis_id']
+
+        def upstream(**kwargs):
+            yield MagicMock(text='That ')
+            raise RuntimeError("connection reset")
+
+        gemini.models.generate_content_stream.side_effect = upstream
+        body = client.post('/api/follow_up/stream', json={
+            'analysis_type': 'symptom', 'analysis_id': analysis_id, 'question': 'what next?'
+        }).get_data(as_text=True)
+        events = [block.split('\n') for block in body.strip().split('\n\n')]
+        assert [lines[0] for lines in events] == ['event: chunk', 'event: error']
+        error = json.loads(events[1][1][len('data: '):])
+        assert error == {'message': FAILED_MESSAGE, 'retryable': True, 'interrupted': True}
+        user = db.get_user_by_username(registered_user['username'])
+        assert db.get_follow_ups(user['id'], 'symptom', analysis_id) == []
+
+    def test_stream_validates_like_follow_up(self, client, registered_user):
+        resp = client.post('/api/follow_up/stream', json={
+            'analysis_type': 'symptom', 'analysis_id': 99999, 'question': 'test'
+        })
+        assert resp.status_code == 404
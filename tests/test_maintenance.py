@@ -0,0 +1,59 @@
+"""Tests for the periodic job registry in maintenance.py."""
+
+import threading
+
+from maintenance import PeriodicJobs
+
+
+class TestPeriodicJobs:
+    def test_runs_jobs_when_due(self):
+        jobs = PeriodicJobs()
+        calls = []
+        jobs.register('tick', lambda: calls.append(1), interval_seconds=60)
+
+        assert jobs.run_due(now=0) == []
+        # A real monotonic clock is far past 0; use the job's own schedule.
+        first = jobs._jobs['tick']['next_run']
+        assert jobs.run_due(now=first) == ['tick']
+        assert jobs.run_due(now=first + 30) == []
+        assert jobs.run_due(now=first + 60) == ['tick']
+        assert len(calls) == 2
+
+    def test_re_registering_replaces_the_job(self):
+        jobs = PeriodicJobs()
+        calls = []
+        jobs.register('compact', lambda: calls.append('old'), interval_seconds=60, run_at_start=True)
+        jobs.register('compact', lambda: calls.append('new'), interval_seconds=60, run_at_start=True)
+
+        jobs.run_due()
+        assert calls == ['new']
+        assert list(jobs.stats()) == ['compact']
+
+    def test_failing_job_is_recorded_and_retried(self):
+        jobs = PeriodicJobs()
+
+        def broken():
+            raise RuntimeError("disk full")
+
+        jobs.register('broken', broken, interval_seconds=0, run_at_start=True)
+        jobs.run_due()
+        jobs.run_due()
+        stats = jobs.stats()['broken']
+        assert stats['runs'] == 2
+        assert 'disk full' in stats['last_error']
+
+    def test_background_thread_runs_jobs(self):
+        jobs = PeriodicJobs(tick_seconds=0.01)
+        ran = threading.Event()
+        jobs.register('signal', ran.set, interval_seconds=60, run_at_start=True)
+        jobs.ensure_started()
+        try:
+            assert ran.wait(2)
+        finally:
+            jobs.stop()
+
+
+class TestTokenCompactionJob:
+    def test_app_registers_compaction(self, app):
+        from maintenance import periodic_jobs
+        assert 'compact_tokens' in periodic_jobs.stats()
@@ -0,0 +1,128 @@
+"""Tests for the manage.py maintenance CLI."""
+
+import json
+
+import pytest
+
+import manage
+
+
+class TestEncodeFragments:
+    def test_reports_sizes_and_re_encodes(self, db_module, capsys):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        with db_module.get_connection() as conn:
+            for _ in range(20):
+                conn.execute(
+                    "INSERT INTO image_analyses (user_id, created_at, detected_conditions, recommendations, "
+                    "safety_tips, disclaimer) VALUES (?, '2024-01-01', '[]', ?, ?, ?)",
+                    (user['id'], json.dumps(["Clean the wound gently"] * 5),
+                     json.dumps(["Wash your hands first"] * 5), "Educational use only.")
+                )
+
+        assert manage.main(['encode-fragments', '--vacuum']) == 0
+
+        out = capsys.readouterr().out
+        assert 'image_analyses: re-encoded 20 rows' in out
+        assert 'Before:' in out and 'After :' in out
+        with db_module.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM text_fragments").fetchone()[0] == 3
+
+    def test_unknown_command_exits(self, db_module):
+        with pytest.raises(SystemExit):
+            manage.main(['no-such-command'])
+
+
+class TestCompactTokens:
+    def test_deletes_dead_tokens(self, db_module, capsys):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        db_module.create_token(user['id'], 'password_reset', ttl_seconds=-1)
+        db_module.create_token(user['id'], 'email_verify', ttl_seconds=3600)
+
+        assert manage.main(['compact-tokens', '--batch-size', '1']) == 0
+
+        assert 'Deleted 1 used/expired tokens' in capsys.readouterr().out
+
+
+class TestArchiveHistory:
+    def test_archives_old_months(self, db_module, capsys):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        db_module.save_symptom_analysis(user['id'], 'rash on arm', {'recommendations': []},
+                                        created_at='2020-03-01T10:00:00+00:00')
+
+        assert manage.main(['archive-history', '--older-than-days', '30']) == 0
+
+        assert 'Archived 1 analyses' in capsys.readouterr().out
+        assert db_module.get_history(user['id'])[0]['archived'] is True
+
+    def test_refuses_without_an_age(self, db_module, capsys):
+        assert manage.main(['archive-history']) == 1
+        assert 'HISTORY_ARCHIVE_AFTER_DAYS' in capsys.readouterr().out
+
+
+class TestRebuildSearch:
+    def test_reindexes(self, db_module, capsys):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        db_module.save_symptom_analysis(user['id'], 'rash on arm', {'recommendations': []})
+        with db_module.get_connection() as conn:
+            conn.execute("DELETE FROM history_search")
+
+        assert manage.main(['rebuild-search']) == 0
+
+        assert 'Re-indexed 1 analyses' in capsys.readouterr().out
+        assert len(db_module.search_history(user['id'], 'rash')['results']) == 1
+
+
+class TestRebuildRollups:
+    def test_backfills(self, db_module, capsys):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        db_module.save_symptom_analysis(user['id'], 'rash on arm', {'urgency_level': 'low', 'recommendations': []})
+        with db_module.get_connection() as conn:
+            conn.execute("DELETE FROM analysis_rollups")
+
+        assert manage.main(['rebuild-rollups']) == 0
+
+        assert 'Rebuilt analytics rollups from 1 analyses' in capsys.readouterr().out
+        assert db_module.rollup_report()['days'][0]['by_urgency'] == {'low': 1}
+
+
+class TestExportHistory:
+    def test_writes_and_resumes_an_export(self, db_module, tmp_path, capsys):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        for day in (1, 2, 3):
+            db_module.save_symptom_analysis(user['id'], f'rash {day}', {'recommendations': []},
+                                            created_at=f'2024-03-0{day}T10:00:00+00:00')
+        output = tmp_path / 'export.ndjson'
+
+        assert manage.main(['export-history', '--user-id', str(user['id']), '--output', str(output)]) == 0
+        records = [json.loads(line) for line in output.read_text().splitlines()]
+        assert [r['symptom_text'] for r in records] == ['rash 3', 'rash 2', 'rash 1']
+
+        output.write_text(output.read_text().splitlines(keepends=True)[0])  # an interrupted download
+        assert manage.main(['export-history', '--user-id', str(user['id']), '--output', str(output),
+                            '--cursor', records[0]['cursor']]) == 0
+        assert [json.loads(line)['symptom_text'] for line in output.read_text().splitlines()] == [
+            'rash 3', 'rash 2', 'rash 1'
+        ]
+
+    def test_unknown_user(self, db_module, capsys):
+        assert manage.main(['export-history', '--user-id', '42']) == 1
+        assert 'No user with id 42' in capsys.readouterr().err
+
+
+class TestReshard:
+    def test_moves_history_and_reports_stats(self, db_module, capsys, monkeypatch):
+        user = db_module.create_user("alice", "alice@example.com", "password123")
+        analysis_id = db_module.save_symptom_analysis(user['id'], 'rash on arm', {'recommendations': []})
+
+        assert manage.main(['reshard', '--shards', '2']) == 0
+        out = capsys.readouterr().out
+        assert 'symptom_analyses: copied 1 rows' in out
+        assert 'HISTORY_SHARDS=2' in out
+        assert db_module.get_analysis(user['id'], 'symptom', analysis_id)['symptom_text'] == 'rash on arm'
+
+        # As after restarting with the new setting.
+        monkeypatch.setattr(db_module, 'HISTORY_SHARDS', 2)
+        assert manage.main(['history-stats']) == 0
+        out = capsys.readouterr().out
+        assert out.count('shard ') == 2
+        assert 'total: 1 users, 0 image / 1 symptom analyses, 0 follow-ups' in out
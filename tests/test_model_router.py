@@ -0,0 +1,120 @@
+"""
+Tests for model_router: fast/strong tier decisions for symptoms, images and
+follow-ups, latency bookkeeping, and the analyzers passing the routed model
+through to Gemini.
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+from unittest.mock import MagicMock
+
+import model_router
+from model_router import FAST_TIER, STRONG_TIER
+from symptom_checker import SymptomChecker
+from medical_analyzer import MedicalAnalyzer
+
+
+@pytest.fixture()
+def checker():
+    return SymptomChecker()
+
+
+def _route(checker, text):
+    return model_router.route_symptoms(text, checker._extract_symptoms(text.lower()), checker.symptom_database,
+                                       checker._unmatched_words(text.lower()))
+
+
+class TestRouteSymptoms:
+    def test_short_covered_text_goes_fast(self, checker):
+        assert _route(checker, "i have a headache").tier == FAST_TIER
+
+    def test_unrecognized_text_escalates(self, checker):
+        assert _route(checker, "something feels off since yesterday").tier == STRONG_TIER
+
+    def test_high_urgency_symptom_escalates(self, checker):
+        assert _route(checker, "chest pain").tier == STRONG_TIER
+
+    def test_filler_around_the_keywords_still_counts_as_covered(self, checker):
+        assert _route(checker, "I've had a really bad headache since yesterday").tier == FAST_TIER
+        # 'fatigue' has no symptom_database entry, which doesn't matter for routing
+        assert _route(checker, "i feel tired").tier == FAST_TIER
+
+    def test_short_partly_matched_text_escalates(self, checker):
+        decision = _route(checker, "headache and my left eye is drooping and blurry")
+        assert decision.tier == STRONG_TIER
+        assert 'drooping' in decision.reason
+
+    def test_many_symptoms_escalate(self, checker):
+        assert _route(checker, "fever, cough and a headache").tier == STRONG_TIER
+
+    def test_long_narrative_escalates(self, checker):
+        text = "i have a headache " + "and it started after lunch " * 30
+        assert _route(checker, text).tier == STRONG_TIER
+
+    def test_decision_exposes_tier_model(self, checker):
+        decision = _route(checker, "i have a headache")
+        assert decision.model == model_router.FAST_MODEL
+
+
+class TestRouteImage:
+    def test_xray_escalates(self):
+        assert model_router.route_image(100, 100, 0.01, is_xray=True).tier == STRONG_TIER
+
+    def test_small_low_detail_goes_fast(self):
+        assert model_router.route_image(200, 200, 0.05, is_xray=False).tier == FAST_TIER
+
+    def test_large_image_escalates(self):
+        assert model_router.route_image(2000, 1500, 0.05, is_xray=False).tier == STRONG_TIER
+
+    def test_high_detail_escalates(self):
+        assert model_router.route_image(200, 200, 0.4, is_xray=False).tier == STRONG_TIER
+
+
+class TestRouteFollowUp:
+    def test_short_early_question_goes_fast(self):
+        assert model_router.route_follow_up("is this serious?", 0).tier == FAST_TIER
+
+    def test_long_conversation_escalates(self):
+        assert model_router.route_follow_up("and now?", 10).tier == STRONG_TIER
+
+
+class TestLatencyStats:
+    def test_timed_records_calls_per_tier(self):
+        decision = model_router.RouteDecision('test', STRONG_TIER, 'test')
+        before = model_router.latency_stats().get(STRONG_TIER, {}).get('calls', 0)
+        with model_router.timed(decision):
+            pass
+        assert model_router.latency_stats()[STRONG_TIER]['calls'] == before + 1
+
+    def test_timed_records_failed_calls(self):
+        decision = model_router.RouteDecision('test', FAST_TIER, 'test')
+        before = model_router.latency_stats().get(FAST_TIER, {}).get('calls', 0)
+        with pytest.raises(RuntimeError):
+            with model_router.timed(decision):
+                raise RuntimeError("down")
+        assert model_router.latency_stats()[FAST_TIER]['calls'] == before + 1
+
+
+class TestAnalyzersUseRoutedModel:
+    def test_symptom_checker_sends_routed_model(self, checker):
+        checker.use_gemini = True
+        checker.client = MagicMock()
+        checker.client.models.generate_content.return_value = MagicMock(parsed=None, text='{}')
+
+        checker.analyze_symptoms("i have a headache")
+        assert checker.client.models.generate_content.call_args.kwargs['model'] == model_router.FAST_MODEL
+
+        checker.analyze_symptoms("crushing chest pain")
+        assert checker.client.models.generate_content.call_args.kwargs['model'] == model_router.STRONG_MODEL
+
+    def test_medical_analyzer_routes_xray_to_strong(self, tmp_path):
+        path = tmp_path / 'xray.png'
+        Image.fromarray(np.full((50, 50, 3), 120, dtype=np.uint8)).save(path)
+        analyzer = MedicalAnalyzer()
+        analyzer.use_gemini = True
+        analyzer.client = MagicMock()
+        analyzer.client.models.generate_content.return_value = MagicMock(parsed=None, text='{}')
+
+        analyzer.analyze_image(str(path))
+        assert analyzer.client.models.generate_content.call_args.kwargs['model'] == model_router.STRONG_MODEL
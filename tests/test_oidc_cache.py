@@ -0,0 +1,189 @@
+"""
+Tests for the cached OIDC discovery document and signing keys: fetching
+from the issuer, sharing the copy between workers through the file,
+refreshing after the TTL, riding out an issuer outage, and Google sign-in
+checking id_tokens against the cached keys. The issuer is FakeIssuer, a
+local HTTP server.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from authlib.integrations.flask_client import OAuth
+from authlib.jose import JsonWebKey, jwt
+
+import oauth as oauth_module
+from oidc_cache import OIDCMetadataCache
+
+
+class FakeIssuer(ThreadingHTTPServer):
+    """Serves a discovery document and a JWKS with one RSA key; counts the
+    requests for each, and answers 503 to everything while `down`."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _IssuerHandler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.discovery_url = self.url + '/.well-known/openid-configuration'
+        self.key = JsonWebKey.generate_key('RSA', 2048, is_private=True, options={'kid': 'key-1'})
+        self.hits = {'discovery': 0, 'jwks': 0}
+        self.down = False
+
+    def id_token(self, client_id, nonce, **claims):
+        now = int(time.time())
+        payload = dict(iss=self.url, aud=client_id, sub='google-sub-1', nonce=nonce, iat=now, exp=now + 300,
+                       **claims)
+        return jwt.encode({'alg': 'RS256', 'kid': 'key-1'}, payload, self.key).decode()
+
+
+class _IssuerHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        issuer = self.server
+        if issuer.down:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path == '/.well-known/openid-configuration':
+            issuer.hits['discovery'] += 1
+            body = {'issuer': issuer.url, 'jwks_uri': issuer.url + '/jwks',
+                    'authorization_endpoint': issuer.url + '/auth', 'token_endpoint': issuer.url + '/token',
+                    'id_token_signing_alg_values_supported': ['RS256']}
+        elif self.path == '/jwks':
+            issuer.hits['jwks'] += 1
+            body = {'keys': [issuer.key.as_dict(is_private=False)]}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def issuer():
+    server = FakeIssuer()
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def cache_path(tmp_path):
+    return str(tmp_path / 'oidc.json')
+
+
+def _age(worker, seconds):
+    """Make the worker's copy, in memory and on disk, `seconds` older."""
+    document = worker.load()
+    document['fetched_at'] -= seconds
+    worker._write_file(document)
+    return document
+
+
+class TestCache:
+    def test_fetches_once_and_shares_the_copy_through_the_file(self, issuer, cache_path):
+        worker = OIDCMetadataCache(issuer.discovery_url, cache_path)
+        assert worker.load() is None
+        document = worker.refresh()
+        assert document['metadata']['issuer'] == issuer.url
+        assert document['jwks']['keys'][0]['kid'] == 'key-1'
+        assert worker.refresh() is document  # fresh - no request
+        assert issuer.hits == {'discovery': 1, 'jwks': 1}
+
+        other_worker = OIDCMetadataCache(issuer.discovery_url, cache_path)
+        assert other_worker.load() == document
+        assert other_worker.refresh() == document
+        assert issuer.hits == {'discovery': 1, 'jwks': 1}
+
+    def test_refetches_after_the_ttl(self, issuer, cache_path):
+        worker = OIDCMetadataCache(issuer.discovery_url, cache_path, ttl_seconds=60)
+        worker.refresh()
+        aged_at = _age(worker, 61)['fetched_at']
+        assert worker.refresh()['fetched_at'] > aged_at
+        assert issuer.hits == {'discovery': 2, 'jwks': 2}
+
+    def test_picks_up_a_copy_another_worker_refreshed(self, issuer, cache_path):
+        stale = OIDCMetadataCache(issuer.discovery_url, cache_path, ttl_seconds=60)
+        stale.refresh()['fetched_at'] -= 61  # in memory only, as if read long ago
+        OIDCMetadataCache(issuer.discovery_url, cache_path, ttl_seconds=60).refresh()
+        hits = dict(issuer.hits)
+
+        assert time.time() - stale.refresh()['fetched_at'] < 60
+        assert issuer.hits == hits
+
+    def test_keeps_the_stale_copy_while_the_issuer_is_down(self, issuer, cache_path):
+        worker = OIDCMetadataCache(issuer.discovery_url, cache_path, ttl_seconds=60)
+        worker.refresh()
+        document = _age(worker, 61)
+        issuer.down = True
+
+        assert worker.refresh() is document
+        assert '503' in worker.stats()['last_error']
+        assert OIDCMetadataCache(issuer.discovery_url, cache_path).load()['jwks'] == document['jwks']
+
+    def test_nothing_cached_and_issuer_down(self, issuer, cache_path):
+        issuer.down = True
+        worker = OIDCMetadataCache(issuer.discovery_url, cache_path)
+        assert worker.refresh() is None
+        assert worker.stats()['cached'] is False
+
+    def test_ignores_a_corrupt_file(self, issuer, cache_path):
+        with open(cache_path, 'w') as f:
+            f.write('{not json')
+        assert OIDCMetadataCache(issuer.discovery_url, cache_path).load() is None
+
+
+class TestGoogleSignIn:
+    @pytest.fixture()
+    def google(self, app, issuer, cache_path, monkeypatch):
+        """Google sign-in configured against the fake issuer; returns a
+        function that (re)starts it like a fresh worker would."""
+        monkeypatch.setattr(oauth_module, 'GOOGLE_CLIENT_ID', 'client-1')
+        monkeypatch.setattr(oauth_module, 'GOOGLE_CLIENT_SECRET', 'secret')
+        monkeypatch.setattr(oauth_module, 'GOOGLE_DISCOVERY_URL', issuer.discovery_url)
+        monkeypatch.setenv('OIDC_CACHE_PATH', cache_path)
+        monkeypatch.setattr(oauth_module, 'google_metadata', None)
+
+        def start_worker():
+            monkeypatch.setattr(oauth_module, 'oauth', OAuth())
+            oauth_module.init_oauth(app)
+            return oauth_module.oauth.google
+        return start_worker
+
+    def test_sign_in_uses_the_prefetched_metadata_and_keys(self, google, issuer):
+        client = google()
+        oauth_module.refresh_google_metadata()  # the worker's warm-up job
+        hits = dict(issuer.hits)
+
+        assert client.load_server_metadata()['token_endpoint'] == issuer.url + '/token'
+        token = {'access_token': 'x', 'id_token': issuer.id_token('client-1', 'n-1', email='a@example.com')}
+        assert client.parse_id_token(token, nonce='n-1')['email'] == 'a@example.com'
+        assert issuer.hits == hits
+
+    def test_restarted_worker_signs_in_while_the_issuer_is_down(self, google, issuer):
+        google()
+        oauth_module.refresh_google_metadata()
+        issuer.down = True
+
+        client = google()  # restart: only the file to go on
+        token = {'access_token': 'x', 'id_token': issuer.id_token('client-1', 'n-1')}
+        assert client.parse_id_token(token, nonce='n-1')['sub'] == 'google-sub-1'
+        assert oauth_module.google_metadata_stats()['cached'] is True
+
+    def test_health_reports_the_cache(self, google, app):
+        google()
+        oauth_module.refresh_google_metadata()
+        report = app.test_client().get('/health').get_json()['google_oidc']
+        assert report['cached'] is True and report['last_error'] is None
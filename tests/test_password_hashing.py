@@ -0,0 +1,109 @@
+"""
+Tests for password_hashing: hashing in the process pool, back-pressure
+when it's saturated, and re-hashing on login when the work factors change.
+"""
+
+import os
+
+import pytest
+
+import password_hashing
+from bulkhead import Bulkhead
+
+
+@pytest.fixture()
+def method(monkeypatch):
+    """Switch PASSWORD_HASH_METHOD for the test."""
+    def switch(value):
+        monkeypatch.setattr(password_hashing, 'PASSWORD_HASH_METHOD', value)
+        password_hashing._configured_prefix.cache_clear()
+    yield switch
+    password_hashing._configured_prefix.cache_clear()
+
+
+@pytest.fixture()
+def saturated(monkeypatch):
+    """A bulkhead with its only slot taken and no queue."""
+    bulkhead = Bulkhead('test', max_concurrent=1, max_queue=0, max_wait_seconds=0)
+    monkeypatch.setattr(password_hashing, 'hashing_bulkhead', bulkhead)
+    assert bulkhead.acquire()
+    yield bulkhead
+    bulkhead.release()
+
+
+class TestHashing:
+    def test_round_trip(self):
+        stored = password_hashing.hash_password('correct horse')
+        assert stored.startswith('scrypt:32768:8:1$')
+        assert password_hashing.check_password(stored, 'correct horse')
+        assert not password_hashing.check_password(stored, 'wrong horse')
+
+    def test_runs_in_a_child_process(self):
+        assert password_hashing._run(os.getpid) != os.getpid()
+
+    def test_inline_without_workers(self, monkeypatch):
+        monkeypatch.setattr(password_hashing, 'PASSWORD_HASH_WORKERS', 0)
+        assert password_hashing._run(os.getpid) == os.getpid()
+
+    def test_needs_rehash_compares_work_factors(self, method):
+        stored = password_hashing.hash_password('pw')
+        assert not password_hashing.needs_rehash(stored)
+        method('scrypt:16384:8:1')
+        assert password_hashing.needs_rehash(stored)
+        method('scrypt')  # werkzeug's defaults, spelled out in the hash
+        assert not password_hashing.needs_rehash(stored)
+
+
+class TestBackPressure:
+    def test_full_queue_raises_busy(self, saturated):
+        with pytest.raises(password_hashing.PasswordHashingBusy):
+            password_hashing.hash_password('pw')
+        assert saturated.stats()['shed_total'] == 1
+
+    def test_login_burst_gets_503_with_retry_after(self, client, registered_user, saturated):
+        client.post('/logout')
+        resp = client.post('/login', data={'username': registered_user['username'],
+                                           'password': registered_user['password']})
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '5'
+        assert b'Too many sign-in requests' in resp.data
+
+    def test_emergency_page_is_unaffected(self, client, saturated):
+        assert client.get('/emergency').status_code == 200
+
+
+class TestRehashOnLogin:
+    def test_changed_work_factor_is_applied_at_login(self, db_module, method):
+        method('pbkdf2:sha256:1000')
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        assert user['password_hash'].startswith('pbkdf2:sha256:1000$')
+
+        method('scrypt:16384:8:1')
+        assert not db_module.verify_password(user, 'wrong-password')
+        assert db_module.get_user_by_id(user['id'])['password_hash'] == user['password_hash']
+
+        assert db_module.verify_password(user, 'password123')
+        rehashed = db_module.get_user_by_id(user['id'])
+        assert rehashed['password_hash'].startswith('scrypt:16384:8:1$')
+        assert db_module.verify_password(rehashed, 'password123')
+
+    def test_does_not_overwrite_a_concurrent_password_change(self, db_module, method):
+        method('pbkdf2:sha256:1000')
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        db_module.set_password(user['id'], 'brand-new-password')
+        method('scrypt:16384:8:1')
+
+        assert db_module.verify_password(user, 'password123')  # the stale row it was given
+        assert db_module.verify_password(db_module.get_user_by_id(user['id']), 'brand-new-password')
+
+    def test_busy_rehash_still_logs_in(self, db_module, method, monkeypatch):
+        method('pbkdf2:sha256:1000')
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        method('scrypt:16384:8:1')
+
+        def busy(password):
+            raise password_hashing.PasswordHashingBusy()
+
+        monkeypatch.setattr(password_hashing, 'hash_password', busy)
+        assert db_module.verify_password(user, 'password123')
+        assert db_module.get_user_by_id(user['id'])['password_hash'] == user['password_hash']
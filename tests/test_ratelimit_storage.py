@@ -0,0 +1,127 @@
+"""
+Tests for the sqlite:// rate-limit storage: the `limits` storage contract
+for fixed and moving windows, counts shared across processes, and the app
+using it by default.
+"""
+
+import multiprocessing
+
+import pytest
+from limits import parse
+from limits.errors import ConfigurationError
+from limits.storage import storage_from_string
+from limits.strategies import FixedWindowRateLimiter, MovingWindowRateLimiter
+
+import ratelimit_storage
+
+
+@pytest.fixture()
+def storage(tmp_path):
+    return storage_from_string(f"sqlite:///{tmp_path}/ratelimits.db")
+
+
+class FakeClock:
+    def __init__(self, monkeypatch, now=1_000_000.0):
+        self.now = now
+        monkeypatch.setattr(ratelimit_storage.time, 'time', lambda: self.now)
+
+
+class TestFixedWindow:
+    def test_counts_until_the_window_ends(self, storage, monkeypatch):
+        clock = FakeClock(monkeypatch)
+        assert storage.incr('k', 60) == 1
+        assert storage.incr('k', 60, amount=2) == 3
+        assert storage.get('k') == 3
+        assert storage.get_expiry('k') == clock.now + 60
+
+        clock.now += 61
+        assert storage.get('k') == 0
+        assert storage.incr('k', 60) == 1  # a fresh window
+        assert storage.get_expiry('k') == clock.now + 60
+
+    def test_limiter_enforces_the_limit(self, storage):
+        limiter = FixedWindowRateLimiter(storage)
+        limit = parse('3/minute')
+        assert [limiter.hit(limit, 'login', '1.2.3.4') for _ in range(4)] == [True, True, True, False]
+        assert limiter.hit(limit, 'login', '5.6.7.8')
+
+    def test_clear_and_reset(self, storage):
+        storage.incr('a', 60)
+        storage.incr('b', 60)
+        storage.clear('a')
+        assert storage.get('a') == 0 and storage.get('b') == 1
+        assert storage.reset() == 1
+        assert storage.get('b') == 0
+
+    def test_expired_rows_are_swept(self, storage, monkeypatch):
+        clock = FakeClock(monkeypatch)
+        monkeypatch.setattr(ratelimit_storage, 'SWEEP_EVERY_WRITES', 2)
+        storage.incr('old', 1)
+        clock.now += 2
+        storage.incr('new', 60)
+        rows = storage._connection().execute("SELECT key FROM counters").fetchall()
+        assert rows == [('new',)]
+
+
+class TestMovingWindow:
+    def test_entries_leave_the_window_one_by_one(self, storage, monkeypatch):
+        clock = FakeClock(monkeypatch)
+        limiter = MovingWindowRateLimiter(storage)
+        limit = parse('2/minute')
+        assert limiter.hit(limit, 'k')
+        clock.now += 30
+        assert limiter.hit(limit, 'k')
+        assert not limiter.hit(limit, 'k')
+        assert storage.get_moving_window(limit.key_for('k'), 2, 60) == (clock.now - 30, 2)
+
+        clock.now += 31  # the first hit has left the window, the second hasn't
+        assert limiter.hit(limit, 'k')
+        assert not limiter.hit(limit, 'k')
+
+
+def _hit_many(path, hits, results):
+    limiter = FixedWindowRateLimiter(storage_from_string(f"sqlite:///{path}"))
+    limit = parse('100/hour')
+    results.put(sum(limiter.hit(limit, 'shared') for _ in range(hits)))
+
+
+class TestAcrossProcesses:
+    def test_workers_share_one_count(self, storage):
+        storage.check()  # the parent's connection - children must open their own
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        workers = [ctx.Process(target=_hit_many, args=(storage.path, 60, results)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        allowed = sum(results.get(timeout=30) for _ in workers)
+        for worker in workers:
+            worker.join()
+        assert allowed == 100  # not 4 x 60, and not 4 x 100
+        assert storage.get('LIMITER/shared/100/1/hour') == 240
+
+    def test_uri_needs_a_path(self):
+        with pytest.raises(ConfigurationError):
+            storage_from_string("sqlite://")
+
+
+@pytest.fixture()
+def default_app(monkeypatch, request):
+    """The app as configured with RATELIMIT_STORAGE_URI blank (set, so
+    load_dotenv() leaves it alone)."""
+    monkeypatch.setenv('RATELIMIT_STORAGE_URI', '')
+    return request.getfixturevalue('app')
+
+
+class TestApp:
+    def test_app_uses_shared_storage_by_default(self, default_app, temp_db_path):
+        import app as app_module
+        storage = app_module.limiter._storage
+        assert isinstance(storage, ratelimit_storage.SQLiteStorage)
+        assert storage.path == temp_db_path + '.ratelimits'
+
+    def test_login_limit_is_enforced(self, default_app):
+        client = default_app.test_client()
+        statuses = [client.post('/login', data={'username': 'nobody', 'password': 'x'}).status_code
+                    for _ in range(11)]
+        assert statuses[-1] == 429
+        assert 429 not in statuses[:10]
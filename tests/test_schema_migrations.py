@@ -0,0 +1,121 @@
+"""
+Tests for the versioned schema migrations behind database.init_db():
+PRAGMA user_version bookkeeping, the no-DDL fast path, upgrades from an
+older version and several processes' worth of init_db() racing at startup.
+"""
+
+import importlib
+import sqlite3
+import threading
+
+import pytest
+
+
+def _user_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _fresh_database_module():
+    import database
+    importlib.reload(database)
+    return database
+
+
+class TestVersioning:
+    def test_new_database_records_the_latest_version(self, temp_db_path):
+        database = _fresh_database_module()
+        database.init_db()
+        database.close_connection()
+        assert _user_version(temp_db_path) == database.schema_version() >= 5
+
+    def test_current_database_runs_no_migrations(self, temp_db_path):
+        database = _fresh_database_module()
+        database.init_db()
+
+        statements = []
+        database._pooled_connection().set_trace_callback(statements.append)
+        database.init_db()
+        database._pooled_connection().set_trace_callback(None)
+        database.close_connection()
+        assert statements[0] == "PRAGMA user_version"
+        # Just reads: the version, and which history shards are in use.
+        assert all(statement.lstrip().startswith(('PRAGMA user_version', 'SELECT')) for statement in statements)
+
+    def test_only_pending_migrations_run(self, temp_db_path, monkeypatch):
+        database = _fresh_database_module()
+        database.init_db()
+        with database.get_connection() as conn:
+            conn.execute("PRAGMA user_version = 3")
+
+        ran = []
+        for version, (description, migrate) in list(database._MIGRATIONS.items()):
+            monkeypatch.setitem(database._MIGRATIONS, version,
+                                (description, lambda conn, v=version, f=migrate: (ran.append(v), f(conn))))
+        database.init_db()
+        database.close_connection()
+        assert ran == list(range(4, database.schema_version() + 1))
+        assert _user_version(temp_db_path) == database.schema_version()
+
+    def test_failed_migration_leaves_version_unchanged(self, temp_db_path, monkeypatch):
+        database = _fresh_database_module()
+        database.init_db()
+        with database.get_connection() as conn:
+            conn.execute("PRAGMA user_version = 3")
+
+        def broken(conn):
+            conn.execute("CREATE TABLE half_done (id INTEGER)")
+            raise RuntimeError("migration bug")
+
+        monkeypatch.setitem(database._MIGRATIONS, 5, ("broken", broken))
+        with pytest.raises(RuntimeError, match="migration bug"):
+            database.init_db()
+        database.close_connection()
+
+        assert _user_version(temp_db_path) == 3
+        conn = sqlite3.connect(temp_db_path)
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+        conn.close()
+
+    def test_add_column_is_idempotent(self, db_module):
+        with db_module.get_connection() as conn:
+            db_module._add_column(conn, 'users', 'nickname', "TEXT")
+            db_module._add_column(conn, 'users', 'nickname', "TEXT")
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(users)")]
+        assert columns.count('nickname') == 1
+
+
+class TestConcurrentStartup:
+    def test_workers_starting_together_migrate_once(self, temp_db_path, monkeypatch):
+        database = _fresh_database_module()
+        applied = []
+        for version, (description, migrate) in list(database._MIGRATIONS.items()):
+            monkeypatch.setitem(database._MIGRATIONS, version,
+                                (description, lambda conn, v=version, f=migrate: (applied.append(v), f(conn))))
+
+        # One pooled connection per thread - as close as a test gets to
+        # several gunicorn workers opening the same file.
+        start = threading.Barrier(6)
+        errors = []
+
+        def worker():
+            start.wait()
+            try:
+                database.init_db()
+            except Exception as exc:  # pragma: no cover - reported below
+                errors.append(exc)
+            finally:
+                database.close_connection()
+
+        threads = [threading.Thread(target=worker) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert sorted(applied) == list(range(1, database.schema_version() + 1))
+        assert _user_version(temp_db_path) == database.schema_version()
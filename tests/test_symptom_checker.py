@@ -58,6 +58,10 @@ class TestExtractSymptoms:
     def test_empty_string(self, checker):
         assert checker._extract_symptoms("") == []
 
+    def test_unmatched_words_are_what_the_keywords_and_filler_leave(self, checker):
+        assert checker._unmatched_words("i have a cough, i keep coughing") == []
+        assert checker._unmatched_words("chest pain in my left arm") == ['left', 'arm']
+
 
 # ---------------------------------------------------------------------------
 # Symptom-combination analysis and urgency scoring
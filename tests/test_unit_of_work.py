@@ -0,0 +1,236 @@
+"""
+Tests for the request-scoped unit of work: @db.unit_of_work views share one
+transaction across database calls from their first write on, committed
+after the response and rolled back when the view fails.
+"""
+
+import sqlite3
+
+import pytest
+from flask import Flask, Response, stream_with_context
+
+
+@pytest.fixture()
+def uow_app(db_module):
+    app = Flask(__name__)
+    app.config['TESTING'] = True
+    db_module.init_request_sessions(app)
+    return app
+
+
+def _user_exists(db_module, username):
+    return db_module.get_user_by_username(username) is not None
+
+
+def _write_locked(db_module):
+    """Whether another connection would have to wait for the write lock."""
+    probe = sqlite3.connect(db_module.DB_PATH, timeout=0)
+    try:
+        probe.execute("BEGIN IMMEDIATE")
+        probe.execute("ROLLBACK")
+        return False
+    except sqlite3.OperationalError:
+        return True
+    finally:
+        probe.close()
+
+
+class TestUnitOfWork:
+    def test_calls_share_one_transaction_and_commit_after_response(self, uow_app, db_module):
+        seen = {}
+
+        @uow_app.route('/ok')
+        @db_module.unit_of_work
+        def ok():
+            db_module.create_user('alice', 'alice@example.com', 'password123')
+            with db_module.get_connection() as conn:
+                seen['in_transaction'] = conn.in_transaction
+            db_module.create_user('bob', 'bob@example.com', 'password123')
+            with db_module.get_connection() as conn:
+                seen['still_open'] = conn.in_transaction
+            return 'ok'
+
+        assert uow_app.test_client().get('/ok').status_code == 200
+        assert seen == {'in_transaction': True, 'still_open': True}
+        assert _user_exists(db_module, 'alice') and _user_exists(db_module, 'bob')
+        with db_module.get_connection() as conn:
+            pass
+        assert db_module._pool.depth == 0
+
+    def test_reads_and_hashing_before_the_first_write_take_no_lock(self, uow_app, db_module, monkeypatch):
+        import password_hashing
+        user = db_module.create_user('alice', 'alice@example.com', 'password123')
+        seen = {}
+        hash_password = password_hashing.hash_password
+
+        def hash_and_probe(password):
+            seen['locked_while_hashing'] = _write_locked(db_module)
+            return hash_password(password)
+
+        monkeypatch.setattr(password_hashing, 'hash_password', hash_and_probe)
+
+        @uow_app.route('/change')
+        @db_module.unit_of_work
+        def change():
+            row = db_module.get_user_by_username('alice')
+            seen['verified'] = db_module.verify_password(row, 'password123')
+            seen['locked_after_reads'] = _write_locked(db_module)
+            db_module.set_password(user['id'], 'another-password')
+            seen['locked_after_write'] = _write_locked(db_module)
+            return 'ok'
+
+        assert uow_app.test_client().get('/change').status_code == 200
+        assert seen == {'verified': True, 'locked_after_reads': False,
+                        'locked_while_hashing': False, 'locked_after_write': True}
+        assert not _write_locked(db_module)
+        assert db_module.verify_password(db_module.get_user_by_id(user['id']), 'another-password')
+
+    def test_exception_rolls_back_everything(self, uow_app, db_module):
+        @uow_app.route('/boom')
+        @db_module.unit_of_work
+        def boom():
+            db_module.create_user('alice', 'alice@example.com', 'password123')
+            raise RuntimeError("boom")
+
+        # TESTING propagates the exception; teardown still rolls back.
+        with pytest.raises(RuntimeError):
+            uow_app.test_client().get('/boom')
+        assert not _user_exists(db_module, 'alice')
+
+    def test_server_error_response_rolls_back(self, uow_app, db_module):
+        @uow_app.route('/fail')
+        @db_module.unit_of_work
+        def fail():
+            db_module.create_user('alice', 'alice@example.com', 'password123')
+            return 'failed', 503
+
+        uow_app.test_client().get('/fail')
+        assert not _user_exists(db_module, 'alice')
+
+    def test_client_error_response_still_commits(self, uow_app, db_module):
+        @uow_app.route('/conflict')
+        @db_module.unit_of_work
+        def conflict():
+            db_module.create_user('alice', 'alice@example.com', 'password123')
+            # Duplicate - only create_user's own savepoint is rolled back.
+            assert db_module.create_user('alice', 'alice@example.com', 'password123') is None
+            return 'taken', 409
+
+        uow_app.test_client().get('/conflict')
+        assert _user_exists(db_module, 'alice')
+
+    def test_streamed_body_falls_back_to_per_call_transactions(self, uow_app, db_module):
+        @uow_app.route('/stream')
+        @db_module.unit_of_work
+        def stream():
+            def generate():
+                yield 'start'
+                db_module.create_user('alice', 'alice@example.com', 'password123')
+                yield 'done'
+            return Response(stream_with_context(generate()))
+
+        assert uow_app.test_client().get('/stream').get_data(as_text=True) == 'startdone'
+        assert _user_exists(db_module, 'alice')
+
+    def test_views_without_the_decorator_are_unaffected(self, uow_app, db_module):
+        @uow_app.route('/plain')
+        def plain():
+            db_module.create_user('alice', 'alice@example.com', 'password123')
+            with db_module.get_connection() as conn:
+                conn.execute("SELECT 1")
+                assert db_module._pool.depth == 1  # its own top-level transaction
+            raise RuntimeError("after the write")
+
+        with pytest.raises(RuntimeError):
+            uow_app.test_client().get('/plain')
+        assert _user_exists(db_module, 'alice')
+
+    def test_decorator_requires_init(self, db_module):
+        app = Flask(__name__)
+
+        @app.route('/x')
+        @db_module.unit_of_work
+        def x():
+            return 'x'
+
+        app.config['TESTING'] = True
+        with pytest.raises(RuntimeError):
+            app.test_client().get('/x')
+
+
+class TestAccountViewsUseOneTransaction:
+    def test_token_pages_take_no_lock_to_look(self, client, monkeypatch):
+        import database as db
+        user = db.create_user('alice', 'alice@example.com', 'password123')
+        token = db.create_token(user['id'], 'password_reset', 60)
+        get_valid_token = db.get_valid_token
+        locked = []
+
+        def look_and_probe(*args):
+            row = get_valid_token(*args)
+            locked.append(_write_locked(db))
+            return row
+
+        monkeypatch.setattr(db, 'get_valid_token', look_and_probe)
+        assert client.get(f'/reset-password/{token}').status_code == 200
+        assert client.get('/verify-email/not-a-token').status_code == 400
+        assert locked == [False, False]
+
+    def test_reset_token_can_only_set_a_password_once(self, client, monkeypatch):
+        import database as db
+        user = db.create_user('alice', 'alice@example.com', 'password123')
+        token = db.create_token(user['id'], 'password_reset', 60)
+        row = db.get_valid_token(token, 'password_reset')
+        # The lookup passes, but another request uses the token up first.
+        monkeypatch.setattr(db, 'get_valid_token', lambda *args: row)
+        db.consume_token(row['id'])
+
+        resp = client.post(f'/reset-password/{token}', data={
+            'password': 'brand-new-password', 'confirm_password': 'brand-new-password'
+        })
+        assert resp.status_code == 400
+        assert db.verify_password(db.get_user_by_id(user['id']), 'password123')
+
+    def test_profile_update_commits(self, client, registered_user):
+        import database as db
+        resp = client.post('/account/profile', data={
+            'username': 'renamed', 'email': 'renamed@example.com',
+            'current_password': registered_user['password'],
+        })
+        assert resp.status_code == 200
+        assert db.get_user_by_username('renamed')['email'] == 'renamed@example.com'
+
+    def test_profile_update_is_all_or_nothing(self, client, registered_user, monkeypatch):
+        import database as db
+        # Another signup takes the email after this request's own checks
+        # would once have passed, but before the update.
+        update_profile = db.update_profile
+
+        def signup_first(*args):
+            db.create_user('other', 'wanted@example.com', 'password123')
+            return update_profile(*args)
+
+        monkeypatch.setattr(db, 'update_profile', signup_first)
+        resp = client.post('/account/profile', data={
+            'username': 'renamed', 'email': 'wanted@example.com',
+            'current_password': registered_user['password'],
+        })
+        assert resp.status_code == 400
+        assert b'already in use' in resp.data
+        assert db.get_user_by_username('renamed') is None
+        assert db.get_user_by_username('testuser')['email'] == 'testuser@example.com'
+
+    def test_account_deletion_drops_cached_contexts_before_taking_the_lock(self, client, registered_user,
+                                                                         monkeypatch):
+        import database as db
+        import app as app_module
+        locked = []
+        monkeypatch.setattr(app_module.conversation_service, 'forget_cached_contexts',
+                            lambda user_id: locked.append(_write_locked(db)))
+
+        resp = client.post('/account/delete', data={
+            'current_password': registered_user['password'], 'confirm_text': 'DELETE'
+        })
+        assert resp.status_code == 302
+        assert locked == [False]
+        assert db.get_user_by_username('testuser') is None
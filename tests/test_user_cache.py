@@ -0,0 +1,111 @@
+"""
+Tests for the user cache behind auth.load_user: lookups served without a
+query, invalidation by every users-table mutator (also from @unit_of_work
+views), the TTL, and the cross-worker signal file.
+"""
+
+import pytest
+
+
+def _user_queries(db_module, fn):
+    statements = []
+    db_module._pooled_connection().set_trace_callback(statements.append)
+    try:
+        result = fn()
+    finally:
+        db_module._pooled_connection().set_trace_callback(None)
+    return result, [s for s in statements if 'FROM users' in s]
+
+
+class TestCaching:
+    def test_repeat_lookups_skip_the_database(self, db_module, alice):
+        assert db_module.get_cached_user(alice['id'])['username'] == 'alice'
+        user, queries = _user_queries(db_module, lambda: db_module.get_cached_user(alice['id']))
+        assert user['username'] == 'alice'
+        assert queries == []
+
+    def test_entries_expire_after_the_ttl(self, db_module, alice, monkeypatch):
+        monkeypatch.setattr(db_module, 'USER_CACHE_TTL_SECONDS', 0)
+        db_module.get_cached_user(alice['id'])
+        _, queries = _user_queries(db_module, lambda: db_module.get_cached_user(alice['id']))
+        assert len(queries) == 1
+
+    def test_callers_cannot_change_the_cached_copy(self, db_module, alice):
+        db_module.get_cached_user(alice['id'])['username'] = 'mallory'
+        assert db_module.get_cached_user(alice['id'])['username'] == 'alice'
+
+    def test_unknown_users_are_not_cached(self, db_module):
+        assert db_module.get_cached_user(12345) is None
+        _, queries = _user_queries(db_module, lambda: db_module.get_cached_user(12345))
+        assert len(queries) == 1
+
+    def test_size_zero_disables_it(self, db_module, alice, monkeypatch):
+        monkeypatch.setattr(db_module, 'USER_CACHE_SIZE', 0)
+        db_module.get_cached_user(alice['id'])
+        _, queries = _user_queries(db_module, lambda: db_module.get_cached_user(alice['id']))
+        assert len(queries) == 1
+
+
+MUTATIONS = {
+    'update_username': (lambda db, uid: db.update_username(uid, 'alice2'), 'username', 'alice2'),
+    'update_email': (lambda db, uid: db.update_email(uid, 'a2@example.com'), 'email', 'a2@example.com'),
+    'set_password': (lambda db, uid: db.set_password(uid, 'another-password'), 'has_password', 1),
+    'set_email_verified': (lambda db, uid: db.set_email_verified(uid), 'email_verified', 1),
+    'set_pending_totp_secret': (lambda db, uid: db.set_pending_totp_secret(uid, 'SECRET'), 'totp_secret', 'SECRET'),
+    'enable_totp': (lambda db, uid: db.enable_totp(uid), 'totp_enabled', 1),
+    'link_oauth_to_user': (lambda db, uid: db.link_oauth_to_user(uid, 'google', 'sub-1'), 'oauth_sub', 'sub-1'),
+}
+
+
+class TestInvalidation:
+    @pytest.mark.parametrize('name', sorted(MUTATIONS))
+    def test_every_mutator_invalidates(self, db_module, alice, name):
+        mutate, field, expected = MUTATIONS[name]
+        db_module.get_cached_user(alice['id'])
+        mutate(db_module, alice['id'])
+        assert db_module.get_cached_user(alice['id'])[field] == expected
+
+    def test_disable_totp_invalidates(self, db_module, alice):
+        db_module.enable_totp(alice['id'])
+        assert db_module.get_cached_user(alice['id'])['totp_enabled'] == 1
+        db_module.disable_totp(alice['id'])
+        assert db_module.get_cached_user(alice['id'])['totp_enabled'] == 0
+
+    def test_deleted_user_is_gone_at_once(self, db_module, alice):
+        db_module.get_cached_user(alice['id'])
+        db_module.delete_user(alice['id'])
+        assert db_module.get_cached_user(alice['id']) is None
+
+    def test_signal_file_tells_other_workers(self, db_module, alice):
+        db_module.get_cached_user(alice['id'])
+        # Another worker renames alice: the row changes and the signal
+        # file is replaced, but this process' cache isn't touched.
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE users SET username = 'renamed' WHERE id = ?", (alice['id'],))
+        db_module._signal_user_change()
+
+        assert db_module.get_cached_user(alice['id'])['username'] == 'renamed'
+
+    def test_without_the_signal_other_workers_wait_for_the_ttl(self, db_module, alice, monkeypatch):
+        monkeypatch.setattr(db_module, 'USER_CACHE_SIGNAL', False)
+        db_module.get_cached_user(alice['id'])
+        with db_module.get_connection() as conn:
+            conn.execute("UPDATE users SET username = 'renamed' WHERE id = ?", (alice['id'],))
+        assert db_module.get_cached_user(alice['id'])['username'] == 'alice'
+
+
+class TestRequests:
+    def test_logged_in_requests_do_not_query_users(self, client, registered_user):
+        import database as db
+        client.get('/history')  # fills the cache
+        _, queries = _user_queries(db, lambda: client.get('/api/history'))
+        assert queries == []
+
+    def test_profile_change_in_a_unit_of_work_is_seen_next_request(self, client, registered_user):
+        client.get('/account')
+        resp = client.post('/account/profile', data={
+            'username': 'renamed_user', 'email': registered_user['email'],
+            'current_password': registered_user['password'],
+        })
+        assert resp.status_code == 200
+        assert b'renamed_user' in client.get('/account').data